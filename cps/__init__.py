@@ -11,7 +11,7 @@ import sys
 import os
 import mimetypes
 
-from flask import Flask, g, session
+from flask import Flask, g
 from .MyLoginManager import MyLoginManager
 from flask_principal import Principal
 from werkzeug.middleware.proxy_fix import ProxyFix
@@ -247,7 +247,6 @@ def create_app():
         from flask import g, request
         from .cw_login import current_user
         from sqlalchemy import or_
-        import time
 
         if config.config_allow_reverse_proxy_header_login:
             """
@@ -337,29 +336,10 @@ def create_app():
                 g.magic_shelves_access = filtered_shelves
                 log.debug(f"Filtered to {len(filtered_shelves)} visible magic shelves for user {current_user.id}")
 
-                # Magic Shelf Count Caching
-                if 'magic_shelf_counts' not in session:
-                    session['magic_shelf_counts'] = {}
-                
-                counts = session['magic_shelf_counts']
-                cache_updated = False
-                now = time.time()
-                CACHE_DURATION = 300  # 5 minutes
-                
+                # Counts come from the shared magic shelf result cache
+                counts = magic_shelf.get_book_counts_for_magic_shelves(g.magic_shelves_access)
                 for shelf in g.magic_shelves_access:
-                    shelf_id_str = str(shelf.id)
-                    cached_data = counts.get(shelf_id_str)
-                    
-                    if cached_data and (now - cached_data.get('timestamp', 0) < CACHE_DURATION):
-                        shelf.book_count = cached_data['count']
-                    else:
-                        count = magic_shelf.get_book_count_for_magic_shelf(shelf.id)
-                        counts[shelf_id_str] = {'count': count, 'timestamp': now}
-                        shelf.book_count = count
-                        cache_updated = True
-                
-                if cache_updated:
-                    session.modified = True
+                    shelf.book_count = counts.get(shelf.id, 0)
 
                 try:
                     magic_shelf.sort_magic_shelves_for_user(g.magic_shelves_access, current_user)
@@ -48,6 +48,9 @@ from .string_helper import strip_whitespaces
 
 log = logger.create()
 
+# How long a library restore waits for in-flight ingest jobs before going ahead anyway
+RESTORE_INGEST_WAIT_SECONDS = 300
+
 feature_support = {
     'ldap': bool(services.ldap),
     'goodreads': bool(services.goodreads_support),
@@ -3001,12 +3004,24 @@ def restore_calibre_db():
 
         # Pause background services and close active sessions to reduce lock contention
         try:
+            # The ingest daemon holds this lock shared for each running job and starts no new ones
+            # while the restore lock file exists, so wait for the jobs already in flight to finish
             ingest_lock_path = os.path.join(tempfile.gettempdir(), "ingest_processor.lock")
-            ingest_lock = open(ingest_lock_path, "w")
-            fcntl.flock(ingest_lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            ingest_lock = os.fdopen(os.open(ingest_lock_path, os.O_RDWR | os.O_CREAT, 0o644), "r+")
+            service_lock_handles.append(ingest_lock)
+            deadline = time.monotonic() + RESTORE_INGEST_WAIT_SECONDS
+            while True:
+                try:
+                    fcntl.flock(ingest_lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except OSError:
+                    if time.monotonic() >= deadline:
+                        raise
+                    time.sleep(1)
+            ingest_lock.seek(0)
             ingest_lock.write("restore_calibre_db")
+            ingest_lock.truncate()
             ingest_lock.flush()
-            service_lock_handles.append(ingest_lock)
         except Exception as e:
             log.warning("Failed to lock ingest processor: %s", e)
 
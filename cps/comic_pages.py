@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+# Calibre-Web Automated – fork of Calibre-Web
+# Copyright (C) 2018-2026 Calibre-Web contributors
+# Copyright (C) 2024-2026 Calibre-Web Automated contributors
+# SPDX-License-Identifier: GPL-3.0-or-later
+# See CONTRIBUTORS for full list of authors.
+
+"""Page-by-page access to CBZ/CBR/CBT archives for the comic reader.
+
+Opening an archive and sorting its members is the expensive part of serving a single page,
+and for RAR files every open re-runs unrar to list the contents. Opened archives are kept in
+a small LRU together with their sorted page index, keyed by path, mtime and size so a replaced
+file is picked up automatically. Decoded page bytes go into a second, size-bounded LRU and the
+pages around the one just served are read in the background, so turning a page is usually a
+cache hit.
+"""
+
+import hashlib
+import os
+import re
+import tarfile
+import threading
+import zipfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from . import logger
+
+try:
+    import rarfile
+    use_rarfile = True
+except (ImportError, SyntaxError):
+    use_rarfile = False
+
+log = logger.create()
+
+PAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.webp', '.svg'}
+PAGE_MIMETYPES = {'.jpg': 'image/jpeg', '.jpeg': 'image/jpeg', '.png': 'image/png', '.gif': 'image/gif',
+                  '.webp': 'image/webp', '.svg': 'image/svg+xml'}
+
+# Archives kept open at once; each holds a file handle and its member list
+ARCHIVE_CACHE_SIZE = 8
+# Upper bound for decoded pages kept in memory, least recently served are dropped first
+PAGE_CACHE_MAX_BYTES = int(os.environ.get("CWA_COMIC_PAGE_CACHE_MB", "128")) * 1024 * 1024
+# Pages read ahead (and behind) of the one just served
+PREFETCH_AHEAD = 2
+PREFETCH_BEHIND = 1
+
+_archives = OrderedDict()
+_archives_lock = threading.Lock()
+_pages = OrderedDict()
+_pages_bytes = 0
+_pages_lock = threading.Lock()
+_prefetcher = None
+_prefetch_pending = set()
+
+
+def natural_key(name):
+    """Sort key matching the reader's numeric collation, so page 10 follows page 9."""
+    return [int(part) if part.isdigit() else part.lower() for part in re.split(r'(\d+)', name)]
+
+
+def is_page(name):
+    if '__MACOSX' in name:
+        return False
+    return os.path.splitext(name)[1].lower() in PAGE_EXTENSIONS
+
+
+def page_mimetype(name):
+    return PAGE_MIMETYPES.get(os.path.splitext(name)[1].lower(), 'application/octet-stream')
+
+
+class _ComicArchive:
+    """An open archive plus its sorted page members; callers hold `lock` while reading the shared handle
+    and check `closed` first, as an archive evicted from the cache is closed under the same lock."""
+
+    def __init__(self, path, rar_executable=None):
+        self.lock = threading.Lock()
+        self.closed = False
+        self.rar_executable = rar_executable
+        if zipfile.is_zipfile(path):
+            self.handle = zipfile.ZipFile(path)
+            members = [info for info in self.handle.infolist() if not info.is_dir()]
+            self._read = self.handle.read
+            name_of = lambda info: info.filename
+        elif use_rarfile and rarfile.is_rarfile(path):
+            if rar_executable:
+                rarfile.UNRAR_TOOL = rar_executable
+            self.handle = rarfile.RarFile(path)
+            members = [info for info in self.handle.infolist() if not info.is_dir()]
+            self._read = self.handle.read
+            name_of = lambda info: info.filename
+        elif tarfile.is_tarfile(path):
+            self.handle = tarfile.open(path)
+            members = [info for info in self.handle.getmembers() if info.isfile()]
+            self._read = lambda info: self.handle.extractfile(info).read()
+            name_of = lambda info: info.name
+        else:
+            raise ValueError("Unsupported comic archive: {}".format(path))
+        # Member info objects carry the offsets, so a page read seeks straight to its entry
+        members = [info for info in members if is_page(name_of(info))]
+        members.sort(key=lambda info: natural_key(name_of(info)))
+        self.members = members
+        self.names = [name_of(info) for info in members]
+
+    def read(self, index):
+        return self._read(self.members[index])
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            try:
+                self.handle.close()
+            except Exception:
+                pass
+
+
+def _archive_key(path):
+    stat = os.stat(path)
+    return path, stat.st_mtime_ns, stat.st_size
+
+
+def _get_archive(path, rar_executable=None):
+    key = _archive_key(path)
+    with _archives_lock:
+        archive = _archives.get(key)
+        if archive is not None:
+            _archives.move_to_end(key)
+            return key, archive
+    archive = _ComicArchive(path, rar_executable)
+    evicted = []
+    with _archives_lock:
+        if key in _archives:
+            evicted.append(archive)
+            archive = _archives[key]
+        else:
+            _archives[key] = archive
+            while len(_archives) > ARCHIVE_CACHE_SIZE:
+                evicted.append(_archives.popitem(last=False)[1])
+        _archives.move_to_end(key)
+    # Closed outside _archives_lock, as close() waits for a page read in progress on the archive
+    for old in evicted:
+        old.close()
+    return key, archive
+
+
+def page_names(path, rar_executable=None):
+    """Sorted page names of the archive, or None if it cannot be opened."""
+    try:
+        return list(_get_archive(path, rar_executable)[1].names)
+    except Exception as ex:
+        log.error("Could not read comic archive %s: %s", path, ex)
+        return None
+
+
+def page_etag(path, index):
+    """Validator for one page; changes whenever the archive file is replaced."""
+    file_path, mtime_ns, size = _archive_key(path)
+    digest = hashlib.sha1("{}:{}:{}".format(file_path, mtime_ns, size).encode('utf-8')).hexdigest()[:16]
+    return "{}-{}".format(digest, index)
+
+
+def _cached_page(page_key):
+    with _pages_lock:
+        data = _pages.get(page_key)
+        if data is not None:
+            _pages.move_to_end(page_key)
+        return data
+
+
+def _store_page(page_key, data):
+    global _pages_bytes
+    if len(data) > PAGE_CACHE_MAX_BYTES:
+        return
+    with _pages_lock:
+        if page_key in _pages:
+            return
+        _pages[page_key] = data
+        _pages_bytes += len(data)
+        while _pages_bytes > PAGE_CACHE_MAX_BYTES:
+            _, evicted = _pages.popitem(last=False)
+            _pages_bytes -= len(evicted)
+
+
+def _load_page(key, archive, index):
+    page_key = key + (index,)
+    data = _cached_page(page_key)
+    if data is None:
+        with archive.lock:
+            # The prefetcher may have read this page while we waited for the handle
+            data = _cached_page(page_key)
+            if data is None and not archive.closed:
+                data = archive.read(index)
+                _store_page(page_key, data)
+        if data is None:
+            # The archive was evicted from the cache and closed in the meantime
+            key, archive = _get_archive(key[0], archive.rar_executable)
+            return _load_page(key, archive, index)
+    return data
+
+
+def _prefetch(key, archive, index):
+    try:
+        _load_page(key, archive, index)
+    except Exception as ex:
+        log.debug("Prefetching page %d of %s failed: %s", index, key[0], ex)
+    finally:
+        with _pages_lock:
+            _prefetch_pending.discard(key + (index,))
+
+
+def _schedule_prefetch(key, archive, index):
+    global _prefetcher
+    wanted = list(range(index + 1, index + 1 + PREFETCH_AHEAD)) + list(range(index - PREFETCH_BEHIND, index))
+    for page in wanted:
+        if not 0 <= page < len(archive.names):
+            continue
+        page_key = key + (page,)
+        with _pages_lock:
+            if page_key in _pages or page_key in _prefetch_pending:
+                continue
+            _prefetch_pending.add(page_key)
+            if _prefetcher is None:
+                _prefetcher = ThreadPoolExecutor(max_workers=1, thread_name_prefix="comic-prefetch")
+        _prefetcher.submit(_prefetch, key, archive, page)
+
+
+def read_page(path, index, rar_executable=None, prefetch=True):
+    """Return (bytes, name) of a page and warm the cache with its neighbours.
+
+    Raises IndexError for a page outside the archive."""
+    key, archive = _get_archive(path, rar_executable)
+    if not 0 <= index < len(archive.names):
+        raise IndexError(index)
+    data = _load_page(key, archive, index)
+    if prefetch:
+        _schedule_prefetch(key, archive, index)
+    return data, archive.names[index]
+
+
+def clear():
+    """Drop all cached archives and pages."""
+    global _pages_bytes
+    with _archives_lock:
+        archives = list(_archives.values())
+        _archives.clear()
+    for archive in archives:
+        archive.close()
+    with _pages_lock:
+        _pages.clear()
+        _pages_bytes = 0
@@ -187,6 +187,7 @@ NIGHTLY_VERSION[1] = '2024-11-16T07:21:28+01:00'
 
 # CACHE
 CACHE_TYPE_THUMBNAILS    = 'thumbnails'
+CACHE_TYPE_EXPORTS       = 'exports'
 
 # Thumbnail Types
 THUMBNAIL_TYPE_COVER     = 1
@@ -8,6 +8,7 @@ from flask import Blueprint, redirect, flash, url_for, request, send_from_direct
 from flask_babel import gettext as _, lazy_gettext as _l
 
 from . import logger, config, constants, csrf, helper, ub, calibre_db
+from .db import CalibreDB
 from .usermanagement import login_required_if_no_ano, user_login_required
 from .admin import admin_required
 from .render_template import render_title_template
@@ -22,8 +23,9 @@ import json
 from threading import Thread, Lock, Timer
 import queue
 import os
+import stat
 import tempfile
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import re
 import shutil
 import base64
@@ -58,6 +60,16 @@ log = logger.create()
 # Folder where the log files are stored
 LOG_ARCHIVE = "/config/log_archive"
 DIRS_JSON = "/app/calibre-web-automated/dirs.json"
+# FIFO read by the long-lived ingest worker started by cwa-ingest-service
+INGEST_FIFO = os.environ.get("CWA_INGEST_FIFO", "/config/cwa_ingest.fifo")
+# Web uploads jump ahead of bulk folder drops in the ingest queue
+INGEST_PRIORITY_UPLOAD = 10
+
+# Coalesced "library changed" refresh (web process). The first notification starts the timer,
+# any arriving before it fires are folded into the same refresh
+LIBRARY_REFRESH_COALESCE_SECONDS = 2
+_library_refresh_timer = None
+_library_refresh_lock = Lock()
 
 # Debounced duplicate scan timer (web process)
 _duplicate_scan_timer = None
@@ -207,24 +219,71 @@ def get_ingest_status():
         return {'state': 'unknown', 'filename': '', 'timestamp': '', 'detail': ''}
 
 def get_ingest_queue_size():
-    """Get the number of files in the retry queue"""
+    """Get the number of files waiting for or being processed by the ingest worker"""
     try:
-        with open('/config/cwa_ingest_retry_queue', 'r') as f:
-            return len([line for line in f if line.strip()])
-    except (FileNotFoundError, IOError):
+        return CWA_DB().ingest_queue_depth()
+    except Exception as e:
+        log.error(f"Failed to read ingest queue depth: {e}")
         return 0
 
+def is_ingest_worker_listening() -> bool:
+    """True when the ingest service holds the read end of the FIFO, not merely when the FIFO exists"""
+    try:
+        if not stat.S_ISFIFO(os.stat(INGEST_FIFO).st_mode):
+            return False
+        # Non-blocking open fails with ENXIO when nobody holds the read end, e.g. a stale FIFO
+        # left behind after CWA_INGEST_DAEMON was turned off
+        os.close(os.open(INGEST_FIFO, os.O_WRONLY | os.O_NONBLOCK))
+        return True
+    except OSError:
+        return False
+
+def queue_upload_for_ingest(path: str) -> None:
+    """Give a web upload priority over bulk drops in the durable ingest queue.
+
+    The watcher still reports the file as usual; re-queueing keeps the higher priority.
+    """
+    if not is_ingest_worker_listening():
+        return
+    try:
+        CWA_DB().ingest_queue_add(path, priority=INGEST_PRIORITY_UPLOAD, source='upload')
+    except Exception as e:
+        log.error(f"Failed to prioritise {path} in the ingest queue: {e}")
+
+def submit_to_ingest_worker(path: str) -> bool:
+    """Hand a path to the long-lived ingest worker. Returns False when no worker is listening."""
+    if not is_ingest_worker_listening():
+        return False
+    try:
+        # Non-blocking open fails with ENXIO instead of hanging when nobody holds the read end
+        fd = os.open(INGEST_FIFO, os.O_WRONLY | os.O_NONBLOCK)
+    except OSError:
+        return False
+    try:
+        os.write(fd, (path + "\n").encode('utf-8', 'surrogateescape'))
+        return True
+    except OSError as e:
+        log.error(f"Failed to hand {path} to the ingest worker: {e}")
+        return False
+    finally:
+        os.close(fd)
+
 def refresh_library(app):
     with app.app_context():  # Create app context for session
         ingest_dir = get_ingest_dir()
-        result = subprocess.run(['python3', '/app/calibre-web-automated/scripts/ingest_processor.py', ingest_dir])
-        return_code = result.returncode
+        if submit_to_ingest_worker(ingest_dir):
+            return_code = None
+        else:
+            result = subprocess.run(['python3', '/app/calibre-web-automated/scripts/ingest_processor.py', ingest_dir])
+            return_code = result.returncode
 
         # Add empty list for messages in app context if a list doesn't already exist
         if "library_refresh_messages" not in current_app.config:
             current_app.config["library_refresh_messages"] = []
 
-        if return_code == 2:
+        if return_code is None:
+            message = _l("Library Refresh 🔄 Missed books handed to the ingest service, they will appear shortly ✅")
+        elif return_code == 2:
             message = _l("Library Refresh 🔄 The book ingest service is already running ✋ Please wait until it has finished before trying again ⌛")
         elif return_code == 0:
             message = _l("Library Refresh 🔄 Library refreshed & ingest process complete! ✅")
@@ -251,6 +310,21 @@ def cwa_library_refresh():
 
     return jsonify({"message": _("Library Refresh 🔄 Checking for any books that may have been missed, please wait...")}), 200
 
+@library_refresh.route("/cwa-ingest-status", methods=["GET"])
+@login_required_if_no_ano
+def cwa_ingest_status():
+    """Queue depth and throughput of the ingest worker as JSON"""
+    try:
+        queue_stats = CWA_DB().ingest_queue_stats()
+    except Exception as e:
+        log.error(f"Failed to read ingest queue stats: {e}")
+        return jsonify({"error": str(e)}), 500
+    return jsonify({
+        "status": get_ingest_status(),
+        "worker_listening": is_ingest_worker_listening(),
+        "queue": queue_stats,
+    })
+
 @csrf.exempt
 @library_refresh.route("/cwa-library-refresh/messages", methods=["GET"])
 @login_required_if_no_ano
@@ -550,6 +624,51 @@ def cwa_internal_reconnect_db():
         log.error(f"Internal reconnect-db failed: {e}")
         return jsonify({"error": str(e)}), 400
 
+def _run_library_refresh():
+    global _library_refresh_timer
+    with _library_refresh_lock:
+        _library_refresh_timer = None
+    try:
+        # A bare CalibreDB handle: the refresh works on class-level state and shouldn't add a session
+        rebuilt = CalibreDB().notify_library_changed(config, ub.app_DB_path)
+        log.debug("Library change applied (%s)", "schema rebuilt" if rebuilt else "sessions expired")
+    except Exception as e:
+        log.error(f"Library change refresh failed: {e}")
+
+
+def schedule_library_refresh():
+    """Queue a coalesced library refresh. Returns False if one was already pending."""
+    global _library_refresh_timer
+    with _library_refresh_lock:
+        if _library_refresh_timer is not None:
+            return False
+        _library_refresh_timer = Timer(LIBRARY_REFRESH_COALESCE_SECONDS, _run_library_refresh)
+        _library_refresh_timer.daemon = True
+        _library_refresh_timer.start()
+        return True
+
+
+@csrf.exempt
+@cwa_internal.route('/cwa-internal/library-changed', methods=["POST"])
+def cwa_internal_library_changed():
+    """Tell the web process metadata.db was changed by another process (e.g. an ingest).
+
+    Unlike /cwa-internal/reconnect-db this keeps the engine and sessions; see
+    CalibreDB.notify_library_changed. Bursts of notifications are coalesced into one refresh.
+
+    Security: Only accepts localhost callers.
+    """
+    try:
+        remote = request.headers.get('X-Forwarded-For', request.remote_addr)
+        if remote not in (None, '127.0.0.1', '::1'):
+            abort(403)
+
+        queued = schedule_library_refresh()
+        return jsonify({"status": "queued" if queued else "coalesced"}), 200
+    except Exception as e:
+        log.error(f"Internal library-changed failed: {e}")
+        return jsonify({"error": str(e)}), 400
+
 @csrf.exempt
 @cwa_stats.route('/cwa-scheduled/cancel', methods=["POST"])
 @login_required_if_no_ano
@@ -952,6 +1071,22 @@ def get_cwa_stats() -> dict[str,int]:
 
     return totals
 
+def get_enforcer_stats() -> dict | None:
+    """Queue depth and throughput of the long-lived cover & metadata enforcer, None if it never ran"""
+    status = CWA_DB().get_enforcer_status()
+    if not status or not status['started_at']:
+        return None
+    done = (status['processed'] or 0) + (status['failed'] or 0)
+    stats = dict(status, books_per_minute=None, avg_seconds=None)
+    try:
+        elapsed = (datetime.now(timezone.utc) - datetime.fromisoformat(status['started_at'])).total_seconds()
+    except (TypeError, ValueError):
+        elapsed = 0
+    if done and elapsed > 0:
+        stats['books_per_minute'] = round(done / elapsed * 60, 2)
+        stats['avg_seconds'] = round((status['busy_seconds'] or 0) / done, 1)
+    return stats
+
 ### TABLE HEADERS
 headers = {
     "enforcement":{
@@ -1034,6 +1169,7 @@ def cwa_stats_show():
         date_range_label = "Last 30 days"
     
     cwa_db = CWA_DB()
+    cwa_db.flush_activity()
     
     # Get list of active users for dropdown (resolve names via app.db)
     active_users_raw = cwa_db.get_active_users()
@@ -1218,6 +1354,7 @@ def cwa_stats_show():
                                 active_users=active_users,
                                 selected_user_id=user_id,
                                 cwa_stats=get_cwa_stats(),
+                                enforcer_stats=get_enforcer_stats(),
                                 hardcover_stats=hardcover_stats,
                                 data_enforcement=data_enforcement, headers_enforcement=headers["enforcement"]["no_paths"], 
                                 data_enforcement_with_paths=data_enforcement_with_paths, headers_enforcement_with_paths=headers["enforcement"]["with_paths"], 
@@ -1249,6 +1386,7 @@ def export_stats_csv(tab_name):
         days = int(days_param) if days_param else 30
     
     cwa_db = CWA_DB()
+    cwa_db.flush_activity()
     output = StringIO()
     writer = csv.writer(output)
     
@@ -1764,9 +1902,36 @@ def empty_tmp_con_dir(tmp_conversion_dir) -> None:
             file_path = os.path.join(tmp_conversion_dir, file)
             if os.path.isfile(file_path):
                 os.remove(file_path)
+            elif file.startswith("worker-") and os.path.isdir(file_path):
+                # Per-worker dirs left behind by a cancelled convert-library run
+                shutil.rmtree(file_path, ignore_errors=True)
     except Exception as e:
         print(f"[cwa-functions]: An error occurred while emptying {tmp_conversion_dir}. See the following error: {e}")
 
+def convert_library_run_stats(state) -> dict | None:
+    """Throughput and ETA of a convert-library run, measured over the books done since it (re)started"""
+    if not state or state['status'] == 'idle' or not state['started_at']:
+        return None
+    done = (state['converted'] or 0) + (state['failed'] or 0)
+    stats = {'status': state['status'],
+             'workers': state['workers'],
+             'converted': state['converted'] or 0,
+             'failed': state['failed'] or 0,
+             'total': state['total'] or 0,
+             'books_per_minute': None,
+             'eta_seconds': None}
+    try:
+        elapsed = (datetime.fromisoformat(state['updated_at']) - datetime.fromisoformat(state['started_at'])).total_seconds()
+    except (TypeError, ValueError):
+        return stats
+    processed = done - (state['processed_at_start'] or 0)
+    if processed > 0 and elapsed > 0:
+        rate = processed / elapsed
+        stats['books_per_minute'] = round(rate * 60, 1)
+        if state['status'] == 'running':
+            stats['eta_seconds'] = round(max(stats['total'] - done, 0) / rate)
+    return stats
+
 def is_convert_library_finished() -> bool:
     log_path = "/config/convert-library.log"
     with open(log_path, 'r') as log:
@@ -1894,7 +2059,8 @@ def get_status():
         status = f.read()
     progress = extract_progress(status)
     statusList = {'status':status,
-                  'progress':progress}
+                  'progress':progress,
+                  'stats':convert_library_run_stats(CWA_DB().get_convert_library_state())}
     return json.dumps(statusList)
 
 
@@ -2091,7 +2257,8 @@ def get_status():
         status = f.read()
     progress = extract_progress(status)
     statusList = {'status':status,
-                  'progress':progress}
+                  'progress':progress,
+                  'stats':convert_library_run_stats(CWA_DB().get_convert_library_state())}
     return json.dumps(statusList)
 
 
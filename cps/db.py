@@ -18,7 +18,7 @@ from uuid import uuid4
 
 from sqlite3 import OperationalError as sqliteOperationalError
 import sqlite3
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy import Table, Column, ForeignKey, CheckConstraint
 from sqlalchemy import String, Integer, Boolean, TIMESTAMP, Float
 from sqlalchemy.orm import relationship, sessionmaker, scoped_session, joinedload, object_session
@@ -31,14 +31,14 @@ try:
 except ImportError:
     from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.pool import StaticPool
-from sqlalchemy.sql.expression import and_, true, false, text, func, or_
+from sqlalchemy.sql.expression import and_, true, false, text, func, or_, select, case, bindparam
 from sqlalchemy.ext.associationproxy import association_proxy
 from .cw_login import current_user
 from flask_babel import gettext as _
 from flask_babel import get_locale
 from flask import flash
 
-from . import logger, ub, isoLanguages
+from . import logger, ub, isoLanguages, search_index
 from .pagination import Pagination
 from .string_helper import strip_whitespaces
 
@@ -553,11 +553,26 @@ class CalibreDB:
     # instances alive once they reach the end of their respective scopes
     instances = WeakSet()
     _reconnect_lock = threading.RLock()  # Reentrant lock to prevent concurrent reconnect operations
+    # Bumped whenever metadata.db was changed behind our back (e.g. by the ingest processor);
+    # sessions expire their identity map the next time they are used after a bump
+    library_generation = 0
+    # (id, datatype) of the custom columns the ORM classes were built from
+    _cc_signature = None
+    # Per-user visibility filters (language, tag and custom column restrictions), see _visibility_filter
+    _visibility_cache = dict()
+    _visibility_lock = threading.Lock()
+    _commit_count = 0  # commits of calibre sessions in this process
+    # Dedicated connection used only to poll PRAGMA data_version, see refresh_if_changed
+    _data_version_lock = threading.Lock()
+    _data_version_con = None
+    _data_version_key = None
+    _data_version_seen = None
 
     def __init__(self, expire_on_commit=True, init=False):
         """ Initialize a new CalibreDB session
         """
         self.session = None
+        self._generation = CalibreDB.library_generation
         if init:
             self.init_db(expire_on_commit)
 
@@ -573,6 +588,7 @@ class CalibreDB:
             return
         self.session = self.session_factory()
         self.session.expire_on_commit = expire_on_commit
+        self._generation = CalibreDB.library_generation
         self.create_functions(self.config)
 
     def ensure_session(self, expire_on_commit=True):
@@ -581,7 +597,14 @@ class CalibreDB:
         Holds lock during entire recreation to prevent race conditions.
         """
         if self.session is not None:
-            return  # Fast path - session already exists
+            # Fast path - session already exists; drop cached rows if the library changed since last use
+            if self._generation != CalibreDB.library_generation:
+                self._generation = CalibreDB.library_generation
+                try:
+                    self.session.expire_all()
+                except Exception:
+                    pass
+            return
         
         # Session is None - need to recreate it
         # Acquire lock to ensure atomic recreation (no interruption by dispose)
@@ -768,6 +791,7 @@ class CalibreDB:
 
             db_writable = os.access(dbpath, os.W_OK)
 
+            search_db = search_index.configure(dbpath, search_index.index_path(app_db_path))
             try:
                 cls.engine = create_engine('sqlite://',
                                            echo=False,
@@ -777,6 +801,8 @@ class CalibreDB:
                 with cls.engine.begin() as connection:
                     connection.execute(text("attach database '{}' as calibre;".format(dbpath)))
                     connection.execute(text("attach database '{}' as app_settings;".format(app_db_path)))
+                    if search_db:
+                        connection.execute(text("attach database '{}' as search_index;".format(search_db)))
                     # Try enabling WAL to improve concurrency unless running on a network share
                     # Controlled by env var NETWORK_SHARE_MODE (default False)
                     try:
@@ -804,7 +830,8 @@ class CalibreDB:
 
             if not cc_classes:
                 try:
-                    cc = conn.execute(text("SELECT id, datatype FROM custom_columns"))
+                    cc = conn.execute(text("SELECT id, datatype FROM custom_columns ORDER BY id")).fetchall()
+                    cls._cc_signature = tuple((row.id, row.datatype) for row in cc)
                     cls.setup_db_cc_classes(cc)
                 except OperationalError as e:
                     log.error_or_exception(e)
@@ -822,6 +849,11 @@ class CalibreDB:
             cls.session_factory = scoped_session(sessionmaker(autocommit=False,
                                                               autoflush=True,
                                                               bind=cls.engine, future=True))
+            event.listen(cls.session_factory.session_factory, "after_commit", cls._count_commit)
+            # The new connection restarts data_version, so no stamp taken before may match a later one
+            cls.library_generation += 1
+            with cls._visibility_lock:
+                cls._visibility_cache.clear()
             for inst in cls.instances:
                 inst.init_session()
 
@@ -921,25 +953,34 @@ class CalibreDB:
             log.error("Database error: {}".format(e))
 
     # Language and content filters for displaying in the UI
+    @classmethod
+    def _count_commit(cls, session):
+        cls._commit_count += 1
+
     def common_filters(self, allow_show_archived=False, return_all_languages=False, viewing_tag_id=None):
         if not allow_show_archived:
-            archived_books = (ub.session.query(ub.ArchivedBook)
-                              .filter(ub.ArchivedBook.user_id==int(current_user.id))
-                              .filter(ub.ArchivedBook.is_archived==True)
-                              .all())
-            archived_book_ids = [archived_book.book_id for archived_book in archived_books]
-            archived_filter = Books.id.notin_(archived_book_ids)
+            # app.db is attached to the calibre connection, so this stays a subquery instead of an id list
+            archived_filter = Books.id.notin_(select(ub.ArchivedBook.book_id)
+                                              .where(ub.ArchivedBook.user_id == int(current_user.id))
+                                              .where(ub.ArchivedBook.is_archived == True))
         else:
             archived_filter = true()
 
+        restrictions = self.visibility_key(return_all_languages, viewing_tag_id)
+        if restrictions is None:
+            return archived_filter
+        return and_(self._visibility_filter(*restrictions), archived_filter)
+
+    def visibility_key(self, return_all_languages=False, viewing_tag_id=None):
+        """The current user's language, tag and custom column restrictions as a hashable tuple,
+        or None if they may see the whole library. Archived books are not part of it."""
         if current_user.filter_language() == "all" or return_all_languages:
-            lang_filter = true()
+            lang_code = None
         else:
-            lang_filter = Books.languages.any(Languages.lang_code == current_user.filter_language())
+            lang_code = current_user.filter_language()
         negtags_list = current_user.list_denied_tags()
         postags_list = current_user.list_allowed_tags()
-        neg_content_tags_filter = false() if negtags_list == [''] else Books.tags.any(Tags.name.in_(negtags_list))
-        
+
         # Issue #906: When viewing a specific tag category, include that tag in allowed tags
         if viewing_tag_id is not None and postags_list != ['']:
             # Get the tag name for the viewing_tag_id
@@ -947,15 +988,38 @@ class CalibreDB:
             if viewing_tag and viewing_tag.name not in postags_list:
                 # Temporarily add the viewed tag to the allowed list for this query
                 postags_list = postags_list + [viewing_tag.name]
-        
+
+        if self.config.config_restricted_column:
+            pos_cc_list = (current_user.allowed_column_value or '').split(',')
+            neg_cc_list = (current_user.denied_column_value or '').split(',')
+        else:
+            pos_cc_list = neg_cc_list = ['']
+
+        if lang_code is None and postags_list == [''] and negtags_list == [''] \
+                and pos_cc_list == [''] and neg_cc_list == ['']:
+            return None
+        return lang_code, tuple(postags_list), tuple(negtags_list), tuple(pos_cc_list), tuple(neg_cc_list)
+
+    def library_change_stamp(self):
+        """Changes whenever metadata.db may have changed: written by another process (data_version),
+        committed through a calibre session of this process, or reported by the ingest processor."""
+        try:
+            data_version = self.session.execute(text("PRAGMA calibre.data_version")).scalar()
+        except OperationalError:
+            data_version = None
+        return data_version, CalibreDB._commit_count, CalibreDB.library_generation
+
+    def _restriction_filter(self, lang_code, postags_list, negtags_list, pos_cc_list, neg_cc_list):
+        postags_list, negtags_list, pos_cc_list, neg_cc_list = \
+            list(postags_list), list(negtags_list), list(pos_cc_list), list(neg_cc_list)
+        lang_filter = true() if lang_code is None else Books.languages.any(Languages.lang_code == lang_code)
+        neg_content_tags_filter = false() if negtags_list == [''] else Books.tags.any(Tags.name.in_(negtags_list))
         pos_content_tags_filter = true() if postags_list == [''] else Books.tags.any(Tags.name.in_(postags_list))
         if self.config.config_restricted_column:
             try:
-                pos_cc_list = current_user.allowed_column_value.split(',')
                 pos_content_cc_filter = true() if pos_cc_list == [''] else \
                     getattr(Books, 'custom_column_' + str(self.config.config_restricted_column)). \
                     any(cc_classes[self.config.config_restricted_column].value.in_(pos_cc_list))
-                neg_cc_list = current_user.denied_column_value.split(',')
                 neg_content_cc_filter = false() if neg_cc_list == [''] else \
                     getattr(Books, 'custom_column_' + str(self.config.config_restricted_column)). \
                     any(cc_classes[self.config.config_restricted_column].value.in_(neg_cc_list))
@@ -967,12 +1031,49 @@ class CalibreDB:
                 flash(_("Custom Column No.%(column)d does not exist in calibre database",
                         column=self.config.config_restricted_column),
                       category="error")
-
+                return None
         else:
             pos_content_cc_filter = true()
             neg_content_cc_filter = false()
         return and_(lang_filter, pos_content_tags_filter, ~neg_content_tags_filter,
-                    pos_content_cc_filter, ~neg_content_cc_filter, archived_filter)
+                    pos_content_cc_filter, ~neg_content_cc_filter)
+
+    def _visibility_filter(self, lang_code, postags_list, negtags_list, pos_cc_list, neg_cc_list):
+        """Filter on Books.id for a restricted user, backed by the cached set of books they may see.
+
+        The restrictions are evaluated once (one pass over the library) and the result is kept
+        until they change or metadata.db is written, by this process or any other. Every query
+        then only checks the book id against that set, which SQLite builds once per statement,
+        instead of running the tag/language/custom column EXISTS subqueries for each row.
+        """
+        restrictions = (lang_code, postags_list, negtags_list, pos_cc_list, neg_cc_list,
+                        self.config.config_restricted_column)
+        stamp = (restrictions, self.library_change_stamp())
+        with CalibreDB._visibility_lock:
+            cached = CalibreDB._visibility_cache.get(restrictions)
+        if cached is not None and cached[0] == stamp:
+            return self._id_set_filter(*cached[1])
+
+        restriction_filter = self._restriction_filter(lang_code, postags_list, negtags_list, pos_cc_list,
+                                                      neg_cc_list)
+        if restriction_filter is None:
+            return false()
+        visible, hidden = list(), list()
+        for book_id, allowed in self.session.query(Books.id, case((restriction_filter, 1), else_=0)):
+            (visible if allowed else hidden).append(book_id)
+        # Whichever list is shorter is sent to SQLite
+        id_set = (True, json.dumps(visible)) if len(visible) <= len(hidden) else (False, json.dumps(hidden))
+        with CalibreDB._visibility_lock:
+            if len(CalibreDB._visibility_cache) > 256:
+                CalibreDB._visibility_cache.clear()
+            CalibreDB._visibility_cache[restrictions] = (stamp, id_set)
+        return self._id_set_filter(*id_set)
+
+    @staticmethod
+    def _id_set_filter(include, ids_json):
+        ids = text("SELECT value FROM json_each(:ids)").bindparams(bindparam("ids", ids_json, unique=True))\
+            .columns(value=Integer)
+        return Books.id.in_(ids) if include else Books.id.notin_(ids)
 
     def generate_linked_query(self, config_read_column, database):
         # Safety: session can be briefly None during DB reconnects
@@ -1080,37 +1181,16 @@ class CalibreDB:
         return entries, randm, pagination
 
     # Orders all Authors in the list according to authors sort
+    # All authors named in the entries' author_sort are loaded with one query per 500 names and
+    # matched in memory, instead of one query per author per entry
     def order_authors(self, entries, list_return=False, combined=False):
         self.ensure_session()
-        for entry in entries:
-            if combined:
-                sort_authors = entry.Books.author_sort.split('&')
-                ids = [a.id for a in entry.Books.authors]
-
-            else:
-                sort_authors = entry.author_sort.split('&')
-                ids = [a.id for a in entry.authors]
-            authors_ordered = list()
-            # error = False
-            for auth in sort_authors:
-                auth = strip_whitespaces(auth)
-                # Skip empty author strings to prevent spurious errors
-                if not auth:
-                    continue
-                results = self.session.query(Authors).filter(Authors.sort == auth).all()
-                # ToDo: How to handle not found author name
-                if not len(results):
-                    log.error("Author '{}' not found to display name in right order".format(auth))
-                    # error = True
-                    break
-                for r in results:
-                    if r.id in ids:
-                        authors_ordered.append(r)
-                        ids.remove(r.id)
-            for author_id in ids:
-                result = self.session.query(Authors).filter(Authors.id == author_id).first()
-                authors_ordered.append(result)
-
+        books = [entry.Books if combined else entry for entry in entries]
+        if not list_return:
+            books = books[:1]
+        authors_by_sort = self._authors_by_sort(books)
+        for entry, book in zip(entries, books):
+            authors_ordered = self._ordered_book_authors(book, authors_by_sort)
             if list_return:
                 if combined:
                     entry.Books.authors = authors_ordered
@@ -1120,6 +1200,77 @@ class CalibreDB:
                 return authors_ordered
         return entries
 
+    def _authors_by_sort(self, books):
+        sort_names = set()
+        for book in books:
+            for auth in (book.author_sort or '').split('&'):
+                auth = strip_whitespaces(auth)
+                if auth:
+                    sort_names.add(auth)
+        authors_by_sort = dict()
+        sort_names = list(sort_names)
+        for start in range(0, len(sort_names), 500):
+            for author in (self.session.query(Authors)
+                           .filter(Authors.sort.in_(sort_names[start:start + 500]))
+                           .order_by(Authors.id)):
+                authors_by_sort.setdefault(author.sort, []).append(author)
+        return authors_by_sort
+
+    @staticmethod
+    def _ordered_book_authors(book, authors_by_sort):
+        remaining = {a.id: a for a in book.authors}
+        authors_ordered = list()
+        for auth in (book.author_sort or '').split('&'):
+            auth = strip_whitespaces(auth)
+            # Skip empty author strings to prevent spurious errors
+            if not auth:
+                continue
+            results = authors_by_sort.get(auth)
+            # ToDo: How to handle not found author name
+            if not results:
+                log.error("Author '{}' not found to display name in right order".format(auth))
+                break
+            for r in results:
+                if r.id in remaining:
+                    authors_ordered.append(remaining.pop(r.id))
+        authors_ordered.extend(remaining.values())
+        return authors_ordered
+
+    def existing_author_sorts(self, author_sorts):
+        """The author sort names used in the author_sort strings that exist in the library"""
+        sort_names = set()
+        for author_sort in author_sorts:
+            for auth in (author_sort or '').split('&'):
+                auth = strip_whitespaces(auth)
+                if auth:
+                    sort_names.add(auth)
+        existing = set()
+        sort_names = list(sort_names)
+        for start in range(0, len(sort_names), 500):
+            existing.update(row[0] for row in self.session.query(Authors.sort)
+                            .filter(Authors.sort.in_(sort_names[start:start + 500])))
+        return existing
+
+    @staticmethod
+    def first_author(author_sort, authors, known_sorts):
+        """Name of the author order_authors() puts first, without loading Authors objects
+
+        authors are the book's (id, name, sort) rows in link order, known_sorts the result of
+        existing_author_sorts() for (at least) this book.
+        """
+        if not authors:
+            return None
+        for auth in (author_sort or '').split('&'):
+            auth = strip_whitespaces(auth)
+            if not auth:
+                continue
+            if auth not in known_sorts:
+                break
+            matches = [author for author in authors if author[2] == auth]
+            if matches:
+                return min(matches)[1]
+        return authors[0][1]
+
     def get_typeahead(self, database, query, replace=('', ''), tag_filter=true()):
         self.ensure_session()
         query = query or ''
@@ -1144,14 +1295,14 @@ class CalibreDB:
             .filter(and_(Books.authors.any(and_(*q)), func.lower(Books.title).ilike("%" + title + "%"))).first()
 
     def search_query(self, term, config, *join):
+        # Eagerly load the data relationship to prevent session errors
+        return self._search_base_query(term, config, *join).options(joinedload(Books.data))
+
+    def _search_base_query(self, term, config, *join, ranked=False):
         self.ensure_session()
-        strip_whitespaces(term).lower()
+        term = strip_whitespaces(term)
         self.create_functions()
         # self.session.connection().connection.connection.create_function("lower", 1, lcase)
-        q = list()
-        author_terms = re.split("[, ]+", term)
-        for author_term in author_terms:
-            q.append(Books.authors.any(func.lower(Authors.name).ilike("%" + author_term + "%")))
         query = self.generate_linked_query(config.config_read_column, Books)
         if len(join) == 6:
             query = query.outerjoin(join[0], join[1]).outerjoin(join[2]).outerjoin(join[3], join[4]).outerjoin(join[5])
@@ -1163,21 +1314,73 @@ class CalibreDB:
             query = query.outerjoin(join[0])
 
         cc = self.get_cc_columns(config, filter_config_custom_read=True)
+        cc = [c for c in cc if c.datatype not in ["datetime", "rating", "bool", "int", "float"]]
+        indexed = self._search_index_filter(term, cc)
+        if indexed is not None:
+            search_filter, hits = indexed
+            query = query.filter(self.common_filters(True)).filter(search_filter)
+            if ranked:
+                query = query.outerjoin(hits, hits.c.book == Books.id).order_by(func.coalesce(hits.c.score, 0.0))
+            return query
+
+        q = list()
+        author_terms = re.split("[, ]+", term)
+        for author_term in author_terms:
+            q.append(Books.authors.any(func.lower(Authors.name).ilike("%" + author_term + "%")))
         filter_expression = [Books.tags.any(func.lower(Tags.name).ilike("%" + term + "%")),
                              Books.series.any(func.lower(Series.name).ilike("%" + term + "%")),
                              Books.authors.any(and_(*q)),
                              Books.publishers.any(func.lower(Publishers.name).ilike("%" + term + "%")),
                              func.lower(Books.title).ilike("%" + term + "%")]
         for c in cc:
-            if c.datatype not in ["datetime", "rating", "bool", "int", "float"]:
-                filter_expression.append(
-                    getattr(Books,
-                            'custom_column_' + str(c.id)).any(
-                        func.lower(cc_classes[c.id].value).ilike("%" + term + "%")))
-        # Eagerly load the data relationship to prevent session errors
-        query = query.options(joinedload(Books.data))
+            filter_expression.append(
+                getattr(Books,
+                        'custom_column_' + str(c.id)).any(
+                    func.lower(cc_classes[c.id].value).ilike("%" + term + "%")))
         return query.filter(self.common_filters(True)).filter(or_(*filter_expression))
 
+    @staticmethod
+    def _search_index_filter(term, cc):
+        """Filter on Books.id answering `term` from the full-text index plus a (book, score)
+        subquery for ranking, or None when the ilike search has to be used."""
+        expressions = search_index.match_expressions(term)
+        if expressions is None or not search_index.sync():
+            return None
+        fields, authors, short_words = expressions
+        weights = search_index.RANK_WEIGHTS
+        selects = ["SELECT rowid AS book, bm25(books_fts, {}) AS score FROM search_index.books_fts "
+                   "WHERE books_fts MATCH :fields".format(weights)]
+        params = {"fields": fields}
+        cc_ids = [int(c.id) for c in cc if c.datatype in search_index.TEXT_CC_DATATYPES]
+        if cc_ids:
+            selects.append("SELECT rowid >> {shift} AS book, 0.0 AS score FROM search_index.custom_fts "
+                           "WHERE custom_fts MATCH :custom AND (rowid & {mask}) IN ({ids})"
+                           .format(shift=search_index.CC_SHIFT, mask=(1 << search_index.CC_SHIFT) - 1,
+                                   ids=",".join(str(cc_id) for cc_id in cc_ids)))
+            params["custom"] = search_index.custom_match(term)
+        # Each authors_fts row is one author, so all words have to match the same author
+        author_select = ("SELECT rowid >> {} AS book, {} * bm25(authors_fts) AS score FROM search_index.authors_fts "
+                         "WHERE authors_fts MATCH :authors".format(search_index.CC_SHIFT, search_index.AUTHOR_WEIGHT))
+        author_filter = None
+        if authors and not short_words:
+            selects.append(author_select)
+            params["authors"] = authors
+        else:
+            # Words too short for the trigram index are checked against the authors directly, together
+            # with the long ones so they all have to match one author
+            author_filter = Books.authors.any(and_(*[func.lower(Authors.name).ilike("%" + word + "%")
+                                                     for word in re.split("[, ]+", term) if word]))
+            if authors:
+                author_hits = text("SELECT book FROM ({})".format(author_select))\
+                    .bindparams(authors=authors).columns(book=Integer)
+                author_filter = and_(Books.id.in_(author_hits), author_filter)
+        hits = text("SELECT book, min(score) AS score FROM ({}) GROUP BY book".format(" UNION ALL ".join(selects)))\
+            .bindparams(**params).columns(book=Integer, score=Float).subquery("search_hits")
+        search_filter = Books.id.in_(select(hits.c.book))
+        if author_filter is not None:
+            search_filter = or_(search_filter, author_filter)
+        return search_filter, hits
+
     def get_cc_columns(self, config, filter_config_custom_read=False):
         self.ensure_session()
         tmp_cc = self.session.query(CustomColumns).filter(CustomColumns.datatype.notin_(cc_exceptions)).all()
@@ -1196,12 +1399,13 @@ class CalibreDB:
         return cc
 
     # read search results from calibre-database and return it (function is used for feed and simple search
+    # Only the ids of all hits are read (ranked by relevance when no order is given), then the requested page
     def get_search_results(self, term, config, offset=None, order=None, limit=None, *join):
         self.ensure_session()
+        query = self._search_base_query(term, config, *join, ranked=not order)
         order = order[0] if order else [Books.sort]
-        pagination = None
-        result = self.search_query(term, config, *join).order_by(*order).all()
-        result_count = len(result)
+        ids = list(dict.fromkeys(row[0] for row in query.with_entities(Books.id).order_by(*order).all()))
+        result_count = len(ids)
         if offset is not None and limit is not None:
             offset = int(offset)
             limit_all = offset + int(limit)
@@ -1209,9 +1413,16 @@ class CalibreDB:
         else:
             offset = 0
             limit_all = result_count
+            pagination = None
 
-        ub.store_combo_ids(result)
-        entries = self.order_authors(result[offset:limit_all], list_return=True, combined=True)
+        ub.searched_ids[current_user.id] = ids
+        page_ids = ids[offset:limit_all]
+        rows = dict()
+        if page_ids:
+            for row in query.options(joinedload(Books.data)).filter(Books.id.in_(page_ids)).all():
+                rows.setdefault(row[0].id, row)
+        entries = self.order_authors([rows[book_id] for book_id in page_ids if book_id in rows],
+                                     list_return=True, combined=True)
 
         return entries, result_count, pagination
 
@@ -1314,6 +1525,84 @@ class CalibreDB:
                 if table is not None:
                     Base.metadata.remove(table)
 
+    @staticmethod
+    def read_cc_signature(config_calibre_dir):
+        """Custom column layout of metadata.db, read over a separate connection.
+
+        The engine's single (StaticPool) connection may be inside another session's transaction,
+        so it is not used here.
+        """
+        dbpath = os.path.join(config_calibre_dir, "metadata.db")
+        with sqlite3.connect("file:{}?mode=ro".format(quote(dbpath)), uri=True, timeout=30) as con:
+            return tuple(con.execute("SELECT id, datatype FROM custom_columns ORDER BY id").fetchall())
+
+    def notify_library_changed(self, config, app_db_path):
+        """Make changes written to metadata.db by another process visible.
+
+        Cheaper than reconnect_db: the engine and the ORM mappings are kept, sessions only expire
+        their cached rows. The schema is rebuilt only when the custom columns changed.
+        Returns True if a full reconnect was needed.
+        """
+        with self._reconnect_lock:
+            if not self._init or self.engine is None or not config.config_calibre_dir:
+                self.reconnect_db(config, app_db_path)
+                return True
+            try:
+                signature = self.read_cc_signature(config.config_calibre_dir)
+            except (sqlite3.Error, OSError) as ex:
+                log.warning("Could not read custom columns, reconnecting: %s", ex)
+                signature = None
+            if signature is None or signature != CalibreDB._cc_signature:
+                log.info("Custom columns changed, rebuilding calibre database mappings")
+                self.reconnect_db(config, app_db_path)
+                return True
+            CalibreDB.library_generation += 1
+            return False
+
+    @classmethod
+    def _read_data_version(cls, config_calibre_dir):
+        """PRAGMA data_version of metadata.db, which changes whenever another connection commits.
+
+        The value is per connection, so it is read over a long-lived one. The connection is
+        reopened if metadata.db was replaced (e.g. restored from a backup).
+        """
+        dbpath = os.path.join(config_calibre_dir, "metadata.db")
+        st = os.stat(dbpath)
+        key = (dbpath, st.st_dev, st.st_ino)
+        with cls._data_version_lock:
+            if cls._data_version_con is None or cls._data_version_key != key:
+                if cls._data_version_con is not None:
+                    try:
+                        cls._data_version_con.close()
+                    except sqlite3.Error:
+                        pass
+                cls._data_version_con = sqlite3.connect("file:{}?mode=ro".format(quote(dbpath)), uri=True,
+                                                        timeout=30, check_same_thread=False)
+                cls._data_version_key = key
+                # A new connection starts its own count, so force one refresh
+                cls._data_version_seen = None
+            return key, cls._data_version_con.execute("PRAGMA data_version").fetchone()[0]
+
+    def refresh_if_changed(self, config, app_db_path):
+        """Apply changes other processes made to metadata.db, if there were any.
+
+        Meant for hot paths such as Kobo sync, which used to reconnect on every request.
+        Returns "unchanged", "expired" (sessions will reload rows) or "rebuilt" (full reconnect).
+        """
+        try:
+            version = self._read_data_version(config.config_calibre_dir)
+        except (sqlite3.Error, OSError, TypeError) as ex:
+            log.warning("Could not poll metadata.db for changes, reconnecting: %s", ex)
+            self.reconnect_db(config, app_db_path)
+            return "rebuilt"
+        if version == CalibreDB._data_version_seen:
+            return "unchanged"
+        CalibreDB._data_version_seen = version
+        rebuilt = self.notify_library_changed(config, app_db_path)
+        # Apply the expiry to this thread's session right away instead of on its next request
+        self.ensure_session()
+        return "rebuilt" if rebuilt else "expired"
+
     def reconnect_db(self, config, app_db_path):
         # Use lock to ensure atomic reconnect operation
         with self._reconnect_lock:
@@ -12,6 +12,7 @@ from sqlalchemy.orm import joinedload
 from datetime import datetime, timezone
 from functools import wraps
 import hashlib
+import json
 import os
 import time
 from shutil import copyfile
@@ -30,6 +31,9 @@ from cwa_db import CWA_DB
 duplicates = Blueprint('duplicates', __name__)
 log = logger.create()
 
+# Books loaded per query while re-keying the duplicate key index
+KEY_BATCH_SIZE = 500
+
 
 def _normalize_timestamp(ts):
     if ts is None:
@@ -96,6 +100,42 @@ def normalize_title_for_duplicates(title, primary_author=None):
     return normalized
 
 
+def duplicate_key(use_title, use_author, use_language, use_series, use_publisher, use_format,
+                  title, primary_author, language, series, publisher, formats):
+    """Normalized composite key of a book for the selected criteria
+
+    Takes the raw values (primary author name, first language code, series and publisher name,
+    list of formats; None/empty if the book has none). Books with equal keys are duplicates.
+    """
+    key_parts = []
+
+    if use_author:
+        primary_author = primary_author or "unknown"
+    
+    if use_title:
+        # Handle potential None title
+        key_parts.append(normalize_title_for_duplicates(title or "untitled", primary_author))
+
+    if use_author:
+        key_parts.append(primary_author.lower().strip())
+    
+    if use_language:
+        key_parts.append((language or "unknown").lower().strip())
+    
+    if use_series:
+        key_parts.append((series or "no_series").lower().strip())
+    
+    if use_publisher:
+        key_parts.append((publisher or "unknown_publisher").lower().strip())
+    
+    if use_format:
+        # Consider books with the same formats as potentially duplicate
+        formats = sorted(book_format.lower() for book_format in formats or () if book_format)
+        key_parts.append(",".join(formats) if formats else "no_format")
+    
+    return tuple(key_parts)
+
+
 def validate_resolution_strategy(strategy):
     """Validate that strategy is one of the allowed values"""
     valid_strategies = ['newest', 'oldest', 'merge', 'highest_quality_format', 'most_metadata', 'largest_file_size']
@@ -440,8 +480,11 @@ def find_duplicate_books(include_dismissed=False, user_id=None):
             include_dismissed, user_id
         )
     elif method_to_use == 'hybrid':
-        # Use SQL as a prefilter to get candidate book IDs, then Python for robust grouping
-        candidate_ids = find_duplicate_candidate_ids_sql(use_title, use_author, user_id=user_id)
+        # Use the duplicate key index (or SQL) as a prefilter to get candidate book IDs, then Python for robust grouping
+        candidate_ids = find_duplicate_candidate_ids_from_keys(use_title, use_author, use_language, use_series,
+                                                               use_publisher, use_format)
+        if candidate_ids is None:
+            candidate_ids = find_duplicate_candidate_ids_sql(use_title, use_author, user_id=user_id)
         if candidate_ids is None:
             print("[cwa-duplicates] Hybrid prefilter unavailable, falling back to full Python scan", flush=True)
             duplicate_groups = find_duplicate_books_python(
@@ -577,6 +620,185 @@ def find_duplicate_candidate_ids_sql(use_title, use_author, user_id=None, min_bo
     return candidate_ids
 
 
+def _memory_mb():
+    """Current and peak resident memory of the process in MB (0 where the platform can't tell)"""
+    current = peak = 0.0
+    try:
+        with open('/proc/self/statm') as f:
+            current = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1048576
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    except (ImportError, OSError):
+        pass
+    return current, peak
+
+
+class ScanPhases:
+    """Wall time and memory growth of each phase of a duplicate scan, for the logs"""
+
+    def __init__(self, label):
+        self.label = label
+        self.phases = []
+        self._start = time.perf_counter()
+        self._memory = _memory_mb()[0]
+
+    def mark(self, phase):
+        now, memory = time.perf_counter(), _memory_mb()[0]
+        self.phases.append((phase, now - self._start, memory - self._memory))
+        self._start, self._memory = now, memory
+
+    def report(self):
+        current, peak = _memory_mb()
+        summary = ", ".join(f"{phase} {seconds:.2f}s/{delta:+.1f}MB" for phase, seconds, delta in self.phases)
+        print(f"[cwa-duplicates] {self.label} phases: {summary} (rss {current:.0f}MB, peak {peak:.0f}MB)", flush=True)
+        log.info("[cwa-duplicates] %s phases: %s (rss %.0fMB, peak %.0fMB)", self.label, summary, current, peak)
+
+
+def scan_duplicate_keys(use_title, use_author, use_language, use_series, use_publisher, use_format,
+                        book_ids=None, user_id=None, user_filter=True):
+    """Duplicate keys of many books, built from plain column queries instead of ORM objects
+
+    One query reads (id, title, author_sort) of the books, then one aggregated query per enabled
+    criterion reads the link data of all of them at once. Nothing is hydrated, so memory stays
+    proportional to the keys.
+
+    Args:
+        book_ids: Only key these books (default: every book)
+        user_id: User whose permissions filter the books
+        user_filter: Apply the user's permission filters (off for the user-independent key index)
+
+    Returns:
+        dict of book_id -> key tuple (see duplicate_key)
+    """
+    from sqlalchemy import Integer, text
+
+    books_query = calibre_db.session.query(db.Books.id, db.Books.title, db.Books.author_sort)
+    if user_filter:
+        books_query = books_query.filter(get_common_filters(user_id=user_id))
+    if book_ids is not None:
+        if not book_ids:
+            return {}
+        books_query = books_query.filter(db.Books.id.in_(
+            text("SELECT value FROM json_each(:dup_book_ids)")
+            .bindparams(dup_book_ids=json.dumps(list(book_ids))).columns(value=Integer)))
+    books = books_query.all()
+    if not books:
+        return {}
+
+    params = {'ids': json.dumps([book[0] for book in books])}
+
+    def rows(sql):
+        return calibre_db.session.execute(text(sql), params)
+
+    def first_values(sql):
+        # SQLite returns the bare column of the row MIN() picked, i.e. the first linked value
+        return {book: value for book, value, __ in rows(sql)}
+
+    authors = {}
+    known_sorts = set()
+    if use_author:
+        for book, author_id, name, sort in rows(
+                "SELECT l.book, a.id, a.name, a.sort FROM books_authors_link l JOIN authors a ON a.id = l.author "
+                "WHERE l.book IN (SELECT value FROM json_each(:ids)) ORDER BY l.book, l.id"):
+            authors.setdefault(book, []).append((author_id, name, sort))
+        known_sorts = calibre_db.existing_author_sorts(book[2] for book in books)
+    languages = first_values(
+        "SELECT l.book, lang.lang_code, MIN(l.id) FROM books_languages_link l JOIN languages lang ON lang.id = l.lang_code "
+        "WHERE l.book IN (SELECT value FROM json_each(:ids)) GROUP BY l.book") if use_language else {}
+    series = first_values(
+        "SELECT l.book, s.name, MIN(l.id) FROM books_series_link l JOIN series s ON s.id = l.series "
+        "WHERE l.book IN (SELECT value FROM json_each(:ids)) GROUP BY l.book") if use_series else {}
+    publishers = first_values(
+        "SELECT l.book, p.name, MIN(l.id) FROM books_publishers_link l JOIN publishers p ON p.id = l.publisher "
+        "WHERE l.book IN (SELECT value FROM json_each(:ids)) GROUP BY l.book") if use_publisher else {}
+    formats = {book: (book_formats or '').split(',') for book, book_formats in rows(
+        "SELECT book, group_concat(format) FROM data WHERE book IN (SELECT value FROM json_each(:ids)) GROUP BY book")
+    } if use_format else {}
+
+    keys = {}
+    for book_id, title, author_sort in books:
+        primary_author = calibre_db.first_author(author_sort, authors.get(book_id), known_sorts) if use_author else None
+        keys[book_id] = duplicate_key(use_title, use_author, use_language, use_series, use_publisher, use_format,
+                                      title, primary_author, languages.get(book_id), series.get(book_id),
+                                      publishers.get(book_id), formats.get(book_id))
+    return keys
+
+
+def refresh_duplicate_keys(use_title, use_author, use_language, use_series, use_publisher, use_format,
+                           cwa_db=None):
+    """Bring the persistent duplicate key index (cwa_duplicate_keys) up to date with metadata.db
+
+    Only books that are new or whose last_modified changed since they were keyed are re-keyed;
+    deleted books are dropped. All books are re-keyed when the criteria changed.
+
+    Returns:
+        dict with 'changed' and 'deleted' book ID sets, 'affected_keys' (old and new keys of those
+        books) and 'reset' (True if everything was re-keyed), or None if the index is unavailable
+    """
+    criteria = json.dumps([int(bool(flag)) for flag in
+                           (use_title, use_author, use_language, use_series, use_publisher, use_format)])
+    phases = ScanPhases("Duplicate key index refresh")
+    try:
+        cwa_db = cwa_db or CWA_DB()
+        stored_criteria, stored_keys = cwa_db.get_duplicate_keys()
+        reset = stored_criteria != criteria
+        if reset:
+            stored_keys = {}
+
+        current = {book_id: str(last_modified) for book_id, last_modified
+                   in calibre_db.session.query(db.Books.id, db.Books.last_modified)}
+        deleted = set(stored_keys) - set(current)
+        changed = [book_id for book_id, last_modified in current.items()
+                   if book_id not in stored_keys or stored_keys[book_id][1] != last_modified]
+        affected_keys = {stored_keys[book_id][0] for book_id in deleted}
+        affected_keys.update(stored_keys[book_id][0] for book_id in changed if book_id in stored_keys)
+        phases.mark("diff")
+
+        keys = scan_duplicate_keys(use_title, use_author, use_language, use_series, use_publisher, use_format,
+                                   book_ids=changed, user_filter=False)
+        rows = []
+        for book_id, key in keys.items():
+            key = json.dumps(key)
+            affected_keys.add(key)
+            rows.append((book_id, key, current[book_id]))
+        phases.mark("keys")
+
+        if (rows or deleted or reset) and not cwa_db.update_duplicate_keys(criteria, rows, deleted, reset):
+            return None
+        phases.mark("store")
+    except Exception as e:
+        log.error("[cwa-duplicates] Could not refresh duplicate key index: %s", str(e))
+        print(f"[cwa-duplicates] Could not refresh duplicate key index: {str(e)}", flush=True)
+        return None
+
+    print(f"[cwa-duplicates] Duplicate key index refreshed: {len(rows)} books re-keyed, "
+          f"{len(deleted)} removed{' (criteria changed)' if reset else ''}", flush=True)
+    phases.report()
+    return {'changed': set(keys), 'deleted': deleted, 'affected_keys': affected_keys, 'reset': reset}
+
+
+def find_duplicate_candidate_ids_from_keys(use_title, use_author, use_language, use_series, use_publisher, use_format):
+    """Candidate prefilter backed by the persistent duplicate key index
+
+    Unlike the SQL prefilter this covers every criterion, so the candidates are exactly the books
+    that share their key with another book (before user filtering).
+
+    Returns:
+        set of int book IDs, or None if the index is unavailable
+    """
+    cwa_db = CWA_DB()
+    if refresh_duplicate_keys(use_title, use_author, use_language, use_series, use_publisher, use_format,
+                              cwa_db=cwa_db) is None:
+        return None
+    candidate_ids = cwa_db.get_duplicate_key_candidates()
+    if candidate_ids is not None:
+        print(f"[cwa-duplicates] Duplicate key index returned {len(candidate_ids)} candidate books", flush=True)
+    return candidate_ids
+
+
 def find_duplicate_books_sql(use_title, use_author, use_language, use_series, use_publisher,
                               include_dismissed=False, user_id=None):
     """SQL-based duplicate detection using GROUP BY - experimental/WIP
@@ -699,11 +921,9 @@ def find_duplicate_books_sql(use_title, use_author, use_language, use_series, us
             continue  # Safety check
         
         # Prepare display data
+        calibre_db.order_authors([book for book in books if not getattr(book, 'ordered_authors', None)],
+                                 list_return=True)
         for book in books:
-            # Ensure we have ordered authors
-            if not hasattr(book, 'ordered_authors') or not book.ordered_authors:
-                book.ordered_authors = calibre_db.order_authors([book])
-            
             # Handle potential missing authors
             if book.ordered_authors and len(book.ordered_authors) > 0:
                 book.author_names = ', '.join([author.name.replace('|', ',') for author in book.ordered_authors if author.name])
@@ -779,107 +999,53 @@ def find_duplicate_books_python(use_title, use_author, use_language, use_series,
         List of duplicate group dictionaries
     """
     print("[cwa-duplicates] Using Python-based duplicate detection", flush=True)
-    
-    # Get all books with proper user filtering - this is much simpler and more reliable
-    # than trying to do complex joins for duplicate detection
-    books_query = (calibre_db.session.query(db.Books)
-                   .filter(get_common_filters(user_id=user_id))  # Respect user permissions and library filtering
-                   .order_by(db.Books.title, db.Books.timestamp.desc()))
+    phases = ScanPhases("Python scan")
 
-    if candidate_ids is not None:
-        if not candidate_ids:
-            print("[cwa-duplicates] No candidate IDs provided, returning empty duplicate set", flush=True)
-            return []
-        books_query = books_query.filter(db.Books.id.in_(list(candidate_ids)))
-    
-    all_books = books_query.all()
-    print(f"[cwa-duplicates] Retrieved {len(all_books)} books with user filtering applied", flush=True)
-    
-    # Safety check for very large libraries (optional performance warning)
-    if len(all_books) > 50000:
-        print(f"[cwa-duplicates] Warning: Processing {len(all_books)} books may take some time", flush=True)
-        log.warning("[cwa-duplicates] Processing large library: %s books", len(all_books))
-    
-    # Group books by configurable criteria combination (case-insensitive)
-    grouped_books = {}
-    
-    for book in all_books:
-        # Build key based on selected criteria
-        key_parts = []
-
-        primary_author = None
-        if use_author:
-            # Ensure authors are loaded and not empty
-            if book.authors and len(book.authors) > 0:
-                # Get primary author (use Calibre-Web's standard approach)
-                book.ordered_authors = calibre_db.order_authors([book])
-                primary_author = book.ordered_authors[0].name if book.ordered_authors and len(book.ordered_authors) > 0 else "unknown"
-            else:
-                primary_author = "unknown"
-        
-        if use_title:
-            # Handle potential None title
-            title = book.title if book.title else "untitled"
-            key_parts.append(normalize_title_for_duplicates(title, primary_author))
+    if candidate_ids is not None and not candidate_ids:
+        print("[cwa-duplicates] No candidate IDs provided, returning empty duplicate set", flush=True)
+        return []
 
-        if use_author:
-            key_parts.append(primary_author.lower().strip() if primary_author else "unknown")
-        
-        if use_language:
-            # Get primary language code
-            if book.languages and len(book.languages) > 0:
-                primary_language = book.languages[0].lang_code if book.languages[0].lang_code else "unknown"
-                key_parts.append(primary_language.lower().strip())
-            else:
-                key_parts.append("unknown")
-        
-        if use_series:
-            # Get series name
-            if book.series and len(book.series) > 0:
-                series_name = book.series[0].name if book.series[0].name else "no_series"
-                key_parts.append(series_name.lower().strip())
-            else:
-                key_parts.append("no_series")
-        
-        if use_publisher:
-            # Get publisher name
-            if book.publishers and len(book.publishers) > 0:
-                publisher_name = book.publishers[0].name if book.publishers[0].name else "unknown_publisher"
-                key_parts.append(publisher_name.lower().strip())
-            else:
-                key_parts.append("unknown_publisher")
-        
-        if use_format:
-            # Get file formats (consider books with same formats as potentially duplicate)
-            if book.data and len(book.data) > 0:
-                formats = sorted([data.format.lower() for data in book.data if data.format])
-                format_str = ",".join(formats) if formats else "no_format"
-                key_parts.append(format_str)
-            else:
-                key_parts.append("no_format")
-        
-        # Create composite key
-        key = tuple(key_parts)
-        
-        if key not in grouped_books:
-            grouped_books[key] = []
-        grouped_books[key].append(book)
-    
-    print(f"[cwa-duplicates] Grouped books into {len(grouped_books)} unique combinations based on selected criteria", flush=True)
+    # Build the keys from plain column queries with proper user filtering; only books that end
+    # up in a duplicate group are loaded as ORM objects below
+    keys = scan_duplicate_keys(use_title, use_author, use_language, use_series, use_publisher, use_format,
+                               book_ids=candidate_ids, user_id=user_id)
+    phases.mark("keys")
+    print(f"[cwa-duplicates] Retrieved {len(keys)} books with user filtering applied", flush=True)
     
-    # Filter to only groups with duplicates and prepare display data
+    # Group books by configurable criteria combination (case-insensitive)
+    grouped_ids = {}
+    for book_id, key in keys.items():
+        grouped_ids.setdefault(key, []).append(book_id)
+    del keys
+    duplicate_ids = [book_ids for book_ids in grouped_ids.values() if len(book_ids) > 1]
+    print(f"[cwa-duplicates] Grouped books into {len(grouped_ids)} unique combinations based on selected criteria", flush=True)
+    del grouped_ids
+    phases.mark("group")
+
+    books_by_id = {}
+    flat_ids = [book_id for book_ids in duplicate_ids for book_id in book_ids]
+    for start in range(0, len(flat_ids), KEY_BATCH_SIZE):
+        for book in (calibre_db.session.query(db.Books)
+                     .options(joinedload(db.Books.authors))
+                     .filter(db.Books.id.in_(flat_ids[start:start + KEY_BATCH_SIZE]))):
+            books_by_id[book.id] = book
+    # Order every book's authors up front with a handful of queries
+    calibre_db.order_authors([book for book in books_by_id.values() if book.authors], list_return=True)
+    grouped_books = [[books_by_id[book_id] for book_id in book_ids if book_id in books_by_id]
+                     for book_ids in duplicate_ids]
+    phases.mark("hydrate")
+    
+    # Prepare display data for the duplicate groups (a book may have been deleted since keying)
     duplicate_groups = []
-    for key, books in grouped_books.items():
+    for books in grouped_books:
         if len(books) > 1:
             # Sort books by timestamp (newest first)
             books.sort(key=lambda x: _timestamp_or_default(x.timestamp, _AWARE_MIN), reverse=True)
             
             # Add additional information for display
+            calibre_db.order_authors([book for book in books if not getattr(book, 'ordered_authors', None)],
+                                     list_return=True)
             for book in books:
-                # Ensure we have ordered authors
-                if not hasattr(book, 'ordered_authors') or not book.ordered_authors:
-                    book.ordered_authors = calibre_db.order_authors([book])
-                
                 # Handle potential missing authors
                 if book.ordered_authors and len(book.ordered_authors) > 0:
                     book.author_names = ', '.join([author.name.replace('|', ',') for author in book.ordered_authors if author.name])
@@ -937,8 +1103,10 @@ def find_duplicate_books_python(use_title, use_author, use_language, use_series,
     
     # Sort by title, then author for consistent display
     duplicate_groups.sort(key=lambda x: (x['title'].lower(), x['author'].lower()))
+    phases.mark("prepare")
     
     print(f"[cwa-duplicates] Found {len(duplicate_groups)} duplicate groups total", flush=True)
+    phases.report()
     
     return duplicate_groups
 
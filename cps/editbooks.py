@@ -33,7 +33,7 @@ from .render_template import render_title_template
 from .kobo_sync_status import change_archived_books
 from .redirect import get_redirect_location
 from .file_helper import validate_mime_type
-from .cwa_functions import get_ingest_dir
+from .cwa_functions import get_ingest_dir, queue_upload_for_ingest
 from .usermanagement import user_login_required, login_required_if_no_ano
 from .string_helper import strip_whitespaces
 from werkzeug.utils import secure_filename
@@ -147,6 +147,7 @@ def upload():
 
                 # Now that manifest is written, perform the atomic rename to trigger ingest
                 os.replace(tmp_path, final_path)
+                queue_upload_for_ingest(final_path)
 
                 # Queue a task entry for UX feedback
                 upload_text = N_("Upload done, processing, please wait...")
@@ -176,6 +177,7 @@ def upload():
                 final_path = _get_ingest_path(requested_file, prefix_parts=["new", current_user.id])
                 tmp_path, final_path = _save_to_ingest_atomic_rename(requested_file, final_path)
                 os.replace(tmp_path, final_path) # No manifest needed, just rename
+                queue_upload_for_ingest(final_path)
                 upload_text = N_("Upload done, processing, please wait...")
                 WorkerThread.add(current_user.name, TaskUpload(upload_text, escape(requested_file.filename)))
             except Exception as e:
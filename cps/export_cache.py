@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+# Calibre-Web Automated – fork of Calibre-Web
+# Copyright (C) 2018-2026 Calibre-Web contributors
+# Copyright (C) 2024-2026 Calibre-Web Automated contributors
+# SPDX-License-Identifier: GPL-3.0-or-later
+# See CONTRIBUTORS for full list of authors.
+
+"""Cache of downloads with embedded metadata.
+
+Embedding metadata runs `calibredb export` (or rewrites the kepub's OPF) on every download.
+The result only depends on the book's metadata and the stored file, so it is kept under
+CACHE_DIR/exports in a folder named after a hash of exactly those inputs. Any metadata edit,
+cover change or replaced format produces a new key; stale entries simply age out through
+the size-bounded LRU eviction.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+from . import logger, fs
+from .constants import CACHE_TYPE_EXPORTS
+
+log = logger.create()
+
+# Upper bound for the cache; least recently served exports are removed first
+EXPORT_CACHE_MAX_BYTES = int(os.environ.get("CWA_EXPORT_CACHE_MAX_MB", "1024")) * 1024 * 1024
+
+# Striped so concurrent downloads of one book export it only once without a lock per key
+_build_locks = [threading.Lock() for _ in range(32)]
+_evict_lock = threading.Lock()
+
+
+def _metadata_fingerprint(book):
+    """Everything that ends up in the embedded OPF, as a stable JSON-able structure."""
+    return {
+        "title": book.title,
+        "sort": book.sort,
+        "author_sort": book.author_sort,
+        "authors": [a.name for a in book.authors],
+        "tags": sorted(t.name for t in book.tags),
+        "series": [s.name for s in book.series],
+        "series_index": book.series_index,
+        "publishers": [p.name for p in book.publishers],
+        "languages": [lang.lang_code for lang in book.languages],
+        "identifiers": sorted((i.type, i.val) for i in book.identifiers),
+        "comments": [c.text for c in book.comments],
+        "ratings": [r.rating for r in book.ratings],
+        "pubdate": str(book.pubdate),
+        "has_cover": book.has_cover,
+        "uuid": book.uuid,
+    }
+
+
+def export_key(book, book_format, source_stat=None, variant=""):
+    """Content address of an export: book id, format, last_modified and a metadata hash.
+
+    source_stat identifies the stored file (size/mtime, or just a size for Google Drive) so a
+    replaced format is re-exported; variant separates otherwise identical exports (e.g. locale).
+    """
+    digest = hashlib.sha256(json.dumps({
+        "metadata": _metadata_fingerprint(book),
+        "source": source_stat,
+        "variant": variant,
+    }, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:24]
+    last_modified = book.last_modified.strftime("%Y%m%d%H%M%S") if book.last_modified else "0"
+    return "{}-{}-{}-{}".format(book.id, book_format.lower(), last_modified, digest)
+
+
+def _entry_dir(key):
+    return os.path.join(fs.FileSystem().get_cache_dir(CACHE_TYPE_EXPORTS), key)
+
+
+def lookup(key, download_name, book_format):
+    """Return the folder holding a cached export, or None. Marks the entry as recently used."""
+    entry = _entry_dir(key)
+    if not os.path.isfile(os.path.join(entry, download_name + "." + book_format)):
+        return None
+    try:
+        os.utime(entry)
+    except OSError:
+        pass
+    return entry
+
+
+def build_lock(key):
+    """Lock to hold while checking for and building the export of `key`."""
+    return _build_locks[int(hashlib.md5(key.encode("utf-8")).hexdigest()[:8], 16) % len(_build_locks)]
+
+
+def store(key, exported_file, download_name, book_format, move=True):
+    """Put a freshly exported file into the cache and return its folder (None on failure)."""
+    entry = _entry_dir(key)
+    staging = entry + ".tmp-{}".format(threading.get_ident())
+    try:
+        os.makedirs(staging, exist_ok=True)
+        target = os.path.join(staging, download_name + "." + book_format)
+        if move:
+            shutil.move(exported_file, target)
+        else:
+            shutil.copy2(exported_file, target)
+        if os.path.isdir(entry):
+            shutil.rmtree(entry, ignore_errors=True)
+        os.rename(staging, entry)
+    except OSError as ex:
+        log.warning("Could not cache export %s: %s", key, ex)
+        shutil.rmtree(staging, ignore_errors=True)
+        return None
+    evict()
+    return entry
+
+
+def evict(max_bytes=None):
+    """Remove least recently used exports until the cache fits in max_bytes."""
+    max_bytes = EXPORT_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    if not _evict_lock.acquire(blocking=False):
+        return  # another request is already evicting
+    try:
+        root = fs.FileSystem().get_cache_dir(CACHE_TYPE_EXPORTS)
+        entries = []
+        total = 0
+        with os.scandir(root) as it:
+            for entry in it:
+                if not entry.is_dir(follow_symlinks=False):
+                    continue
+                size = 0
+                try:
+                    with os.scandir(entry.path) as files:
+                        for f in files:
+                            if f.is_file(follow_symlinks=False):
+                                size += f.stat(follow_symlinks=False).st_size
+                    entries.append((entry.stat(follow_symlinks=False).st_mtime, size, entry.path))
+                except OSError:
+                    continue
+                total += size
+        if total <= max_bytes:
+            return
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= max_bytes:
+                break
+            # Leave entries that are still being written alone
+            if ".tmp-" in os.path.basename(path) and time.time() - mtime < 3600:
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            log.debug("Evicted cached export %s", os.path.basename(path))
+    except OSError as ex:
+        log.warning("Export cache eviction failed: %s", ex)
+    finally:
+        _evict_lock.release()
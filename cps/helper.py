@@ -44,7 +44,7 @@ except ImportError as e:
 from . import calibre_db, cli_param
 from .string_helper import strip_whitespaces
 from .tasks.convert import TaskConvert
-from . import logger, config, db, ub, fs
+from . import logger, config, db, ub, fs, export_cache
 from . import gdriveutils as gd
 from .constants import (STATIC_DIR as _STATIC_DIR, CACHE_TYPE_THUMBNAILS, THUMBNAIL_TYPE_COVER, THUMBNAIL_TYPE_SERIES,
                         SUPPORTED_CALIBRE_BINARIES)
@@ -1193,82 +1193,112 @@ def save_cover_with_thumbnail_update(img, book_path, book_id=None):
     return result, message
 
 
+def _cached_export(book, book_format, book_name, source_stat, variant, export):
+    """Serve an embedded-metadata export from the export cache, building it with `export` on a miss.
+
+    Returns (directory, download_name, fresh); fresh is True only when `export` ran, which is
+    when the KOReader checksum of the new file needs to be stored.
+    """
+    key = export_cache.export_key(book, book_format, source_stat, variant)
+    with export_cache.build_lock(key):
+        cached = export_cache.lookup(key, book_name, book_format)
+        if cached:
+            log.debug("Serving cached export %s", key)
+            return cached, book_name, False
+
+        export_dir, export_name = export()
+        exported_file = os.path.join(export_dir, export_name + "." + book_format)
+        if not os.path.isfile(exported_file):
+            return export_dir, export_name, True
+        cached = export_cache.store(key, exported_file, book_name, book_format)
+        if not cached:
+            return export_dir, export_name, True
+        # calibredb export may have created a per-export subdirectory in the temp dir
+        if export_dir != get_temp_dir():
+            shutil.rmtree(export_dir, ignore_errors=True)
+        return cached, book_name, True
+
+
 def do_download_file(book, book_format, client, data, headers):
     book_name = data.name
     download_name = filename = None
     metadata_was_embedded = False  # Track if we embedded metadata
+    # The kepub OPF is rendered in the user's locale, so cache it per locale
+    embed_variant = str(current_user.locale) if book_format == "kepub" else ""
 
     if config.config_use_google_drive:
-        # startTime = time.time()
-        df = gd.getFileFromEbooksFolder(book.path, data.name + "." + book_format)
-        # log.debug('%s', time.time() - startTime)
-        if df:
-            if config.config_embed_metadata and (
-                 (book_format == "kepub" and config.config_kepubifypath) or
-                 (book_format != "kepub" and config.config_binariesdir)):
-                output_path = os.path.join(config.config_calibre_dir, book.path)
-                if not os.path.exists(output_path):
-                    os.makedirs(output_path)
-                output = os.path.join(config.config_calibre_dir, book.path, book_name + "." + book_format)
-                gd.downloadFile(book.path, book_name + "." + book_format, output)
-                if book_format == "kepub" and config.config_kepubifypath:
+        embed = config.config_embed_metadata and (
+            (book_format == "kepub" and config.config_kepubifypath) or
+            (book_format != "kepub" and config.config_binariesdir))
+        if embed:
+            # Checked before looking up the Drive file so cache hits avoid the Drive round trip as well
+            key = export_cache.export_key(book, book_format, [data.uncompressed_size], embed_variant)
+            cached = export_cache.lookup(key, book_name, book_format)
+            if cached:
+                filename, download_name = cached, book_name
+        if not filename:
+            # startTime = time.time()
+            df = gd.getFileFromEbooksFolder(book.path, data.name + "." + book_format)
+            # log.debug('%s', time.time() - startTime)
+            if df:
+                if embed:
+                    output_path = os.path.join(config.config_calibre_dir, book.path)
+                    if not os.path.exists(output_path):
+                        os.makedirs(output_path)
+                    output = os.path.join(config.config_calibre_dir, book.path, book_name + "." + book_format)
+
+                    def _export():
+                        gd.downloadFile(book.path, book_name + "." + book_format, output)
+                        if book_format == "kepub":
+                            return do_kepubify_metadata_replace(book, output)
+                        return do_calibre_export(book.id, book_format)
+
                     try:
-                        filename, download_name = do_kepubify_metadata_replace(book, output)
-                        metadata_was_embedded = True
+                        filename, download_name, metadata_was_embedded = _cached_export(
+                            book, book_format, book_name, [data.uncompressed_size], embed_variant, _export)
                     except Exception as e:
-                        log.error_or_exception(f"Failed to kepubify metadata for book {book.id}: {e}")
+                        log.error_or_exception(f"Failed to embed metadata for book {book.id}: {e}")
                         filename = os.path.dirname(output)
                         download_name = os.path.splitext(os.path.basename(output))[0]
-                elif book_format != "kepub" and config.config_binariesdir:
-                    filename, download_name = do_calibre_export(book.id, book_format)
-                    metadata_was_embedded = True
+                else:
+                    return gd.do_gdrive_download(df, headers)
             else:
-                return gd.do_gdrive_download(df, headers)
-        else:
-            abort(404)
+                abort(404)
     else:
         filename = os.path.join(config.get_book_path(), book.path)
-        if not os.path.isfile(os.path.join(filename, book_name + "." + book_format)):
+        source_file = os.path.join(filename, book_name + "." + book_format)
+        if not os.path.isfile(source_file):
             # ToDo: improve error handling
-            log.error('File not found: %s', os.path.join(filename, book_name + "." + book_format))
+            log.error('File not found: %s', source_file)
 
         if client == "kobo" and book_format == "kepub":
             headers["Content-Disposition"] = headers["Content-Disposition"].replace(".kepub", ".kepub.epub")
 
+        try:
+            source_st = os.stat(source_file)
+            source_stat = [source_st.st_size, source_st.st_mtime_ns]
+        except OSError:
+            source_stat = None
+
         if book_format == "kepub" and config.config_kepubifypath and config.config_embed_metadata:
             try:
-                filename, download_name = do_kepubify_metadata_replace(book, os.path.join(filename,
-                                                                                          book_name + "." + book_format))
-                metadata_was_embedded = True
+                filename, download_name, metadata_was_embedded = _cached_export(
+                    book, book_format, book_name, source_stat, embed_variant,
+                    lambda: do_kepubify_metadata_replace(book, source_file))
             except Exception as e:
                 log.error_or_exception(f"Failed to kepubify metadata for book {book.id}: {e}")
                 filename = os.path.join(config.get_book_path(), book.path)
                 download_name = book_name
         elif book_format != "kepub" and config.config_binariesdir and config.config_embed_metadata:
-            filename, download_name = do_calibre_export(book.id, book_format)
-            metadata_was_embedded = True
-
-            # Rename the exported file to match the expected download name (from Content-Disposition)
-            # This ensures KOReader calculates the checksum on the same file we calculated it on
-            if filename and download_name:
-                uuid_file = os.path.join(filename, download_name + "." + book_format)
-                expected_file = os.path.join(filename, book_name + "." + book_format)
-
-                if os.path.exists(uuid_file) and uuid_file != expected_file:
-                    try:
-                        # Remove the target file if it already exists
-                        if os.path.exists(expected_file):
-                            os.remove(expected_file)
-                        # Rename UUID file to expected name
-                        os.rename(uuid_file, expected_file)
-                        download_name = book_name
-                        log.info(f'Renamed exported file to match expected name: {book_name}.{book_format}')
-                    except Exception as e:
-                        log.error(f'Failed to rename exported file: {e}')
+            # Cached exports are stored under the expected download name (from Content-Disposition),
+            # so KOReader calculates the checksum on the same file we calculated it on
+            filename, download_name, metadata_was_embedded = _cached_export(
+                book, book_format, book_name, source_stat, embed_variant,
+                lambda: do_calibre_export(book.id, book_format))
         else:
             download_name = book_name
 
-    # Calculate and store checksum if metadata was embedded
+    # Calculate and store checksum if metadata was embedded (cache hits already have theirs)
     if metadata_was_embedded and filename and download_name:
         try:
             from .progress_syncing import calculate_and_store_checksum
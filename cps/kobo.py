@@ -13,7 +13,7 @@ from kobo_sync_utils import get_kobo_created_ts
 import os
 import uuid
 import zipfile
-from time import gmtime, strftime
+from time import gmtime, strftime, perf_counter
 import json
 from urllib.parse import unquote
 
@@ -51,6 +51,8 @@ KOBO_STOREAPI_URL = "https://storeapi.kobo.com"
 KOBO_IMAGEHOST_URL = "https://cdn.kobo.com/book-images"
 
 SYNC_ITEM_LIMIT = 100
+# Reconnect to metadata.db on every sync like older versions did (for latency comparisons)
+KOBO_SYNC_FORCE_RECONNECT = os.environ.get("CWA_KOBO_SYNC_FORCE_RECONNECT", "false").strip().lower() in ("1", "true", "yes", "on")
 
 kobo = Blueprint("kobo", __name__, url_prefix="/kobo/<auth_token>")
 kobo_auth.disable_failed_auth_redirect_for_blueprint(kobo)
@@ -139,11 +141,7 @@ def get_magic_shelf_book_ids_for_kobo(user_id):
 
     book_ids = set()
     for shelf in magic_shelves:
-        books, _ = magic_shelf.get_books_for_magic_shelf(
-            shelf.id, page=1, page_size=None
-        )
-        for book in books:
-            book_ids.add(book.id)
+        book_ids.update(magic_shelf.get_book_ids_for_magic_shelf(shelf.id))
 
     if book_ids:
         log.debug("Kobo Sync: magic shelf allowed books: %s", len(book_ids))
@@ -159,6 +157,7 @@ def HandleSyncRequest():
         log.info("Users need download permissions for syncing library to Kobo reader")
         return abort(403)
 
+    sync_started = perf_counter()
     sync_token = SyncToken.SyncToken.from_headers(request.headers)
     log.info("Kobo library sync request received")
     log.debug("SyncToken: {}".format(sync_token))
@@ -179,8 +178,16 @@ def HandleSyncRequest():
     new_archived_last_modified = datetime.min
     sync_results = []
 
-    calibre_db.reconnect_db(config, ub.app_DB_path)
-
+    # Only pick up what other processes changed in metadata.db; a full reconnect per sync tore down
+    # the engine under every concurrent request. KOBO_SYNC_FORCE_RECONNECT restores the old behaviour
+    # so sync latencies can be compared.
+    db_refresh_started = perf_counter()
+    if KOBO_SYNC_FORCE_RECONNECT:
+        calibre_db.reconnect_db(config, ub.app_DB_path)
+        db_refresh = "reconnect"
+    else:
+        db_refresh = calibre_db.refresh_if_changed(config, ub.app_DB_path)
+    db_refresh_ms = (perf_counter() - db_refresh_started) * 1000
 
     # Two-Way-Sync Deletion Logic
     magic_shelf_book_ids = set()
@@ -408,10 +415,11 @@ def HandleSyncRequest():
     sync_token.archive_last_modified = new_archived_last_modified
     sync_token.reading_state_last_modified = new_reading_state_last_modified
 
-    return generate_sync_response(sync_token, sync_results, cont_sync)
+    return generate_sync_response(sync_token, sync_results, cont_sync,
+                                  sync_timing=(sync_started, db_refresh, db_refresh_ms))
 
 
-def generate_sync_response(sync_token, sync_results, set_cont=False):
+def generate_sync_response(sync_token, sync_results, set_cont=False, sync_timing=None):
     extra_headers = {}
     if config.config_kobo_proxy and not set_cont:
         # Merge in sync results from the official Kobo store.
@@ -431,6 +439,11 @@ def generate_sync_response(sync_token, sync_results, set_cont=False):
         extra_headers["x-kobo-sync"] = "continue"
     sync_token.to_headers(extra_headers)
 
+    sync_started, db_refresh, db_refresh_ms = sync_timing or (perf_counter(), "skipped", 0.0)
+    sync_ms = (perf_counter() - sync_started) * 1000
+    log.info("Kobo library sync answered in %.0f ms (db %s in %.1f ms, %d entries)",
+             sync_ms, db_refresh, db_refresh_ms, len(sync_results))
+
     # Track Kobo sync activity
     try:
         from scripts.cwa_db import CWA_DB
@@ -442,7 +455,10 @@ def generate_sync_response(sync_token, sync_results, set_cont=False):
             event_type='KOBO_SYNC',
             extra_data=json_lib.dumps({
                 'books_synced': len(sync_results),
-                'endpoint': '/v1/library/sync'
+                'endpoint': '/v1/library/sync',
+                'duration_ms': round(sync_ms, 1),
+                'db_refresh': db_refresh,
+                'db_refresh_ms': round(db_refresh_ms, 1)
             })
         )
     except Exception as e:
@@ -5,6 +5,11 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 # See CONTRIBUTORS for full list of authors.
 
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
 from . import db, ub, logger
 from .cw_login import current_user
 from sqlalchemy import and_, or_, not_
@@ -14,6 +19,16 @@ from datetime import datetime, timedelta, timezone
 
 log = logger.create()
 
+# Rule results, shared by every user with the same visibility restrictions. An entry is only
+# used while CalibreDB.library_change_stamp() is unchanged, so ingests and edits invalidate it
+_result_cache = OrderedDict()
+_result_cache_lock = threading.Lock()
+RESULT_CACHE_SIZE = 256
+# Sidebar counts per user, see get_book_counts_for_magic_shelves
+_count_cache = OrderedDict()
+_count_cache_lock = threading.Lock()
+COUNT_CACHE_SIZE = 256
+
 MAGIC_SHELF_ORDER_MODES = {
     'manual',
     'name_asc',
@@ -514,6 +529,104 @@ def build_query_from_rules(rules_json, user_id=None):
     
     return None
 
+def _uses_builtin_read_status(rules):
+    from . import config
+    if config.config_read_column and config.config_read_column in db.cc_classes:
+        return False
+    for rule in rules.get('rules', []):
+        if 'condition' in rule:
+            if _uses_builtin_read_status(rule):
+                return True
+        elif rule.get('id') == 'read_status':
+            return True
+    return False
+
+
+def _order_key(sort_order):
+    if sort_order is None:
+        return ''
+    if not isinstance(sort_order, (list, tuple)):
+        sort_order = [sort_order]
+    return '|'.join(str(order_expr) for order_expr in sort_order)
+
+
+def _matching_book_ids(magic_shelf, cdb, sort_order=None, bypass_cache=False, any_order=False):
+    """Ordered ids of the books matching the shelf's rules that the current user may see.
+
+    The user's archived books are not excluded here (see _visible_ids), which lets users with
+    the same restrictions share one entry. The key is a hash of the rules plus everything else
+    the result depends on; with any_order the ids of whichever order is cached are good enough.
+    """
+    from . import config
+
+    rules = magic_shelf.rules
+    if not rules or not rules.get('rules'):
+        log.debug(f"No rules defined for magic shelf {magic_shelf.id}")
+        return []
+
+    owner_read_state = None
+    if _uses_builtin_read_status(rules):
+        # Rules on the built-in read status depend on the shelf owner's read books
+        read_count, read_modified = ub.session.query(func.count(ub.ReadBook.id), func.max(ub.ReadBook.last_modified))\
+            .filter(ub.ReadBook.user_id == magic_shelf.user_id).one()
+        owner_read_state = (magic_shelf.user_id, read_count, str(read_modified))
+    key = (_rules_hash(rules), owner_read_state, cdb.visibility_key(), config.config_restricted_column,
+           config.config_read_column)
+    stamp = cdb.library_change_stamp()
+    order_key = _order_key(sort_order)
+
+    if not bypass_cache:
+        with _result_cache_lock:
+            entry = _result_cache.get(key)
+            if entry is not None and entry['stamp'] == stamp:
+                _result_cache.move_to_end(key)
+                if order_key in entry['ids']:
+                    return entry['ids'][order_key]
+                if any_order and entry['ids']:
+                    return next(iter(entry['ids'].values()))
+
+    query_filter = build_query_from_rules(rules, user_id=magic_shelf.user_id)
+    if query_filter is None:
+        log.warning(f"Failed to build query filter for magic shelf {magic_shelf.id}")
+        return []
+
+    query = cdb.session.query(db.Books.id)\
+        .filter(query_filter)\
+        .filter(cdb.common_filters(allow_show_archived=True))
+    if sort_order is not None:
+        if isinstance(sort_order, (list, tuple)):
+            for order_expr in sort_order:
+                query = query.order_by(order_expr)
+        else:
+            query = query.order_by(sort_order)
+    ids = tuple(dict.fromkeys(row[0] for row in query.all()))
+
+    with _result_cache_lock:
+        entry = _result_cache.get(key)
+        if entry is None or entry['stamp'] != stamp:
+            entry = _result_cache[key] = {'stamp': stamp, 'ids': {}}
+        entry['ids'][order_key] = ids
+        _result_cache.move_to_end(key)
+        while len(_result_cache) > RESULT_CACHE_SIZE:
+            _result_cache.popitem(last=False)
+    log.debug(f"Magic shelf {magic_shelf.id} evaluated ({len(ids)} books)")
+    return ids
+
+
+def _rules_hash(rules):
+    return hashlib.sha1(json.dumps(rules, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def _archived_book_ids():
+    return {row[0] for row in ub.session.query(ub.ArchivedBook.book_id)
+            .filter(ub.ArchivedBook.user_id == int(current_user.id))
+            .filter(ub.ArchivedBook.is_archived == True)}
+
+
+def _visible_ids(ids, archived_ids):
+    return [book_id for book_id in ids if book_id not in archived_ids] if archived_ids else list(ids)
+
+
 def get_books_for_magic_shelf(shelf_id, page=1, page_size=None, sort_order=None, sort_param='stored', bypass_cache=False):
     """
     Takes a MagicShelf ID and returns a paginated list of book objects that match its rules.
@@ -523,8 +636,8 @@ def get_books_for_magic_shelf(shelf_id, page=1, page_size=None, sort_order=None,
         page: Page number (1-indexed)
         page_size: Number of books per page (None = all books)
         sort_order: SQLAlchemy order_by expression
-        sort_param: String identifier for the sort order (used for cache key)
-        bypass_cache: If True, forces a database query and cache update
+        sort_param: String identifier for the sort order (kept for callers; the cache keys on sort_order itself)
+        bypass_cache: If True, forces the rules to be evaluated again
     
     Returns:
         tuple: (books, total_count)
@@ -535,109 +648,10 @@ def get_books_for_magic_shelf(shelf_id, page=1, page_size=None, sort_order=None,
             log.warning(f"Magic shelf with ID {shelf_id} not found")
             return [], 0
 
-        # 1. Check Cache
-        if not bypass_cache and current_user.is_authenticated:
-            cache = ub.session.query(ub.MagicShelfCache).filter_by(
-                shelf_id=shelf_id, 
-                user_id=current_user.id, 
-                sort_param=sort_param
-            ).first()
-            
-            # Check TTL (e.g. 30 minutes)
-            if cache:
-                # Handle potential naive/aware datetime issues
-                created_at = cache.created_at
-                if created_at.tzinfo is None:
-                    created_at = created_at.replace(tzinfo=timezone.utc)
-                
-                is_expired = (datetime.now(timezone.utc) - created_at) > timedelta(minutes=30)
-                
-                if not is_expired:
-                    all_ids = cache.book_ids
-                    total_count = cache.total_count
-                    
-                    # Slice for pagination
-                    if page_size is not None and page_size > 0:
-                        start = (page - 1) * page_size
-                        page_ids = all_ids[start : start + page_size]
-                    else:
-                        page_ids = all_ids
-
-                    if not page_ids:
-                        return [], total_count
-
-                    # Fetch objects (must preserve order!)
-                    cdb = db.CalibreDB(init=True)
-                    books = cdb.session.query(db.Books).filter(db.Books.id.in_(page_ids)).all()
-                    book_map = {b.id: b for b in books}
-                    ordered_books = [book_map[bid] for bid in page_ids if bid in book_map]
-                    
-                    log.debug(f"Magic shelf {shelf_id} served from cache ({len(ordered_books)} books)")
-                    return ordered_books, total_count
-                else:
-                    log.debug(f"Magic shelf {shelf_id} cache expired")
-
-        rules = magic_shelf.rules
-        log.debug(f"Loading magic shelf '{magic_shelf.name}' (ID: {shelf_id}) with {len(rules.get('rules', [])) if rules else 0} rules")
-        
-        if not rules or not rules.get('rules'):
-            log.debug(f"No rules defined for magic shelf {shelf_id}")
-            return [], 0
-
         cdb = db.CalibreDB(init=True)
-        query_filter = build_query_from_rules(rules, user_id=magic_shelf.user_id)
-        
-        if query_filter is None:
-            log.warning(f"Failed to build query filter for magic shelf {shelf_id}")
-            return [], 0
-        
-        # Build base query
-        query = cdb.session.query(db.Books)
-        query = query.filter(query_filter)
-        
-        # Apply standard user permissions filters
-        query = query.filter(cdb.common_filters())
-        
-        # Apply sorting
-        if sort_order is not None:
-            if isinstance(sort_order, list):
-                for order_expr in sort_order:
-                    query = query.order_by(order_expr)
-            else:
-                query = query.order_by(sort_order)
-        
-        # Execute Full Query for Cache
-        try:
-            # Fetch ALL IDs
-            all_ids_tuples = query.with_entities(db.Books.id).all()
-            all_ids = [x[0] for x in all_ids_tuples]
-            total_count = len(all_ids)
-            
-            # Update Cache
-            if current_user.is_authenticated:
-                # Delete old cache for this specific combo
-                ub.session.query(ub.MagicShelfCache).filter_by(
-                    shelf_id=shelf_id, 
-                    user_id=current_user.id, 
-                    sort_param=sort_param
-                ).delete()
-                
-                new_cache = ub.MagicShelfCache(
-                    shelf_id=shelf_id,
-                    user_id=current_user.id,
-                    sort_param=sort_param,
-                    book_ids=all_ids,
-                    total_count=total_count
-                )
-                ub.session.add(new_cache)
-                ub.session.commit()
-                log.debug(f"Magic shelf {shelf_id} cache updated ({total_count} items)")
-
-        except SQLAlchemyError as e:
-            log.error(f"Error executing query for magic shelf {shelf_id}: {e}")
-            return [], 0
-        
-        # Apply pagination to the list of IDs we just fetched
+        all_ids = _visible_ids(_matching_book_ids(magic_shelf, cdb, sort_order, bypass_cache), _archived_book_ids())
+        total_count = len(all_ids)
+
         if page_size is not None and page_size > 0:
             start = (page - 1) * page_size
             page_ids = all_ids[start : start + page_size]
@@ -647,7 +661,7 @@ def get_books_for_magic_shelf(shelf_id, page=1, page_size=None, sort_order=None,
         if not page_ids:
             return [], total_count
 
-        # Fetch objects for the current page
+        # Fetch objects for the current page (must preserve order!)
         books = cdb.session.query(db.Books).filter(db.Books.id.in_(page_ids)).all()
         book_map = {b.id: b for b in books}
         ordered_books = [book_map[bid] for bid in page_ids if bid in book_map]
@@ -662,43 +676,110 @@ def get_books_for_magic_shelf(shelf_id, page=1, page_size=None, sort_order=None,
         return [], 0
 
 
-def get_book_count_for_magic_shelf(shelf_id):
+def get_book_ids_for_magic_shelf(shelf_id):
     """
-    Efficiently gets the total count of books for a magic shelf.
+    Ids of the books on a magic shelf the current user may see, in no particular order.
     
     Args:
         shelf_id: ID of the magic shelf
     
     Returns:
-        int: Total count of matching books
+        list: Book ids
     """
     try:
         magic_shelf = ub.session.query(ub.MagicShelf).get(shelf_id)
         if not magic_shelf:
-            return 0
+            return []
+        cdb = db.CalibreDB(init=True)
+        return _visible_ids(_matching_book_ids(magic_shelf, cdb, any_order=True), _archived_book_ids())
+    except Exception as e:
+        log.error(f"Error listing books for magic shelf {shelf_id}: {e}")
+        return []
 
-        rules = magic_shelf.rules
-        if not rules or not rules.get('rules'):
-            return 0
 
-        cdb = db.CalibreDB(init=True)
-        query_filter = build_query_from_rules(rules, user_id=magic_shelf.user_id)
-        
-        if query_filter is None:
-            return 0
-        
-        # Build base query
-        query = cdb.session.query(db.Books)
-        query = query.filter(query_filter)
-        
-        # Apply standard user permissions filters
-        query = query.filter(cdb.common_filters())
-        
-        return query.count()
-        
+def get_book_count_for_magic_shelf(shelf_id):
+    """
+    Efficiently gets the total count of books for a magic shelf.
+    
+    Args:
+        shelf_id: ID of the magic shelf
+    
+    Returns:
+        int: Total count of matching books
+    """
+    return len(get_book_ids_for_magic_shelf(shelf_id))
+
+
+def _counts_key(shelves, cdb):
+    """Everything the current user's shelf counts depend on, read without evaluating any shelf.
+
+    Besides the library change stamp that is the shelves' rules, the user's visibility restrictions
+    and archived books, and the read books of the owners of shelves with read-status rules.
+    """
+    from . import config
+
+    read_owners = {shelf.user_id for shelf in shelves if shelf.rules and _uses_builtin_read_status(shelf.rules)}
+    read_state = ()
+    if read_owners:
+        read_state = tuple(sorted(
+            (user_id, read_count, str(read_modified)) for user_id, read_count, read_modified in
+            ub.session.query(ub.ReadBook.user_id, func.count(ub.ReadBook.id), func.max(ub.ReadBook.last_modified))
+            .filter(ub.ReadBook.user_id.in_(read_owners))
+            .group_by(ub.ReadBook.user_id)))
+    archived_count, archived_modified = ub.session.query(func.count(ub.ArchivedBook.id),
+                                                         func.max(ub.ArchivedBook.last_modified))\
+        .filter(ub.ArchivedBook.user_id == int(current_user.id)).one()
+    return (tuple((shelf.id, _rules_hash(shelf.rules)) for shelf in shelves), read_state,
+            (archived_count, str(archived_modified)), cdb.visibility_key(), config.config_restricted_column,
+            config.config_read_column, cdb.library_change_stamp())
+
+
+def get_book_counts_for_magic_shelves(shelves):
+    """
+    Book counts for several magic shelves at once (e.g. the sidebar), reading the
+    user's archived books only once.
+
+    The sidebar asks on every page, so the counts are kept per user and only worked out again
+    when something they depend on changed (see _counts_key).
+    
+    Args:
+        shelves: MagicShelf objects
+    
+    Returns:
+        dict: shelf id -> count of matching books
+    """
+    from . import calibre_db
+
+    user_id = int(current_user.id)
+    try:
+        calibre_db.ensure_session()
+        key = _counts_key(shelves, calibre_db)
+        with _count_cache_lock:
+            entry = _count_cache.get(user_id)
+            if entry is not None and entry[0] == key:
+                _count_cache.move_to_end(user_id)
+                return dict(entry[1])
+        archived_ids = _archived_book_ids()
     except Exception as e:
-        log.error(f"Error counting books for magic shelf {shelf_id}: {e}")
-        return 0
+        log.error(f"Error counting books for magic shelves: {e}")
+        return {shelf.id: 0 for shelf in shelves}
+
+    counts = {}
+    complete = True
+    for shelf in shelves:
+        try:
+            counts[shelf.id] = len(_visible_ids(_matching_book_ids(shelf, calibre_db, any_order=True), archived_ids))
+        except Exception as e:
+            log.error(f"Error counting books for magic shelf {shelf.id}: {e}")
+            counts[shelf.id] = 0
+            complete = False
+    if complete:
+        with _count_cache_lock:
+            _count_cache[user_id] = (key, dict(counts))
+            _count_cache.move_to_end(user_id)
+            while len(_count_cache) > COUNT_CACHE_SIZE:
+                _count_cache.popitem(last=False)
+    return counts
 
 
 def create_system_magic_shelves(user_id, template_keys=None):
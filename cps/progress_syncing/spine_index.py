@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Calibre-Web Automated – fork of Calibre-Web
+# Copyright (C) 2018-2026 Calibre-Web contributors
+# Copyright (C) 2024-2026 Calibre-Web Automated contributors
+# SPDX-License-Identifier: GPL-3.0-or-later
+# See CONTRIBUTORS for full list of authors.
+
+"""
+EPUB Spine Index
+
+Converting a Kobo position (chapter file + progress within the chapter) into a
+whole-book percentage needs the spine order and the character count of every
+chapter. Building that means unzipping the book and parsing each chapter, so the
+result is stored in the CWA database per (book, format) together with the file's
+mtime and size, and kept in a small in-process LRU. It is rebuilt only when the
+file on disk changes, and the ingest processor builds it right after import.
+"""
+
+import os
+import re
+import threading
+import zipfile
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+from lxml import etree
+
+from .. import logger
+
+log = logger.create()
+
+NAMESPACES = {
+    'container': 'urn:oasis:names:tc:opendocument:xmlns:container',
+    'opf': 'http://www.idpf.org/2007/opf'
+}
+
+# Number of spine indexes kept in memory per process
+MEMORY_CACHE_SIZE = 256
+
+_memory_cache = OrderedDict()
+_memory_lock = threading.Lock()
+
+
+def build_spine_index(file_path: str) -> Optional[Tuple[List[str], List[int]]]:
+    """
+    Parse an EPUB/KEPUB and return its spine item paths and per-chapter character counts.
+
+    Returns:
+        (spine_items, chapter_lengths), or None if the file has no readable spine
+    """
+    spine_items = []
+    chapter_lengths = []
+    with zipfile.ZipFile(file_path, 'r') as epub_zip:
+        # Find OPF
+        container_tree = etree.fromstring(epub_zip.read('META-INF/container.xml'))
+        opf_path = container_tree.xpath('//container:rootfile/@full-path',
+                                        namespaces={'container': NAMESPACES['container']})[0]
+
+        # Parse OPF
+        opf_tree = etree.fromstring(epub_zip.read(opf_path))
+        opf_dir = os.path.dirname(opf_path)
+
+        manifest = {}
+        for item in opf_tree.xpath('//opf:manifest/opf:item', namespaces={'opf': NAMESPACES['opf']}):
+            item_id = item.get('id')
+            href = item.get('href')
+            if item_id and href:
+                manifest[item_id] = os.path.normpath(os.path.join(opf_dir, href)).replace('\\', '/')
+
+        for itemref in opf_tree.xpath('//opf:spine/opf:itemref', namespaces={'opf': NAMESPACES['opf']}):
+            idref = itemref.get('idref')
+            if idref and idref in manifest:
+                spine_items.append(manifest[idref])
+
+        if not spine_items:
+            return None
+
+        for spine_item in spine_items:
+            try:
+                content = epub_zip.read(spine_item).decode('utf-8', errors='ignore')
+                try:
+                    html_tree = etree.fromstring(content.encode('utf-8'))
+                    char_count = len(''.join(html_tree.itertext()).strip())
+                except etree.XMLSyntaxError:
+                    char_count = len(re.sub(r'<[^>]+>', '', content).strip())
+                chapter_lengths.append(char_count)
+            except Exception:
+                chapter_lengths.append(0)
+
+    return spine_items, chapter_lengths
+
+
+def _file_signature(file_path: str) -> Tuple[int, int]:
+    stat = os.stat(file_path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _remember(key, index):
+    with _memory_lock:
+        _memory_cache[key] = index
+        _memory_cache.move_to_end(key)
+        while len(_memory_cache) > MEMORY_CACHE_SIZE:
+            _memory_cache.popitem(last=False)
+
+
+def _get_cwa_db(cwa_db):
+    if cwa_db is not None:
+        return cwa_db
+    try:
+        from cwa_db import CWA_DB
+        return CWA_DB()
+    except Exception as e:
+        log.debug(f"CWA database unavailable for spine index: {e}")
+        return None
+
+
+def store_spine_index(book_id: int, book_format: str, file_path: str,
+                      cwa_db=None) -> Optional[Tuple[List[str], List[int]]]:
+    """
+    Build the spine index of a file and store it, regardless of what is already stored.
+
+    Returns:
+        (spine_items, chapter_lengths), or None if the file could not be indexed
+    """
+    file_mtime, file_size = _file_signature(file_path)
+    index = build_spine_index(file_path)
+    if index is None:
+        return None
+    cwa_db = _get_cwa_db(cwa_db)
+    if cwa_db is not None:
+        cwa_db.set_epub_spine_index(book_id, book_format, file_mtime, file_size, index[0], index[1])
+    _remember((book_id, book_format.upper(), file_mtime, file_size), index)
+    return index
+
+
+def load_spine_index(book_id: int, book_format: str, file_path: str,
+                     cwa_db=None) -> Optional[Tuple[List[str], List[int]]]:
+    """
+    Get the spine index of a book format, building and storing it only if the file changed.
+
+    Returns:
+        (spine_items, chapter_lengths), or None if the file could not be indexed
+    """
+    file_mtime, file_size = _file_signature(file_path)
+    key = (book_id, book_format.upper(), file_mtime, file_size)
+    with _memory_lock:
+        index = _memory_cache.get(key)
+        if index is not None:
+            _memory_cache.move_to_end(key)
+            return index
+
+    cwa_db = _get_cwa_db(cwa_db)
+    stored = cwa_db.get_epub_spine_index(book_id, book_format) if cwa_db is not None else None
+    if stored and stored['file_mtime'] == file_mtime and stored['file_size'] == file_size:
+        index = (stored['spine'], stored['chapter_lengths'])
+        _remember(key, index)
+        return index
+
+    log.debug(f"Building spine index for book {book_id} ({book_format.upper()})")
+    return store_spine_index(book_id, book_format, file_path, cwa_db=cwa_db)
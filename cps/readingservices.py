@@ -15,19 +15,17 @@ These routes are at the root level: /api/v3/..., /api/UserStorage/...
 
 import json
 import os
-import zipfile
-import re
 from datetime import datetime, timezone
 from functools import wraps
 from typing import TypedDict, NotRequired
 from flask import Blueprint, request, make_response, jsonify, abort
 from werkzeug.datastructures import Headers
 import requests
-from lxml import etree
 
 from . import logger, calibre_db, db, config, ub, csrf
 from .cw_login import current_user, login_required
 from .services import hardcover
+from .progress_syncing.spine_index import load_spine_index
 
 log = logger.create()
 
@@ -197,6 +195,7 @@ class EpubProgressCalculator:
         self.book = book
         self.spine_items: list[str] = []
         self.chapter_lengths: list[int] = []
+        self.chapter_offsets: list[int] = []
         self.total_chars = 0
         self.initialized = False
         self.error = False
@@ -232,61 +231,20 @@ class EpubProgressCalculator:
             if not os.path.exists(file_path):
                 self.error = True
                 return
-            
-            with zipfile.ZipFile(file_path, 'r') as epub_zip:
-                # Find OPF
-                container_data = epub_zip.read('META-INF/container.xml')
-                container_tree = etree.fromstring(container_data)
-                ns = {
-                    'container': 'urn:oasis:names:tc:opendocument:xmlns:container',
-                    'opf': 'http://www.idpf.org/2007/opf'
-                }
-                opf_path = container_tree.xpath(
-                    '//container:rootfile/@full-path',
-                    namespaces={'container': ns['container']}
-                )[0]
-                
-                # Parse OPF
-                opf_data = epub_zip.read(opf_path)
-                opf_tree = etree.fromstring(opf_data)
-                opf_dir = os.path.dirname(opf_path)
-                
-                # Get manifest
-                manifest = {}
-                for item in opf_tree.xpath('//opf:manifest/opf:item', namespaces={'opf': ns['opf']}):
-                    item_id = item.get('id')
-                    href = item.get('href')
-                    if item_id and href:
-                        full_href = os.path.normpath(os.path.join(opf_dir, href)).replace('\\', '/')
-                        manifest[item_id] = full_href
-                
-                # Get spine
-                for itemref in opf_tree.xpath('//opf:spine/opf:itemref', namespaces={'opf': ns['opf']}):
-                    idref = itemref.get('idref')
-                    if idref and idref in manifest:
-                        self.spine_items.append(manifest[idref])
-                
-                if not self.spine_items:
-                    self.error = True
-                    return
 
-                # Calculate lengths
-                for spine_item in self.spine_items:
-                    try:
-                        content = epub_zip.read(spine_item).decode('utf-8', errors='ignore')
-                        try:
-                            html_tree = etree.fromstring(content.encode('utf-8'))
-                            text_content = ''.join(html_tree.itertext())
-                            char_count = len(text_content.strip())
-                        except etree.XMLSyntaxError:
-                            text_content = re.sub(r'<[^>]+>', '', content)
-                            char_count = len(text_content.strip())
-                        self.chapter_lengths.append(char_count)
-                    except Exception:
-                        self.chapter_lengths.append(0)
-                
-                self.total_chars = sum(self.chapter_lengths)
-                self.initialized = True
+            # Parsed once per file version and shared across requests through the CWA database
+            index = load_spine_index(self.book.id, book_data.format, file_path)
+            if not index:
+                self.error = True
+                return
+
+            self.spine_items, self.chapter_lengths = index
+            running_total = 0
+            for length in self.chapter_lengths:
+                self.chapter_offsets.append(running_total)
+                running_total += length
+            self.total_chars = running_total
+            self.initialized = True
 
         except Exception as e:
             log.error(f"Error initializing EPUB calculator: {e}")
@@ -310,7 +268,7 @@ class EpubProgressCalculator:
         if target_chapter_index is None:
             return None
         
-        chars_before = sum(self.chapter_lengths[:target_chapter_index])
+        chars_before = self.chapter_offsets[target_chapter_index]
         chars_in_chapter = self.chapter_lengths[target_chapter_index]
         chars_read = chars_before + (chars_in_chapter * chapter_progress)
         
@@ -129,23 +129,41 @@ def cwa_update_available() -> tuple[bool, str, str]:
         print(f"[cwa-update-notification-service] Error checking for CWA updates: {e}", flush=True)
         return False, "0.0.0", "0.0.0"
 
-# Gets the date the last cwa update notification was displayed
-def get_cwa_last_notification() -> str:
+# Dates the once-per-day notifications were last shown, keyed by notice file, so page renders
+# stop reading the notice files once today's notification is out
+_notice_dates = {}
+
+# Number of untranslated strings per locale; the catalogues ship with the image, so each is parsed once
+_missing_translation_counts = {}
+
+def _read_notice_date(notice_file: str) -> str:
     current_date = datetime.now().strftime("%Y-%m-%d")
-    if not os.path.isfile('/app/cwa_update_notice'):
-        with open('/app/cwa_update_notice', 'w') as f:
+    if _notice_dates.get(notice_file) == current_date:
+        return current_date
+    if not os.path.isfile(notice_file):
+        with open(notice_file, 'w') as f:
             f.write(current_date)
         return "0001-01-01"
-    else:
-        with open('/app/cwa_update_notice', 'r') as f:
-            last_notification = f.read()
+    with open(notice_file, 'r') as f:
+        last_notification = f.read().strip()
+    _notice_dates[notice_file] = last_notification
     return last_notification
 
+def _write_notice_date(notice_file: str, current_date: str) -> None:
+    with open(notice_file, 'w') as f:
+        f.write(current_date)
+    _notice_dates[notice_file] = current_date
+
+# Gets the date the last cwa update notification was displayed
+def get_cwa_last_notification() -> str:
+    return _read_notice_date('/app/cwa_update_notice')
+
 # Displays a notification to the user that an update for CWA is available, no matter which page they're on
 # Currently set to only display once per calender day
-def cwa_update_notification() -> None:
-    db = CWA_DB()
-    if db.cwa_settings['cwa_update_notifications']:
+def cwa_update_notification(cwa_settings=None) -> None:
+    if cwa_settings is None:
+        cwa_settings = CWA_DB().cwa_settings
+    if cwa_settings['cwa_update_notifications']:
         current_date = datetime.now().strftime("%Y-%m-%d")
         cwa_last_notification = get_cwa_last_notification()
         
@@ -158,8 +176,7 @@ def cwa_update_notification() -> None:
             flash(_(message), category="cwa_update")
             print(f"[cwa-update-notification-service] {message}", flush=True)
 
-        with open('/app/cwa_update_notice', 'w') as f:
-            f.write(current_date)
+        _write_notice_date('/app/cwa_update_notice', current_date)
         return
     else:
         return
@@ -170,11 +187,14 @@ def theme_migration_notification() -> None:
     current_date = datetime.now().strftime("%Y-%m-%d")
     
     # Check if notification already shown today
+    if _notice_dates.get(notice_file) == current_date:
+        return
     if os.path.isfile(notice_file):
         try:
             with open(notice_file, 'r') as f:
                 last_notification = f.read().strip()
                 if last_notification == current_date:
+                    _notice_dates[notice_file] = current_date
                     return
         except Exception:
             pass
@@ -185,44 +205,44 @@ def theme_migration_notification() -> None:
     
     # Mark as shown today
     try:
-        with open(notice_file, 'w') as f:
-            f.write(current_date)
+        _write_notice_date(notice_file, current_date)
     except Exception as e:
         print(f"[theme-migration-notification] Error writing notice file: {e}", flush=True)
 
 
+def missing_translations_count(lang: str) -> int:
+    count = _missing_translation_counts.get(lang)
+    if count is None:
+        po_path = f"cps/translations/{lang}/LC_MESSAGES/messages.po"
+        count = 0
+        if os.path.isfile(po_path):
+            try:
+                po = polib.pofile(po_path)
+                count = sum(1 for entry in po if not entry.msgstr.strip())
+            except Exception as e:
+                print(f"[translation-notification-service] Error reading {po_path}: {e}", flush=True)
+        _missing_translation_counts[lang] = count
+    return count
+
 # Checks if translations are missing for the current language
-def translations_missing_notification() -> None:
-    db = CWA_DB()
-    if db.cwa_settings['contribute_translations_notifications']:
+def translations_missing_notification(cwa_settings=None) -> None:
+    if cwa_settings is None:
+        cwa_settings = CWA_DB().cwa_settings
+    if cwa_settings['contribute_translations_notifications']:
         lang = str(get_locale())
         # Skip English as it is the default language
         if lang == 'en':
             return
-        po_path = f"cps/translations/{lang}/LC_MESSAGES/messages.po"
         current_date = datetime.now().strftime("%Y-%m-%d")
         notice_file = f"/app/cwa_translation_notice_{lang}"
-        missing_count = 0
-        if os.path.isfile(po_path):
-            try:
-                po = polib.pofile(po_path)
-                missing_count = sum(1 for entry in po if not entry.msgstr.strip())
-            except Exception as e:
-                print(f"[translation-notification-service] Error reading {po_path}: {e}", flush=True)
+        missing_count = missing_translations_count(lang)
         if missing_count > 0:
-            if not os.path.isfile(notice_file):
-                with open(notice_file, 'w') as f:
-                    f.write(current_date)
-                last_notification = "0001-01-01"
-            else:
-                with open(notice_file, 'r') as f:
-                    last_notification = f.read().strip()
+            last_notification = _read_notice_date(notice_file)
             if last_notification != current_date:
                 message = _(f"🌐 Help improve CWA's {constants.LANGUAGE_NAMES.get(lang, lang)} translations! {missing_count} strings in your language need translation. ")
                 flash(message, category="translation_missing")
                 print(f"[translation-notification-service] {message}", flush=True)
-                with open(notice_file, 'w') as f:
-                    f.write(current_date)
+                _write_notice_date(notice_file, current_date)
         return
     else:
         return
@@ -237,9 +257,16 @@ def render_title_template(*args, **kwargs):
         }
     except Exception:
         magic_shelf_routes = {"render": False, "create": False}
+    # One CWA_DB per render; its connection and parsed settings are shared per thread
+    try:
+        cwa_db = CWA_DB()
+        cwa_settings = cwa_db.cwa_settings
+    except Exception as e:
+        log.debug("Could not load CWA settings for page notifications: %s", str(e))
+        cwa_db, cwa_settings = None, None
     if current_user.role_admin():
         try:
-            cwa_update_notification()
+            cwa_update_notification(cwa_settings)
         except Exception as e:
             print(f"[cwa-update-notification-service] The following error occurred when checking for available updates:\n{e}", flush=True)
     # Notify users about theme migration (once per day)
@@ -249,7 +276,7 @@ def render_title_template(*args, **kwargs):
         print(f"[theme-migration-notification] Error showing theme migration notification: {e}", flush=True)
     # Notify any user if translations are missing for their language
     try:
-        translations_missing_notification()
+        translations_missing_notification(cwa_settings)
     except Exception as e:
         print(f"[translation-notification-service] The following error occurred when checking for missing translations:\n{e}", flush=True)
     duplicate_notification = {
@@ -260,42 +287,41 @@ def render_title_template(*args, **kwargs):
         "stale": False,
     }
     try:
-        if current_user.is_authenticated and (current_user.role_admin() or current_user.role_edit()):
-            cwa_db = CWA_DB()
-            detection_enabled = cwa_db.cwa_settings.get('duplicate_detection_enabled', 1)
-            notifications_enabled = bool(cwa_db.cwa_settings.get('duplicate_notifications_enabled', 1))
+        if cwa_db is not None and current_user.is_authenticated and (current_user.role_admin() or current_user.role_edit()):
+            detection_enabled = cwa_settings.get('duplicate_detection_enabled', 1)
+            notifications_enabled = bool(cwa_settings.get('duplicate_notifications_enabled', 1))
             if detection_enabled:
-                cache_data = cwa_db.get_duplicate_cache()
-                if cache_data and cache_data.get('duplicate_groups') is not None:
-                    duplicate_groups = cache_data.get('duplicate_groups') or []
+                summary = cwa_db.get_duplicate_summary()
+                if summary is not None:
+                    dismissed_hashes = set()
                     try:
                         dismissed_groups = ub.session.query(ub.DismissedDuplicateGroup.group_hash)\
                             .filter(ub.DismissedDuplicateGroup.user_id == current_user.id)\
                             .all()
                         dismissed_hashes = {row[0] for row in dismissed_groups}
-                        if dismissed_hashes:
-                            duplicate_groups = [
-                                group for group in duplicate_groups
-                                if group.get('group_hash') not in dismissed_hashes
-                            ]
                     except Exception:
                         pass
 
                     preview = []
-                    for group in duplicate_groups[:3]:
+                    for group in summary['groups']:
+                        if len(preview) == 3:
+                            break
+                        if group['group_hash'] in dismissed_hashes:
+                            continue
                         preview.append({
-                            'title': group.get('title', ''),
-                            'author': group.get('author', ''),
-                            'count': group.get('count', 0),
-                            'hash': group.get('group_hash', '')
+                            'title': group['title'],
+                            'author': group['author'],
+                            'count': group['count'],
+                            'hash': group['group_hash']
                         })
 
                     duplicate_notification = {
                         "enabled": notifications_enabled,
-                        "count": len(duplicate_groups),
+                        "count": sum(1 for group in summary['groups'] if group['group_hash'] not in dismissed_hashes)
+                                 if summary['hashes'] & dismissed_hashes else len(summary['groups']),
                         "preview": preview,
                         "cached": True,
-                        "stale": bool(cache_data.get('scan_pending')),
+                        "stale": summary['scan_pending'],
                     }
                 else:
                     duplicate_notification = {
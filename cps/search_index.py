@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-
+# Calibre-Web Automated – fork of Calibre-Web
+# Copyright (C) 2018-2026 Calibre-Web contributors
+# Copyright (C) 2024-2026 Calibre-Web Automated contributors
+# SPDX-License-Identifier: GPL-3.0-or-later
+# See CONTRIBUTORS for full list of authors.
+
+"""Full-text index for the simple search, the OPDS search feed and the books table.
+
+The plain search ORs `ilike('%term%')` over authors, tags, series, publishers, title and every
+text custom column through the Python lcase() function, i.e. a full scan of several link tables
+per search. This module keeps an FTS5 index of the same fields (plus comments) in a sidecar
+database next to app.db, so calibre's metadata.db is never written. Values are stored lower-cased
+and unidecoded like lcase() does, and the trigram tokenizer keeps the substring semantics of
+the ilike search.
+
+Authors get one row each in their own table, so all words of an author search have to match
+the same author like they do in the ilike search.
+
+The sidecar is attached to the calibre engine as `search_index`. Before a search, sync() polls
+PRAGMA data_version of metadata.db and, when something was committed since the last look,
+starts a background update that re-indexes the books whose last_modified changed or whose
+authors, series, tags, publishers or custom column values were renamed (renames don't touch
+books.last_modified) and drops deleted ones. Searches keep using the index while it is updated,
+each committed batch shows up as soon as it is done. The first build runs the same way and
+resumes where it stopped after a restart; only until it is done searches use the ilike query.
+"""
+
+import json
+import os
+import re
+import sqlite3
+import threading
+from pathlib import Path
+
+import unidecode
+
+from . import logger
+
+log = logger.create()
+
+SCHEMA_VERSION = "2"
+# The trigram tokenizer can't match anything shorter
+MIN_TERM_LENGTH = 3
+BATCH_SIZE = 500
+# Custom column rows use rowid = book id << CC_SHIFT | custom column id, author rows
+# book id << CC_SHIFT | position of the author
+CC_SHIFT = 16
+# bm25 weights for title, series, tags, publishers, comments, and for the authors table
+RANK_WEIGHTS = "10.0, 3.0, 2.0, 1.0, 1.0"
+AUTHOR_WEIGHT = 5.0
+# (table, link table, link column) of the names indexed per book
+NAME_TABLES = (("authors", "books_authors_link", "author"), ("series", "books_series_link", "series"),
+               ("tags", "books_tags_link", "tag"), ("publishers", "books_publishers_link", "publisher"))
+TEXT_CC_DATATYPES = ('text', 'enumeration', 'comments')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS index_meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS indexed_books (id INTEGER PRIMARY KEY, last_modified TEXT);
+CREATE TABLE IF NOT EXISTS indexed_names (kind TEXT, id INTEGER, name TEXT, PRIMARY KEY (kind, id));
+CREATE VIRTUAL TABLE IF NOT EXISTS books_fts USING fts5(
+    title, series, tags, publishers, comments, tokenize='trigram');
+CREATE VIRTUAL TABLE IF NOT EXISTS authors_fts USING fts5(value, tokenize='trigram');
+CREATE VIRTUAL TABLE IF NOT EXISTS custom_fts USING fts5(value, tokenize='trigram');
+"""
+
+
+class _SearchIndex:
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.con = None
+        self.path = None
+        self.ready = False
+        self.building = False  # a build or update is running in the background
+        self.generation = 0  # bumped by configure() so a running build stops
+        self.data_version = None
+        self.custom_columns = ()  # (id, normalized) of the indexed text custom columns
+
+
+_index = _SearchIndex()
+
+
+def normalize(value):
+    """Same normalisation as db.lcase(): lower-cased and transliterated to ASCII."""
+    if not value:
+        return ""
+    try:
+        return unidecode.unidecode(value.lower())
+    except Exception:
+        return value.lower()
+
+
+def index_path(app_db_path):
+    return os.path.join(os.path.dirname(app_db_path), "search_index.db")
+
+
+def _phrase(value):
+    return '"' + value.replace('"', '""') + '"'
+
+
+def match_expressions(term):
+    """FTS5 queries answering `term` the way the ilike search does, or None if the index can't.
+
+    Returns (fields, authors, short_author_words): `fields` matches the whole term in any column
+    of books_fts, `authors` requires every author word of at least MIN_TERM_LENGTH characters in
+    one row of authors_fts (None if there is none), and the shorter author words are left for
+    the caller to check with ilike.
+    """
+    normalized = normalize(term.strip())
+    if len(normalized) < MIN_TERM_LENGTH:
+        return None
+    fields = "{title series tags publishers comments} : " + _phrase(normalized)
+    words = [word for word in re.split("[, ]+", normalized) if word]
+    long_words = [word for word in words if len(word) >= MIN_TERM_LENGTH]
+    short_words = [word for word in words if len(word) < MIN_TERM_LENGTH]
+    authors = " AND ".join(_phrase(word) for word in long_words) or None
+    return fields, authors, short_words
+
+
+def custom_match(term):
+    return _phrase(normalize(term.strip()))
+
+
+def _meta(con, key):
+    row = con.execute("SELECT value FROM index_meta WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else None
+
+
+def _set_meta(con, key, value):
+    con.execute("INSERT OR REPLACE INTO index_meta (key, value) VALUES (?, ?)", (key, value))
+
+
+def _reset(con):
+    con.executescript("""
+        DROP TABLE IF EXISTS index_meta;
+        DROP TABLE IF EXISTS indexed_books;
+        DROP TABLE IF EXISTS indexed_names;
+        DROP TABLE IF EXISTS books_fts;
+        DROP TABLE IF EXISTS authors_fts;
+        DROP TABLE IF EXISTS custom_fts;
+    """)
+    con.executescript(_SCHEMA)
+
+
+def configure(metadata_db, path):
+    """(Re)open the index for the library at metadata_db; returns the path to attach, or None.
+
+    An index built for another library, schema or set of custom columns is thrown away and
+    rebuilt in the background.
+    """
+    with _index.lock:
+        _index.generation += 1
+        if _index.con is not None:
+            try:
+                _index.con.close()
+            except sqlite3.Error:
+                pass
+        _index.con = None
+        _index.ready = False
+        _index.data_version = None
+        try:
+            con = sqlite3.connect(Path(path).as_uri(), uri=True, timeout=30, check_same_thread=False)
+            con.execute("ATTACH DATABASE ? AS calibre", (Path(metadata_db).as_uri() + "?mode=ro",))
+            if os.getenv('NETWORK_SHARE_MODE', 'False').lower() not in ('1', 'true', 'yes', 'on'):
+                con.execute("PRAGMA main.journal_mode=WAL")
+            con.executescript(_SCHEMA)
+
+            library = "{}|{}".format(os.path.realpath(metadata_db),
+                                     (con.execute("SELECT uuid FROM calibre.library_id").fetchone() or [""])[0])
+            custom_columns = tuple(con.execute(
+                "SELECT id, normalized FROM calibre.custom_columns WHERE datatype IN ({}) ORDER BY id"
+                .format(",".join("?" * len(TEXT_CC_DATATYPES))), TEXT_CC_DATATYPES).fetchall())
+            signature = json.dumps([SCHEMA_VERSION, library, custom_columns])
+            if _meta(con, "signature") != signature:
+                if _meta(con, "signature") is not None:
+                    log.info("Search index doesn't match the library anymore, rebuilding it")
+                _reset(con)
+                _set_meta(con, "signature", signature)
+            con.commit()
+        except sqlite3.Error as ex:
+            log.warning("Full-text search index unavailable, using the plain search: %s", ex)
+            return None
+        _index.con = con
+        _index.path = path
+        _index.custom_columns = custom_columns
+        _index.ready = _meta(con, "built") == "1"
+    return path
+
+
+def _joined(con, sql, book_ids):
+    """{book id: newline separated values} for a query selecting (book, value) rows."""
+    values = {}
+    for book, value in con.execute(sql.format(",".join("?" * len(book_ids))), book_ids):
+        if value:
+            values.setdefault(book, []).append(value)
+    return {book: normalize("\n".join(items)) for book, items in values.items()}
+
+
+def _index_books(con, book_ids, custom_columns):
+    placeholders = ",".join("?" * len(book_ids))
+    books = con.execute("SELECT id, title, last_modified FROM calibre.books WHERE id IN ({})".format(placeholders),
+                        book_ids).fetchall()
+    authors = {}
+    for book, name in con.execute("SELECT l.book, a.name FROM calibre.books_authors_link l "
+                                  "JOIN calibre.authors a ON a.id = l.author WHERE l.book IN ({}) ORDER BY l.id"
+                                  .format(placeholders), book_ids):
+        if name:
+            authors.setdefault(book, []).append(normalize(name))
+    series = _joined(con, "SELECT l.book, s.name FROM calibre.books_series_link l "
+                          "JOIN calibre.series s ON s.id = l.series WHERE l.book IN ({})", book_ids)
+    tags = _joined(con, "SELECT l.book, t.name FROM calibre.books_tags_link l "
+                        "JOIN calibre.tags t ON t.id = l.tag WHERE l.book IN ({})", book_ids)
+    publishers = _joined(con, "SELECT l.book, p.name FROM calibre.books_publishers_link l "
+                              "JOIN calibre.publishers p ON p.id = l.publisher WHERE l.book IN ({})", book_ids)
+    comments = _joined(con, "SELECT book, text FROM calibre.comments WHERE book IN ({})", book_ids)
+
+    _remove_books(con, book_ids)
+    con.executemany(
+        "INSERT INTO books_fts (rowid, title, series, tags, publishers, comments) VALUES (?, ?, ?, ?, ?, ?)",
+        [(book_id, normalize(title), series.get(book_id, ""), tags.get(book_id, ""),
+          publishers.get(book_id, ""), comments.get(book_id, "")) for book_id, title, __ in books])
+    con.executemany("INSERT INTO authors_fts (rowid, value) VALUES (?, ?)",
+                    [((book_id << CC_SHIFT) | position, name)
+                     for book_id, names in authors.items() for position, name in enumerate(names)])
+    con.executemany("INSERT INTO indexed_books (id, last_modified) VALUES (?, ?)",
+                    [(book_id, last_modified) for book_id, __, last_modified in books])
+
+    for cc_id, normalized in custom_columns:
+        if normalized:
+            sql = ("SELECT l.book, c.value FROM calibre.books_custom_column_{0}_link l "
+                   "JOIN calibre.custom_column_{0} c ON c.id = l.value WHERE l.book IN ({{}})").format(int(cc_id))
+        else:
+            sql = "SELECT book, value FROM calibre.custom_column_{0} WHERE book IN ({{}})".format(int(cc_id))
+        con.executemany("INSERT INTO custom_fts (rowid, value) VALUES (?, ?)",
+                        [((book_id << CC_SHIFT) | cc_id, value)
+                         for book_id, value in _joined(con, sql, book_ids).items()])
+
+
+def _remove_books(con, book_ids):
+    con.executemany("DELETE FROM books_fts WHERE rowid = ?", [(book_id,) for book_id in book_ids])
+    ranges = [(book_id << CC_SHIFT, ((book_id + 1) << CC_SHIFT) - 1) for book_id in book_ids]
+    con.executemany("DELETE FROM authors_fts WHERE rowid BETWEEN ? AND ?", ranges)
+    con.executemany("DELETE FROM custom_fts WHERE rowid BETWEEN ? AND ?", ranges)
+    con.executemany("DELETE FROM indexed_books WHERE id = ?", [(book_id,) for book_id in book_ids])
+
+
+def _name_sources(custom_columns):
+    """(kind, table, name column, link table, link column) of the names indexed with each book."""
+    sources = [(table, table, "name", link, column) for table, link, column in NAME_TABLES]
+    for cc_id, normalized in custom_columns:
+        if normalized:
+            table = "custom_column_{}".format(int(cc_id))
+            sources.append((table, table, "value", "books_{}_link".format(table), "value"))
+    return sources
+
+
+def _mark_renamed(con, custom_columns):
+    """Queue the books using a renamed author, series, tag, publisher or custom column value for
+    re-indexing, since a rename doesn't touch their last_modified, and remember the current names.
+    """
+    renamed = set()
+    for kind, table, name, link, column in _name_sources(custom_columns):
+        renamed.update(row[0] for row in con.execute(
+            "SELECT l.book FROM calibre.{table} t JOIN indexed_names n ON n.kind = ? AND n.id = t.id "
+            "JOIN calibre.{link} l ON l.{column} = t.id WHERE n.name IS NOT t.{name}"
+            .format(table=table, name=name, link=link, column=column), (kind,)))
+        con.execute("INSERT OR REPLACE INTO indexed_names (kind, id, name) SELECT ?, t.id, t.{name} "
+                    "FROM calibre.{table} t LEFT JOIN indexed_names n ON n.kind = ? AND n.id = t.id "
+                    "WHERE n.name IS NOT t.{name}".format(table=table, name=name), (kind, kind))
+        con.execute("DELETE FROM indexed_names WHERE kind = ? AND id NOT IN (SELECT id FROM calibre.{})"
+                    .format(table), (kind,))
+    con.executemany("UPDATE indexed_books SET last_modified = NULL WHERE id = ?", [(book,) for book in renamed])
+
+
+def update(generation=None):
+    """Index new, changed and renamed books and drop deleted ones, one committed batch at a time.
+
+    Returns False if configure() was called in the meantime (the caller's generation is stale).
+    """
+    with _index.lock:
+        con = _index.con
+        if con is None or (generation is not None and generation != _index.generation):
+            return False
+        try:
+            _mark_renamed(con, _index.custom_columns)
+            deleted = [row[0] for row in con.execute(
+                "SELECT id FROM indexed_books WHERE id NOT IN (SELECT id FROM calibre.books)")]
+            _remove_books(con, deleted)
+            con.commit()
+        except sqlite3.Error:
+            con.rollback()
+            raise
+        changed = [row[0] for row in con.execute(
+            "SELECT b.id FROM calibre.books b LEFT JOIN indexed_books i ON i.id = b.id "
+            "WHERE i.id IS NULL OR i.last_modified IS NOT b.last_modified")]
+    # Batches take the lock one at a time so configure() isn't held up by a long build
+    for start in range(0, len(changed), BATCH_SIZE):
+        with _index.lock:
+            if _index.con is not con or (generation is not None and generation != _index.generation):
+                return False
+            try:
+                _index_books(con, changed[start:start + BATCH_SIZE], _index.custom_columns)
+                con.commit()
+            except sqlite3.Error:
+                con.rollback()
+                raise
+    if changed or deleted:
+        log.debug("Search index updated: %d book(s) indexed, %d removed", len(changed), len(deleted))
+    return True
+
+
+def _refresh(generation):
+    """Background build or update of the index up to the data_version seen when it starts."""
+    try:
+        with _index.lock:
+            if generation != _index.generation:
+                return
+            data_version = _index.con.execute("PRAGMA calibre.data_version").fetchone()[0]
+            building = not _index.ready
+        if building:
+            log.info("Building full-text search index")
+        if not update(generation):
+            return
+        with _index.lock:
+            if generation != _index.generation:
+                return
+            if building:
+                _set_meta(_index.con, "built", "1")
+                _index.con.commit()
+                _index.ready = True
+                log.info("Full-text search index is ready")
+            _index.data_version = data_version
+    except sqlite3.Error as ex:
+        log.error("Updating the full-text search index failed: %s", ex)
+    finally:
+        with _index.lock:
+            _index.building = False
+
+
+def sync():
+    """True when searches can use the index; starts a background update if metadata.db changed.
+
+    The update never runs in the caller's thread. Once the index has been built, searches keep
+    using it while an update runs; before that they use the ilike query.
+    """
+    if _index.building:
+        return _index.ready
+    with _index.lock:
+        if _index.con is None:
+            return False
+        if _index.building:
+            return _index.ready
+        if _index.ready:
+            try:
+                if _index.con.execute("PRAGMA calibre.data_version").fetchone()[0] == _index.data_version:
+                    return True
+            except sqlite3.Error as ex:
+                log.warning("Could not check the full-text search index: %s", ex)
+                return False
+        _index.building = True
+        threading.Thread(target=_refresh, args=(_index.generation,), name="search-index-update",
+                         daemon=True).start()
+        return _index.ready
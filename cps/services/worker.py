@@ -5,17 +5,21 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 # See CONTRIBUTORS for full list of authors.
 
+import os
 import threading
 import abc
 import uuid
 import time
+import multiprocessing
 
 try:
     import queue
 except ImportError:
     import Queue as queue
 from datetime import datetime
-from collections import namedtuple
+from collections import namedtuple, deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
 
 from cps import logger
 
@@ -32,6 +36,39 @@ STAT_CANCELLED = 5
 # Only retain this many tasks in dequeued list
 TASK_CLEANUP_TRIGGER = 20
 
+# Task lanes; every lane has its own queue and threads so a long library-wide job only
+# ever holds up tasks of its own kind
+LANE_IO = 'io'
+LANE_CPU = 'cpu'
+LANE_THUMBNAIL = 'thumbnail'
+LANE_MAIL = 'mail'
+LANE_MAINTENANCE = 'maintenance'
+
+
+def _env_int(name, default, minimum=1):
+    try:
+        return max(minimum, int(os.environ.get(name, default)))
+    except (TypeError, ValueError):
+        return default
+
+
+# Number of tasks each lane runs at the same time. The thumbnail lane always runs one task at a
+# time: generating and clearing thumbnails write and delete the same files and app.db rows
+LANE_LIMITS = {
+    LANE_IO: _env_int('CWA_TASK_LANE_IO', 2),
+    LANE_CPU: _env_int('CWA_TASK_LANE_CPU', 1),
+    LANE_THUMBNAIL: 1,
+    LANE_MAIL: _env_int('CWA_TASK_LANE_MAIL', 1),
+    LANE_MAINTENANCE: _env_int('CWA_TASK_LANE_MAINTENANCE', 1),
+}
+# Worker processes CPU-bound tasks can hand picklable work to; 0 keeps that work in-process
+TASK_PROCESS_WORKERS = _env_int('CWA_TASK_PROCESS_WORKERS', 0, minimum=0)
+# Start delays remembered per lane for the average wait time
+LANE_WAIT_SAMPLES = 50
+# Seconds a queued exclusive task holds back new tasks of all lanes; after that they start again
+# and the exclusive task runs as soon as nothing else is running
+EXCLUSIVE_PRIORITY_SECONDS = _env_int('CWA_TASK_EXCLUSIVE_PRIORITY', 60, minimum=0)
+
 QueuedTask = namedtuple('QueuedTask', 'num, user, added, task, hidden')
 
 
@@ -52,46 +89,172 @@ class ImprovedQueue(queue.Queue):
             return list(self.queue)
 
 
-# Class for all worker tasks in the background
-class WorkerThread(threading.Thread):
+class TaskLane:
+    """Queue of one kind of task plus the bookkeeping needed to report its depth and wait times"""
+
+    def __init__(self, name, workers):
+        self.name = name
+        self.workers = workers
+        self.queue = ImprovedQueue()
+        self.running = 0
+        self.waits = deque(maxlen=LANE_WAIT_SAMPLES)
+        self.lock = threading.Lock()
+
+    def started(self, item):
+        with self.lock:
+            self.running += 1
+            self.waits.append((datetime.now() - item.added).total_seconds())
+
+    def finished(self):
+        with self.lock:
+            self.running -= 1
+
+    def stats(self):
+        queued = [item for item in self.queue.to_list() if item.task.stat == STAT_WAITING]
+        now = datetime.now()
+        with self.lock:
+            waits = list(self.waits)
+            running = self.running
+        return {
+            'lane': self.name,
+            'workers': self.workers,
+            'running': running,
+            'queued': len(queued),
+            'oldest_wait': max(((now - item.added).total_seconds() for item in queued), default=0),
+            'average_wait': sum(waits) / len(waits) if waits else 0,
+        }
+
+
+class TaskGate:
+    """Lets tasks of all lanes run side by side, except exclusive ones which run on their own
+
+    An exclusive task is announced when it is queued. From then on, for up to priority_seconds,
+    no other task starts, so it isn't starved by busy lanes. It waits for the tasks already
+    running to finish. A task that runs for hours (e.g. a thumbnail rebuild) would stall every
+    lane for that long, so after priority_seconds new tasks start again and the exclusive task
+    runs at the next moment nothing else is running.
+    """
+
+    def __init__(self, priority_seconds=EXCLUSIVE_PRIORITY_SECONDS):
+        self.condition = threading.Condition()
+        self.priority_seconds = priority_seconds
+        self.running = 0
+        self.announced = {}  # token of every queued exclusive task -> time.monotonic(), oldest first
+        self.exclusive_running = False
+
+    def announce(self, token):
+        """Called when an exclusive task is queued, before any task queued after it can start"""
+        with self.condition:
+            self.announced[token] = time.monotonic()
+
+    def withdraw(self, token):
+        """Called for an announced exclusive task that won't run, e.g. because it was cancelled"""
+        with self.condition:
+            self.announced.pop(token, None)
+            self.condition.notify_all()
+
+    def _priority_left(self):
+        """Seconds new tasks still have to wait for the oldest announced exclusive task"""
+        if not self.announced:
+            return 0
+        return self.priority_seconds - (time.monotonic() - next(iter(self.announced.values())))
+
+    @contextmanager
+    def hold(self, exclusive=False, token=None):
+        """Runs a task under the gate; an exclusive task passes the token it was announced with"""
+        with self.condition:
+            if exclusive:
+                self.condition.wait_for(lambda: not self.exclusive_running and self.running == 0)
+                self.announced.pop(token, None)
+                self.exclusive_running = True
+            else:
+                while self.exclusive_running or self._priority_left() > 0:
+                    self.condition.wait(None if self.exclusive_running else self._priority_left())
+                self.running += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                if exclusive:
+                    self.exclusive_running = False
+                else:
+                    self.running -= 1
+                self.condition.notify_all()
+
+
+# Runs all worker tasks in the background, one set of threads per lane
+class WorkerThread(object):
     _instance = None
+    _instance_lock = threading.Lock()
 
     @classmethod
     def get_instance(cls):
-        if cls._instance is None:
-            cls._instance = WorkerThread()
-        return cls._instance
-
-    def __init__(self):
-        threading.Thread.__init__(self)
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = WorkerThread()
+            return cls._instance
 
+    def __init__(self, lane_limits=None):
         self.dequeued = list()
 
         self.doLock = threading.Lock()
-        self.queue = ImprovedQueue()
         self.num = 0
-        self.start()
+        self._process_pool = None
+        self.gate = TaskGate()
+        self.lanes = {name: TaskLane(name, workers) for name, workers in (lane_limits or LANE_LIMITS).items()}
+        for lane in self.lanes.values():
+            for index in range(lane.workers):
+                threading.Thread(target=self.run, args=(lane,), name="task-{}-{}".format(lane.name, index + 1)).start()
+
+    def lane_for(self, task):
+        return self.lanes.get(getattr(task, 'lane', LANE_IO)) or self.lanes[LANE_IO]
 
     @classmethod
     def add(cls, user, task, hidden=False):
         ins = cls.get_instance()
-        ins.num += 1
         username = user if user is not None else 'System'
-        log.debug("Add Task for user: {} - {}".format(username, task))
-        ins.queue.put(QueuedTask(
-            num=ins.num,
-            user=username,
-            added=datetime.now(),
-            task=task,
-            hidden=hidden
-        ))
+        lane = ins.lane_for(task)
+        log.debug("Add Task for user: {} - {} ({} lane)".format(username, task, lane.name))
+        with ins.doLock:
+            ins.num += 1
+            # Announced before it is queued, so no task queued after it can start first
+            if getattr(task, 'exclusive', False):
+                ins.gate.announce(task.id)
+            lane.queue.put(QueuedTask(
+                num=ins.num,
+                user=username,
+                added=datetime.now(),
+                task=task,
+                hidden=hidden
+            ))
+
+    def _queued(self):
+        queued = []
+        for lane in self.lanes.values():
+            queued.extend(lane.queue.to_list())
+        return queued
 
     @property
     def tasks(self):
         with self.doLock:
-            tasks = self.queue.to_list() + self.dequeued
+            tasks = self._queued() + self.dequeued
             return sorted(tasks, key=lambda x: x.num)
 
+    def lane_stats(self):
+        """Queue depth, running count and wait times of every lane"""
+        return [lane.stats() for lane in self.lanes.values()]
+
+    def process_pool(self):
+        """Shared pool of worker processes for CPU-bound functions, or None if disabled"""
+        if not TASK_PROCESS_WORKERS:
+            return None
+        with self.doLock:
+            if self._process_pool is None:
+                # spawn, as forking a process that runs the web server threads is not safe
+                self._process_pool = ProcessPoolExecutor(max_workers=TASK_PROCESS_WORKERS,
+                                                         mp_context=multiprocessing.get_context('spawn'))
+            return self._process_pool
+
     def cleanup_tasks(self):
         with self.doLock:
             dead = []
@@ -109,8 +272,8 @@ class WorkerThread(threading.Thread):
 
             self.dequeued = sorted(ret, key=lambda y: y.num)
 
-    # Main thread loop starting the different tasks
-    def run(self):
+    # Lane thread loop starting the different tasks
+    def run(self, lane):
         main_thread = _get_main_thread()
         while main_thread.is_alive():
             try:
@@ -119,9 +282,8 @@ class WorkerThread(threading.Thread):
                 # the main thread is still alive.
                 # We don't use a daemon here because we don't want the tasks to just be abruptly halted, leading to
                 # possible file / database corruption
-                item = self.queue.get(timeout=1)
+                item = lane.queue.get(timeout=1)
             except queue.Empty:
-                time.sleep(1)
                 continue
 
             with self.doLock:
@@ -133,15 +295,30 @@ class WorkerThread(threading.Thread):
                 self.cleanup_tasks()
 
             # sometimes tasks (like Upload) don't actually have work to do and are created as already finished
-            if item.task.stat is STAT_WAITING:
-                # CalibreTask.start() should wrap all exceptions in its own error handling
-                item.task.start(self)
+            if item.task.stat is not STAT_WAITING:
+                if getattr(item.task, 'exclusive', False):
+                    self.gate.withdraw(item.task.id)
+            else:
+                with self.gate.hold(getattr(item.task, 'exclusive', False), item.task.id):
+                    # The task may have been cancelled while waiting for an exclusive task
+                    if item.task.stat is STAT_WAITING:
+                        lane.started(item)
+                        try:
+                            # CalibreTask.start() should wrap all exceptions in its own error handling
+                            item.task.start(self)
+                        finally:
+                            lane.finished()
 
             # remove self_cleanup tasks and hidden "System Tasks" from list
             if item.task.self_cleanup or item.hidden:
-                self.dequeued.remove(item)
+                with self.doLock:
+                    if item in self.dequeued:
+                        self.dequeued.remove(item)
+
+            lane.queue.task_done()
 
-            self.queue.task_done()
+        if self._process_pool is not None:
+            self._process_pool.shutdown(wait=False)
 
     def end_task(self, task_id):
         ins = self.get_instance()
@@ -163,8 +340,8 @@ class WorkerThread(threading.Thread):
         
         try:
             with ins.doLock:
-                # Access queue and dequeued directly to avoid recursive lock from .tasks property
-                tasks_snapshot = list(ins.queue.to_list() + ins.dequeued)
+                # Access the lane queues and dequeued directly to avoid recursive lock from .tasks property
+                tasks_snapshot = list(ins._queued() + ins.dequeued)
         except Exception as e:
             log.warning("[worker] Could not get tasks snapshot: %s", str(e))
             return 0
@@ -199,6 +376,11 @@ class WorkerThread(threading.Thread):
 class CalibreTask:
     __metaclass__ = abc.ABCMeta
 
+    # Lane of the WorkerThread the task is queued on
+    lane = LANE_IO
+    # Exclusive tasks run only while no task of any lane is running, see TaskGate
+    exclusive = False
+
     def __init__(self, message):
         self._progress = 0
         self.stat = STAT_WAITING
@@ -63,6 +63,9 @@ var imageFiles = [];
 var imageFilenames = [];
 var totalImages = 0;
 var prevScrollPosition = 0;
+// true when pages are fetched one by one from the server instead of unpacking the whole archive
+var serverPages = false;
+var pageLoaded = [];
 
 var settings = {
     hflip: false,
@@ -260,6 +263,56 @@ function loadFromArrayBuffer(ab) {
     });
 }
 
+function loadFromPageIndex(pages) {
+    serverPages = true;
+    totalImages = pages.length;
+    if (currentImage >= totalImages) {
+        currentImage = 0;
+    }
+    pages.forEach(function(page) {
+        imageFilenames.push(page.name);
+        imageFiles.push({filename: page.name, dataURI: page.url});
+        pageLoaded.push(false);
+        // thumbnails are only fetched once the TOC is opened and scrolled to them
+        $("#thumbnails").append(
+            "<li>" +
+            "<a data-page='" + imageFiles.length + "'>" +
+            "<img loading='lazy' src='" + page.url + "'/>" +
+            "<span>" + imageFiles.length + "</span>" +
+            "</a>" +
+            "</li>"
+        );
+        drawCanvas();
+    });
+    updateProgress(100);
+    updateDirectionButtons();
+    updatePage();
+}
+
+function loadServerPage(index) {
+    if (index < 0 || index >= imageFiles.length || pageLoaded[index]) {
+        return;
+    }
+    pageLoaded[index] = true;
+    setImage(imageFiles[index].dataURI, $(".mainImage")[index]);
+}
+
+// Single page mode only needs the visible page and its neighbours, the long strip needs all of them
+function loadServerPages() {
+    if (!serverPages) {
+        return;
+    }
+    if (settings.pageDisplay === 0) {
+        for (var i = currentImage - 1; i <= currentImage + 2; i++) {
+            loadServerPage(i);
+        }
+    } else {
+        for (var j = 0; j < imageFiles.length; j++) {
+            loadServerPage(j);
+        }
+    }
+}
+
 function scrollTocToActive() {
     $(".page").text((currentImage + 1 ) + "/" + totalImages);
 
@@ -279,6 +332,7 @@ function scrollTocToActive() {
 }
 
 function updatePage() {
+    loadServerPages();
     scrollTocToActive();
     scrollCurrentImageIntoView();
     updateProgress();
@@ -423,6 +477,9 @@ function setImage(url, _canvas) {
 // reloadImages is a slow process when multiple images are involved. Only used when rotating/mirroring
 function reloadImages() {
     for(i=0; i < imageFiles.length; i++) {
+        if (serverPages && !pageLoaded[i]) {
+            continue;
+        }
         setImage(imageFiles[i].dataURI, $(".mainImage")[i]);
     }
 }
@@ -659,7 +716,7 @@ function updateArrows() {
     }
 };
 
-function init(filename) {
+function init(filename, pagesUrl) {
     var request = new XMLHttpRequest();
     request.open("GET", filename);
     request.responseType = "arraybuffer";
@@ -673,7 +730,19 @@ function init(filename) {
     kthoom.loadSettings();
     setTheme();
     updateScale();
-    request.send();
+    if (pagesUrl) {
+        $.getJSON(pagesUrl).done(function (data) {
+            if (data.pages && data.pages.length) {
+                loadFromPageIndex(data.pages);
+            } else {
+                request.send();
+            }
+        }).fail(function () {
+            request.send();
+        });
+    } else {
+        request.send();
+    }
     initProgressClick();
     document.body.className += /AppleWebKit/.test(navigator.userAgent) ? " webkit" : "";
 
@@ -44,6 +44,17 @@ $(function() {
             });
         }, 1000);
     }
+    if ($('#lanetable').length) {
+        $('#lanetable').bootstrapTable({
+            formatNoMatches: function () {
+                return '';
+            },
+            striped: true
+        });
+        setInterval(function () {
+            $('#lanetable').bootstrapTable('refresh', {silent: true});
+        }, 5000);
+    }
     if ($('#upcomingtable').length) {
         $('#upcomingtable').bootstrapTable({
             formatNoMatches: function () {
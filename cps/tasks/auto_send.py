@@ -9,13 +9,15 @@ from datetime import datetime
 
 from flask_babel import lazy_gettext as N_
 
-from cps.services.worker import CalibreTask, STAT_FINISH_SUCCESS
+from cps.services.worker import CalibreTask, STAT_FINISH_SUCCESS, LANE_MAIL
 from cps import helper, ub, db, calibre_db, config, logger
 
 log = logger.create()
 
 
 class TaskAutoSend(CalibreTask):
+    lane = LANE_MAIL
+
     def __init__(self, task_message, book_id, user_id, delay_minutes=5):
         super(TaskAutoSend, self).__init__(task_message)
         self.start_time = self.end_time = datetime.now()
@@ -8,10 +8,16 @@
 from flask_babel import lazy_gettext as N_
 
 from cps import config, logger, db, ub, calibre_db
-from cps.services.worker import CalibreTask
+from cps.services.worker import CalibreTask, LANE_MAINTENANCE
 
 
 class TaskReconnectDatabase(CalibreTask):
+    lane = LANE_MAINTENANCE
+    # Disposing the engine under a task of another lane would break its queries mid-flight. While
+    # queued it holds back new tasks of all lanes only for CWA_TASK_EXCLUSIVE_PRIORITY seconds, so
+    # behind a long-running task (e.g. a thumbnail rebuild) it may wait until that one is done
+    exclusive = True
+
     def __init__(self, task_message=N_('Reconnecting Calibre database')):
         super(TaskReconnectDatabase, self).__init__(task_message)
         self.log = logger.create()
@@ -32,6 +38,8 @@ class TaskReconnectDatabase(CalibreTask):
 
 
 class TaskCleanArchivedBooks(CalibreTask):
+    lane = LANE_MAINTENANCE
+
     def __init__(self, task_message=N_('Clean archived book references')):
         super(TaskCleanArchivedBooks, self).__init__(task_message)
         self.log = logger.create()
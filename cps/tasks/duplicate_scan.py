@@ -11,8 +11,8 @@ from sqlalchemy import func
 from flask_babel import lazy_gettext as N_
 
 from cps import calibre_db, db, logger
-from cps.duplicates import find_duplicate_books_python, find_duplicate_candidate_ids_sql
-from cps.services.worker import CalibreTask, STAT_CANCELLED, STAT_ENDED
+from cps.duplicates import find_duplicate_books_python, refresh_duplicate_keys
+from cps.services.worker import CalibreTask, STAT_CANCELLED, STAT_ENDED, LANE_MAINTENANCE
 from cps.ub import init_db_thread
 
 # Access CWA DB (scripts path)
@@ -24,6 +24,8 @@ log = logger.create()
 
 
 class TaskDuplicateScan(CalibreTask):
+    lane = LANE_MAINTENANCE
+
     def __init__(self, full_scan=True, task_message=None, trigger_type='manual', user_id=None):
         super(TaskDuplicateScan, self).__init__(task_message or N_('Duplicate scan'))
         self.full_scan = full_scan
@@ -105,12 +107,19 @@ class TaskDuplicateScan(CalibreTask):
                 use_format = settings.get('duplicate_detection_format', 0)
 
                 last_scanned_book_id = int(cache_data.get('last_scanned_book_id') or 0)
-                candidate_ids = find_duplicate_candidate_ids_sql(use_title, use_author, user_id=self.user_id,
-                                                                min_book_id=last_scanned_book_id)
+                # Re-key only books added, edited or deleted since the last scan
+                refresh = refresh_duplicate_keys(use_title, use_author, use_language, use_series, use_publisher,
+                                                 use_format, cwa_db=cwa_db)
+                changed_ids = set()
+                if refresh is None or refresh['reset']:
+                    candidate_ids = None
+                else:
+                    changed_ids = refresh['changed'] | refresh['deleted']
+                    candidate_ids = cwa_db.get_duplicate_key_candidates(refresh['affected_keys']) if changed_ids else set()
 
                 if candidate_ids is None:
-                    log.warning("[cwa-duplicates] Incremental scan prefilter unavailable; falling back to full scan")
-                    print("[cwa-duplicates] Incremental scan prefilter unavailable; falling back to full scan", flush=True)
+                    log.warning("[cwa-duplicates] Duplicate key index unavailable or criteria changed; falling back to full scan")
+                    print("[cwa-duplicates] Duplicate key index unavailable or criteria changed; falling back to full scan", flush=True)
 
                     duplicate_groups = find_duplicate_books(include_dismissed=False, user_id=self.user_id)
                     self.result_count = len(duplicate_groups)
@@ -217,10 +226,10 @@ class TaskDuplicateScan(CalibreTask):
                         print("[cwa-duplicates] No duplicates found, skipping auto-resolution", flush=True)
                     return
                 
-                log.debug("[cwa-duplicates] Incremental scan: last_scanned_book_id=%s, candidate_ids=%s",
-                         last_scanned_book_id, len(candidate_ids) if candidate_ids else 0)
+                log.debug("[cwa-duplicates] Incremental scan: last_scanned_book_id=%s, changed=%s, candidate_ids=%s",
+                         last_scanned_book_id, len(changed_ids), len(candidate_ids))
                 print(f"[cwa-duplicates] Incremental scan: last_scanned_book_id={last_scanned_book_id}, "
-                      f"candidates={len(candidate_ids) if candidate_ids else 0}", flush=True)
+                      f"changed={len(changed_ids)}, candidates={len(candidate_ids)}", flush=True)
 
                 max_book_id = 0
                 try:
@@ -229,8 +238,8 @@ class TaskDuplicateScan(CalibreTask):
                 except Exception as ex:
                     log.warning("[cwa-duplicates] Could not get max book ID in TaskDuplicateScan: %s", str(ex))
 
-                if not candidate_ids:
-                    # No impacted groups; just bump last_scanned_book_id
+                if not changed_ids:
+                    # Nothing changed since the last scan; just bump last_scanned_book_id
                     try:
                         cwa_db.cur.execute("""
                             UPDATE cwa_duplicate_cache
@@ -238,19 +247,20 @@ class TaskDuplicateScan(CalibreTask):
                             WHERE id = 1
                         """, (max_book_id, datetime.now().isoformat()))
                         cwa_db.con.commit()
-                        log.info("[cwa-duplicates] Incremental scan: no candidates; cache timestamp updated (last_scanned_book_id=%s)",
+                        CWA_DB.invalidate_duplicate_summary()
+                        log.info("[cwa-duplicates] Incremental scan: no changes; cache timestamp updated (last_scanned_book_id=%s)",
                                  max_book_id)
                     except Exception:
                         pass
                     self.result_count = 0
                 else:
-                    # Identify affected groups in cache
+                    # Identify affected groups in cache: groups a changed book left or joined
                     cached_groups = cache_data.get('duplicate_groups', [])
-                    candidate_set = set(candidate_ids)
+                    affected_ids = changed_ids | candidate_ids
                     affected_hashes = {
                         group.get('group_hash')
                         for group in cached_groups
-                        if group.get('book_ids') and candidate_set.intersection(set(group.get('book_ids')))
+                        if group.get('book_ids') and affected_ids.intersection(group.get('book_ids'))
                     }
 
                     # Recompute groups for candidate IDs (include dismissed for cache)
@@ -286,6 +296,7 @@ class TaskDuplicateScan(CalibreTask):
                             WHERE id = 1
                         """, (datetime.now().isoformat(), json.dumps(merged_groups), len(merged_groups), max_book_id))
                         cwa_db.con.commit()
+                        CWA_DB.invalidate_duplicate_summary()
                         log.info("[cwa-duplicates] Duplicate cache updated (incremental): merged_groups=%s max_book_id=%s",
                                  len(merged_groups), max_book_id)
                     except Exception as ex:
@@ -313,22 +324,6 @@ class TaskDuplicateScan(CalibreTask):
                 self.message = N_('Duplicate scan completed: %(count)s new groups', count=self.result_count)
             self._handleSuccess()
 
-            # Ensure cache is refreshed for after_import scans so notifications update reliably
-            try:
-                if self.trigger_type == 'after_import':
-                    all_groups = find_duplicate_books(include_dismissed=True, user_id=self.user_id)
-                    max_book_id = 0
-                    try:
-                        max_id_result = calibre_db.session.query(func.max(db.Books.id)).scalar()
-                        max_book_id = max_id_result if max_id_result is not None else 0
-                    except Exception as ex:
-                        log.warning("[cwa-duplicates] Could not get max book ID for after_import cache refresh: %s", str(ex))
-                    cwa_db.update_duplicate_cache(all_groups, len(all_groups), max_book_id)
-                    log.info("[cwa-duplicates] Cache refreshed after after_import scan: groups=%s max_book_id=%s",
-                             len(all_groups), max_book_id)
-            except Exception as ex:
-                log.warning("[cwa-duplicates] Failed to refresh cache after after_import scan: %s", str(ex))
-            
             # Check if auto-resolution is enabled
             log.debug("[cwa-duplicates] Scan complete. result_count=%s, trigger_type=%s", 
                      self.result_count, self.trigger_type)
@@ -9,13 +9,14 @@ import os
 from lxml import etree
 
 from cps import config, db, gdriveutils, logger
-from cps.services.worker import CalibreTask
+from cps.services.worker import CalibreTask, LANE_MAINTENANCE
 from flask_babel import lazy_gettext as N_
 
 from ..epub_helper import create_new_metadata_backup
 
 
 class TaskBackupMetadata(CalibreTask):
+    lane = LANE_MAINTENANCE
 
     def __init__(self, export_language="en",
                  translated_title="Cover",
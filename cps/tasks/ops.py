@@ -11,7 +11,7 @@ import re
 
 from flask_babel import lazy_gettext as N_
 
-from cps.services.worker import CalibreTask, STAT_CANCELLED, STAT_ENDED
+from cps.services.worker import CalibreTask, STAT_CANCELLED, STAT_ENDED, LANE_MAINTENANCE
 from cps import logger, helper
 
 log = logger.create()
@@ -23,6 +23,7 @@ class TaskConvertLibraryRun(CalibreTask):
     It triggers the existing web endpoint and then tails the log for completion,
     updating progress heuristically if counts are present in the log.
     """
+    lane = LANE_MAINTENANCE
 
     def __init__(self):
         super(TaskConvertLibraryRun, self).__init__(N_(u"Convert Library – full run"))
@@ -90,6 +91,7 @@ class TaskConvertLibraryRun(CalibreTask):
 
 class TaskEpubFixerRun(CalibreTask):
     """Lightweight wrapper to surface EPUB Fixer run in Tasks UI."""
+    lane = LANE_MAINTENANCE
 
     def __init__(self):
         super(TaskEpubFixerRun, self).__init__(N_(u"EPUB Fixer – full run"))
@@ -6,14 +6,14 @@
 # See CONTRIBUTORS for full list of authors.
 
 import os
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from shutil import copyfile, copyfileobj
 from urllib.request import urlopen
-from io import BytesIO
 from datetime import datetime, timezone
 
 from .. import constants
 from cps import config, db, fs, gdriveutils, logger, ub
-from cps.services.worker import CalibreTask, STAT_CANCELLED, STAT_ENDED
+from cps.services.worker import CalibreTask, STAT_CANCELLED, STAT_ENDED, LANE_THUMBNAIL
 from sqlalchemy import func, text, or_
 from flask_babel import lazy_gettext as N_
 try:
@@ -22,6 +22,14 @@ try:
 except (ImportError, RuntimeError) as e:
     use_IM = False
 
+THUMBNAIL_FORMATS = ('webp', 'jpg')
+# Covers rendered in parallel. This is a thread pool on purpose: Wand's calls into ImageMagick
+# release the GIL, so threads scale, while spawned worker processes would each re-import the web
+# app (cps) just to unpickle render_cover_thumbnails
+THUMBNAIL_WORKERS = max(1, int(os.environ.get("CWA_THUMBNAIL_WORKERS", min(4, os.cpu_count() or 1))))
+# Thumbnail rows are committed to app.db once per this many books
+THUMBNAIL_COMMIT_BATCH = 50
+
 
 def get_resize_height(resolution):
     return int(255 * resolution)
@@ -52,7 +60,56 @@ def get_best_fit(width, height, image_width, image_height):
     return {'width': resize_width, 'height': resize_height}
 
 
+def render_cover_thumbnails(source, targets):
+    """Decode a cover once and write all requested thumbnails from the in-memory image.
+
+    source is the path of the cover file or its content, targets a list of
+    (resolution, format, path). Every resolution is resized once from the decoded original and
+    then encoded in each of its formats. Files are replaced atomically, so a thumbnail being
+    served is never half written. Returns {(resolution, format): error} for failed targets.
+    """
+    by_resolution = {}
+    for resolution, fmt, path in targets:
+        by_resolution.setdefault(resolution, []).append((fmt, path))
+
+    errors = {}
+    try:
+        original = Image(blob=source) if isinstance(source, bytes) else Image(filename=source)
+    except Exception as ex:
+        return {(resolution, fmt): str(ex) for resolution, fmt, __ in targets}
+    with original:
+        for resolution, outputs in by_resolution.items():
+            try:
+                with original.clone() as img:
+                    height = get_resize_height(resolution)
+                    if img.height > height:
+                        width = get_resize_width(resolution, img.width, img.height)
+                        img.resize(width=width, height=height, filter='lanczos')
+                    for fmt, path in outputs:
+                        tmp_path = path + '.tmp'
+                        try:
+                            # Set format for thumbnail
+                            img.format = fmt
+                            try:
+                                img.compression_quality = 82
+                            except Exception:
+                                pass
+                            with open(tmp_path, 'wb') as f:
+                                img.save(file=f)
+                            os.replace(tmp_path, path)
+                        except Exception as ex:
+                            errors[(resolution, fmt)] = str(ex)
+                            if os.path.exists(tmp_path):
+                                os.remove(tmp_path)
+            except Exception as ex:
+                for fmt, __ in outputs:
+                    errors.setdefault((resolution, fmt), str(ex))
+    return errors
+
+
 class TaskGenerateCoverThumbnails(CalibreTask):
+    lane = LANE_THUMBNAIL
+
     def __init__(self, book_id=-1, task_message=''):
         super(TaskGenerateCoverThumbnails, self).__init__(task_message)
         self.log = logger.create()
@@ -72,27 +129,58 @@ class TaskGenerateCoverThumbnails(CalibreTask):
                 books_with_covers = self.get_books_with_covers(self.book_id)
                 count = len(books_with_covers)
 
+                # Covers are decoded/encoded by the pool; app.db is only touched from this thread
                 total_generated = 0
-                for i, book in enumerate(books_with_covers):
-
-                    # Generate new thumbnails for missing covers
-                    generated = self.create_book_cover_thumbnails(book)
+                done = 0
+                uncommitted = 0
+                remaining = iter(books_with_covers)
+                pending = {}
+                with ThreadPoolExecutor(max_workers=THUMBNAIL_WORKERS, thread_name_prefix='cover-thumbnails') as pool:
+                    while True:
+                        stopped = self.stat in (STAT_CANCELLED, STAT_ENDED)
+                        # Keep the pool busy without queueing the whole library
+                        while not stopped and len(pending) < THUMBNAIL_WORKERS * 2:
+                            book = next(remaining, None)
+                            if book is None:
+                                break
+                            job = self.prepare_book_cover_thumbnails(book)
+                            if job is None:
+                                done += 1
+                                continue
+                            pending[pool.submit(render_cover_thumbnails, job['source'], job['targets'])] = (book, job)
+                        if stopped:
+                            for future in pending:
+                                future.cancel()
+                        if not pending:
+                            break
+
+                        finished, __ = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in finished:
+                            book, job = pending.pop(future)
+                            if future.cancelled():
+                                continue
+                            total_generated += self.store_book_cover_thumbnails(book, job, future.result())
+                            done += 1
+                            uncommitted += 1
+
+                        if uncommitted >= THUMBNAIL_COMMIT_BATCH:
+                            self.commit_thumbnails()
+                            uncommitted = 0
+
+                        # Increment the progress
+                        self.progress = (1.0 / count) * done
+                        if total_generated > 0:
+                            self.message = N_('Generated %(count)s cover thumbnails', count=total_generated)
+                self.commit_thumbnails()
 
-                    # Increment the progress
-                    self.progress = (1.0 / count) * i
-
-                    if generated > 0:
-                        total_generated += generated
-                        self.message = N_('Generated %(count)s cover thumbnails', count=total_generated)
-
-                    # Check if job has been cancelled or ended
-                    if self.stat == STAT_CANCELLED:
-                        self.log.info(f'GenerateCoverThumbnails task has been cancelled.')
-                        return
+                # Check if job has been cancelled or ended
+                if self.stat == STAT_CANCELLED:
+                    self.log.info(f'GenerateCoverThumbnails task has been cancelled.')
+                    return
 
-                    if self.stat == STAT_ENDED:
-                        self.log.info(f'GenerateCoverThumbnails task has been ended.')
-                        return
+                if self.stat == STAT_ENDED:
+                    self.log.info(f'GenerateCoverThumbnails task has been ended.')
+                    return
 
                 if total_generated == 0:
                     self.self_cleanup = True
@@ -127,169 +215,117 @@ class TaskGenerateCoverThumbnails(CalibreTask):
             .filter(or_(ub.Thumbnail.expiration.is_(None), ub.Thumbnail.expiration > datetime.now(timezone.utc))) \
             .all()
 
-    def create_book_cover_thumbnails(self, book):
-        generated = 0
+    def prepare_book_cover_thumbnails(self, book):
+        """Work out which thumbnails of a book have to be (re)generated.
+
+        Returns None if there is nothing to render, otherwise a job dict with the thumbnail row
+        of each (resolution, format) to render (None for a new one), the legacy rows it replaces,
+        the cover source and the render targets.
+        """
         book_cover_thumbnails = self.get_book_cover_thumbnails(book.id)
 
-        # Build a map: (resolution, format) -> thumbnail
-        thumb_map = {}
-        for t in book_cover_thumbnails:
-            thumb_map[(t.resolution, t.format.lower())] = t
+        # Legacy named or format-mismatch thumbnails are replaced by deterministic ones
+        current = {}
+        stale = []
+        for thumbnail in book_cover_thumbnails:
+            legacy_naming = not (thumbnail.filename.startswith('book_') or thumbnail.filename.startswith('series_'))
+            if legacy_naming or thumbnail.format.lower() not in THUMBNAIL_FORMATS:
+                stale.append(thumbnail)
+            else:
+                current[(thumbnail.resolution, thumbnail.format.lower())] = thumbnail
 
-        # For each resolution and format, check if thumbnail exists and file is present
-        formats = ['webp', 'jpg']
+        # For each resolution and format, check if thumbnail exists, file is present and up to date
+        thumbnails = {}
         for resolution in self.resolutions:
-            for fmt in formats:
-                thumb = thumb_map.get((resolution, fmt))
-                file_missing = True
-                if thumb:
-                    file_missing = not self.cache.get_cache_file_exists(thumb.filename, constants.CACHE_TYPE_THUMBNAILS)
-                if not thumb or file_missing:
-                    generated += 1
-                    self.create_book_cover_single_thumbnail_format(book, resolution, fmt)
-
-        # Replace outdated, legacy, or format-mismatch thumbnails
-        for thumbnail in book_cover_thumbnails:
-            try:
-                legacy_naming = not (thumbnail.filename.startswith('book_') or thumbnail.filename.startswith('series_'))
-                wrong_format = thumbnail.format.lower() not in formats
-                source_newer = book.last_modified.replace(tzinfo=None) > thumbnail.generated_at
-
-                # If any legacy condition matched, migrate: delete old file & regenerate with deterministic name
-                if legacy_naming or wrong_format:
-                    old_id = thumbnail.id
-                    old_filename = thumbnail.filename
-                    self.app_db_session.delete(thumbnail)
-                    self.app_db_session.commit()
-                    # Regenerate both formats for this resolution
-                    for fmt in formats:
-                        self.create_book_cover_single_thumbnail_format(book, thumbnail.resolution, fmt)
-                    # remove old file if still present
-                    try:
-                        self.cache.delete_cache_file(old_filename, constants.CACHE_TYPE_THUMBNAILS)
-                    except Exception:
-                        pass
-                    generated += 1
+            for fmt in THUMBNAIL_FORMATS:
+                thumbnail = current.get((resolution, fmt))
+                if not thumbnail or not self.cache.get_cache_file_exists(thumbnail.filename,
+                                                                         constants.CACHE_TYPE_THUMBNAILS):
+                    thumbnails[(resolution, fmt)] = thumbnail
                     continue
+                try:
+                    if book.last_modified.replace(tzinfo=None) > thumbnail.generated_at:
+                        thumbnails[(resolution, fmt)] = thumbnail
+                except Exception as ex:
+                    self.log.debug(f"Thumbnail update check failed for book {book.id}: {ex}")
 
-                if source_newer:
-                    generated += 1
-                    self.update_book_cover_thumbnail(book, thumbnail)
-            except Exception as ex:
-                self.log.debug(f"Thumbnail migration/update issue for book {book.id}: {ex}")
-        return generated
-
-    def create_book_cover_single_thumbnail_format(self, book, resolution, fmt):
-        thumbnail = ub.Thumbnail()
-        thumbnail.type = constants.THUMBNAIL_TYPE_COVER
-        thumbnail.entity_id = book.id
-        thumbnail.format = fmt
-        thumbnail.resolution = resolution
-
-        self.app_db_session.add(thumbnail)
-        try:
-            self.app_db_session.commit()
-            self.generate_book_thumbnail(book, thumbnail)
-        except Exception as ex:
-            self.log.debug(f'Error creating {fmt.upper()} book thumbnail: ' + str(ex))
-            self._handleError(f'Error creating {fmt.upper()} book thumbnail: ' + str(ex))
-            self.app_db_session.rollback()
-
-    def create_book_cover_single_thumbnail(self, book, resolution):
-        # Generate WebP thumbnail (for web UI)
-        thumbnail_webp = ub.Thumbnail()
-        thumbnail_webp.type = constants.THUMBNAIL_TYPE_COVER
-        thumbnail_webp.entity_id = book.id
-        thumbnail_webp.format = 'webp'
-        thumbnail_webp.resolution = resolution
+        if not thumbnails:
+            if stale:
+                self.remove_stale_thumbnails(stale)
+            return None
 
-        self.app_db_session.add(thumbnail_webp)
         try:
-            self.app_db_session.commit()
-            self.generate_book_thumbnail(book, thumbnail_webp)
+            source = self.get_book_cover_source(book)
         except Exception as ex:
-            self.log.debug('Error creating WebP book thumbnail: ' + str(ex))
-            self._handleError('Error creating WebP book thumbnail: ' + str(ex))
-            self.app_db_session.rollback()
+            self.log.debug('Error generating thumbnail file: ' + str(ex))
+            self._handleError('Error creating book thumbnail: ' + str(ex))
+            return None
+
+        targets = []
+        for (resolution, fmt), thumbnail in thumbnails.items():
+            filename = thumbnail.filename if thumbnail else \
+                ub.thumbnail_filename(constants.THUMBNAIL_TYPE_COVER, book.id, resolution, fmt)
+            targets.append((resolution, fmt,
+                            self.cache.get_cache_file_path(filename, constants.CACHE_TYPE_THUMBNAILS)))
+        return {'thumbnails': thumbnails, 'stale': stale, 'source': source, 'targets': targets}
+
+    def get_book_cover_source(self, book):
+        """Path of the book's cover file, or its content when the library is on Google Drive."""
+        if config.config_use_google_drive:
+            if not gdriveutils.is_gdrive_ready():
+                raise Exception('Google Drive is configured but not ready')
+
+            content = gdriveutils.get_cover_via_gdrive(book.path)
+            if not content:
+                raise Exception('Google Drive cover url not found')
+            return bytes(content)
+
+        book_cover_filepath = os.path.join(config.get_book_path(), book.path, 'cover.jpg')
+        if not os.path.isfile(book_cover_filepath):
+            raise Exception('Book cover file not found')
+        return book_cover_filepath
+
+    def store_book_cover_thumbnails(self, book, job, errors):
+        """Add/update the rows of the rendered thumbnails; committed in batches by run()."""
+        generated = 0
+        for (resolution, fmt), thumbnail in job['thumbnails'].items():
+            error = errors.get((resolution, fmt))
+            if error:
+                self.log.debug(f'Error creating {fmt.upper()} book thumbnail: ' + error)
+                self._handleError(f'Error creating {fmt.upper()} book thumbnail: ' + error)
+                continue
+            if thumbnail is None:
+                thumbnail = ub.Thumbnail()
+                thumbnail.type = constants.THUMBNAIL_TYPE_COVER
+                thumbnail.entity_id = book.id
+                thumbnail.format = fmt
+                thumbnail.resolution = resolution
+                thumbnail.filename = ub.thumbnail_filename(constants.THUMBNAIL_TYPE_COVER, book.id, resolution, fmt)
+                self.app_db_session.add(thumbnail)
+            else:
+                thumbnail.generated_at = datetime.now(timezone.utc)
+            generated += 1
+        if job['stale']:
+            self.remove_stale_thumbnails(job['stale'])
+        return generated
 
-        # Generate JPEG thumbnail (for Kobo/devices)
-        thumbnail_jpg = ub.Thumbnail()
-        thumbnail_jpg.type = constants.THUMBNAIL_TYPE_COVER
-        thumbnail_jpg.entity_id = book.id
-        thumbnail_jpg.format = 'jpg'
-        thumbnail_jpg.resolution = resolution
+    def remove_stale_thumbnails(self, thumbnails):
+        for thumbnail in thumbnails:
+            self.app_db_session.delete(thumbnail)
+            # remove old file if still present
+            try:
+                self.cache.delete_cache_file(thumbnail.filename, constants.CACHE_TYPE_THUMBNAILS)
+            except Exception:
+                pass
 
-        self.app_db_session.add(thumbnail_jpg)
+    def commit_thumbnails(self):
         try:
             self.app_db_session.commit()
-            self.generate_book_thumbnail(book, thumbnail_jpg)
         except Exception as ex:
-            self.log.debug('Error creating JPEG book thumbnail: ' + str(ex))
-            self._handleError('Error creating JPEG book thumbnail: ' + str(ex))
+            self.log.debug('Error saving book thumbnails: ' + str(ex))
+            self._handleError('Error saving book thumbnails: ' + str(ex))
             self.app_db_session.rollback()
 
-    def update_book_cover_thumbnail(self, book, thumbnail):
-        thumbnail.generated_at = datetime.now(timezone.utc)
-
-        try:
-            self.app_db_session.commit()
-            self.cache.delete_cache_file(thumbnail.filename, constants.CACHE_TYPE_THUMBNAILS)
-            self.generate_book_thumbnail(book, thumbnail)
-        except Exception as ex:
-            self.log.debug('Error updating book thumbnail: ' + str(ex))
-            self._handleError('Error updating book thumbnail: ' + str(ex))
-            self.app_db_session.rollback()
-
-    def generate_book_thumbnail(self, book, thumbnail):
-        if book and thumbnail:
-            if config.config_use_google_drive:
-                if not gdriveutils.is_gdrive_ready():
-                    raise Exception('Google Drive is configured but not ready')
-
-                content = gdriveutils.get_cover_via_gdrive(book.path)
-                if not content:
-                    raise Exception('Google Drive cover url not found')
-                try:
-                    stream = BytesIO(content)
-                    with Image(file=stream) as img:
-                        filename = self.cache.get_cache_file_path(thumbnail.filename,
-                                                                  constants.CACHE_TYPE_THUMBNAILS)
-                        height = get_resize_height(thumbnail.resolution)
-                        if img.height > height:
-                            width = get_resize_width(thumbnail.resolution, img.width, img.height)
-                            img.resize(width=width, height=height, filter='lanczos')
-                        # Set format for thumbnail
-                        img.format = thumbnail.format
-                        try:
-                            img.compression_quality = 82
-                        except Exception:
-                            pass
-                        img.save(filename=filename)
-                except Exception as ex:
-                    self.log.debug('Error generating thumbnail file: ' + str(ex))
-                    raise ex
-                finally:
-                    if stream is not None:
-                        stream.close()
-            else:
-                book_cover_filepath = os.path.join(config.get_book_path(), book.path, 'cover.jpg')
-                if not os.path.isfile(book_cover_filepath):
-                    raise Exception('Book cover file not found')
-
-                with Image(filename=book_cover_filepath) as img:
-                    height = get_resize_height(thumbnail.resolution)
-                    filename = self.cache.get_cache_file_path(thumbnail.filename, constants.CACHE_TYPE_THUMBNAILS)
-                    if img.height > height:
-                        width = get_resize_width(thumbnail.resolution, img.width, img.height)
-                        img.resize(width=width, height=height, filter='lanczos')
-                    # Set format for thumbnail
-                    img.format = thumbnail.format
-                    try:
-                        img.compression_quality = 82
-                    except Exception:
-                        pass
-                    img.save(filename=filename)
-
     @property
     def name(self):
         return N_('Cover Thumbnails')
@@ -306,6 +342,8 @@ class TaskGenerateCoverThumbnails(CalibreTask):
 
 
 class TaskGenerateSeriesThumbnails(CalibreTask):
+    lane = LANE_THUMBNAIL
+
     def __init__(self, task_message=''):
         super(TaskGenerateSeriesThumbnails, self).__init__(task_message)
         self.log = logger.create()
@@ -521,6 +559,9 @@ class TaskGenerateSeriesThumbnails(CalibreTask):
 
 
 class TaskClearCoverThumbnailCache(CalibreTask):
+    # Same lane as generation, so clearing never deletes files or rows a running generation writes
+    lane = LANE_THUMBNAIL
+
     def __init__(self, book_id, task_message=N_('Clearing cover thumbnail cache')):
         super(TaskClearCoverThumbnailCache, self).__init__(task_message)
         self.log = logger.create()
@@ -92,7 +92,7 @@ def migrate_thumbnail_structure():
         log.info("Thumbnail migration: Old subdirectories will be cleaned up automatically as thumbnails regenerate")
         
         # Note: We don't delete thumbnails immediately anymore.
-        # The TaskGenerateCoverThumbnails.create_book_cover_thumbnails() method already
+        # The TaskGenerateCoverThumbnails.prepare_book_cover_thumbnails() method already
         # detects legacy thumbnails (via legacy_naming check) and migrates them on-demand.
         # This prevents mass regeneration on first page load after update.
         
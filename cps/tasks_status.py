@@ -17,6 +17,7 @@ from .render_template import render_title_template
 from .services.worker import WorkerThread, STAT_WAITING, STAT_FAIL, STAT_STARTED, STAT_FINISH_SUCCESS, STAT_ENDED, \
     STAT_CANCELLED
 from .usermanagement import user_login_required
+from .admin import admin_required
 
 tasks = Blueprint('tasks', __name__)
 
@@ -30,6 +31,13 @@ def get_email_status_json():
     return jsonify(render_task_status(tasks))
 
 
+@tasks.route("/ajax/tasklanes")
+@user_login_required
+@admin_required
+def get_task_lanes_json():
+    return jsonify(WorkerThread.get_instance().lane_stats())
+
+
 @tasks.route("/tasks")
 @user_login_required
 def get_tasks_status():
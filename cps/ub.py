@@ -730,24 +730,8 @@ class RemoteAuthToken(Base):
         return '<Token %r>' % self.id
 
 
-def filename(context):
-    """Generate deterministic filename for thumbnails.
-
-    Prefer the pattern:
-        cover thumbnails:  book_<entity_id>_r<resolution>.<ext>
-        series thumbnails: series_<entity_id>_r<resolution>.<ext>
-
-    Fallback to legacy uuid-based naming if required fields are missing.
-    This keeps previously generated files valid while making new ones easier
-    to reason about and purge selectively.
-    """
-    params = context.get_current_parameters()
-    file_format = params.get('format', 'jpeg')
-    entity_id = params.get('entity_id')
-    resolution = params.get('resolution')
-    thumb_type = params.get('type')  # cover or series
-    uuid_val = params.get('uuid')
-
+def thumbnail_filename(thumb_type, entity_id, resolution, file_format='jpeg', uuid_val=None):
+    """Deterministic filename of a thumbnail, see filename()."""
     # map format 'jpeg' -> extension jpg
     if file_format == 'jpeg':
         ext = 'jpg'
@@ -768,6 +752,25 @@ def filename(context):
     return f"{uuid_val}.{ext}" if uuid_val else f"legacy_unknown.{ext}"
 
 
+def filename(context):
+    """Generate deterministic filename for thumbnails.
+
+    Prefer the pattern:
+        cover thumbnails:  book_<entity_id>_r<resolution>.<ext>
+        series thumbnails: series_<entity_id>_r<resolution>.<ext>
+
+    Fallback to legacy uuid-based naming if required fields are missing.
+    This keeps previously generated files valid while making new ones easier
+    to reason about and purge selectively.
+    """
+    params = context.get_current_parameters()
+    return thumbnail_filename(params.get('type'),  # cover or series
+                              params.get('entity_id'),
+                              params.get('resolution'),
+                              params.get('format', 'jpeg'),
+                              params.get('uuid'))
+
+
 class Thumbnail(Base):
     __tablename__ = 'thumbnail'
 
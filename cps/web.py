@@ -44,6 +44,7 @@ from .cw_babel import get_available_locale
 from .usermanagement import login_required_if_no_ano
 from .kobo_sync_status import remove_synced_book
 from . import magic_shelf
+from . import comic_pages
 from .render_template import render_title_template
 from .kobo_sync_status import change_archived_books
 from . import limiter
@@ -130,6 +131,9 @@ def add_security_headers(resp):
     if request.endpoint == "web.read_book":
         csp += " blob: ; style-src-elem 'self' blob: 'unsafe-inline'"
     csp += "; object-src 'none';"
+    if request.endpoint == "web.get_comic_page":
+        # Pages come straight out of uploaded archives; an SVG page must never run script on our origin
+        csp += " sandbox;"
     resp.headers['Content-Security-Policy'] = csp
     resp.headers['X-Content-Type-Options'] = 'nosniff'
     resp.headers['X-Frame-Options'] = 'SAMEORIGIN'
@@ -229,53 +233,55 @@ def update_view():
     return "1", 200
 
 
-'''
-@web.route("/ajax/getcomic/<int:book_id>/<book_format>/<int:page>")
-@user_login_required
-def get_comic_book(book_id, book_format, page):
-    book = calibre_db.get_book(book_id)
+def _comic_book_path(book_id, book_format):
+    if config.config_use_google_drive or book_format.lower() not in ("cbz", "cbr", "cbt"):
+        return None
+    book = calibre_db.get_filtered_book(book_id, allow_show_archived=True)
     if not book:
-        return "", 204
+        return None
+    data = calibre_db.get_book_format(book_id, book_format.upper())
+    if not data:
+        return None
+    comic_path = os.path.join(config.get_book_path(), book.path, data.name + "." + book_format.lower())
+    return comic_path if os.path.isfile(comic_path) else None
+
+
+@web.route("/ajax/comic/<int:book_id>/<book_format>")
+@login_required_if_no_ano
+@viewer_required
+def get_comic_pages(book_id, book_format):
+    comic_path = _comic_book_path(book_id, book_format)
+    names = comic_pages.page_names(comic_path, config.config_rarfile_location) if comic_path else None
+    if names is None:
+        abort(404)
+    return jsonify(pages=[{"name": name,
+                           "url": url_for('web.get_comic_page', book_id=book_id, book_format=book_format, page=index)}
+                          for index, name in enumerate(names)])
+
+
+@web.route("/ajax/comic/<int:book_id>/<book_format>/<int:page>")
+@login_required_if_no_ano
+@viewer_required
+def get_comic_page(book_id, book_format, page):
+    comic_path = _comic_book_path(book_id, book_format)
+    if not comic_path:
+        abort(404)
+    etag = comic_pages.page_etag(comic_path, page)
+    if etag in request.if_none_match:
+        response = make_response("", 304)
     else:
-        for bookformat in book.data:
-            if bookformat.format.lower() == book_format.lower():
-                cbr_file = os.path.join(config.config_calibre_dir, book.path, bookformat.name) + "." + book_format
-                if book_format in ("cbr", "rar"):
-                    if feature_support['rar'] == True:
-                        rarfile.UNRAR_TOOL = config.config_rarfile_location
-                        try:
-                            rf = rarfile.RarFile(cbr_file)
-                            names = sort(rf.namelist())
-                            extract = lambda page: rf.read(names[page])
-                        except:
-                            # rarfile not valid
-                            log.error('Unrar binary not found, or unable to decompress file %s', cbr_file)
-                            return "", 204
-                    else:
-                        log.info('Unrar is not supported please install python rarfile extension')
-                        # no support means return nothing
-                        return "", 204
-                elif book_format in ("cbz", "zip"):
-                    zf = zipfile.ZipFile(cbr_file)
-                    names=sort(zf.namelist())
-                    extract = lambda page: zf.read(names[page])
-                elif book_format in ("cbt", "tar"):
-                    tf = tarfile.TarFile(cbr_file)
-                    names=sort(tf.getnames())
-                    extract = lambda page: tf.extractfile(names[page]).read()
-                else:
-                    log.error('unsupported comic format')
-                    return "", 204
-
-                b64 = codecs.encode(extract(page), 'base64').decode()
-                ext = names[page].rpartition('.')[-1]
-                if ext not in ('png', 'gif', 'jpg', 'jpeg', 'webp'):
-                    ext = 'png'
-                extractedfile="data:image/" + ext + ";base64," + b64
-                fileData={"name": names[page], "page":page, "last":len(names)-1, "content": extractedfile}
-                return make_response(json.dumps(fileData))
-        return "", 204
-'''
+        try:
+            data, name = comic_pages.read_page(comic_path, page, config.config_rarfile_location)
+        except IndexError:
+            abort(404)
+        except Exception as ex:
+            log.error("Could not read page %d of comic %s: %s", page, comic_path, ex)
+            abort(404)
+        response = make_response(data)
+        response.headers["Content-Type"] = comic_pages.page_mimetype(name)
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "private, max-age=86400"
+    return response
 
 
 # ################################### Typeahead ##################################################################
@@ -1224,19 +1230,9 @@ def edit_magic_shelf(shelf_id):
             shelf.kobo_sync = kobo_sync
             shelf.is_public = 1 if is_public else 0
             flag_modified(shelf, "rules")
-            
-            # Invalidate Complex Query Cache
-            ub.session.query(ub.MagicShelfCache).filter_by(shelf_id=shelf.id).delete()
-            
+            # Cached results and counts are keyed on the rules, so nothing needs invalidating here
             ub.session_commit()
             
-            # Invalidate cache
-            if 'magic_shelf_counts' in flask_session:
-                counts = flask_session['magic_shelf_counts']
-                if str(shelf_id) in counts:
-                    del counts[str(shelf_id)]
-                    flask_session.modified = True
-            
             log.info(f"User {current_user.id} updated magic shelf {shelf_id} ('{name}') with icon '{icon}'")
             return jsonify({"success": True})
         except Exception as e:
@@ -1344,8 +1340,6 @@ def delete_magic_shelf(shelf_id):
     
     try:
         shelf_name = shelf.name
-        # Delete cache entries first
-        ub.session.query(ub.MagicShelfCache).filter_by(shelf_id=shelf_id).delete()
         # Delete any hide records for this shelf
         ub.session.query(ub.HiddenMagicShelfTemplate).filter_by(shelf_id=shelf_id).delete()
         # Delete the shelf
@@ -15,7 +15,9 @@ from pathlib import Path
 import subprocess
 import tempfile
 import atexit
-from datetime import datetime
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from datetime import datetime, timezone
 import sqlite3
 
 import pwd
@@ -23,6 +25,7 @@ import grp
 
 from cwa_db import CWA_DB
 from kindle_epub_fixer import EPUBFixer
+from library_permissions import fix_book_dirs, network_share_mode
 
 ### Global Variables
 convert_library_log_file = "/config/convert-library.log"
@@ -90,6 +93,30 @@ backup_destinations = {
         if entry.is_dir()
     }
 
+# Number of books converted at the same time. ebook-convert is single threaded, so by
+# default one per core up to 4, leaving some headroom for the web app and ingest
+try:
+    DEFAULT_WORKERS = max(1, int(os.getenv("CWA_CONVERT_LIBRARY_WORKERS", min(4, os.cpu_count() or 1))))
+except ValueError:
+    DEFAULT_WORKERS = 1
+
+
+def book_id_from_path(file: str) -> str | None:
+    """ Gets the Calibre Library Book ID from the immediate book folder (e.g., "Title (6120)") """
+    m = re.search(r"\((\d+)\)$", os.path.basename(os.path.dirname(file)))
+    return m.group(1) if m else None
+
+
+@dataclass
+class ConversionResult:
+    """ Outcome of converting one book on a worker, handed back to the main thread for import """
+    file: str
+    book_id: str
+    work_dir: str
+    target_filepath: str | None = None
+    converted_name: str | None = None
+    error: str | None = None
+
 
 class LibraryConverter:
     def __init__(self, args) -> None:
@@ -125,7 +152,7 @@ class LibraryConverter:
         self.supported_book_formats = {'acsm', 'azw', 'azw3', 'azw4', 'cbz', 'cbr', 'cb7', 'cbc', 'chm', 'djvu', 'docx', 'epub', 'fb2', 'fbz', 'html', 'htmlz', 'lit', 'lrf', 'mobi', 'odt', 'pdf', 'prc', 'pdb', 'pml', 'rb', 'rtf', 'snb', 'tcr', 'txt', 'txtz', 'kfx', 'kfx-zip'}
         self.hierarchy_of_success = {'epub', 'lit', 'mobi', 'azw', 'azw3', 'fb2', 'fbz', 'azw4', 'prc', 'odt', 'lrf', 'pdb',  'cbz', 'pml', 'rb', 'cbr', 'cb7', 'cbc', 'chm', 'djvu', 'snb', 'tcr', 'pdf', 'docx', 'rtf', 'html', 'htmlz', 'txtz', 'txt', 'kfx', 'kfx-zip'}
 
-        self.current_book = 1
+        self.workers = max(1, getattr(args, 'workers', None) or DEFAULT_WORKERS)
         self.ingest_folder, self.library_dir, self.tmp_conversion_dir = self.get_dirs('/app/calibre-web-automated/dirs.json')
 
         self.calibre_env = os.environ.copy()
@@ -136,7 +163,9 @@ class LibraryConverter:
         if self.split_library:
             self.library_dir = self.split_library["split_path"]
             self.calibre_env['CALIBRE_OVERRIDE_DATABASE_PATH'] = os.path.join(self.split_library["db_path"], "metadata.db")
-        self.to_convert = self.get_books_to_convert()
+        skip_book_ids = self.prepare_run_state()
+        self.to_convert = [file for file in self.get_books_to_convert()
+                           if (book_id_from_path(file) or "") not in skip_book_ids]
 
 
     def get_split_library(self) -> dict[str, str] | None:
@@ -350,6 +379,21 @@ class LibraryConverter:
         return to_convert
 
 
+    def prepare_run_state(self) -> set[str]:
+        """Resumes an interrupted run for the same target format, otherwise starts a fresh one.
+
+        Returns the ids of books that already failed in the resumed run so they aren't retried."""
+        state = self.db.get_convert_library_state()
+        self.resumed = bool(state and state['status'] == 'running' and state['target_format'] == self.target_format)
+        if not self.resumed:
+            self.db.reset_convert_library_books()
+            self.converted = self.failed = 0
+            return set()
+        self.converted = state['converted'] or 0
+        self.failed = state['failed'] or 0
+        return {str(book_id) for book_id in self.db.get_convert_library_books('failed')}
+
+
     def backup(self, input_file, backup_type):
         try:
             output_path = backup_destinations[backup_type]
@@ -358,203 +402,236 @@ class LibraryConverter:
             print_and_log(f"[convert-library]: ERROR - The following error occurred when trying to copy {input_file} to {output_path}:\n{e}")
 
 
+    def run_streamed(self, command: list, env=None) -> None:
+        """Runs a conversion command, passing its output through and raising CalledProcessError if it fails"""
+        with subprocess.Popen(
+            command,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            env=env,
+            text=True,
+            encoding='utf-8'
+        ) as process:
+            for line in process.stdout: # Read from the combined stdout (which includes stderr)
+                if self.verbose:
+                    print_and_log(line)
+                else:
+                    print(line)
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, command)
+
+
+    def progress_label(self) -> str:
+        return f"({self.converted + self.failed}/{self.total})"
+
+
     def convert_library(self):
-        for file in self.to_convert:
-            filename = os.path.basename(file)
-            file_extension = Path(file).suffix
+        """Converts books on a pool of workers, each with its own temp dir, and imports the results one at a time.
+
+        ebook-convert/kepubify runs are what take the time, so those run in parallel. Everything writing to the
+        library or cwa.db (calibredb add_format, stats, run state) stays on this thread."""
+        self.total = self.converted + self.failed + len(self.to_convert)
+        self.db.update_convert_library_state(status='running', target_format=self.target_format, workers=self.workers,
+                                             total=self.total, converted=self.converted, failed=self.failed,
+                                             processed_at_start=self.converted + self.failed,
+                                             started_at=datetime.now(timezone.utc).isoformat())
+        if self.resumed:
+            print_and_log(f"[convert-library]: Resuming the previous run {self.progress_label()}, {self.failed} book(s) that failed in it will be skipped")
+        print_and_log(f"[convert-library]: Converting {len(self.to_convert)} book(s) with {self.workers} worker(s)...")
+
+        free_dirs = []
+        for worker in range(1, self.workers + 1):
+            work_dir = os.path.join(self.tmp_conversion_dir, f"worker-{worker}")
+            os.makedirs(work_dir, exist_ok=True)
+            self.empty_tmp_con_dir(work_dir)
+            free_dirs.append(work_dir)
+
+        files = iter(self.to_convert)
+        pending = set()
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="convert-library") as pool:
+            while True:
+                # Every queued conversion owns a temp dir until its result has been imported
+                while free_dirs:
+                    file = next(files, None)
+                    if file is None:
+                        break
+                    book_id = book_id_from_path(file)
+                    if book_id is None:
+                        self.report_missing_book_id(file)
+                        continue
+                    pending.add(pool.submit(self.convert_book, file, book_id, free_dirs.pop()))
+                if not pending:
+                    break
 
-            print_and_log(f"[convert-library]: ({self.current_book}/{len(self.to_convert)}) Converting {filename} from {file_extension} format to {self.target_format} format...")
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    result = future.result()
+                    self.import_converted_book(result)
+                    self.empty_tmp_con_dir(result.work_dir)
+                    free_dirs.append(result.work_dir)
+
+        for work_dir in free_dirs:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        self.db.update_convert_library_state(status='finished')
+
+
+    def report_missing_book_id(self, file: str) -> None:
+        self.failed += 1
+        print_and_log(f"[convert-library]: {self.progress_label()} A Calibre Library Book ID could not be determined for {file}. Make sure the structure of your calibre library matches the following example:\n")
+        print_and_log("Terry Goodkind/")
+        print_and_log("└── Wizard's First Rule (6120)")
+        print_and_log("    ├── cover.jpg")
+        print_and_log("    ├── metadata.opf")
+        print_and_log("    └── Wizard's First Rule - Terry Goodkind.epub")
+
+        self.backup(file, backup_type="failed")
+        self.db.update_convert_library_state(failed=self.failed)
+
+
+    def convert_book(self, file: str, book_id: str, work_dir: str) -> "ConversionResult":
+        """Converts a single book into work_dir. Runs on a worker thread, so it must not use self.db"""
+        result = ConversionResult(file=file, book_id=book_id, work_dir=work_dir)
+        filename = os.path.basename(file)
+        file_extension = Path(file).suffix
+        label = f"[{os.path.basename(work_dir)}]"
+
+        print_and_log(f"[convert-library]: {label} Converting {filename} from {file_extension} format to {self.target_format} format...")
+
+        if self.target_format == "kepub":
+            convert_successful, target_filepath, converted_name = self.convert_to_kepub(file, file_extension, work_dir, label)
+            if not convert_successful:
+                result.error = "kepub conversion failed"
+                return result
+        else:
+            try: # Convert Book to target format (target is not kepub)
+                target_filepath = os.path.join(work_dir, f"{Path(file).stem}.{self.target_format}")
+                self.run_streamed(["ebook-convert", file, target_filepath], env=self.calibre_env)
+
+                if self.cwa_settings['auto_backup_conversions']:
+                    self.backup(file, backup_type="converted")
+                converted_name = os.path.basename(target_filepath)
+            except subprocess.CalledProcessError as e:
+                print_and_log(f"[convert-library]: {label} Conversion of {filename} was unsuccessful. See the following error:\n{e}")
+                result.error = str(e)
+                return result
 
-            try: # Get Calibre Library Book ID from the immediate book folder (e.g., "Title (6120)")
-                book_folder = os.path.basename(os.path.dirname(file))
-                m = re.search(r"\((\d+)\)$", book_folder)
-                book_id = m.group(1)  # type: ignore[attr-defined]
+        if self.target_format == "epub" and self.kindle_epub_fixer:
+            try:
+                EPUBFixer().process(input_path=target_filepath)
+                print_and_log(f"[convert-library]: {label} Resulting EPUB file successfully processed by CWA-EPUB-Fixer!")
             except Exception as e:
-                print_and_log(f"[convert-library]: ({self.current_book}/{len(self.to_convert)}) A Calibre Library Book ID could not be determined for {file}. Make sure the structure of your calibre library matches the following example:\n")
-                print_and_log("Terry Goodkind/")
-                print_and_log("└── Wizard's First Rule (6120)")
-                print_and_log("    ├── cover.jpg")
-                print_and_log("    ├── metadata.opf")
-                print_and_log("    └── Wizard's First Rule - Terry Goodkind.epub")
-
-                self.backup(file, backup_type="failed")
-                self.current_book += 1
-                continue
+                print_and_log(f"[convert-library]: {label} An error occurred while processing {os.path.basename(target_filepath)} with the kindle-epub-fixer. See the following error:\n{e}")
 
-            if self.target_format == "kepub":
-                convert_successful, target_filepath = self.convert_to_kepub(file, file_extension)
-                if not convert_successful:
-                    print_and_log(f"[convert-library]: ({self.current_book}/{len(self.to_convert)}) Conversion of {os.path.basename(file)} was unsuccessful. Moving to next book...")
-                    self.current_book += 1
-                    continue
-            else:
-                try: # Convert Book to target format (target is not kepub)
-                    target_filepath = f"{self.tmp_conversion_dir}{Path(file).stem}.{self.target_format}"
-                    with subprocess.Popen(
-                        ["ebook-convert", file, target_filepath],
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.STDOUT,
-                        env=self.calibre_env,
-                        text=True,
-                        encoding='utf-8'
-                    ) as process:
-                        for line in process.stdout: # Read from the combined stdout (which includes stderr)
-                            if self.verbose:
-                                print_and_log(line)
-                            else:
-                                print(line)
-
-                    if self.cwa_settings['auto_backup_conversions']:
-                        self.backup(file, backup_type="converted")
-
-                    self.db.conversion_add_entry(os.path.basename(target_filepath),
-                                                Path(file).suffix,
-                                                self.target_format,
-                                                str(self.cwa_settings["auto_backup_conversions"]))
-
-                    print_and_log(f"[convert-library]: ({self.current_book}/{len(self.to_convert)}) Conversion of {os.path.basename(file)} to {self.target_format} format successful!") # Removed as of V3.0.0 - Removing old version from library...
-                except subprocess.CalledProcessError as e:
-                    print_and_log(f"[convert-library]: ({self.current_book}/{len(self.to_convert)}) Conversion of {os.path.basename(file)} was unsuccessful. See the following error:\n{e}")
-                    self.current_book += 1
-                    continue
+        result.target_filepath = target_filepath
+        result.converted_name = converted_name
+        return result
 
-            if self.target_format == "epub" and self.kindle_epub_fixer:
-                try:
-                    EPUBFixer().process(input_path=target_filepath)
-                    print_and_log(f"[convert-library]: ({self.current_book}/{len(self.to_convert)}) Resulting EPUB file successfully processed by CWA-EPUB-Fixer!")
-                except Exception as e:
-                    print_and_log(f"[convert-library]: ({self.current_book}/{len(self.to_convert)}) An error occurred while processing {os.path.basename(target_filepath)} with the kindle-epub-fixer. See the following error:\n{e}")
-
-            try: # Import converted book to library. As of V3.0.0, "add_format" is used instead of "add"
-                with subprocess.Popen(
-                    ["calibredb", "add_format", book_id, target_filepath, f"--library-path={self.library_dir}"],
-                    env=self.calibre_env,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.STDOUT,
-                    text=True,
-                    encoding='utf-8'
-                ) as process:
-                    for line in process.stdout: # Read from the combined stdout (which includes stderr)
-                        if self.verbose:
-                            print_and_log(line)
-                        else:
-                            print(line)
 
-                if self.cwa_settings['auto_backup_imports']:
-                    self.backup(target_filepath, backup_type="imported")
+    def import_converted_book(self, result: "ConversionResult") -> None:
+        """Adds a converted file to its book and records the outcome. Only ever called from the main thread"""
+        if result.target_filepath is None:
+            self.record_book(result.book_id, converted=False)
+            print_and_log(f"[convert-library]: {self.progress_label()} Conversion of {os.path.basename(result.file)} was unsuccessful. Moving to next book...")
+            return
 
-                self.db.import_add_entry(os.path.basename(target_filepath),
-                                        str(self.cwa_settings["auto_backup_imports"]))
+        target_filepath = result.target_filepath
+        self.db.conversion_add_entry(result.converted_name,
+                                     Path(result.file).suffix,
+                                     self.target_format,
+                                     str(self.cwa_settings["auto_backup_conversions"]))
 
-                print_and_log(f"[convert-library]: ({self.current_book}/{len(self.to_convert)}) Import of {os.path.basename(target_filepath)} successfully completed!")
-            except subprocess.CalledProcessError as e:
-                print_and_log(f"[convert-library]: ({self.current_book}/{len(self.to_convert)}) Import of {os.path.basename(target_filepath)} was not successfully completed. Converted file moved to /config/processed_books/failed/{os.path.basename(target_filepath)}. See the following error:\n{e}")
-                try:
-                    output_path = f"/config/processed_books/failed/{os.path.basename(target_filepath)}"
-                    shutil.move(target_filepath, output_path)
-                except Exception as e:
-                    print_and_log(f"[convert-library]: ERROR - The following error occurred when trying to copy {file} to {output_path}:\n{e}")
-                self.current_book += 1
-                continue
+        try: # Import converted book to library. As of V3.0.0, "add_format" is used instead of "add"
+            self.run_streamed(["calibredb", "add_format", result.book_id, target_filepath, f"--library-path={self.library_dir}"],
+                              env=self.calibre_env)
 
-            self.set_library_permissions()
-            self.empty_tmp_con_dir()
-            self.current_book += 1
-            continue
+            if self.cwa_settings['auto_backup_imports']:
+                self.backup(target_filepath, backup_type="imported")
 
+            self.db.import_add_entry(os.path.basename(target_filepath),
+                                    str(self.cwa_settings["auto_backup_imports"]))
+        except subprocess.CalledProcessError as e:
+            self.record_book(result.book_id, converted=False)
+            print_and_log(f"[convert-library]: {self.progress_label()} Import of {os.path.basename(target_filepath)} was not successfully completed. Converted file moved to /config/processed_books/failed/{os.path.basename(target_filepath)}. See the following error:\n{e}")
+            try:
+                output_path = f"/config/processed_books/failed/{os.path.basename(target_filepath)}"
+                shutil.move(target_filepath, output_path)
+            except Exception as e:
+                print_and_log(f"[convert-library]: ERROR - The following error occurred when trying to copy {result.file} to {output_path}:\n{e}")
+            return
 
-    def convert_to_kepub(self, filepath:str ,import_format:str) -> tuple[bool, str]:
+        self.record_book(result.book_id, converted=True)
+        print_and_log(f"[convert-library]: {self.progress_label()} Conversion of {os.path.basename(result.file)} to {self.target_format} format and import successfully completed!")
+        self.set_library_permissions(os.path.dirname(result.file))
+
+
+    def record_book(self, book_id: str, converted: bool) -> None:
+        if converted:
+            self.converted += 1
+        else:
+            self.failed += 1
+        self.db.update_convert_library_state(book_id=book_id, book_status='converted' if converted else 'failed',
+                                             converted=self.converted, failed=self.failed)
+
+
+    def convert_to_kepub(self, filepath:str ,import_format:str, work_dir:str, label:str) -> tuple[bool, str, str]:
         """Kepubify is limited in that it can only convert from epub to kepub, therefore any files not already in epub need to first be converted to epub, and then to kepub"""
         if import_format == "epub":
-            print_and_log(f"[convert-library]: ({self.current_book}/{len(self.to_convert)}) File already in epub format, converting directly to kepub...")
+            print_and_log(f"[convert-library]: {label} File already in epub format, converting directly to kepub...")
 
             if self.cwa_settings['auto_backup_conversions']:
                 self.backup(filepath, backup_type="converted")
 
             epub_filepath = filepath
-            epub_ready = True
         else:
-            print_and_log(f"\n[convert-library]: ({self.current_book}/{len(self.to_convert)}) *** NOTICE TO USER: Kepubify is limited in that it can only convert from epubs. To get around this, CWA will automatically convert other supported formats to epub using the Calibre's conversion tools & then use Kepubify to produce your desired kepubs. Obviously multi-step conversions aren't ideal so if you notice issues with your converted files, bare in mind starting with epubs will ensure the best possible results***\n")
+            print_and_log(f"\n[convert-library]: {label} *** NOTICE TO USER: Kepubify is limited in that it can only convert from epubs. To get around this, CWA will automatically convert other supported formats to epub using the Calibre's conversion tools & then use Kepubify to produce your desired kepubs. Obviously multi-step conversions aren't ideal so if you notice issues with your converted files, bare in mind starting with epubs will ensure the best possible results***\n")
             try: # Convert book to epub format so it can then be converted to kepub
-                epub_filepath = f"{self.tmp_conversion_dir}{Path(filepath).stem}.epub"
-                with subprocess.Popen(
-                    ["ebook-convert", filepath, epub_filepath],
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.STDOUT,
-                    env=self.calibre_env,
-                    text=True
-                ) as process:
-                    for line in process.stdout: # Read from the combined stdout (which includes stderr)
-                        if self.verbose:
-                            print_and_log(line)
-                        else:
-                            print(line)
+                epub_filepath = os.path.join(work_dir, f"{Path(filepath).stem}.epub")
+                self.run_streamed(["ebook-convert", filepath, epub_filepath], env=self.calibre_env)
 
                 if self.cwa_settings['auto_backup_conversions']:
                     self.backup(filepath, backup_type="converted")
 
-                print_and_log(f"[convert-library]: ({self.current_book}/{len(self.to_convert)}) Intermediate conversion of {os.path.basename(filepath)} to epub from {import_format} successful, now converting to kepub...")
-                epub_ready = True
+                print_and_log(f"[convert-library]: {label} Intermediate conversion of {os.path.basename(filepath)} to epub from {import_format} successful, now converting to kepub...")
             except subprocess.CalledProcessError as e:
-                print_and_log(f"[convert-library]: ({self.current_book}/{len(self.to_convert)}) Intermediate conversion of {os.path.basename(filepath)} to epub was unsuccessful. Cancelling kepub conversion and moving on to next file. See the following error:\n{e}")
-                return False, ""
+                print_and_log(f"[convert-library]: {label} Intermediate conversion of {os.path.basename(filepath)} to epub was unsuccessful. Cancelling kepub conversion and moving on to next file. See the following error:\n{e}")
+                return False, "", ""
 
-        if epub_ready:
-            epub_filepath = Path(epub_filepath)
-            target_filepath = f"{self.tmp_conversion_dir}{epub_filepath.stem}.kepub"
-            try:
-                with subprocess.Popen(
-                    ['kepubify', '--inplace', '--calibre', '--output', self.tmp_conversion_dir, epub_filepath],
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.STDOUT,
-                    text=True,
-                    encoding='utf-8'
-                ) as process:
-                    for line in process.stdout: # Read from the combined stdout (which includes stderr)
-                        if self.verbose:
-                            print_and_log(line)
-                        else:
-                            print(line)
-
-                if self.cwa_settings['auto_backup_conversions']:
-                    self.backup(filepath, backup_type="converted")
+        epub_filepath = Path(epub_filepath)
+        target_filepath = os.path.join(work_dir, f"{epub_filepath.stem}.kepub")
+        try:
+            self.run_streamed(['kepubify', '--inplace', '--calibre', '--output', work_dir, str(epub_filepath)])
 
-                self.db.conversion_add_entry(epub_filepath.stem,
-                                            import_format,
-                                            self.target_format,
-                                            str(self.cwa_settings["auto_backup_conversions"]))
+            if self.cwa_settings['auto_backup_conversions']:
+                self.backup(filepath, backup_type="converted")
 
-                return True, target_filepath
-            except subprocess.CalledProcessError as e:
-                print_and_log(f"[convert-library]: ({self.current_book}/{len(self.to_convert)}) CON_ERROR: {os.path.basename(filepath)} could not be converted to kepub due to the following error:\nEXIT/ERROR CODE: {e.returncode}\n{e.stderr}")
-                self.backup(epub_filepath, backup_type="failed")
-                return False, ""
-        else:
-            print_and_log(f"[convert-library]: ({self.current_book}/{len(self.to_convert)}) An error occurred when converting the original {import_format} to epub. Cancelling kepub conversion and moving on to next file...")
-            return False, ""
+            return True, target_filepath, epub_filepath.stem
+        except subprocess.CalledProcessError as e:
+            print_and_log(f"[convert-library]: {label} CON_ERROR: {os.path.basename(filepath)} could not be converted to kepub due to the following error:\nEXIT/ERROR CODE: {e.returncode}")
+            self.backup(epub_filepath, backup_type="failed")
+            return False, "", ""
 
 
-    def empty_tmp_con_dir(self):
+    def empty_tmp_con_dir(self, work_dir: str):
         try:
-            files = os.listdir(self.tmp_conversion_dir)
+            files = os.listdir(work_dir)
             for file in files:
-                file_path = os.path.join(self.tmp_conversion_dir, file)
+                file_path = os.path.join(work_dir, file)
                 if os.path.isfile(file_path):
                     os.remove(file_path)
         except OSError:
-            print_and_log(f"[convert-library]: ({self.current_book}/{len(self.to_convert)}) An error occurred while emptying {self.tmp_conversion_dir}.")
+            print_and_log(f"[convert-library]: An error occurred while emptying {work_dir}.")
 
 
-    def set_library_permissions(self):
+    def set_library_permissions(self, book_dir:str):
+        """Only the converted book's folder changed, so that is all that gets chowned"""
         try:
-            nsm = os.getenv("NETWORK_SHARE_MODE", "false").strip().lower() in ("1", "true", "yes", "on")
-            if not nsm:
-                subprocess.run(["chown", "-R", "abc:abc", self.library_dir], check=True)
-                print_and_log(f"[convert-library]: ({self.current_book}/{len(self.to_convert)}) Successfully set ownership of new files in {self.library_dir} to abc:abc.")
+            if not network_share_mode():
+                fix_book_dirs(self.library_dir, [book_dir])
+                print_and_log(f"[convert-library]: {self.progress_label()} Successfully set ownership of new files in {book_dir} to abc:abc.")
             else:
-                print_and_log(f"[convert-library]: ({self.current_book}/{len(self.to_convert)}) NETWORK_SHARE_MODE=true detected; skipping chown of {self.library_dir}")
-        except subprocess.CalledProcessError as e:
-            print_and_log(f"[convert-library]: ({self.current_book}/{len(self.to_convert)}) An error occurred while attempting to recursively set ownership of {self.library_dir} to abc:abc. See the following error:\n{e}")
+                print_and_log(f"[convert-library]: {self.progress_label()} NETWORK_SHARE_MODE=true detected; skipping chown of {self.library_dir}")
+        except Exception as e:
+            print_and_log(f"[convert-library]: {self.progress_label()} An error occurred while attempting to set ownership of {book_dir} to abc:abc. See the following error:\n{e}")
 
 
 def main():
@@ -564,6 +641,7 @@ def main():
     )
 
     parser.add_argument('--verbose', '-v', action='store_true', required=False, dest='verbose', help='When passed, the output from the ebook-convert command will be included in what is shown to the user in the Web UI', default=False)
+    parser.add_argument('--workers', '-w', type=int, required=False, dest='workers', help=f'Number of books to convert at the same time (default {DEFAULT_WORKERS}, set with CWA_CONVERT_LIBRARY_WORKERS)', default=None)
     args = parser.parse_args()
 
     logger.info(f"CWA Convert Library Service - Run Started: {datetime.now()}\n")
@@ -571,11 +649,12 @@ def main():
     if len(converter.to_convert) > 0:
         converter.convert_library()
     else:
+        converter.db.update_convert_library_state(status='finished')
         print_and_log(f'[convert-library]: No books found in library without a copy in the target format ({converter.target_format}). Exiting now...')
         logger.info(f"\nCWA Convert Library Service - Run Ended: {datetime.now()}")
         sys.exit(0)
 
-    print_and_log(f"\n[convert-library]: Library conversion complete! {len(converter.to_convert)} books converted! Exiting now...")
+    print_and_log(f"\n[convert-library]: Library conversion complete! {converter.converted} books converted, {converter.failed} failed! Exiting now...")
     logger.info(f"\nCWA Convert Library Service - Run Ended: {datetime.now()}")
     sys.exit(0)
 
@@ -9,12 +9,16 @@ import atexit
 import json
 import os
 import re
+import shutil
+import signal
 import sqlite3
 import subprocess
 import sys
 import tempfile
+import threading
 import time
-from datetime import datetime
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timezone
 from pathlib import Path
 import unicodedata
 
@@ -71,28 +75,46 @@ change_logs_dir = "/app/calibre-web-automated/metadata_change_logs"
 metadata_temp_dir = "/app/calibre-web-automated/metadata_temp"
 
 
+lock_path = tempfile.gettempdir() + '/cover_enforcer.lock'
+
+def _env_number(name: str, default, cast=int):
+    try:
+        return max(cast(0), cast(os.getenv(name, default)))
+    except ValueError:
+        return default
+
+# Settings of the long-lived enforcer started with --watch
+# Books whose ebook-polish runs happen at the same time
+ENFORCER_WORKERS = max(1, _env_number("CWA_ENFORCER_WORKERS", 2))
+# A book is only enforced once no new change log arrived for it for this long
+ENFORCER_DEBOUNCE_SECONDS = _env_number("CWA_ENFORCER_DEBOUNCE_SECONDS", 3.0, float)
+# The change log folder is rescanned at least this often, even without a wake-up from the watcher
+ENFORCER_SCAN_INTERVAL = 5.0
+
+
 # Creates a lock file unless one already exists meaning an instance of the script is
-# already running, then the script is closed, the user is notified and the program
-# exits with code 2
-try:
-    lock = open(tempfile.gettempdir() + '/cover_enforcer.lock', 'x')
-    lock.close()
-except FileExistsError:
-    print("[cover-metadata-enforcer]: CANCELLING... cover-metadata-enforcer was initiated but is already running")
-    sys.exit(2)
+# already running (or the library is being restored). Returns False if the lock is taken
+def acquireLock() -> bool:
+    try:
+        lock = open(lock_path, 'x')
+        lock.close()
+        return True
+    except FileExistsError:
+        return False
 
 # Defining function to delete the lock on script exit
 def removeLock():
-    os.remove(tempfile.gettempdir() + '/cover_enforcer.lock')
-
-# Will automatically run when the script exits
-atexit.register(removeLock)
+    try:
+        os.remove(lock_path)
+    except FileNotFoundError:
+        ...
 
 
 class Book:
-    def __init__(self, book_dir: str, file_path: str):
+    def __init__(self, book_dir: str, file_path: str, metadata_dir: str = metadata_temp_dir):
         self.book_dir: str = book_dir
         self.file_path: str = file_path
+        self.metadata_dir: str = metadata_dir
 
         self.calibre_library = self.get_calibre_library()
 
@@ -156,7 +178,7 @@ class Book:
 
 
     def get_new_metadata_path(self) -> str:
-        """Uses the export function of the calibredb utility to export any new metadata for the given book to metadata_temp, and returns the path to the new metadata.opf"""
+        """Uses the export function of the calibredb utility to export any new metadata for the given book to its metadata dir, and returns the path to the new metadata.opf"""
         # Add retry logic with exponential backoff to handle database locks
         max_retries = 3
         for attempt in range(max_retries):
@@ -171,12 +193,12 @@ class Book:
                     time.sleep(0.5)
                 
                 result = subprocess.run(
-                    ["calibredb", "export", "--with-library", self.calibre_library, "--to-dir", metadata_temp_dir, self.book_id],
+                    ["calibredb", "export", "--with-library", self.calibre_library, "--to-dir", self.metadata_dir, self.book_id],
                     env=self.calibre_env, check=False, capture_output=True, text=True, timeout=60
                 )
                 
                 if result.returncode == 0:
-                    temp_files = [os.path.join(dirpath,f) for (dirpath, dirnames, filenames) in os.walk(metadata_temp_dir) for f in filenames]
+                    temp_files = [os.path.join(dirpath,f) for (dirpath, dirnames, filenames) in os.walk(self.metadata_dir) for f in filenames]
                     opf_files = [f for f in temp_files if f.endswith('.opf')]
                     if opf_files:
                         return opf_files[0]
@@ -535,7 +557,13 @@ class Enforcer:
 
         return supported_files
 
-    def enforce_cover(self, book_dir: str) -> list:
+    def refresh_settings(self) -> None:
+        """Re-reads the CWA settings, for the long-lived enforcer"""
+        self.cwa_settings = self.db.get_cwa_settings()
+        self.enforcer_on = self.cwa_settings["auto_metadata_enforcement"]
+
+
+    def enforce_cover(self, book_dir: str, metadata_dir: str = metadata_temp_dir) -> list:
         """Will force the Cover & Metadata to update for the supported book files in the given directory"""
         supported_files = self.get_supported_files_from_dir(book_dir)
         if supported_files:
@@ -543,13 +571,10 @@ class Enforcer:
                 print("[cover-metadata-enforcer] Multiple file formats for current book detected...", flush=True)
             book_objects = []
             for file in supported_files:
-                book = Book(book_dir, file)
+                book = Book(book_dir, file, metadata_dir)
                 self.replace_old_metadata(book.old_metadata_path, book.new_metadata_path)
-                
+
                 # Use subprocess instead of os.system for better error handling
-                # Add small delay to ensure any file locks are released
-                time.sleep(0.5)
-                
                 try:
                     if Path(book.cover_path).exists():
                         result = subprocess.run(
@@ -571,7 +596,7 @@ class Enforcer:
                 except Exception as e:
                     print(f"[cover-metadata-enforcer] Error running ebook-polish for {file}: {e}", flush=True)
                 
-                self.empty_metadata_temp()
+                self.empty_metadata_temp(metadata_dir)
                 print(f"[cover-metadata-enforcer]: DONE: '{book.title_author}.{book.file_format}': Cover & Metadata updated", flush=True)
 
                 # Calculate and store new checksum after modification
@@ -692,9 +717,28 @@ class Enforcer:
         print(f"[cover-metadata-enforcer] ERROR: Failed to enforce metadata for '{log_info.get('title', 'Unknown')}' (book_id={log_info.get('book_id', 'unknown')}): {error}", flush=True)
 
 
-    def empty_metadata_temp(self):
-        """Empties the metadata_temp folder"""
-        os.system(f"rm -r {metadata_temp_dir}/*")
+    def empty_metadata_temp(self, metadata_dir: str = metadata_temp_dir):
+        """Empties the given metadata folder (metadata_temp by default)"""
+        for entry in os.scandir(metadata_dir):
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path, ignore_errors=True)
+            else:
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    ...
+
+
+    def enforce_from_log(self, log_path: str, metadata_dir: str) -> tuple[dict | None, list, Exception | None]:
+        """Enforces the book of a change log. Runs on the --watch worker threads, so it leaves cwa.db to the caller"""
+        log_info = self.read_log(auto=False, log_path=log_path)
+        if log_info is None:
+            return None, [], None
+        try:
+            book_dir = self.get_book_dir_from_log(log_info)
+            return log_info, self.enforce_cover(book_dir, metadata_dir), None
+        except Exception as e:
+            return log_info, [], e
 
 
     def check_for_other_logs(self, processed_book_ids: set | None = None):
@@ -749,6 +793,167 @@ class Enforcer:
                     self.delete_log(auto=False, log_path=log_path)
 
 
+class EnforcerService:
+    """Long-lived enforcer started with --watch, replacing a fresh process per change log.
+
+    The metadata-change-detector pipes a line per new change log into stdin, which only wakes the
+    service up, the change log folder itself is the queue. Logs are coalesced per book id (only the
+    newest is kept) and a book is enforced once its logs have been quiet for ENFORCER_DEBOUNCE_SECONDS,
+    so a bulk edit of many books turns into one run per book on a bounded pool of workers. Results are
+    written to cwa.db from the main thread only, and the queue depth and throughput are published in
+    cwa_enforcer_status for the stats page. The service exits once stdin is closed and its queue is empty."""
+
+    def __init__(self, enforcer: Enforcer, workers: int = ENFORCER_WORKERS, debounce: float = ENFORCER_DEBOUNCE_SECONDS):
+        self.enforcer = enforcer
+        self.workers = workers
+        self.debounce = debounce
+        self.pending: dict[str, tuple[str, datetime, float]] = {} # book_id -> (newest log, its timestamp, monotonic time it was first seen)
+        self.in_flight = {} # future -> (book_id, log path, metadata dir, monotonic start time)
+        self.free_dirs = [os.path.join(metadata_temp_dir, f"worker-{worker}") for worker in range(1, workers + 1)]
+        self.wakeup = threading.Event()
+        self.input_closed = False
+        self.holds_lock = False
+        self.processed = 0
+        self.failed = 0
+        self.busy_seconds = 0.0
+        self.published = None
+
+
+    def read_input(self, stream) -> None:
+        for _ in stream:
+            self.wakeup.set()
+        self.input_closed = True
+        self.wakeup.set()
+
+
+    def scan(self) -> None:
+        """Adds new change logs to the queue, deleting logs superseded by a newer one for the same book"""
+        now = time.monotonic()
+        in_flight_logs = {log_path for _, log_path, _, _ in self.in_flight.values()}
+        try:
+            log_files = [entry.path for entry in os.scandir(change_logs_dir) if entry.name.endswith('.json')]
+        except FileNotFoundError:
+            return
+        for log_path in sorted(log_files):
+            if log_path in in_flight_logs:
+                continue
+            book_id, timestamp = self.enforcer._parse_log_filename(log_path)
+            if book_id is None or timestamp is None:
+                continue
+            queued = self.pending.get(book_id)
+            if queued is None:
+                self.pending[book_id] = (log_path, timestamp, now)
+            elif queued[0] == log_path:
+                continue
+            elif timestamp >= queued[1]:
+                self.enforcer.delete_log(auto=False, log_path=queued[0])
+                self.pending[book_id] = (log_path, timestamp, now)
+            else:
+                self.enforcer.delete_log(auto=False, log_path=log_path)
+
+
+    def ready_books(self) -> list[str]:
+        """Queued books whose logs have been quiet long enough and that aren't being enforced right now"""
+        now = time.monotonic()
+        busy = {book_id for book_id, _, _, _ in self.in_flight.values()}
+        ready = [(seen, book_id) for book_id, (_, _, seen) in self.pending.items()
+                 if now - seen >= self.debounce and book_id not in busy]
+        return [book_id for _, book_id in sorted(ready)]
+
+
+    def seconds_until_ready(self) -> float:
+        if not self.pending:
+            return ENFORCER_SCAN_INTERVAL
+        now = time.monotonic()
+        return max(0.05, min(seen + self.debounce - now for _, _, seen in self.pending.values()))
+
+
+    def dispatch(self, pool: ThreadPoolExecutor) -> None:
+        ready = self.ready_books()
+        if not ready or not self.free_dirs:
+            return
+        self.enforcer.refresh_settings()
+        if not self.enforcer.enforcer_on:
+            for book_id in ready:
+                log_path, _, _ = self.pending.pop(book_id)
+                print(f"[cover-metadata-enforcer] The CWA Automatic Metadata enforcement service is currently disabled in the settings. Therefore the metadata changes for book {book_id} won't be enforced.", flush=True)
+                self.enforcer.delete_log(auto=False, log_path=log_path)
+            return
+        if not self.holds_lock:
+            # A one-off enforcer run or a library restore is in progress, try again on the next pass
+            if not acquireLock():
+                return
+            self.holds_lock = True
+        for book_id in ready:
+            if not self.free_dirs:
+                break
+            log_path, _, _ = self.pending.pop(book_id)
+            metadata_dir = self.free_dirs.pop()
+            os.makedirs(metadata_dir, exist_ok=True)
+            future = pool.submit(self.enforcer.enforce_from_log, log_path, metadata_dir)
+            self.in_flight[future] = (book_id, log_path, metadata_dir, time.monotonic())
+
+
+    def collect(self, finished) -> None:
+        for future in finished:
+            book_id, log_path, metadata_dir, started = self.in_flight.pop(future)
+            self.free_dirs.append(metadata_dir)
+            self.busy_seconds += time.monotonic() - started
+            log_info, book_objects, error = future.result()
+            if log_info is not None:
+                if book_objects and error is None:
+                    for book in book_objects:
+                        book.log_info = dict(log_info, file_path=book.file_path)
+                        self.enforcer.db.enforce_add_entry_from_log(book.log_info)
+                    self.processed += 1
+                else:
+                    self.enforcer.record_failed_enforcement(log_info, error or "No supported files or enforcement failed")
+                    self.failed += 1
+            self.enforcer.delete_log(auto=False, log_path=log_path)
+        if not self.in_flight and self.holds_lock:
+            removeLock()
+            self.holds_lock = False
+
+
+    def publish(self, running: bool = True) -> None:
+        """Writes the counters to cwa.db when they changed"""
+        status = (running, len(self.pending), len(self.in_flight), self.processed, self.failed)
+        if status == self.published:
+            return
+        self.enforcer.db.update_enforcer_status(running=int(running), queue_depth=len(self.pending),
+                                                in_flight=len(self.in_flight), processed=self.processed,
+                                                failed=self.failed, busy_seconds=round(self.busy_seconds, 2))
+        self.published = status
+
+
+    def run(self, stream=sys.stdin) -> None:
+        self.enforcer.db.update_enforcer_status(started_at=datetime.now(timezone.utc).isoformat(), processed=0,
+                                                failed=0, busy_seconds=0)
+        print(f"[cover-metadata-enforcer] Waiting for metadata changes ({self.workers} worker(s), {self.debounce:g}s debounce)...", flush=True)
+        threading.Thread(target=self.read_input, args=(stream,), daemon=True).start()
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="cover-enforcer") as pool:
+                while True:
+                    self.wakeup.clear()
+                    self.scan()
+                    self.dispatch(pool)
+                    self.publish()
+                    if self.input_closed and not self.pending and not self.in_flight:
+                        break
+                    timeout = min(ENFORCER_SCAN_INTERVAL, self.seconds_until_ready())
+                    if self.in_flight:
+                        finished, _ = wait(self.in_flight, timeout=timeout, return_when=FIRST_COMPLETED)
+                        self.collect(finished)
+                    else:
+                        self.wakeup.wait(timeout)
+        finally:
+            if self.holds_lock:
+                removeLock()
+            self.pending.clear()
+            self.in_flight.clear()
+            self.publish(running=False)
+
+
 def main():
     parser = argparse.ArgumentParser(
         prog='cover-enforcer',
@@ -766,8 +971,23 @@ def main():
     parser.add_argument('-history', action='store_true', dest='history', help='Display a history of all enforcements ever carried out on your machine (not yet implemented)', default=False)
     parser.add_argument('-paths', '-p', action='store_true', dest='paths', help="Use with '-history' flag to display stored paths of all files in enforcement database", default=False)
     parser.add_argument('-v', '--verbose', action='store_true', dest='verbose', help="Use with history to display entire enforcement history instead of only the most recent 10 entries", default=False)
+    parser.add_argument('--watch', action='store_true', dest='watch', help='Keep running and enforce the change logs in the change log folder, waking up on every line written to stdin until it is closed', default=False)
+    parser.add_argument('--workers', action='store', type=int, dest='workers', help=f'With --watch, number of books enforced at the same time (default {ENFORCER_WORKERS}, set with CWA_ENFORCER_WORKERS)', default=ENFORCER_WORKERS)
     args = parser.parse_args()
 
+    if args.watch:
+        # Stopping the service should still release the lock and mark the service as stopped
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        EnforcerService(Enforcer(args), workers=max(1, args.workers)).run()
+        sys.exit(0)
+
+    # Exit with code 2 if another run (or the --watch service) is already enforcing
+    if not acquireLock():
+        print("[cover-metadata-enforcer]: CANCELLING... cover-metadata-enforcer was initiated but is already running")
+        sys.exit(2)
+    # Will automatically run when the script exits
+    atexit.register(removeLock)
+
     enforcer = Enforcer(args)
 
     if len(sys.argv) == 1:
@@ -9,12 +9,134 @@ import sys
 import os
 from sqlite3 import Error as sqlError
 import re
-from datetime import datetime
+import time
+import copy
+import threading
+import atexit
+import random
+from datetime import datetime, timezone
 
 from tabulate import tabulate
 
 
+def _parse_sample_rates(value: str) -> dict[str, float]:
+    """Parses "OPDS_ACCESS=0.1,KOBO_SYNC=0.5" into {event type: fraction of events kept}"""
+    rates = {}
+    for part in value.split(','):
+        name, _, rate = part.partition('=')
+        if not name.strip():
+            continue
+        try:
+            rates[name.strip().upper()] = min(1.0, max(0.0, float(rate)))
+        except ValueError:
+            print(f"[cwa-db] Ignoring invalid activity sample rate '{part}'")
+    return rates
+
+
+ACTIVITY_ASYNC = os.environ.get("CWA_ACTIVITY_ASYNC", "true").strip().lower() in ("1", "true", "yes", "on")
+ACTIVITY_FLUSH_SECONDS = float(os.environ.get("CWA_ACTIVITY_FLUSH_SECONDS", "2"))
+ACTIVITY_FLUSH_SIZE = int(os.environ.get("CWA_ACTIVITY_FLUSH_SIZE", "100"))
+ACTIVITY_SAMPLE_RATES = _parse_sample_rates(os.environ.get("CWA_ACTIVITY_SAMPLE_RATES", ""))
+
+# A row kept by sampling stands for 1/sample_rate events, so activity stats add up these weights
+# instead of counting rows. Distinct counts (unique books, active users) can't be scaled that way
+# and only see the rows that were kept.
+ACTIVITY_WEIGHT = ("(CASE WHEN json_valid(extra_data) "
+                   "THEN COALESCE(1.0 / json_extract(extra_data, '$.sample_rate'), 1) ELSE 1 END)")
+
+
+def activity_count(condition=None) -> str:
+    """SQL for the estimated number of cwa_user_activity events, optionally only those matching condition"""
+    if condition:
+        return f"CAST(ROUND(TOTAL(CASE WHEN {condition} THEN {ACTIVITY_WEIGHT} END)) AS INTEGER)"
+    return f"CAST(ROUND(TOTAL({ACTIVITY_WEIGHT})) AS INTEGER)"
+
+
+ACTIVITY_COUNT = activity_count()
+
+
+class ActivityLog:
+    """Buffers cwa_user_activity rows and writes them in batches from a background thread.
+
+    Logging used to INSERT and commit inside the request, so every login, OPDS hit or download
+    waited on the cwa.db write lock. Rows are written every ACTIVITY_FLUSH_SECONDS, or as soon as
+    ACTIVITY_FLUSH_SIZE are waiting, and whatever is left is written at interpreter exit.
+    """
+    MAX_PENDING = 10000
+
+    def __init__(self, flush_seconds: float, flush_size: int):
+        self.flush_seconds = flush_seconds
+        self.flush_size = flush_size
+        self._pending: list[tuple[str, tuple]] = []
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._dropped = 0
+        atexit.register(self.flush)
+
+    def add(self, db_file: str, row: tuple) -> None:
+        with self._lock:
+            if len(self._pending) >= self.MAX_PENDING:
+                self._dropped += 1
+                return
+            self._pending.append((db_file, row))
+            full = len(self._pending) >= self.flush_size
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="cwa-activity-log", daemon=True)
+                self._thread.start()
+        if full:
+            self._wakeup.set()
+
+    def flush(self) -> None:
+        """Writes everything queued so far; returns once it is in cwa.db"""
+        with self._write_lock:
+            with self._lock:
+                batch, self._pending = self._pending, []
+                dropped, self._dropped = self._dropped, 0
+            if dropped:
+                print(f"[cwa-db] Activity log buffer was full, dropped {dropped} event(s)")
+            by_db: dict[str, list[tuple]] = {}
+            for db_file, row in batch:
+                by_db.setdefault(db_file, []).append(row)
+            for db_file, rows in by_db.items():
+                try:
+                    con = sqlite3.connect(db_file, timeout=30)
+                    try:
+                        with con:
+                            con.executemany("""
+                                INSERT INTO cwa_user_activity (user_id, user_name, event_type, item_id, item_title, extra_data, timestamp)
+                                VALUES (?, ?, ?, ?, ?, ?, ?)
+                            """, rows)
+                    finally:
+                        con.close()
+                except Exception as e:
+                    print(f"[cwa-db] Error logging activity ({len(rows)} event(s) lost): {e}")
+
+    def _run(self) -> None:
+        while True:
+            self._wakeup.wait(self.flush_seconds)
+            self._wakeup.clear()
+            self.flush()
+
+
+# cps imports this module both as `cwa_db` and `scripts.cwa_db`; share one buffer between the two
+_activity_log = next((m._activity_log for m in (sys.modules.get("cwa_db"), sys.modules.get("scripts.cwa_db"))
+                      if m is not None and hasattr(m, "_activity_log")), None) \
+    or ActivityLog(ACTIVITY_FLUSH_SECONDS, ACTIVITY_FLUSH_SIZE)
+
+
 class CWA_DB:
+    # CWA_DB() is constructed all over the web app (per page render, per OPDS request, ...), so the
+    # expensive parts are shared by every instance in the process: each thread keeps one connection
+    # per db file, the schema checks/migrations run once per db file, and the parsed settings row is
+    # cached until cwa.db changes
+    _local = threading.local()
+    _init_lock = threading.Lock()
+    _initialised = {}  # (db file, inode) -> (tables, schema, default settings)
+    _settings_generation = 0  # bumped on settings writes made through this process
+    _duplicate_generation = 0  # bumped on duplicate cache writes made through this process
+
     def __init__(self, verbose=False):
         self.verbose = verbose
 
@@ -26,30 +148,63 @@ class CWA_DB:
         script_dir = os.path.dirname(os.path.abspath(__file__))
         self.schema_path = os.path.join(script_dir, "cwa_schema.sql")
         self.stats_tables = ["cwa_enforcement", "cwa_import", "cwa_conversions", "epub_fixes", "cwa_user_activity", "cwa_duplicate_cache", "cwa_duplicate_resolutions"]
-        self.tables, self.schema = self.make_tables()
 
-        self.cwa_default_settings = self.get_cwa_default_settings()
-        self.ensure_settings_schema_match()
-        self.match_stat_table_columns_with_schema()
-        self.ensure_scheduled_jobs_schema()
-        self.set_default_settings()
+        with CWA_DB._init_lock:
+            state = CWA_DB._initialised.get(self._db_key)
+            if state is None:
+                self.tables, self.schema = self.make_tables()
+
+                self.cwa_default_settings = self.get_cwa_default_settings()
+                self.ensure_settings_schema_match()
+                self.match_stat_table_columns_with_schema()
+                self.ensure_scheduled_jobs_schema()
+                self.set_default_settings()
+                CWA_DB._initialised[self._db_key] = (self.tables, self.schema, self.cwa_default_settings)
+            else:
+                self.tables, self.schema, self.cwa_default_settings = state
         self.cwa_settings = self.get_cwa_settings()
 
 
     def connect_to_db(self) -> tuple[sqlite3.Connection, sqlite3.Cursor] | None:
-        """Establishes connection with the db or makes one if one doesn't already exist"""
-        con = None
-        cur = None
-        try:
-            con = sqlite3.connect(self.db_path + self.db_file, timeout=30)
-        except sqlError as e:
-            print(f"[cwa-db]: The following error occurred while trying to connect to the CWA Enforcement DB: {e}")
-            sys.exit(0)
-        if con:
-            cur = con.cursor()
+        """Returns this thread's connection to the db, making the db if it doesn't already exist"""
+        full_path = self.db_path + self.db_file
+        pool = getattr(CWA_DB._local, "connections", None)
+        if pool is None:
+            pool = CWA_DB._local.connections = {}
+
+        con, inode = pool.get(full_path, (None, None))
+        if con is not None:
+            try:
+                current_inode = os.stat(full_path).st_ino
+                if current_inode != inode:
+                    raise FileNotFoundError(full_path)  # db was deleted or replaced
+                if con.in_transaction:
+                    # Writes of another CWA_DB on this thread that weren't committed yet; they are
+                    # that instance's to commit or roll back, so they are left alone
+                    print(f"[cwa-db] Sharing this thread's connection to {full_path} while it has uncommitted writes")
+            except (OSError, sqlite3.ProgrammingError):
+                try:
+                    con.close()
+                except sqlite3.Error:
+                    pass
+                con = None
+
+        if con is None:
+            try:
+                con = sqlite3.connect(full_path, timeout=30)
+                inode = os.stat(full_path).st_ino
+            except (sqlError, OSError) as e:
+                print(f"[cwa-db]: The following error occurred while trying to connect to the CWA Enforcement DB: {e}")
+                sys.exit(0)
+            pool[full_path] = (con, inode)
+            # data_version counts per connection, so cached rows can't be trusted across connections
+            getattr(CWA_DB._local, "settings", {}).pop((full_path, inode), None)
+            getattr(CWA_DB._local, "duplicate_summary", {}).pop((full_path, inode), None)
             if self.verbose:
                 print("[cwa-db]: Connection with the CWA Enforcement DB Successful!")
-            return con, cur
+
+        self._db_key = (full_path, inode)
+        return con, con.cursor()
 
 
     def make_tables(self) -> tuple[list[str], list[str]]:
@@ -215,6 +370,7 @@ class CWA_DB:
                 for update in updates_made:
                     print(f"[cwa-db]   - {update}")
         except Exception as e:
+            self.con.rollback()
             print(f"[cwa-db] Warning: Failed to sync new settings with defaults: {e}")
 
 
@@ -336,6 +492,7 @@ class CWA_DB:
                 for fix in fixes_made:
                     print(f"[cwa-db]   - {fix}")
         except Exception as e:
+            self.con.rollback()
             print(f"[cwa-db] Warning: Failed to fix malformed setting values: {e}")
 
 
@@ -444,6 +601,7 @@ class CWA_DB:
             for setting in self.cwa_default_settings:
                 self.cur.execute(f"UPDATE cwa_settings SET {setting}=?;", (self.cwa_default_settings[setting],))
                 self.con.commit()
+            self.invalidate_settings_cache()
             print("[cwa-db] CWA Default Settings successfully applied!")
             return
         try:
@@ -477,7 +635,31 @@ class CWA_DB:
 
 
     def get_cwa_settings(self) -> dict:
-        """Gets the current cwa_settings values from the table of the same name in cwa.db and returns them as a dict"""
+        """Gets the current cwa_settings values from the table of the same name in cwa.db and returns them as a dict
+
+        The parsed row is cached per connection. PRAGMA data_version tells us when another
+        connection (e.g. the web UI while this is the ingest processor) has written to cwa.db.
+        """
+        data_version = self.cur.execute("PRAGMA data_version").fetchone()[0]
+        cache = getattr(CWA_DB._local, "settings", None)
+        if cache is None:
+            cache = CWA_DB._local.settings = {}
+        stamp = (self._db_key, data_version, CWA_DB._settings_generation)
+        cached = cache.get(self._db_key)
+        if cached is not None and cached[0] == stamp:
+            return copy.deepcopy(cached[1])
+
+        cwa_settings = self._read_cwa_settings()
+        cache[self._db_key] = (stamp, cwa_settings)
+        return copy.deepcopy(cwa_settings)
+
+
+    @classmethod
+    def invalidate_settings_cache(cls) -> None:
+        cls._settings_generation += 1
+
+
+    def _read_cwa_settings(self) -> dict:
         self.cur.execute("SELECT * FROM cwa_settings")
         if self.cur.fetchall() == []: # If settings table is empty, populates it with default values
             self.cur.execute("INSERT INTO cwa_settings DEFAULT VALUES;")
@@ -543,33 +725,79 @@ class CWA_DB:
                 self.cur.execute(f"UPDATE cwa_settings SET {setting}=?;", (result[setting],))
                 self.con.commit()
             except Exception as e:
+                self.con.rollback()
                 print(f"[CWA_DB] Error updating setting '{setting}' with value '{result[setting]}': {e}")
                 # Continue to next setting instead of failing completely
                 continue
         self.set_default_settings()
+        self.invalidate_settings_cache()
+        self.cwa_settings = self.get_cwa_settings()
 
 
     def enforce_add_entry_from_log(self, log_info: dict, trigger_type: str = "auto -log"):
         """Adds an entry to the db from a change log file"""
-        self.cur.execute(
-            "INSERT INTO cwa_enforcement(timestamp, book_id, book_title, author, file_path, trigger_type) VALUES (?, ?, ?, ?, ?, ?);",
-            (log_info['timestamp'], log_info['book_id'], log_info['title'], log_info['authors'], log_info['file_path'], trigger_type)
-        )
-        self.con.commit()
+        try:
+            self.cur.execute(
+                "INSERT INTO cwa_enforcement(timestamp, book_id, book_title, author, file_path, trigger_type) VALUES (?, ?, ?, ?, ?, ?);",
+                (log_info['timestamp'], log_info['book_id'], log_info['title'], log_info['authors'], log_info['file_path'], trigger_type)
+            )
+            self.con.commit()
+        except Exception:
+            self.con.rollback()
+            raise
 
 
     def enforce_add_entry_from_dir(self, book_dicts: list[dict[str,str]]):
         """Adds an entry to the db when cover_enforcer is ran with a directory"""
-        for book in book_dicts:
-            self.cur.execute("INSERT INTO cwa_enforcement(timestamp, book_id, book_title, author, file_path, trigger_type) VALUES (?, ?, ?, ?, ?, ?);", (book['timestamp'], book['book_id'], book['book_title'], book['author_name'], book['file_path'], 'manual -dir'))
-            self.con.commit()
+        try:
+            for book in book_dicts:
+                self.cur.execute("INSERT INTO cwa_enforcement(timestamp, book_id, book_title, author, file_path, trigger_type) VALUES (?, ?, ?, ?, ?, ?);", (book['timestamp'], book['book_id'], book['book_title'], book['author_name'], book['file_path'], 'manual -dir'))
+                self.con.commit()
+        except Exception:
+            self.con.rollback()
+            raise
 
 
     def enforce_add_entry_from_all(self, book_dicts: list[dict[str,str]]):
         """Adds an entry to the db when cover_enforcer is ran with the -all flag"""
-        for book in book_dicts:
-            self.cur.execute("INSERT INTO cwa_enforcement(timestamp, book_id, book_title, author, file_path, trigger_type) VALUES (?, ?, ?, ?, ?, ?);", (book['timestamp'], book['book_id'], book['book_title'], book['author_name'], book['file_path'], 'manual -all'))
+        try:
+            for book in book_dicts:
+                self.cur.execute("INSERT INTO cwa_enforcement(timestamp, book_id, book_title, author, file_path, trigger_type) VALUES (?, ?, ?, ?, ?, ?);", (book['timestamp'], book['book_id'], book['book_title'], book['author_name'], book['file_path'], 'manual -all'))
+                self.con.commit()
+        except Exception:
+            self.con.rollback()
+            raise
+
+
+    ENFORCER_STATUS_FIELDS = ('running', 'queue_depth', 'in_flight', 'processed', 'failed', 'busy_seconds', 'started_at')
+
+    def get_enforcer_status(self):
+        """Get the queue and throughput counters of the long-lived enforcer, or None on error"""
+        try:
+            self.cur.execute(f"SELECT {', '.join(self.ENFORCER_STATUS_FIELDS)}, updated_at FROM cwa_enforcer_status WHERE id = 1")
+            row = self.cur.fetchone()
+        except Exception as e:
+            print(f"[cwa-db] Error reading enforcer status: {e}")
+            return None
+        if not row:
+            return None
+        return dict(zip(self.ENFORCER_STATUS_FIELDS + ('updated_at',), row))
+
+    def update_enforcer_status(self, **fields):
+        """Set columns of cwa_enforcer_status, updated_at is set automatically"""
+        unknown = set(fields) - set(self.ENFORCER_STATUS_FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown enforcer status fields: {', '.join(sorted(unknown))}")
+        try:
+            assignments = ''.join(f"{name} = ?, " for name in fields)
+            self.cur.execute(f"UPDATE cwa_enforcer_status SET {assignments}updated_at = ? WHERE id = 1",
+                             (*fields.values(), datetime.now(timezone.utc).isoformat()))
             self.con.commit()
+            return True
+        except Exception as e:
+            self.con.rollback()
+            print(f"[cwa-db] Error updating enforcer status: {e}")
+            return False
 
 
     def enforce_show(self, paths: bool, verbose: bool, web_ui=False):
@@ -658,19 +886,59 @@ class CWA_DB:
 
     def import_add_entry(self, filename, original_backed_up):
         timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        self.cur.execute("INSERT INTO cwa_import(timestamp, filename, original_backed_up) VALUES (?, ?, ?);", (timestamp, filename, original_backed_up))
-        self.con.commit()
+        try:
+            self.cur.execute("INSERT INTO cwa_import(timestamp, filename, original_backed_up) VALUES (?, ?, ?);", (timestamp, filename, original_backed_up))
+            self.con.commit()
+        except Exception:
+            self.con.rollback()
+            raise
 
 
     def conversion_add_entry(self, filename, original_format, end_format, original_backed_up): # TODO Add end_format - 22.11.2024 - Done?
         timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        self.cur.execute("INSERT INTO cwa_conversions(timestamp, filename, original_format, end_format, original_backed_up) VALUES (?, ?, ?, ?, ?);", (timestamp, filename, original_format, end_format, original_backed_up))
-        self.con.commit()
+        try:
+            self.cur.execute("INSERT INTO cwa_conversions(timestamp, filename, original_format, end_format, original_backed_up) VALUES (?, ?, ?, ?, ?);", (timestamp, filename, original_format, end_format, original_backed_up))
+            self.con.commit()
+        except Exception:
+            self.con.rollback()
+            raise
 
     def epub_fixer_add_entry(self, filename, manually_triggered, num_of_fixes_applied, original_backed_up, file_path, fixes_applied=""):
         timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        self.cur.execute("INSERT INTO epub_fixes(timestamp, filename, manually_triggered, num_of_fixes_applied, original_backed_up, file_path, fixes_applied) VALUES (?, ?, ?, ?, ?, ?, ?);", (timestamp, filename, manually_triggered, num_of_fixes_applied, original_backed_up, file_path, fixes_applied))
-        self.con.commit()
+        try:
+            self.cur.execute("INSERT INTO epub_fixes(timestamp, filename, manually_triggered, num_of_fixes_applied, original_backed_up, file_path, fixes_applied) VALUES (?, ?, ?, ?, ?, ?, ?);", (timestamp, filename, manually_triggered, num_of_fixes_applied, original_backed_up, file_path, fixes_applied))
+            self.con.commit()
+        except Exception:
+            self.con.rollback()
+            raise
+
+    def epub_fixer_record_batch(self, fixes: list[tuple], files: list[tuple]) -> bool:
+        """Record the results of a batch of library-wide fixer runs in a single transaction
+
+        Args:
+            fixes: (filename, manually_triggered, num_of_fixes_applied, original_backed_up, file_path, fixes_applied) rows for epub_fixes
+            files: (file_path, file_size, file_mtime, fixer_version) of the files as they were left by the fixer
+        """
+        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        try:
+            self.cur.executemany("INSERT INTO epub_fixes(timestamp, filename, manually_triggered, num_of_fixes_applied, original_backed_up, file_path, fixes_applied) VALUES (?, ?, ?, ?, ?, ?, ?);",
+                                 [(timestamp, *row) for row in fixes])
+            self.cur.executemany("INSERT OR REPLACE INTO cwa_epub_fixer_files(file_path, file_size, file_mtime, fixer_version, checked_at) VALUES (?, ?, ?, ?, ?);",
+                                 [(*row, timestamp) for row in files])
+            self.con.commit()
+            return True
+        except Exception as e:
+            self.con.rollback()
+            print(f"[cwa-db] Error recording EPUB fixer results: {e}")
+            return False
+
+    def get_epub_fixer_files(self) -> dict[str, tuple[int, int, int]]:
+        """Get file_path -> (file_size, file_mtime, fixer_version) of every EPUB the library-wide fixer has checked"""
+        try:
+            return {row[0]: tuple(row[1:]) for row in self.cur.execute("SELECT file_path, file_size, file_mtime, fixer_version FROM cwa_epub_fixer_files")}
+        except Exception as e:
+            print(f"[cwa-db] Error reading EPUB fixer files: {e}")
+            return {}
 
     def get_stat_totals(self) -> dict[str,int]:
         totals = {"cwa_enforcement":0,
@@ -715,6 +983,7 @@ class CWA_DB:
             self.con.commit()
             return self.cur.lastrowid
         except Exception as e:
+            self.con.rollback()
             print(f"[cwa-db] ERROR adding scheduled auto-send: {e}")
             return None
 
@@ -732,6 +1001,7 @@ class CWA_DB:
             self.con.commit()
             return self.cur.lastrowid
         except Exception as e:
+            self.con.rollback()
             print(f"[cwa-db] ERROR adding scheduled job '{job_type}': {e}")
             return None
 
@@ -742,6 +1012,7 @@ class CWA_DB:
             self.con.commit()
             return self.cur.rowcount > 0
         except Exception as e:
+            self.con.rollback()
             print(f"[cwa-db] ERROR marking scheduled job dispatched: {e}")
             return False
 
@@ -750,6 +1021,7 @@ class CWA_DB:
             self.cur.execute("UPDATE cwa_scheduled_jobs SET state='cancelled' WHERE id=?", (int(row_id),))
             self.con.commit()
         except Exception as e:
+            self.con.rollback()
             print(f"[cwa-db] ERROR marking scheduled job cancelled: {e}")
 
     def scheduled_cancel_for_book(self, book_id: int) -> int:
@@ -772,6 +1044,7 @@ class CWA_DB:
                 print(f"[cwa-db] Cancelled {cancelled_count} scheduled job(s) for book {book_id}", flush=True)
             return cancelled_count
         except Exception as e:
+            self.con.rollback()
             print(f"[cwa-db] ERROR cancelling scheduled jobs for book {book_id}: {e}", flush=True)
             return 0
 
@@ -780,6 +1053,7 @@ class CWA_DB:
             self.cur.execute("UPDATE cwa_scheduled_jobs SET scheduler_job_id=? WHERE id=?", (scheduler_job_id, int(row_id)))
             self.con.commit()
         except Exception as e:
+            self.con.rollback()
             print(f"[cwa-db] ERROR updating scheduler_job_id: {e}")
 
     def scheduled_get_by_id(self, row_id: int):
@@ -869,11 +1143,169 @@ class CWA_DB:
             print(f"[cwa-db] ERROR fetching pending scheduled jobs for {job_type}: {e}")
             return []
 
+    # ==============================
+    # Ingest Queue
+    # ==============================
+
+    def ingest_queue_add(self, filepath: str, priority: int = 0, source: str = 'watcher') -> None:
+        """Queue a file for the ingest worker.
+
+        Re-adding a path that is already queued keeps the higher priority, a finished or failed
+        path is reset so it is processed again, and a path being processed is left alone.
+        """
+        now = time.time()
+        try:
+            self.cur.execute(
+                """
+                INSERT INTO cwa_ingest_queue(filepath, source, priority, state, attempts, next_attempt_at, enqueued_at)
+                VALUES(?, ?, ?, 'pending', 0, 0, ?)
+                ON CONFLICT(filepath) DO UPDATE SET
+                    priority = MAX(cwa_ingest_queue.priority, excluded.priority),
+                    source = CASE WHEN excluded.priority > cwa_ingest_queue.priority THEN excluded.source ELSE cwa_ingest_queue.source END,
+                    state = CASE WHEN cwa_ingest_queue.state = 'processing' THEN 'processing' ELSE 'pending' END,
+                    attempts = CASE WHEN cwa_ingest_queue.state IN ('done', 'failed') THEN 0 ELSE cwa_ingest_queue.attempts END,
+                    next_attempt_at = CASE WHEN cwa_ingest_queue.state IN ('done', 'failed') THEN 0 ELSE cwa_ingest_queue.next_attempt_at END,
+                    enqueued_at = CASE WHEN cwa_ingest_queue.state IN ('done', 'failed') THEN excluded.enqueued_at ELSE cwa_ingest_queue.enqueued_at END
+                """,
+                (filepath, source, int(priority), now)
+            )
+            self.con.commit()
+        except Exception:
+            self.con.rollback()
+            raise
+
+    def ingest_queue_claim(self) -> dict | None:
+        """Atomically move the next ready entry (highest priority, oldest first) to 'processing'."""
+        now = time.time()
+        self.con.commit()
+        self.cur.execute("BEGIN IMMEDIATE")
+        try:
+            row = self.cur.execute(
+                """
+                SELECT id, filepath, source, priority, attempts FROM cwa_ingest_queue
+                WHERE state = 'pending' AND next_attempt_at <= ?
+                ORDER BY priority DESC, id ASC LIMIT 1
+                """,
+                (now,)
+            ).fetchone()
+            if row is None:
+                self.con.commit()
+                return None
+            self.cur.execute(
+                "UPDATE cwa_ingest_queue SET state = 'processing', attempts = attempts + 1, started_at = ? WHERE id = ?",
+                (now, row[0])
+            )
+            self.con.commit()
+        except Exception:
+            self.con.rollback()
+            raise
+        return {'id': row[0], 'filepath': row[1], 'source': row[2], 'priority': row[3], 'attempts': row[4] + 1}
+
+    def ingest_queue_finish(self, row_id: int, duration_seconds: float, error: str = '') -> None:
+        """Mark an entry done, or failed for good when an error is given."""
+        try:
+            self.cur.execute(
+                "UPDATE cwa_ingest_queue SET state = ?, finished_at = ?, duration_seconds = ?, last_error = ? WHERE id = ?",
+                ('failed' if error else 'done', time.time(), duration_seconds, error, int(row_id))
+            )
+            self.con.commit()
+        except Exception:
+            self.con.rollback()
+            raise
+
+    def ingest_queue_retry(self, row_id: int, delay_seconds: float, error: str) -> None:
+        """Put an entry back in the queue, not to be picked up again for delay_seconds."""
+        try:
+            self.cur.execute(
+                "UPDATE cwa_ingest_queue SET state = 'pending', next_attempt_at = ?, last_error = ? WHERE id = ?",
+                (time.time() + delay_seconds, error, int(row_id))
+            )
+            self.con.commit()
+        except Exception:
+            self.con.rollback()
+            raise
+
+    def ingest_queue_requeue_interrupted(self) -> int:
+        """Entries left in 'processing' by a crashed or restarted worker go back to 'pending'."""
+        try:
+            self.cur.execute("UPDATE cwa_ingest_queue SET state = 'pending' WHERE state = 'processing'")
+            self.con.commit()
+        except Exception:
+            self.con.rollback()
+            raise
+        return self.cur.rowcount
+
+    def ingest_queue_prune(self, days: int = 7) -> int:
+        """Forget finished entries older than the given number of days. Pending entries are never dropped."""
+        try:
+            self.cur.execute(
+                "DELETE FROM cwa_ingest_queue WHERE state IN ('done', 'failed') AND finished_at < ?",
+                (time.time() - days * 86400,)
+            )
+            self.con.commit()
+        except Exception:
+            self.con.rollback()
+            raise
+        return self.cur.rowcount
+
+    def ingest_queue_depth(self) -> int:
+        return self.cur.execute(
+            "SELECT COUNT(*) FROM cwa_ingest_queue WHERE state IN ('pending', 'processing')"
+        ).fetchone()[0]
+
+    def ingest_queue_stats(self) -> dict:
+        """Queue depth per state plus throughput over the last 5 minutes and the last hour."""
+        now = time.time()
+        counts = dict(self.cur.execute("SELECT state, COUNT(*) FROM cwa_ingest_queue GROUP BY state").fetchall())
+        retrying, next_retry_at = self.cur.execute(
+            "SELECT COUNT(*), MIN(next_attempt_at) FROM cwa_ingest_queue WHERE state = 'pending' AND attempts > 0"
+        ).fetchone()
+        processing = [row[0] for row in self.cur.execute(
+            "SELECT filepath FROM cwa_ingest_queue WHERE state = 'processing' ORDER BY started_at"
+        ).fetchall()]
+
+        throughput = {}
+        for label, window in (("last_5_min", 300), ("last_hour", 3600)):
+            done, failed, avg_seconds = self.cur.execute(
+                """
+                SELECT SUM(state = 'done'), SUM(state = 'failed'), AVG(duration_seconds)
+                FROM cwa_ingest_queue WHERE finished_at >= ?
+                """,
+                (now - window,)
+            ).fetchone()
+            throughput[label] = {
+                'done': done or 0,
+                'failed': failed or 0,
+                'files_per_minute': round((done or 0) / (window / 60), 2),
+                'avg_seconds': round(avg_seconds, 2) if avg_seconds is not None else None,
+            }
+
+        return {
+            'depth': counts.get('pending', 0) + counts.get('processing', 0),
+            'pending': counts.get('pending', 0),
+            'processing': counts.get('processing', 0),
+            'retrying': retrying or 0,
+            'failed': counts.get('failed', 0),
+            'done': counts.get('done', 0),
+            'next_retry_at': next_retry_at,
+            'processing_files': [os.path.basename(p) for p in processing],
+            'throughput': throughput,
+        }
+
     def log_activity(self, user_id, user_name, event_type, item_id=None, item_title=None, extra_data=None):
-        """Logs a user activity event to the database with device detection."""
+        """Logs a user activity event to the database with device detection.
+
+        Events are buffered and written in batches (see ActivityLog); high-volume event types can
+        be sampled with CWA_ACTIVITY_SAMPLE_RATES, in which case the kept rows record their rate and
+        the stats queries count each of them as 1/rate events (see ACTIVITY_WEIGHT).
+        """
         try:
             import json
-            
+
+            sample_rate = ACTIVITY_SAMPLE_RATES.get(str(event_type).upper())
+            if sample_rate is not None and sample_rate < 1.0 and random.random() >= sample_rate:
+                return
+
             # Parse extra_data if it's a string
             if isinstance(extra_data, str):
                 try:
@@ -903,18 +1335,32 @@ class CWA_DB:
             except:
                 # If flask context not available, skip device detection
                 pass
+
+            if sample_rate is not None and sample_rate < 1.0:
+                extra_data_dict['sample_rate'] = sample_rate
             
             # Convert back to JSON string
             extra_data_json = json.dumps(extra_data_dict) if extra_data_dict else None
-            
-            self.cur.execute("""
-                INSERT INTO cwa_user_activity (user_id, user_name, event_type, item_id, item_title, extra_data)
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, (user_id, user_name, event_type, item_id, item_title, extra_data_json))
-            self.con.commit()
+            # Same format as the column's CURRENT_TIMESTAMP default, taken now rather than at flush time
+            timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
+            row = (user_id, user_name, event_type, item_id, item_title, extra_data_json, timestamp)
+
+            if ACTIVITY_ASYNC:
+                _activity_log.add(self.db_path + self.db_file, row)
+            else:
+                self.cur.execute("""
+                    INSERT INTO cwa_user_activity (user_id, user_name, event_type, item_id, item_title, extra_data, timestamp)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                """, row)
+                self.con.commit()
         except Exception as e:
+            self.con.rollback()
             print(f"[cwa-db] Error logging activity: {e}")
 
+    def flush_activity(self) -> None:
+        """Writes buffered activity events now, for readers that need to see the latest ones."""
+        _activity_log.flush()
+
     def get_active_users(self):
         """Returns list of distinct users who have activity logged."""
         try:
@@ -951,7 +1397,7 @@ class CWA_DB:
                 SELECT 
                     CAST(strftime('%w', timestamp) AS INTEGER) as day_of_week,
                     CAST(strftime('%H', timestamp) AS INTEGER) as hour,
-                    COUNT(*) as activity_count
+                    {ACTIVITY_COUNT} as activity_count
                 FROM cwa_user_activity
                 WHERE {combined_filter}
                 GROUP BY day_of_week, hour
@@ -1021,7 +1467,7 @@ class CWA_DB:
                         END,
                         'UNKNOWN'
                     )) as format,
-                    COUNT(*) as count
+                    {ACTIVITY_COUNT} as count
                 FROM cwa_user_activity
                 WHERE event_type IN ('DOWNLOAD', 'READ', 'EMAIL')
                     AND {combined_filter}
@@ -1059,7 +1505,7 @@ class CWA_DB:
                         END,
                         'direct'
                     ) as source,
-                    COUNT(*) as count
+                    {ACTIVITY_COUNT} as count
                 FROM cwa_user_activity
                 WHERE event_type IN ('READ', 'DOWNLOAD')
                     AND {combined_filter}
@@ -1097,7 +1543,7 @@ class CWA_DB:
                         END,
                         'unknown'
                     ) as device_type,
-                    COUNT(*) as count
+                    {ACTIVITY_COUNT} as count
                 FROM cwa_user_activity
                 WHERE {combined_filter}
                 GROUP BY device_type
@@ -1126,7 +1572,7 @@ class CWA_DB:
                     json_extract(extra_data, '$.ip') as ip_address,
                     json_extract(extra_data, '$.username_attempted') as username,
                     MAX(timestamp) as last_attempt,
-                    COUNT(*) as attempt_count
+                    {ACTIVITY_COUNT} as attempt_count
                 FROM cwa_user_activity
                 WHERE event_type = 'LOGIN_FAILED'
                     AND {date_filter}
@@ -1602,14 +2048,14 @@ class CWA_DB:
             
             # Count total searches in period
             total_searches = self.cur.execute(f"""
-                SELECT COUNT(*)
+                SELECT {ACTIVITY_COUNT}
                 FROM cwa_user_activity
                 WHERE event_type = 'SEARCH' AND {combined_filter}
             """).fetchone()[0]
             
             # Count successful searches (followed by DOWNLOAD or READ within 5 minutes)
             successful_searches = self.cur.execute(f"""
-                SELECT COUNT(DISTINCT s.id)
+                SELECT {ACTIVITY_COUNT}
                 FROM cwa_user_activity s
                 WHERE s.event_type = 'SEARCH' 
                     AND {combined_filter}
@@ -1628,13 +2074,13 @@ class CWA_DB:
             if date_filter_prev:
                 combined_filter_prev = date_filter_prev + user_filter
                 total_prev = self.cur.execute(f"""
-                    SELECT COUNT(*)
+                    SELECT {ACTIVITY_COUNT}
                     FROM cwa_user_activity
                     WHERE event_type = 'SEARCH' AND {combined_filter_prev}
                 """).fetchone()[0]
                 
                 successful_prev = self.cur.execute(f"""
-                    SELECT COUNT(DISTINCT s.id)
+                    SELECT {ACTIVITY_COUNT}
                     FROM cwa_user_activity s
                     WHERE s.event_type = 'SEARCH' 
                         AND {combined_filter_prev}
@@ -1692,18 +2138,18 @@ class CWA_DB:
             user_filter = self._build_user_filter(user_id)
             combined_filter = date_filter + user_filter
             
+            add_count = activity_count("event_type = 'SHELF_ADD'")
+            remove_count = activity_count("event_type = 'SHELF_REMOVE'")
+            view_count = activity_count("event_type = 'MAGIC_SHELF_VIEW'")
+
             # Get shelf activity (parse shelf_name from extra_data JSON)
             self.cur.execute(f"""
                 SELECT 
                     json_extract(extra_data, '$.shelf_name') as shelf_name,
-                    SUM(CASE WHEN event_type = 'SHELF_ADD' THEN 1 ELSE 0 END) as add_count,
-                    SUM(CASE WHEN event_type = 'SHELF_REMOVE' THEN 1 ELSE 0 END) as remove_count,
-                    SUM(CASE 
-                        WHEN event_type = 'SHELF_ADD' THEN 1 
-                        WHEN event_type = 'SHELF_REMOVE' THEN -1 
-                        ELSE 0 
-                    END) as net_change,
-                    SUM(CASE WHEN event_type = 'MAGIC_SHELF_VIEW' THEN 1 ELSE 0 END) as view_count,
+                    {add_count} as add_count,
+                    {remove_count} as remove_count,
+                    {add_count} - {remove_count} as net_change,
+                    {view_count} as view_count,
                     json_extract(extra_data, '$.shelf_type') as shelf_type
                 FROM cwa_user_activity
                 WHERE event_type IN ('SHELF_ADD', 'SHELF_REMOVE', 'MAGIC_SHELF_VIEW')
@@ -1754,7 +2200,7 @@ class CWA_DB:
                         WHEN event_type IN ('DOWNLOAD', 'READ', 'SEARCH', 'LOGIN') THEN 'Web UI'
                         ELSE 'Other'
                     END as category,
-                    COUNT(*) as count
+                    {ACTIVITY_COUNT} as count
                 FROM cwa_user_activity
                 WHERE {combined_filter}
                 GROUP BY category
@@ -1821,7 +2267,7 @@ class CWA_DB:
                         WHEN event_type = 'LOGIN' THEN 'Authentication'
                         ELSE 'Other'
                     END as category,
-                    COUNT(*) as access_count,
+                    {ACTIVITY_COUNT} as access_count,
                     MAX(timestamp) as last_accessed
                 FROM cwa_user_activity
                 WHERE {combined_filter}
@@ -1871,7 +2317,7 @@ class CWA_DB:
                 SELECT 
                     CAST(strftime('%w', timestamp) AS INTEGER) as day_of_week,
                     CAST(strftime('%H', timestamp) AS INTEGER) as hour,
-                    COUNT(*) as api_count
+                    {ACTIVITY_COUNT} as api_count
                 FROM cwa_user_activity
                 WHERE event_type IN ('KOBO_SYNC', 'OPDS_ACCESS', 'EMAIL', 'DOWNLOAD')
                     AND {combined_filter}
@@ -2129,7 +2575,7 @@ class CWA_DB:
                 SELECT 
                     CAST(strftime('%w', timestamp) AS INTEGER) as day_of_week,
                     CAST(strftime('%H', timestamp) AS INTEGER) as hour,
-                    COUNT(*) as activity_count
+                    {ACTIVITY_COUNT} as activity_count
                 FROM cwa_user_activity
                 WHERE {combined_filter}
                 GROUP BY day_of_week, hour
@@ -2197,7 +2643,7 @@ class CWA_DB:
                         json_extract(extra_data, '$.format'),
                         'Unknown'
                     )) as format,
-                    COUNT(*) as count
+                    {ACTIVITY_COUNT} as count
                 FROM cwa_user_activity
                 WHERE event_type IN ('DOWNLOAD', 'READ')
                     AND {combined_filter}
@@ -2232,7 +2678,7 @@ class CWA_DB:
             
             # 1. Activity timeline - Daily counts by event type
             self.cur.execute(f"""
-                SELECT date(timestamp) as day, event_type, COUNT(*) as count
+                SELECT date(timestamp) as day, event_type, {ACTIVITY_COUNT} as count
                 FROM cwa_user_activity 
                 WHERE {combined_filter}
                 GROUP BY day, event_type
@@ -2244,7 +2690,7 @@ class CWA_DB:
             if self._has_user_filter(user_id):
                 # Show most active days for specific user
                 self.cur.execute(f"""
-                    SELECT date(timestamp) as day, COUNT(*) as activity_count
+                    SELECT date(timestamp) as day, {ACTIVITY_COUNT} as activity_count
                     FROM cwa_user_activity 
                     WHERE {combined_filter}
                     GROUP BY day
@@ -2255,7 +2701,7 @@ class CWA_DB:
             else:
                 # Show top active users across all users
                 self.cur.execute(f"""
-                    SELECT user_id, COALESCE(user_name, 'Unknown User') as user_name, COUNT(*) as activity_count
+                    SELECT user_id, COALESCE(user_name, 'Unknown User') as user_name, {ACTIVITY_COUNT} as activity_count
                     FROM cwa_user_activity 
                     WHERE {combined_filter}
                     GROUP BY user_id, user_name
@@ -2266,7 +2712,7 @@ class CWA_DB:
 
             # 3. Most popular books (reads + downloads + emails combined)
             self.cur.execute(f"""
-                SELECT item_title, item_id, COUNT(*) as hits
+                SELECT item_title, item_id, {ACTIVITY_COUNT} as hits
                 FROM cwa_user_activity 
                 WHERE item_id IS NOT NULL 
                   AND event_type IN ('DOWNLOAD', 'READ', 'EMAIL')
@@ -2299,7 +2745,7 @@ class CWA_DB:
                         END,
                         'UNKNOWN'
                     )) as format,
-                    COUNT(*) as count
+                    {ACTIVITY_COUNT} as count
                 FROM cwa_user_activity
                 WHERE event_type IN ('DOWNLOAD', 'EMAIL')
                   AND extra_data IS NOT NULL
@@ -2311,7 +2757,7 @@ class CWA_DB:
 
             # 6. Event type breakdown (LOGIN, DOWNLOAD, READ, SEARCH, EMAIL)
             self.cur.execute(f"""
-                SELECT event_type, COUNT(*) as count
+                SELECT event_type, {ACTIVITY_COUNT} as count
                 FROM cwa_user_activity
                 WHERE {combined_filter}
                 GROUP BY event_type
@@ -2324,14 +2770,14 @@ class CWA_DB:
                 # For single user, show total logins instead of active users
                 self.cur.execute(f"""
                     SELECT 
-                        COUNT(*) as total_events,
-                        COUNT(CASE WHEN event_type = 'LOGIN' THEN 1 END) as total_logins,
+                        {ACTIVITY_COUNT} as total_events,
+                        {activity_count("event_type = 'LOGIN'")} as total_logins,
                         COUNT(DISTINCT CASE WHEN event_type IN ('DOWNLOAD', 'EMAIL') THEN item_id END) as unique_downloads,
                         COUNT(DISTINCT CASE WHEN event_type = 'READ' THEN item_id END) as unique_reads,
                         0 as active_users,
-                        COUNT(CASE WHEN event_type IN ('DOWNLOAD', 'EMAIL') THEN 1 END) as total_downloads,
-                        COUNT(CASE WHEN event_type = 'READ' THEN 1 END) as total_reads,
-                        COUNT(CASE WHEN event_type = 'SEARCH' THEN 1 END) as total_searches
+                        {activity_count("event_type IN ('DOWNLOAD', 'EMAIL')")} as total_downloads,
+                        {activity_count("event_type = 'READ'")} as total_reads,
+                        {activity_count("event_type = 'SEARCH'")} as total_searches
                     FROM cwa_user_activity
                     WHERE {combined_filter}
                 """)
@@ -2339,14 +2785,14 @@ class CWA_DB:
                 # For all users, show active user count
                 self.cur.execute(f"""
                     SELECT 
-                        COUNT(*) as total_events,
-                        COUNT(CASE WHEN event_type = 'LOGIN' THEN 1 END) as total_logins,
+                        {ACTIVITY_COUNT} as total_events,
+                        {activity_count("event_type = 'LOGIN'")} as total_logins,
                         COUNT(DISTINCT CASE WHEN event_type IN ('DOWNLOAD', 'EMAIL') THEN item_id END) as unique_downloads,
                         COUNT(DISTINCT CASE WHEN event_type = 'READ' THEN item_id END) as unique_reads,
                         COUNT(DISTINCT user_id) as active_users,
-                        COUNT(CASE WHEN event_type IN ('DOWNLOAD', 'EMAIL') THEN 1 END) as total_downloads,
-                        COUNT(CASE WHEN event_type = 'READ' THEN 1 END) as total_reads,
-                        COUNT(CASE WHEN event_type = 'SEARCH' THEN 1 END) as total_searches
+                        {activity_count("event_type IN ('DOWNLOAD', 'EMAIL')")} as total_downloads,
+                        {activity_count("event_type = 'READ'")} as total_reads,
+                        {activity_count("event_type = 'SEARCH'")} as total_searches
                     FROM cwa_user_activity
                     WHERE {combined_filter}
                 """)
@@ -2402,8 +2848,10 @@ class CWA_DB:
                 WHERE id = 1
             """)
             self.con.commit()
+            CWA_DB.invalidate_duplicate_summary()
             return True
         except Exception as e:
+            self.con.rollback()
             print(f"[cwa-db] Error invalidating duplicate cache: {e}")
             return False
 
@@ -2430,6 +2878,44 @@ class CWA_DB:
             print(f"[cwa-db] Error getting duplicate cache: {e}")
             return None
 
+    def get_duplicate_summary(self):
+        """Lightweight view of the duplicate cache for the banner shown on every page
+
+        Returns None when no scan has been cached yet, otherwise a dict with 'groups' (title,
+        author, count and group_hash of each group, without book ids), 'hashes' and 'scan_pending'.
+        Cached per connection like the settings row, so the groups JSON is only decoded again
+        after the cache table changed. The returned dict is shared and must not be modified.
+        """
+        data_version = self.cur.execute("PRAGMA data_version").fetchone()[0]
+        cache = getattr(CWA_DB._local, "duplicate_summary", None)
+        if cache is None:
+            cache = CWA_DB._local.duplicate_summary = {}
+        stamp = (self._db_key, data_version, CWA_DB._duplicate_generation)
+        cached = cache.get(self._db_key)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+
+        summary = None
+        cache_data = self.get_duplicate_cache()
+        if cache_data and cache_data.get('duplicate_groups') is not None:
+            groups = tuple({
+                'title': group.get('title', ''),
+                'author': group.get('author', ''),
+                'count': group.get('count', 0),
+                'group_hash': group.get('group_hash', ''),
+            } for group in cache_data['duplicate_groups'])
+            summary = {
+                'groups': groups,
+                'hashes': frozenset(group['group_hash'] for group in groups),
+                'scan_pending': bool(cache_data.get('scan_pending')),
+            }
+        cache[self._db_key] = (stamp, summary)
+        return summary
+
+    @classmethod
+    def invalidate_duplicate_summary(cls) -> None:
+        cls._duplicate_generation += 1
+
     def update_duplicate_cache(self, duplicate_groups, total_count, max_book_id=None):
         """Update duplicate cache with fresh scan results
         
@@ -2476,11 +2962,175 @@ class CWA_DB:
                     WHERE id = 1
                 """, (datetime.now().isoformat(), groups_json, total_count))
             self.con.commit()
+            CWA_DB.invalidate_duplicate_summary()
             return True
         except Exception as e:
+            self.con.rollback()
             print(f"[cwa-db] Error updating duplicate cache: {e}")
             return False
 
+    def get_duplicate_keys(self):
+        """Get the persistent duplicate key index
+
+        Returns:
+            (criteria, keys): the criteria the keys were computed with ('' if never built) and a
+            dict of book_id -> (dup_key, last_modified)
+        """
+        row = self.cur.execute("SELECT key_criteria FROM cwa_duplicate_cache WHERE id = 1").fetchone()
+        keys = {book_id: (dup_key, last_modified) for book_id, dup_key, last_modified
+                in self.cur.execute("SELECT book_id, dup_key, last_modified FROM cwa_duplicate_keys")}
+        return (row[0] or '') if row else '', keys
+
+    def update_duplicate_keys(self, criteria, rows, deleted_book_ids=(), reset=False):
+        """Store re-keyed books in the duplicate key index in one transaction
+
+        Args:
+            criteria: Criteria the keys were computed with
+            rows: (book_id, dup_key, last_modified) tuples to insert or replace
+            deleted_book_ids: Books no longer in the library
+            reset: Drop every stored key first (criteria changed)
+        """
+        try:
+            if reset:
+                self.cur.execute("DELETE FROM cwa_duplicate_keys")
+            self.cur.executemany("DELETE FROM cwa_duplicate_keys WHERE book_id = ?",
+                                 [(book_id,) for book_id in deleted_book_ids])
+            self.cur.executemany("INSERT OR REPLACE INTO cwa_duplicate_keys (book_id, dup_key, last_modified) VALUES (?, ?, ?)",
+                                 rows)
+            self.cur.execute("UPDATE cwa_duplicate_cache SET key_criteria = ? WHERE id = 1", (criteria,))
+            self.con.commit()
+            return True
+        except Exception as e:
+            self.con.rollback()
+            print(f"[cwa-db] Error updating duplicate keys: {e}")
+            return False
+
+    def get_duplicate_key_candidates(self, keys=None):
+        """Get the ids of books sharing their duplicate key with at least one other book
+
+        Args:
+            keys: Only consider these keys (optional)
+
+        Returns:
+            set of book ids, or None on error
+        """
+        import json
+        query = """
+            SELECT book_id FROM cwa_duplicate_keys
+            WHERE dup_key IN (SELECT dup_key FROM cwa_duplicate_keys GROUP BY dup_key HAVING COUNT(*) > 1)
+        """
+        params = ()
+        if keys is not None:
+            query += " AND dup_key IN (SELECT value FROM json_each(?))"
+            params = (json.dumps(list(keys)),)
+        try:
+            return {row[0] for row in self.cur.execute(query, params)}
+        except Exception as e:
+            print(f"[cwa-db] Error reading duplicate key candidates: {e}")
+            return None
+
+    def get_epub_spine_index(self, book_id, book_format):
+        """Get the stored spine index of a book format
+
+        Returns:
+            dict with file_mtime, file_size, spine and chapter_lengths, or None if not indexed
+        """
+        import json
+        try:
+            row = self.cur.execute("""
+                SELECT file_mtime, file_size, spine, chapter_lengths FROM cwa_epub_spine_index
+                WHERE book_id = ? AND format = ?
+            """, (book_id, book_format.upper())).fetchone()
+        except Exception as e:
+            print(f"[cwa-db] Error reading EPUB spine index: {e}")
+            return None
+        if not row:
+            return None
+        return {'file_mtime': row[0], 'file_size': row[1],
+                'spine': json.loads(row[2]), 'chapter_lengths': json.loads(row[3])}
+
+    def set_epub_spine_index(self, book_id, book_format, file_mtime, file_size, spine, chapter_lengths):
+        """Store the spine index of a book format, replacing any previous one"""
+        import json
+        try:
+            self.cur.execute("""
+                INSERT OR REPLACE INTO cwa_epub_spine_index
+                (book_id, format, file_mtime, file_size, spine, chapter_lengths)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, (book_id, book_format.upper(), file_mtime, file_size,
+                  json.dumps(spine, separators=(',', ':')), json.dumps(chapter_lengths, separators=(',', ':'))))
+            self.con.commit()
+            return True
+        except Exception as e:
+            self.con.rollback()
+            print(f"[cwa-db] Error storing EPUB spine index: {e}")
+            return False
+
+    CONVERT_LIBRARY_STATE_FIELDS = ('status', 'target_format', 'workers', 'total', 'converted', 'failed',
+                                    'processed_at_start', 'started_at')
+
+    def get_convert_library_state(self):
+        """Get the progress of the current or last convert-library run, or None on error"""
+        try:
+            self.cur.execute("""
+                SELECT status, target_format, workers, total, converted, failed, processed_at_start,
+                       started_at, updated_at
+                FROM cwa_convert_library_state WHERE id = 1
+            """)
+            row = self.cur.fetchone()
+        except Exception as e:
+            print(f"[cwa-db] Error reading convert-library state: {e}")
+            return None
+        if not row:
+            return None
+        return dict(zip(self.CONVERT_LIBRARY_STATE_FIELDS + ('updated_at',), row))
+
+    def update_convert_library_state(self, book_id=None, book_status=None, **fields):
+        """Update the convert-library run state, optionally recording the outcome of one book
+
+        Args:
+            book_id: Book whose outcome is recorded in the same transaction (optional)
+            book_status: 'converted' or 'failed'
+            **fields: Columns of cwa_convert_library_state to set
+        """
+        unknown = set(fields) - set(self.CONVERT_LIBRARY_STATE_FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown convert-library state fields: {', '.join(sorted(unknown))}")
+        now = datetime.now(timezone.utc).isoformat()
+        try:
+            if book_id is not None:
+                self.cur.execute("INSERT OR REPLACE INTO cwa_convert_library_books (book_id, status, updated_at) VALUES (?, ?, ?)",
+                                 (int(book_id), book_status, now))
+            assignments = ''.join(f"{name} = ?, " for name in fields)
+            self.cur.execute(f"UPDATE cwa_convert_library_state SET {assignments}updated_at = ? WHERE id = 1",
+                             (*fields.values(), now))
+            self.con.commit()
+            return True
+        except Exception as e:
+            self.con.rollback()
+            print(f"[cwa-db] Error updating convert-library state: {e}")
+            return False
+
+    def get_convert_library_books(self, status):
+        """Get the ids of books recorded with the given status in the current convert-library run"""
+        try:
+            return {row[0] for row in self.cur.execute("SELECT book_id FROM cwa_convert_library_books WHERE status = ?",
+                                                       (status,))}
+        except Exception as e:
+            print(f"[cwa-db] Error reading convert-library books: {e}")
+            return set()
+
+    def reset_convert_library_books(self):
+        """Forget the per-book outcomes of the previous convert-library run"""
+        try:
+            self.cur.execute("DELETE FROM cwa_convert_library_books")
+            self.con.commit()
+            return True
+        except Exception as e:
+            self.con.rollback()
+            print(f"[cwa-db] Error resetting convert-library books: {e}")
+            return False
+
     def log_duplicate_resolution(self, group_hash, group_title, group_author, kept_book_id, 
                                  deleted_book_ids, strategy, trigger_type, user_id=None, notes=None):
         """Log a duplicate resolution to audit table"""
@@ -2496,6 +3146,7 @@ class CWA_DB:
             self.con.commit()
             return True
         except Exception as e:
+            self.con.rollback()
             print(f"[cwa-db] Error logging duplicate resolution: {e}")
             return False
 
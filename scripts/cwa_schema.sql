@@ -119,6 +119,24 @@ CREATE TABLE IF NOT EXISTS cwa_scheduled_jobs(
     last_error TEXT DEFAULT ''
 );
 
+-- Durable ingest queue, one row per file handed to the ingest worker. Higher priority runs first.
+CREATE TABLE IF NOT EXISTS cwa_ingest_queue(
+    id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+    filepath TEXT NOT NULL UNIQUE,
+    source TEXT DEFAULT 'watcher' NOT NULL,     -- 'watcher' | 'upload' | 'refresh'
+    priority INTEGER DEFAULT 0 NOT NULL,
+    state TEXT DEFAULT 'pending' NOT NULL,      -- 'pending' | 'processing' | 'done' | 'failed'
+    attempts INTEGER DEFAULT 0 NOT NULL,
+    next_attempt_at REAL DEFAULT 0 NOT NULL,    -- unix time, pushed back exponentially on retry
+    last_error TEXT DEFAULT '',
+    enqueued_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    duration_seconds REAL
+);
+CREATE INDEX IF NOT EXISTS idx_ingest_queue_ready ON cwa_ingest_queue(state, priority, next_attempt_at);
+CREATE INDEX IF NOT EXISTS idx_ingest_queue_finished ON cwa_ingest_queue(finished_at);
+
 CREATE TABLE IF NOT EXISTS cwa_user_activity (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     user_id INTEGER,
@@ -173,12 +191,22 @@ CREATE TABLE IF NOT EXISTS cwa_duplicate_cache (
     scan_pending INTEGER DEFAULT 1,  -- 1=needs scan, 0=cache valid
     last_scanned_book_id INTEGER DEFAULT 0,  -- Track last scanned book for incremental updates
     scan_duration_seconds REAL DEFAULT 0,  -- Performance tracking
-    scan_method_used TEXT DEFAULT 'python'  -- Track which method was used: 'sql', 'python', 'hybrid'
+    scan_method_used TEXT DEFAULT 'python',  -- Track which method was used: 'sql', 'python', 'hybrid'
+    key_criteria TEXT DEFAULT ''  -- Criteria the rows in cwa_duplicate_keys were computed with
 );
 
 -- Insert default row for cache table
 INSERT OR IGNORE INTO cwa_duplicate_cache (id, scan_pending) VALUES (1, 1);
 
+-- Normalized duplicate key of every book, re-keyed only when a book's last_modified changes
+CREATE TABLE IF NOT EXISTS cwa_duplicate_keys (
+    book_id INTEGER PRIMARY KEY,
+    dup_key TEXT NOT NULL,  -- JSON array of the normalized criteria values
+    last_modified TEXT  -- books.last_modified the key was computed from
+);
+
+CREATE INDEX IF NOT EXISTS idx_duplicate_keys_dup_key ON cwa_duplicate_keys(dup_key);
+
 -- Auto-resolution audit log
 CREATE TABLE IF NOT EXISTS cwa_duplicate_resolutions (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -197,3 +225,62 @@ CREATE TABLE IF NOT EXISTS cwa_duplicate_resolutions (
 
 CREATE INDEX IF NOT EXISTS idx_duplicate_resolutions_timestamp ON cwa_duplicate_resolutions(timestamp);
 CREATE INDEX IF NOT EXISTS idx_duplicate_resolutions_group_hash ON cwa_duplicate_resolutions(group_hash);
+
+-- Spine and per-chapter character counts of EPUB/KEPUB files, used to turn Kobo chapter
+-- positions into whole-book progress without re-parsing the book
+CREATE TABLE IF NOT EXISTS cwa_epub_spine_index (
+    book_id INTEGER NOT NULL,
+    format TEXT NOT NULL,  -- 'EPUB' or 'KEPUB'
+    file_mtime INTEGER NOT NULL,  -- st_mtime_ns of the file the index was built from
+    file_size INTEGER NOT NULL,
+    spine TEXT NOT NULL,  -- JSON array of spine item paths inside the archive
+    chapter_lengths TEXT NOT NULL,  -- JSON array of character counts, one per spine item
+    PRIMARY KEY (book_id, format)
+);
+
+-- Progress of the current or last convert-library run, an interrupted run resumes from here
+CREATE TABLE IF NOT EXISTS cwa_convert_library_state (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    status TEXT NOT NULL DEFAULT 'idle',  -- 'idle', 'running' or 'finished'
+    target_format TEXT,
+    workers INTEGER DEFAULT 1,
+    total INTEGER DEFAULT 0,
+    converted INTEGER DEFAULT 0,
+    failed INTEGER DEFAULT 0,
+    processed_at_start INTEGER DEFAULT 0,  -- converted + failed when the current process started (for throughput)
+    started_at TEXT,  -- when the current process started, UTC ISO format
+    updated_at TEXT
+);
+
+INSERT OR IGNORE INTO cwa_convert_library_state (id) VALUES (1);
+
+-- Books handled by the current convert-library run
+CREATE TABLE IF NOT EXISTS cwa_convert_library_books (
+    book_id INTEGER PRIMARY KEY,
+    status TEXT NOT NULL,  -- 'converted' or 'failed'
+    updated_at TEXT
+);
+
+-- Size and mtime of every EPUB after the library-wide fixer last checked it, unchanged files are skipped on the next run
+CREATE TABLE IF NOT EXISTS cwa_epub_fixer_files (
+    file_path TEXT PRIMARY KEY,
+    file_size INTEGER NOT NULL,
+    file_mtime INTEGER NOT NULL,  -- st_mtime_ns
+    fixer_version INTEGER NOT NULL,
+    checked_at TEXT
+);
+
+-- Queue and throughput of the long-lived cover & metadata enforcer, shown on the stats page
+CREATE TABLE IF NOT EXISTS cwa_enforcer_status (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    running SMALLINT DEFAULT 0,
+    queue_depth INTEGER DEFAULT 0,  -- books with a pending change log
+    in_flight INTEGER DEFAULT 0,
+    processed INTEGER DEFAULT 0,  -- since the enforcer started
+    failed INTEGER DEFAULT 0,
+    busy_seconds REAL DEFAULT 0,  -- summed time spent on finished books
+    started_at TEXT,  -- UTC ISO format
+    updated_at TEXT
+);
+
+INSERT OR IGNORE INTO cwa_enforcer_status (id) VALUES (1);
@@ -15,10 +15,15 @@ import shutil
 import sqlite3
 import fcntl
 import threading
+import queue
+import re
+from contextlib import contextmanager
+from dataclasses import dataclass, field
 from pathlib import Path
 
 from cwa_db import CWA_DB
 from kindle_epub_fixer import EPUBFixer
+from library_permissions import book_dirs_changed_since, book_dirs_for_ids, fix_book_dirs, network_share_mode
 import audiobook
 import requests
 
@@ -32,6 +37,58 @@ TaskAutoSend = None
 WorkerThread = None
 _ub = None
 
+# Used to report how long the long-lived ingest worker took to warm up
+_MODULE_LOADED_AT = time.monotonic()
+
+# The watcher feeds the long-lived ingest worker through this FIFO (see IngestWorker)
+INGEST_FIFO_PATH = os.environ.get("CWA_INGEST_FIFO", "/config/cwa_ingest.fifo")
+INGEST_STATUS_FILE = "/config/cwa_ingest_status"
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return max(1, int(os.environ.get(name, default)))
+    except (TypeError, ValueError):
+        return default
+
+# Size of the ingest worker pool and per-stage concurrency limits. The CPU-heavy stages
+# run in parallel; anything that writes to metadata.db (calibredb add / add_format)
+# is always serialized through the "library_write" stage.
+INGEST_WORKERS = _env_int("CWA_INGEST_WORKERS", min(4, os.cpu_count() or 1))
+INGEST_STAGE_LIMITS = {
+    "convert": _env_int("CWA_INGEST_CONVERT_CONCURRENCY", INGEST_WORKERS),
+    "epub_fixer": _env_int("CWA_INGEST_FIXER_CONCURRENCY", INGEST_WORKERS),
+    "checksum": _env_int("CWA_INGEST_CHECKSUM_CONCURRENCY", INGEST_WORKERS),
+    "library_write": 1,
+}
+_stage_semaphores = {name: threading.BoundedSemaphore(limit) for name, limit in INGEST_STAGE_LIMITS.items()}
+
+# Failed ingests are retried with exponential backoff before being marked failed for good
+INGEST_MAX_ATTEMPTS = _env_int("CWA_INGEST_MAX_ATTEMPTS", 5)
+INGEST_RETRY_BASE_SECONDS = _env_int("CWA_INGEST_RETRY_BASE_SECONDS", 30)
+INGEST_RETRY_MAX_SECONDS = _env_int("CWA_INGEST_RETRY_MAX_SECONDS", 3600)
+# Batched `calibredb add`: files reaching the add step within the window share one call
+INGEST_BATCH_WINDOW_SECONDS = float(os.environ.get("CWA_INGEST_BATCH_WINDOW", "2") or 0)
+INGEST_BATCH_SIZE = _env_int("CWA_INGEST_BATCH_SIZE", 20)
+# Files queued before the durable queue existed, imported into cwa_ingest_queue on start
+LEGACY_RETRY_QUEUE_FILE = "/config/cwa_ingest_retry_queue"
+
+
+def ingest_retry_delay(attempts: int) -> int:
+    """Seconds to wait before the next attempt after the given number of failed attempts."""
+    return min(INGEST_RETRY_BASE_SECONDS * (2 ** max(0, attempts - 1)), INGEST_RETRY_MAX_SECONDS)
+
+
+@contextmanager
+def ingest_stage(name: str):
+    """Hold one of the slots of an ingest stage for the duration of the block."""
+    semaphore = _stage_semaphores[name]
+    semaphore.acquire()
+    try:
+        yield
+    finally:
+        semaphore.release()
+
 # Debounced duplicate scan timer
 _duplicate_scan_timer = None
 _duplicate_scan_lock = threading.Lock()
@@ -48,8 +105,8 @@ class ProcessLock:
     def acquire(self, timeout=5):
         """Acquire the lock with timeout. Returns True if successful, False if another process has it."""
         try:
-            # Try to open/create the lock file
-            self.lock_file = open(self.lock_path, 'w+')
+            # Open without truncating so a waiting process can still read the holder's PID
+            self.lock_file = os.fdopen(os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644), 'r+')
 
             # Try to acquire an exclusive lock with timeout
             start_time = time.time()
@@ -183,6 +240,58 @@ def cleanup_lock():
 # Register cleanup function
 atexit.register(cleanup_lock)
 
+# Present for as long as a metadata.db restore from the admin page is running
+RESTORE_LOCK_PATH = os.path.join(tempfile.gettempdir(), "restore_calibre_db.lock")
+
+
+@contextmanager
+def ingest_job_lock(lock_path: str = process_lock.lock_path, restore_lock_path: str = RESTORE_LOCK_PATH):
+    """Hold a shared lock on the ingest lock file while one daemon job runs.
+
+    Daemon jobs share the lock with each other, so the worker pool still runs in parallel, but a
+    one-shot ingest run or a library restore (both take it exclusively) waits for in-flight jobs
+    and holds new ones back until it is done. New jobs also wait while a restore is running so the
+    restore's exclusive lock is not starved by a busy queue.
+    """
+    announced = False
+    while True:
+        while os.path.exists(restore_lock_path):
+            if not announced:
+                print("[ingest-processor] Library restore in progress, pausing ingest", flush=True)
+                announced = True
+            time.sleep(1)
+        lock_file = os.fdopen(os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644), 'r+')
+        try:
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                if not announced:
+                    print("[ingest-processor] Ingest lock held by another process, waiting", flush=True)
+                    announced = True
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_SH)
+            # A one-shot run removes the file on release; a lock on the unlinked inode guards nothing
+            if (not os.path.exists(restore_lock_path) and os.path.exists(lock_path)
+                    and os.stat(lock_path).st_ino == os.fstat(lock_file.fileno()).st_ino):
+                # Every job writes the same PID, so a one-shot run sees a live holder rather than a stale lock
+                lock_file.seek(0)
+                lock_file.write(str(os.getpid()))
+                lock_file.truncate()
+                lock_file.flush()
+                break
+        except BaseException:
+            lock_file.close()
+            raise
+        lock_file.close()
+    if announced:
+        print("[ingest-processor] Resuming ingest", flush=True)
+    try:
+        yield
+    finally:
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+        finally:
+            lock_file.close()
+
 
 def get_app_db_path() -> str:
     """Resolve app.db path consistently with the main app config."""
@@ -277,10 +386,6 @@ def gdrive_sync_if_enabled():
         except Exception as e:
             print(f"[ingest-processor] WARN: GDrive sync failed: {e}", flush=True)
 
-# Acquire process lock to prevent concurrent execution
-if not process_lock.acquire(timeout=10):
-    sys.exit(2)
-
 # Ensure processed backups directory structure exists so backups never crash on missing folders
 try:
     _processed_root = "/config/processed_books"
@@ -342,8 +447,199 @@ def get_internal_api_headers():
     """Provide headers that satisfy localhost-only internal endpoint checks."""
     return {"X-Forwarded-For": "127.0.0.1"}
 
+
+def parse_book_ids(output: str) -> list[int]:
+    """Collect every id from the 'Added/Merged/Updated book ids: X, Y' lines of calibredb output, in order."""
+    ids = []
+    for match in re.finditer(r"(?:Added|Merged|Updated) book id[s]?:\s*([0-9,\s]+)", output, flags=re.IGNORECASE):
+        for value in match.group(1).split(','):
+            value = value.strip()
+            if value.isdigit() and int(value) not in ids:
+                ids.append(int(value))
+    return ids
+
+
+def map_added_ids_to_files(files: list[tuple[str, int]], rows: list[tuple[int, str, int]]) -> list[int | None]:
+    """Work out which book id each file of a batched `calibredb add` ended up as.
+
+    files: (FORMAT, size in bytes) per staged file, in the order they were passed to calibredb.
+    rows: (book_id, FORMAT, uncompressed_size) from the data table for the ids calibredb reported.
+
+    calibredb copies the file into the library unchanged, so format + size identifies it. Files that
+    can't be matched that way (e.g. two identical sizes) fall back to calibredb's argument order when
+    the leftovers line up one to one; anything still ambiguous maps to None.
+    """
+    mapping: list[int | None] = [None] * len(files)
+    used: set[int] = set()
+    for i, (fmt, size) in enumerate(files):
+        if files.count((fmt, size)) > 1:
+            continue  # another file of the batch could be the one that got this id
+        candidates = [book_id for book_id, row_fmt, row_size in rows
+                      if row_fmt == fmt and row_size == size and book_id not in used]
+        if len(candidates) == 1:
+            mapping[i] = candidates[0]
+            used.add(candidates[0])
+
+    leftover_files = [i for i, book_id in enumerate(mapping) if book_id is None]
+    leftover_ids = sorted({book_id for book_id, _fmt, _size in rows} - used)
+    if leftover_files and len(leftover_files) == len(leftover_ids):
+        for i, book_id in zip(leftover_files, leftover_ids):
+            mapping[i] = book_id
+    return mapping
+
+
+@dataclass
+class _LibraryAddRequest:
+    staged_path: str
+    automerge: str
+    library_dir: str
+    env: dict
+    done: threading.Event = field(default_factory=threading.Event)
+    book_ids: list[int] = field(default_factory=list)
+    error: Exception | None = None
+
+    @property
+    def group_key(self) -> tuple:
+        return self.automerge, self.library_dir, self.env.get('CALIBRE_OVERRIDE_DATABASE_PATH')
+
+
+class LibraryAddBatcher:
+    """Coalesces the `calibredb add` calls of concurrent ingest workers into single invocations.
+
+    Every calibredb run reloads calibre and reopens metadata.db, which costs seconds per book.
+    Files that reach the add step within CWA_INGEST_BATCH_WINDOW seconds of each other are added
+    with one call (at most CWA_INGEST_BATCH_SIZE files, and never more than there are ingest
+    workers), and the reported ids are mapped back to the files so each worker can carry on with
+    its per-book steps. Disabled (window 0) outside the long-lived ingest worker, where there is
+    never more than one file in flight.
+    """
+
+    def __init__(self, window_seconds: float = 0.0, max_batch: int = 1):
+        self.window_seconds = window_seconds
+        self.max_batch = max_batch
+        self._requests: queue.Queue[_LibraryAddRequest] = queue.Queue()
+        self._thread: threading.Thread | None = None
+        self._thread_lock = threading.Lock()
+
+    @property
+    def batching(self) -> bool:
+        return self.window_seconds > 0 and self.max_batch > 1
+
+    def add(self, staged_path: str, automerge: str, library_dir: str, env: dict) -> list[int]:
+        """Add one file to the library and return the book id(s) calibredb reported for it.
+
+        Raises subprocess.CalledProcessError like a direct calibredb call would.
+        """
+        request = _LibraryAddRequest(staged_path, automerge, library_dir, env)
+        if not self.batching:
+            self._run_single(request)
+        else:
+            self._ensure_thread()
+            self._requests.put(request)
+            request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.book_ids
+
+    def _ensure_thread(self) -> None:
+        with self._thread_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._loop, name="calibredb-add-batcher", daemon=True)
+                self._thread.start()
+
+    def _loop(self) -> None:
+        while True:
+            batch = [self._requests.get()]
+            deadline = time.monotonic() + self.window_seconds
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._requests.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            groups: dict[tuple, list[_LibraryAddRequest]] = {}
+            for request in batch:
+                groups.setdefault(request.group_key, []).append(request)
+            for requests_in_group in groups.values():
+                try:
+                    self._run_batch(requests_in_group)
+                except Exception as e:
+                    for request in requests_in_group:
+                        if request.error is None and not request.book_ids:
+                            request.error = e
+                finally:
+                    for request in requests_in_group:
+                        request.done.set()
+
+    @staticmethod
+    def _command(paths: list[str], automerge: str, library_dir: str) -> list[str]:
+        return ["calibredb", "add", *paths, "--automerge", automerge, f"--library-path={library_dir}"]
+
+    def _run_single(self, request: _LibraryAddRequest) -> None:
+        with ingest_stage("library_write"):
+            self._run_single_locked(request)
+
+    def _run_batch(self, requests_in_group: list[_LibraryAddRequest]) -> None:
+        if len(requests_in_group) == 1:
+            self._run_single(requests_in_group[0])
+            return
+
+        first = requests_in_group[0]
+        metadata_db = first.env.get('CALIBRE_OVERRIDE_DATABASE_PATH') or os.path.join(first.library_dir, "metadata.db")
+        paths = [request.staged_path for request in requests_in_group]
+        files = [(Path(path).suffix[1:].upper(), os.path.getsize(path)) for path in paths]
+
+        t_start = time.monotonic()
+        with ingest_stage("library_write"):
+            with sqlite3.connect(metadata_db, timeout=30) as con:
+                max_id_before = con.execute("SELECT COALESCE(MAX(id), 0) FROM books").fetchone()[0]
+            try:
+                result = subprocess.run(self._command(paths, first.automerge, first.library_dir),
+                                        env=first.env, check=True, capture_output=True, text=True)
+            except subprocess.CalledProcessError as e:
+                print(f"[ingest-processor] WARN: Batched calibredb add of {len(paths)} files failed "
+                      f"(exit {e.returncode}), adding them one at a time", flush=True)
+                result = None
+            if result is None:
+                for request in requests_in_group:
+                    self._run_single_locked(request)
+                return
+
+            ids = parse_book_ids((result.stdout or '') + '\n' + (result.stderr or ''))
+            with sqlite3.connect(metadata_db, timeout=30) as con:
+                if ids:
+                    placeholders = ",".join("?" * len(ids))
+                    rows = con.execute(f"SELECT book, UPPER(format), uncompressed_size FROM data WHERE book IN ({placeholders})", ids).fetchall()
+                else:
+                    rows = con.execute("SELECT book, UPPER(format), uncompressed_size FROM data WHERE book > ?", (max_id_before,)).fetchall()
+
+        mapping = map_added_ids_to_files(files, rows)
+        for request, book_id in zip(requests_in_group, mapping):
+            if book_id is not None:
+                request.book_ids = [book_id]
+        mapped = sum(1 for book_id in mapping if book_id is not None)
+        print(f"[ingest-processor] Added {len(paths)} files with one calibredb call in {time.monotonic() - t_start:.2f}s "
+              f"({mapped} mapped to book ids)", flush=True)
+
+    def _run_single_locked(self, request: _LibraryAddRequest) -> None:
+        """Like _run_single, for callers already holding the library_write stage."""
+        try:
+            result = subprocess.run(self._command([request.staged_path], request.automerge, request.library_dir),
+                                    env=request.env, check=True, capture_output=True, text=True)
+        except subprocess.CalledProcessError as e:
+            request.error = e
+            return
+        request.book_ids = parse_book_ids((result.stdout or '') + '\n' + (result.stderr or ''))
+
+
+# Enabled by IngestWorker; one-shot runs add their single file directly
+library_add_batcher = LibraryAddBatcher()
+
 class NewBookProcessor:
-    def __init__(self, filepath: str):
+    def __init__(self, filepath: str, db: CWA_DB | None = None):
         def _normalize_format(value: str) -> str:
             if value is None:
                 return ""
@@ -362,8 +658,8 @@ class NewBookProcessor:
                 if v is not None and str(v).strip() != ""
             ]
 
-        # Settings / DB
-        self.db = CWA_DB()
+        # Settings / DB (the ingest worker passes in its long-lived handle)
+        self.db = db if db is not None else CWA_DB()
         self.cwa_settings = self.db.cwa_settings
 
         # Core ingest settings
@@ -403,7 +699,9 @@ class NewBookProcessor:
             except Exception as e:
                 print(f"[ingest-processor] WARN: Could not read config_calibre_dir from app.db ({app_db_path}), using default. Error: {e}", flush=True)
 
-        Path(self.tmp_conversion_dir).mkdir(exist_ok=True)
+        # Every ingest gets its own scratch dir so parallel workers never clean up each other's files
+        Path(self.tmp_conversion_dir).mkdir(parents=True, exist_ok=True)
+        self.tmp_conversion_dir = tempfile.mkdtemp(prefix="ingest_", dir=self.tmp_conversion_dir) + "/"
         self.staging_dir = os.path.join(self.tmp_conversion_dir, "staging")
         Path(self.staging_dir).mkdir(exist_ok=True)
 
@@ -428,6 +726,11 @@ class NewBookProcessor:
         # Track the last added Calibre book id(s) from calibredb output
         self.last_added_book_id: int | None = None
         self.last_added_book_ids: list[int] = []
+        # Set when a batched add couldn't be mapped to a book id, so nothing may guess one
+        self.book_id_unknown = False
+        # Books that gained a format; with the ids above these are the folders whose ownership gets fixed
+        self.touched_book_ids: set[int] = set()
+        self.started_at = time.time()
         self._title_sort_regex = self._get_title_sort_regex()
 
     @staticmethod
@@ -579,7 +882,8 @@ class NewBookProcessor:
         target_filepath = f"{self.tmp_conversion_dir}{original_filepath.stem}.{end_format}"
         try:
             t_convert_book_start = time.time()
-            subprocess.run(['ebook-convert', self.filepath, target_filepath], env=self.calibre_env, check=True)
+            with ingest_stage("convert"):
+                subprocess.run(['ebook-convert', self.filepath, target_filepath], env=self.calibre_env, check=True)
             t_convert_book_end = time.time()
             time_book_conversion = t_convert_book_end - t_convert_book_start
             print(f"\n[ingest-processor]: END_CON: Conversion of {self.filename} complete in {time_book_conversion:.2f} seconds.\n", flush=True)
@@ -619,7 +923,8 @@ class NewBookProcessor:
             converted_filepath = Path(converted_filepath)
             target_filepath = f"{self.tmp_conversion_dir}{converted_filepath.stem}.kepub"
             try:
-                subprocess.run(['kepubify', '--inplace', '--calibre', '--output', self.tmp_conversion_dir, converted_filepath], check=True)
+                with ingest_stage("convert"):
+                    subprocess.run(['kepubify', '--inplace', '--calibre', '--output', self.tmp_conversion_dir, converted_filepath], check=True)
                 if self.cwa_settings['auto_backup_conversions']:
                     self.backup(self.filepath, backup_type="converted")
 
@@ -738,6 +1043,7 @@ class NewBookProcessor:
 
         # Stage file for import
         staged_path = Path(self.staging_dir) / source_path.name
+        self.book_id_unknown = False
         try:
             shutil.copy2(source_path, staged_path)
         except Exception as e:
@@ -747,15 +1053,20 @@ class NewBookProcessor:
 
         try:
             if text:
-                result = subprocess.run([
-                    "calibredb", "add", str(staged_path), "--automerge", self.cwa_settings['auto_ingest_automerge'], f"--library-path={self.library_dir}"
-                ], env=self.calibre_env, check=True, capture_output=True, text=True)
-                added_ids = self._parse_added_book_ids((result.stdout or '') + '\n' + (result.stderr or ''))
+                # Goes through the batcher so concurrent workers share a single calibredb call
+                added_ids = library_add_batcher.add(str(staged_path), self.cwa_settings['auto_ingest_automerge'],
+                                                    self.library_dir, self.calibre_env)
                 if added_ids:
                     self.last_added_book_ids = added_ids
                     self.last_added_book_id = added_ids[-1]
+                elif library_add_batcher.batching:
+                    # "Most recently modified" is meaningless once several books land at once
+                    self.book_id_unknown = True
+                    print(f"[ingest-processor] WARN: Could not map {staged_path.name} to a book id after a batched add; "
+                          "skipping metadata fetch, auto-send and checksums for it", flush=True)
                 else:
-                    self._fallback_last_added_book_id()
+                    with ingest_stage("library_write"):
+                        self._fallback_last_added_book_id()
             else:  # audiobook path
                 meta = audiobook.get_audio_file_info(str(staged_path), format, os.path.basename(str(staged_path)), False)
 
@@ -796,13 +1107,14 @@ class NewBookProcessor:
                     if isinstance(ident, str) and ":" in ident and ident.strip():
                         add_command.extend(["--identifier", ident.strip()])
 
-                result = subprocess.run(add_command, env=self.calibre_env, check=True, capture_output=True, text=True)
-                added_ids = self._parse_added_book_ids((result.stdout or '') + '\n' + (result.stderr or ''))
-                if added_ids:
-                    self.last_added_book_ids = added_ids
-                    self.last_added_book_id = added_ids[-1]
-                else:
-                    self._fallback_last_added_book_id()
+                with ingest_stage("library_write"):
+                    result = subprocess.run(add_command, env=self.calibre_env, check=True, capture_output=True, text=True)
+                    added_ids = self._parse_added_book_ids((result.stdout or '') + '\n' + (result.stderr or ''))
+                    if added_ids:
+                        self.last_added_book_ids = added_ids
+                        self.last_added_book_id = added_ids[-1]
+                    else:
+                        self._fallback_last_added_book_id()
             print(f"[ingest-processor] Added {staged_path.stem} to Calibre database", flush=True)
 
             if self.cwa_settings['auto_backup_imports']:
@@ -817,13 +1129,13 @@ class NewBookProcessor:
             # Fetch metadata if enabled, prefer exact book id from calibredb
             if self.last_added_book_id is not None:
                 self.fetch_metadata_if_enabled(book_id=self.last_added_book_id)
-            else:
+            elif not self.book_id_unknown:
                 self.fetch_metadata_if_enabled(staged_path.stem)
 
             # Trigger auto-send for users who have it enabled
             if self.last_added_book_id is not None:
                 self.trigger_auto_send_if_enabled(book_id=self.last_added_book_id, book_path=book_path)
-            else:
+            elif not self.book_id_unknown:
                 self.trigger_auto_send_if_enabled(staged_path.stem, book_path)
 
             # CRITICAL FIX: Refresh Calibre-Web's database session to make new books visible
@@ -839,9 +1151,13 @@ class NewBookProcessor:
             # Generate KOReader sync checksums for the imported book
             if self.last_added_book_id is not None:
                 self.generate_book_checksums(staged_path.stem, book_id=self.last_added_book_id)
-            else:
+            elif not self.book_id_unknown:
                 self.generate_book_checksums(staged_path.stem)
 
+            # Index the spine of EPUB/KEPUB formats so Kobo progress conversion never parses the book on request
+            if self.last_added_book_id is not None:
+                self.build_spine_index(book_id=self.last_added_book_id)
+
             # If we overwrote an existing book, Calibre does not bump books.timestamp, only last_modified.
             # Update timestamp to last_modified for any rows changed by this import so sorting by 'new' reflects overwrites.
             if self.cwa_settings.get('auto_ingest_automerge') == 'overwrite':
@@ -882,6 +1198,36 @@ class NewBookProcessor:
             print(f"[ingest-processor] ERROR: Failed to validate book_id {book_id}: {e}", flush=True)
             return False
 
+    def add_retained_format(self, original_path: str) -> None:
+        """Adds the original file of a converted import as another format of the book just added."""
+        if self.book_id_unknown:
+            # The newest book is most likely another worker's, so don't attach the file to it
+            print(f"[ingest-processor] WARN: Could not map {self.filename} to a book id after a batched add; "
+                  "not retaining its original format", flush=True)
+            self.backup(original_path, backup_type="failed")
+            return
+        # Find the book that was just added to get its ID
+        try:
+            # Prefer the exact id we just added if available
+            if self.last_added_book_id is not None:
+                target_book_id = self.last_added_book_id
+            else:
+                with sqlite3.connect(self.metadata_db, timeout=30) as con:
+                    cur = con.cursor()
+                    cur.execute("SELECT id FROM books ORDER BY timestamp DESC LIMIT 1")
+                    res = cur.fetchone()
+                    target_book_id = res[0] if res else None
+
+            if target_book_id is not None:
+                if os.path.exists(original_path) and os.path.getsize(original_path) > 0:
+                    self.add_format_to_book(int(target_book_id), original_path)
+                else:
+                    print(f"[ingest-processor] Original file no longer exists or is empty, cannot retain format: {original_path}", flush=True)
+            else:
+                print(f"[ingest-processor] Could not find book ID to add retained format for: {self.filename}", flush=True)
+        except Exception as e:
+            print(f"[ingest-processor] Error adding retained format: {e}", flush=True)
+
     def add_format_to_book(self, book_id:int, book_path:str) -> None:
         """Attach a new format file to an existing Calibre book using calibredb add_format"""
         source_path = Path(book_path)
@@ -906,12 +1252,16 @@ class NewBookProcessor:
             return
 
         try:
-            result = subprocess.run([
-                "calibredb", "add_format", str(book_id), str(staged_path), f"--library-path={self.library_dir}"
-            ], env=self.calibre_env, check=True, capture_output=True, text=True)
+            with ingest_stage("library_write"):
+                result = subprocess.run([
+                    "calibredb", "add_format", str(book_id), str(staged_path), f"--library-path={self.library_dir}"
+                ], env=self.calibre_env, check=True, capture_output=True, text=True)
             print(f"[ingest-processor] Added new format for book id {book_id}: {os.path.basename(str(staged_path))}", flush=True)
+            self.touched_book_ids.add(int(book_id))
             if self.cwa_settings['auto_backup_imports']:
                 self.backup(str(staged_path), backup_type="imported")
+            if staged_path.suffix.lower() in ('.epub', '.kepub'):
+                self.build_spine_index(book_id=int(book_id))
             # Optional post-add-format GDrive sync
             gdrive_sync_if_enabled()
         except subprocess.CalledProcessError as e:
@@ -927,7 +1277,8 @@ class NewBookProcessor:
 
     def run_kindle_epub_fixer(self, filepath:str, dest=None) -> None:
         try:
-            EPUBFixer().process(input_path=filepath, output_path=dest)
+            with ingest_stage("epub_fixer"):
+                EPUBFixer().process(input_path=filepath, output_path=dest)
             print(f"[ingest-processor] {os.path.basename(filepath)} successfully processed with the cwa-kindle-epub-fixer!")
         except Exception as e:
             print(f"[ingest-processor] An error occurred while processing {os.path.basename(filepath)} with the kindle-epub-fixer. See the following error:\n{e}")
@@ -1076,12 +1427,14 @@ class NewBookProcessor:
         try:
             import sqlite3
             # Import the centralized partial MD5 calculation function
-            sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+            project_root = os.path.dirname(os.path.dirname(__file__))
+            if project_root not in sys.path:
+                sys.path.insert(0, project_root)
             from cps.progress_syncing.checksums import calculate_koreader_partial_md5, store_checksum, CHECKSUM_VERSION
 
             calibre_db_path = os.path.join(self.library_dir, 'metadata.db')
 
-            with sqlite3.connect(calibre_db_path, timeout=30) as con:
+            with ingest_stage("checksum"), sqlite3.connect(calibre_db_path, timeout=30) as con:
                 cur = con.cursor()
 
                 book_row = None
@@ -1153,15 +1506,53 @@ class NewBookProcessor:
             # Don't fail the import if checksum generation fails
 
 
+    def build_spine_index(self, book_id: int) -> None:
+        """Store the spine/chapter-length index of the book's EPUB and KEPUB formats in the CWA DB
+
+        Args:
+            book_id: ID of the imported book
+        """
+        try:
+            project_root = os.path.dirname(os.path.dirname(__file__))
+            if project_root not in sys.path:
+                sys.path.insert(0, project_root)
+            from cps.progress_syncing.spine_index import store_spine_index
+
+            calibre_db_path = os.path.join(self.library_dir, 'metadata.db')
+            # Shares the post-import checksum stage's concurrency limit
+            with ingest_stage("checksum"):
+                with sqlite3.connect(calibre_db_path, timeout=30) as con:
+                    cur = con.cursor()
+                    book_row = cur.execute('SELECT path FROM books WHERE id = ?', (book_id,)).fetchone()
+                    if not book_row:
+                        return
+                    formats = cur.execute(
+                        "SELECT format, name FROM data WHERE book = ? AND format IN ('EPUB', 'KEPUB')",
+                        (book_id,)
+                    ).fetchall()
+
+                for format_ext, format_name in formats:
+                    file_path = os.path.join(self.library_dir, book_row[0], f"{format_name}.{format_ext.lower()}")
+                    if not os.path.exists(file_path):
+                        continue
+                    if store_spine_index(book_id, format_ext, file_path, cwa_db=self.db) is None:
+                        print(f"[ingest-processor] WARN: No readable spine in {format_ext.upper()} of book ID {book_id}", flush=True)
+
+        except Exception as e:
+            print(f"[ingest-processor] Error building spine index: {e}", flush=True)
+            # Don't fail the import; the index is built on first use instead
+
+
     def refresh_cwa_session(self) -> None:
         """Refresh Calibre-Web's database session to make newly added books visible
 
         This solves the issue where external calibredb adds aren't immediately visible
         in Calibre-Web until container restart.
         """
-        # Route DB reconnect via the long-lived web process to avoid cross-process config/session issues
+        # Tell the long-lived web process the library changed; it coalesces bursts of these
+        # and only rebuilds its ORM mappings if the custom columns changed
         try:
-            url = get_internal_api_url("/cwa-internal/reconnect-db")
+            url = get_internal_api_url("/cwa-internal/library-changed")
             print("[ingest-processor] Refreshing Calibre-Web database session...", flush=True)
             resp = requests.post(
                 url,
@@ -1170,7 +1561,7 @@ class NewBookProcessor:
                 verify=False,
             )
             if resp.status_code == 200:
-                print("[ingest-processor] Database session refresh enqueued", flush=True)
+                print("[ingest-processor] Database session refresh queued", flush=True)
             else:
                 print(f"[ingest-processor] WARN: DB refresh endpoint returned {resp.status_code}", flush=True)
         except Exception as e:
@@ -1245,19 +1636,32 @@ class NewBookProcessor:
 
 
     def set_library_permissions(self):
+        """Hand the book folders this import touched back to abc:abc.
+
+        The rest of the library is left to the scheduled ownership audit (library_permissions.py).
+        """
+        if network_share_mode():
+            print(f"[ingest-processor] NETWORK_SHARE_MODE=true detected; skipping chown of {self.library_dir}", flush=True)
+            return
+        book_ids = self.touched_book_ids.union(self.last_added_book_ids)
         try:
-            nsm = os.getenv("NETWORK_SHARE_MODE", "false").strip().lower() in ("1", "true", "yes", "on")
-            if not nsm:
-                subprocess.run(["chown", "-R", "abc:abc", self.library_dir], check=True)
+            if book_ids:
+                book_dirs = book_dirs_for_ids(self.library_dir, self.metadata_db, book_ids)
             else:
-                print(f"[ingest-processor] NETWORK_SHARE_MODE=true detected; skipping chown of {self.library_dir}", flush=True)
-        except subprocess.CalledProcessError as e:
-            print(f"[ingest-processor] An error occurred while attempting to recursively set ownership of {self.library_dir} to abc:abc. See the following error:\n{e}", flush=True)
+                # Nothing we can name (e.g. an unmapped batched add): fall back to what changed during this job
+                book_dirs = book_dirs_changed_since(self.library_dir, self.started_at - 1)
+            stats = fix_book_dirs(self.library_dir, book_dirs)
+            if stats is not None and stats.changed:
+                print(f"[ingest-processor] Set ownership of {len(book_dirs)} book folder(s) to abc:abc ({stats})", flush=True)
+        except Exception as e:
+            print(f"[ingest-processor] An error occurred while attempting to set ownership of the imported book(s) in {self.library_dir} to abc:abc. See the following error:\n{e}", flush=True)
 
 
-def main(filepath=None):
+def main(filepath=None, db: CWA_DB | None = None):
     """Checks if filepath is a directory. If it is, main will be ran on every file in the given directory
-    Inotifywait won't detect files inside folders if the folder was moved rather than copied"""
+    Inotifywait won't detect files inside folders if the folder was moved rather than copied
+
+    Returns False if the file didn't become ready in time and was left in place to be retried"""
 
     if filepath is None:
         if len(sys.argv) < 2:
@@ -1292,10 +1696,10 @@ def main(filepath=None):
             for filename in os.listdir(filepath):
                 f = os.path.join(filepath, filename)
                 if Path(f).exists():
-                    main(f)
+                    main(f, db=db)
             return
 
-        nbp = NewBookProcessor(filepath)
+        nbp = NewBookProcessor(filepath, db=db)
 
         # If this file is not an ignored temporary, wait briefly for stability to avoid importing a still-growing file
         ext_tmp_check = Path(nbp.filename).suffix.replace('.', '')
@@ -1306,7 +1710,7 @@ def main(filepath=None):
             if not ready:
                 print(f"[ingest-processor] WARN: File did not become ready in time or vanished (after {timeout_minutes} minutes): {nbp.filename}", flush=True)
                 skip_delete = True
-                return
+                return False
 
         # Sidecar manifest handling for explicit actions (e.g., add_format)
         manifest_path = filepath + ".cwa.json"
@@ -1385,27 +1789,7 @@ def main(filepath=None):
                     # If the original format should be retained, also add it as an additional format
                     if nbp.input_format in nbp.convert_retained_formats and nbp.input_format not in nbp.ingest_ignored_formats:
                         print(f"[ingest-processor]: Retaining original format ({nbp.input_format}) for {nbp.filename}...", flush=True)
-                        # Find the book that was just added to get its ID
-                        try:
-                            # Prefer the exact id we just added if available
-                            if nbp.last_added_book_id is not None:
-                                target_book_id = nbp.last_added_book_id
-                            else:
-                                with sqlite3.connect(nbp.metadata_db, timeout=30) as con:
-                                    cur = con.cursor()
-                                    cur.execute("SELECT id FROM books ORDER BY timestamp DESC LIMIT 1")
-                                    res = cur.fetchone()
-                                    target_book_id = res[0] if res else None
-
-                            if target_book_id is not None:
-                                if os.path.exists(filepath) and os.path.getsize(filepath) > 0:
-                                    nbp.add_format_to_book(int(target_book_id), filepath)
-                                else:
-                                    print(f"[ingest-processor] Original file no longer exists or is empty, cannot retain format: {filepath}", flush=True)
-                            else:
-                                print(f"[ingest-processor] Could not find book ID to add retained format for: {nbp.filename}", flush=True)
-                        except Exception as e:
-                            print(f"[ingest-processor] Error adding retained format: {e}", flush=True)
+                        nbp.add_retained_format(filepath)
 
             elif nbp.can_convert and not nbp.auto_convert_on: # Books not in target format but Auto-Converter is off so files are imported anyway
                 print(f"\n[ingest-processor]: {nbp.filename} not in target format but CWA Auto-Convert is deactivated so importing the file anyway...", flush=True)
@@ -1443,5 +1827,244 @@ def main(filepath=None):
             except Exception:
                 pass  # Ignore errors in cleanup
 
+class IngestWorker:
+    """Long-lived ingest worker pool fed by the cwa-ingest-service watcher.
+
+    The watcher writes one file path per line into a FIFO. The reader thread records every
+    path in the durable cwa_ingest_queue table, and INGEST_WORKERS threads claim entries
+    (highest priority first) and run main() in-process for each of them, keeping the
+    interpreter, the cps imports and one CWA_DB handle per thread warm. Stage limits are
+    enforced by ingest_stage(), so only the metadata.db writes are serialized.
+    """
+
+    def __init__(self, fifo_path: str = INGEST_FIFO_PATH, status_file: str = INGEST_STATUS_FILE,
+                 workers: int = INGEST_WORKERS):
+        self.fifo_path = fifo_path
+        self.status_file = status_file
+        self.workers = workers
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._active = 0
+        self.files_processed = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        # Read once up front so the safety timeout is known before the first file arrives
+        self.settings = self._thread_db().cwa_settings
+
+    def _thread_db(self) -> CWA_DB:
+        """sqlite connections can't cross threads, so every worker keeps its own warm handle."""
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = CWA_DB()
+            self._local.db = db
+        return db
+
+    def write_status(self, state: str, filename: str = "", detail: str = "") -> None:
+        """Mirror the status line format the run script used to write."""
+        if not filename:
+            line = state
+        else:
+            line = f"{state}:{filename}:{time.strftime('%Y-%m-%d %H:%M:%S')}"
+            if detail:
+                line += f":{detail}"
+        try:
+            with open(self.status_file, 'w') as f:
+                f.write(line + "\n")
+        except OSError as e:
+            print(f"[ingest-processor] WARN: Could not write ingest status: {e}", flush=True)
+
+    def _safety_timeout(self) -> int:
+        timeout_minutes = self.settings.get('ingest_timeout_minutes', 15) or 15
+        return int(timeout_minutes) * 60 * 3
+
+    def _on_safety_timeout(self, job: dict) -> None:
+        """A single file hung a worker: move it aside and exit so the run script restarts us.
+
+        Everything else still marked 'processing' is picked up again when the worker restarts.
+        """
+        filepath = job['filepath']
+        filename = os.path.basename(filepath)
+        print(f"[ingest-processor] SAFETY TIMEOUT: {filepath} took longer than {self._safety_timeout()} seconds, restarting ingest worker", flush=True)
+        self.write_status("safety_timeout", filename)
+        try:
+            CWA_DB().ingest_queue_finish(job['id'], self._safety_timeout(), error="safety timeout")
+        except Exception as e:
+            print(f"[ingest-processor] WARN: Could not record safety timeout for {filename}: {e}", flush=True)
+        try:
+            failed_dir = backup_destinations.get("failed", "/config/processed_books/failed")
+            timestamp = time.strftime('%Y%m%d_%H%M%S')
+            shutil.copy(filepath, os.path.join(failed_dir, f"{timestamp}_safety_timeout_{filename}"))
+        except Exception:
+            pass
+        try:
+            os.remove(filepath)
+        except OSError:
+            pass
+        os._exit(124)
+
+    def submit(self, path: str, priority: int = 0, source: str = 'watcher') -> None:
+        """Queue a path; directories are expanded so their files spread over the pool."""
+        if os.path.isdir(path):
+            for root, _dirs, files in os.walk(path):
+                for name in sorted(files):
+                    self.submit(os.path.join(root, name), priority, source)
+            return
+        self._thread_db().ingest_queue_add(path, priority=priority, source=source)
+        self._wakeup.set()
+
+    def import_legacy_retry_queue(self) -> None:
+        """Move anything left in the old flat retry file into the durable queue."""
+        try:
+            with open(LEGACY_RETRY_QUEUE_FILE, 'r') as f:
+                paths = [line.strip() for line in f if line.strip()]
+        except FileNotFoundError:
+            return
+        for path in paths:
+            if os.path.exists(path):
+                self.submit(path)
+        open(LEGACY_RETRY_QUEUE_FILE, 'w').close()
+        if paths:
+            print(f"[ingest-processor] Imported {len(paths)} file(s) from the legacy retry queue", flush=True)
+
+    def process(self, job: dict) -> tuple[bool, str, float]:
+        """Run a single ingest in-process. Returns (success, error, elapsed seconds)."""
+        filepath = job['filepath']
+        filename = os.path.basename(filepath)
+        db = self._thread_db()
+        # Settings can be changed from the web UI at any time; re-reading them is a single query
+        db.cwa_settings = db.get_cwa_settings()
+        self.settings = db.cwa_settings
+
+        with ingest_job_lock():
+            watchdog = threading.Timer(self._safety_timeout(), self._on_safety_timeout, args=(job,))
+            watchdog.daemon = True
+            watchdog.start()
+
+            self.write_status("processing", filename)
+            t_start = time.monotonic()
+            error = ""
+            try:
+                if main(filepath, db=db) is False:
+                    # Still being written; _finish() puts it back in the queue with a backoff
+                    error = "file was not ready"
+            except SystemExit as e:
+                if e.code not in (None, 0):
+                    error = f"exited with code {e.code}"
+            except Exception as e:
+                error = str(e) or e.__class__.__name__
+                print(f"[ingest-processor] Error processing {filepath}: {error}", flush=True)
+            finally:
+                watchdog.cancel()
+            elapsed = time.monotonic() - t_start
+
+        with self._lock:
+            self.files_processed += 1
+            self.total_seconds += elapsed
+            self.max_seconds = max(self.max_seconds, elapsed)
+            avg = self.total_seconds / self.files_processed
+            processed = self.files_processed
+        print(f"[ingest-processor] INGEST_LATENCY: {filename} took {elapsed:.2f}s "
+              f"(files: {processed}, avg: {avg:.2f}s, max: {self.max_seconds:.2f}s, "
+              f"queued: {db.ingest_queue_depth()})", flush=True)
+
+        self.write_status("error" if error else "completed", filename)
+        return not error, error, elapsed
+
+    def _finish(self, db: CWA_DB, job: dict, success: bool, error: str, elapsed: float) -> None:
+        filepath = job['filepath']
+        if success or not os.path.exists(filepath):
+            # A failed ingest whose file is gone has already been moved to processed_books/failed
+            db.ingest_queue_finish(job['id'], elapsed, error="" if success else error)
+        elif job['attempts'] < INGEST_MAX_ATTEMPTS:
+            delay = ingest_retry_delay(job['attempts'])
+            print(f"[ingest-processor] Retrying {os.path.basename(filepath)} in {delay}s "
+                  f"(attempt {job['attempts']}/{INGEST_MAX_ATTEMPTS}): {error}", flush=True)
+            db.ingest_queue_retry(job['id'], delay, error)
+        else:
+            print(f"[ingest-processor] Giving up on {os.path.basename(filepath)} after {job['attempts']} attempts: {error}", flush=True)
+            db.ingest_queue_finish(job['id'], elapsed, error=error)
+
+    def _worker_loop(self) -> None:
+        db = self._thread_db()
+        while True:
+            try:
+                job = db.ingest_queue_claim()
+            except sqlite3.Error as e:
+                print(f"[ingest-processor] WARN: Could not claim from the ingest queue: {e}", flush=True)
+                job = None
+            if job is None:
+                # Woken early by new submissions; the timeout also picks up retries whose backoff expired
+                self._wakeup.wait(timeout=5)
+                self._wakeup.clear()
+                continue
+
+            with self._lock:
+                self._active += 1
+            try:
+                if os.path.exists(job['filepath']):
+                    success, error, elapsed = self.process(job)
+                else:
+                    print(f"[ingest-processor] Skipping {job['filepath']}: file no longer exists", flush=True)
+                    success, error, elapsed = True, "", 0.0
+                self._finish(db, job, success, error, elapsed)
+            except Exception as e:
+                print(f"[ingest-processor] ERROR: Ingest worker failed on {job['filepath']}: {e}", flush=True)
+            finally:
+                with self._lock:
+                    self._active -= 1
+                    idle = self._active == 0
+                if idle and db.ingest_queue_depth() == 0:
+                    self.write_status("idle")
+
+    def start_workers(self) -> None:
+        """Start the bounded pool of self.workers threads that drain the ingest queue."""
+        # The batcher only merges the adds of jobs already in flight, so a batch is full (and sent
+        # without waiting out the window) once every worker has joined it
+        library_add_batcher.window_seconds = INGEST_BATCH_WINDOW_SECONDS
+        library_add_batcher.max_batch = min(INGEST_BATCH_SIZE, self.workers)
+        for i in range(self.workers):
+            threading.Thread(target=self._worker_loop, name=f"ingest-worker-{i + 1}", daemon=True).start()
+
+    def run(self) -> None:
+        """Start the worker pool, then block on the FIFO forever queueing one path per line."""
+        db = self._thread_db()
+        requeued = db.ingest_queue_requeue_interrupted()
+        if requeued:
+            print(f"[ingest-processor] Re-queued {requeued} file(s) interrupted by the last shutdown", flush=True)
+        db.ingest_queue_prune()
+        self.import_legacy_retry_queue()
+
+        if not os.path.exists(self.fifo_path):
+            os.mkfifo(self.fifo_path, 0o660)
+        # O_RDWR keeps a writer attached so we never see EOF when the watcher side closes
+        fifo_fd = os.open(self.fifo_path, os.O_RDWR)
+
+        self.start_workers()
+
+        limits = ", ".join(f"{name}={limit}" for name, limit in INGEST_STAGE_LIMITS.items())
+        batching = (f"batching up to {library_add_batcher.max_batch} adds per {INGEST_BATCH_WINDOW_SECONDS:g}s"
+                    if library_add_batcher.batching else "batching off")
+        print(f"[ingest-processor] Ingest worker ready in {time.monotonic() - _MODULE_LOADED_AT:.2f}s "
+              f"with {self.workers} worker(s) ({limits}; {batching}), {db.ingest_queue_depth()} file(s) queued, "
+              f"listening on {self.fifo_path}", flush=True)
+        self.write_status("idle")
+        with os.fdopen(fifo_fd, 'r', encoding='utf-8', errors='surrogateescape') as fifo:
+            for line in fifo:
+                filepath = line.rstrip("\n")
+                if filepath:
+                    try:
+                        self.submit(filepath)
+                    except Exception as e:
+                        print(f"[ingest-processor] ERROR: Could not queue {filepath}: {e}", flush=True)
+
+
 if __name__ == "__main__":
-    main()
+    if len(sys.argv) > 1 and sys.argv[1] == "--daemon":
+        # The daemon takes the lock per job (see ingest_job_lock) so a library restore can pause it
+        IngestWorker(sys.argv[2] if len(sys.argv) > 2 else INGEST_FIFO_PATH).run()
+    else:
+        # Acquire process lock to prevent concurrent execution
+        if not process_lock.acquire(timeout=10):
+            sys.exit(2)
+        main()
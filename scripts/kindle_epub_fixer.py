@@ -4,8 +4,10 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 # See CONTRIBUTORS for full list of authors.
 
+import copy
 import os
 import re
+import struct
 import zipfile
 from xml.dom import minidom
 import argparse
@@ -18,6 +20,10 @@ import logging
 import tempfile
 import atexit
 import traceback
+import multiprocessing
+import signal
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime
 import json
 import shutil
@@ -44,6 +50,16 @@ except Exception:
 # Compile regex pattern once at module level for performance
 LANGUAGE_TAG_PATTERN = re.compile(r'^[a-z]{2,3}(-[a-z]{2,4})?$', re.IGNORECASE)
 
+# Bump whenever the fixes change, so library runs check books an older version already passed
+FIXER_VERSION = 1
+# Library runs fix this many EPUBs at the same time, each in its own process
+try:
+    DEFAULT_LIBRARY_WORKERS = max(1, int(os.getenv("CWA_EPUB_FIXER_WORKERS", min(4, os.cpu_count() or 1))))
+except ValueError:
+    DEFAULT_LIBRARY_WORKERS = 1
+# Library run results are written to cwa.db in batches of this size
+DB_BATCH_SIZE = 50
+
 ### Global Variables
 dirs_json = "/app/calibre-web-automated/dirs.json"
 change_logs_dir = "/app/calibre-web-automated/metadata_change_logs"
@@ -119,26 +135,51 @@ def exit_if_cancelled() -> None:
         sys.exit(0)
 
 ### LOCK FILES
+lock_path = tempfile.gettempdir() + '/kindle_epub_fixer.lock'
+
 # Creates a lock file unless one already exists meaning an instance of the script is
-# already running, then the script is closed, the user is notified and the program
-# exits with code 2
-try:
-    lock = open(tempfile.gettempdir() + '/kindle_epub_fixer.lock', 'x')
-    lock.close()
-except FileExistsError:
-    print_and_log("[cwa-kindle-epub-fixer] CANCELLING... kindle-epub-fixer was initiated but is already running")
-    logger.info(f"\nCWA Kindle EPUB Fixer Service - Run Ended: {datetime.now()}")
-    sys.exit(2)
+# already running, in which case the caller cancels the run
+def acquireLock() -> bool:
+    try:
+        lock = open(lock_path, 'x')
+        lock.close()
+        return True
+    except FileExistsError:
+        return False
 
 # Defining function to delete the lock on script exit
 def removeLock():
     try:
-        os.remove(tempfile.gettempdir() + '/kindle_epub_fixer.lock')
+        os.remove(lock_path)
     except FileNotFoundError:
         ...
 
-# Will automatically run when the script exits
-atexit.register(removeLock)
+
+def _copy_raw_entry(src: zipfile.ZipFile, dst: zipfile.ZipFile, info: zipfile.ZipInfo) -> None:
+    """Copies an entry's compressed bytes from one archive to another without decompressing them"""
+    if info.flag_bits & 0x1: # Encrypted entries can't be copied this way, zipfile will refuse them
+        raise ValueError(f"{info.filename} is encrypted")
+    src.fp.seek(info.header_offset)
+    header = struct.unpack(zipfile.structFileHeader, src.fp.read(zipfile.sizeFileHeader))
+    src.fp.seek(header[zipfile._FH_FILENAME_LENGTH] + header[zipfile._FH_EXTRA_FIELD_LENGTH], os.SEEK_CUR)
+
+    out_info = copy.copy(info)
+    out_info.flag_bits &= ~0x8 # CRC and sizes are known, so no data descriptor follows the data
+    out_info.extra = b''
+    out_info.header_offset = dst.fp.tell()
+    dst.fp.write(out_info.FileHeader(zip64=info.compress_size > zipfile.ZIP64_LIMIT or info.file_size > zipfile.ZIP64_LIMIT))
+    remaining = info.compress_size
+    while remaining:
+        chunk = src.fp.read(min(remaining, 1024 * 1024))
+        if not chunk:
+            raise zipfile.BadZipFile(f"Truncated data for {info.filename}")
+        dst.fp.write(chunk)
+        remaining -= len(chunk)
+
+    dst.filelist.append(out_info)
+    dst.NameToInfo[out_info.filename] = out_info
+    dst.start_dir = dst.fp.tell()
+    dst._didModify = True
 
 
 class EPUBFixer:
@@ -151,8 +192,10 @@ class EPUBFixer:
 
         self.fixed_problems = []
         self.files = {}
-        self.binary_files = {}
+        self.binary_files = {} # filename -> ZipInfo, only read from the source EPUB when needed
         self.entries = []
+        self.entry_infos = {}
+        self.epub_path = None
         self.file_original_bytes = {}
         self.file_encodings = {}
         self.file_encoding_sources = {}
@@ -418,24 +461,33 @@ class EPUBFixer:
                 print_and_log(f"[cwa-kindle-epub-fixer] ERROR - Error occurred when backing up {epub_path} to {output_path}:\n{e}", log=self.manually_triggered)
 
     def read_epub(self, epub_path):
-        """Read EPUB file contents"""
+        """Read the text entries of the EPUB, binary entries (images, fonts...) are left in the archive"""
+        self.epub_path = epub_path
         with zipfile.ZipFile(epub_path, 'r') as zip_ref:
-            self.entries = zip_ref.namelist()
-            for filename in self.entries:
+            for info in zip_ref.infolist():
+                filename = info.filename
+                self.entries.append(filename)
+                self.entry_infos[filename] = info
                 ext = filename.split('.')[-1]
                 if filename == 'mimetype':
-                    self.files[filename] = zip_ref.read(filename)
+                    self.files[filename] = self.file_original_bytes[filename] = zip_ref.read(info)
                     continue
 
                 if ext in ['html', 'xhtml', 'htm', 'xml', 'svg', 'css', 'opf', 'ncx']:
-                    data = zip_ref.read(filename)
+                    data = zip_ref.read(info)
                     decoded = self._decode_text_entry(filename, data)
                     if decoded is None:
                         self.files[filename] = data
                     else:
                         self.files[filename] = decoded
                 else:
-                    self.binary_files[filename] = zip_ref.read(filename)
+                    self.binary_files[filename] = info
+
+    def _read_binary_head(self, filename: str, size: int) -> bytes:
+        """First bytes of a binary entry, read straight from the source EPUB"""
+        with zipfile.ZipFile(self.epub_path, 'r') as zip_ref:
+            with zip_ref.open(self.binary_files[filename]) as entry:
+                return entry.read(size)
 
     def fix_encoding(self):
         """Add UTF-8 encoding declaration if missing and fix malformed XML declarations"""
@@ -859,8 +911,8 @@ class EPUBFixer:
         for filename in list(self.binary_files.keys()):
             ext = filename.split('.')[-1].lower()
             if ext in ['jpg', 'jpeg', 'png', 'gif', 'svg', 'webp', 'bmp']:
-                file_data = self.binary_files[filename]
-                file_size = len(file_data)
+                file_size = self.binary_files[filename].file_size
+                file_data = self._read_binary_head(filename, 8)
                 total_size += file_size
                 
                 # Check for unsupported formats
@@ -1020,28 +1072,63 @@ class EPUBFixer:
         except Exception as e:
             print_and_log(f"[cwa-kindle-epub-fixer] Warning: Could not strip Amazon identifiers: {e}", log=self.manually_triggered)
 
+    def _encoded_text(self, filename: str) -> bytes:
+        content = self.files[filename]
+        if isinstance(content, bytes):
+            return content
+        if filename == 'mimetype':
+            return content.encode('utf-8')
+        return content.encode(self.file_target_encodings.get(filename, 'utf-8'))
+
+    def changed_entries(self) -> dict[str, bytes]:
+        """Text entries whose bytes differ from the source EPUB, encoded as they will be written"""
+        changed = {}
+        for filename in self.files:
+            data = self._encoded_text(filename)
+            if data != self.file_original_bytes.get(filename):
+                changed[filename] = data
+        return changed
+
+    def needs_rewrite(self) -> bool:
+        removed = set(self.entries) - set(self.files) - set(self.binary_files)
+        return bool(removed or self.changed_entries())
+
     def write_epub(self, output_path):
-        """Write EPUB file"""
-        with zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED) as zip_ref:
-            # First write mimetype file
-            if 'mimetype' in self.files:
-                mimetype_content = self.files['mimetype']
-                if isinstance(mimetype_content, str):
-                    mimetype_content = mimetype_content.encode('utf-8')
-                zip_ref.writestr('mimetype', mimetype_content, compress_type=zipfile.ZIP_STORED)
-
-            # Add text files
-            for filename, content in self.files.items():
-                if filename != 'mimetype':
-                    if isinstance(content, bytes):
-                        zip_ref.writestr(filename, content)
-                    else:
-                        encoding = self.file_target_encodings.get(filename, 'utf-8')
-                        zip_ref.writestr(filename, content.encode(encoding))
+        """Write EPUB file
+
+        Only entries that changed are compressed again, everything else (images, fonts...) is copied
+        from the source EPUB as it is stored there. The archive is written next to output_path first
+        and moved into place, so the source can be read while it's being written even if both are the same file."""
+        changed = self.changed_entries()
+        output_dir = os.path.dirname(os.path.abspath(output_path))
+        fd, tmp_path = tempfile.mkstemp(prefix='.cwa-epub-fixer-', suffix='.epub', dir=output_dir)
+        os.close(fd)
+        try:
+            with zipfile.ZipFile(self.epub_path, 'r') as src, zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_DEFLATED) as zip_ref:
+                # mimetype has to be the first entry and stored uncompressed
+                if 'mimetype' in self.files:
+                    zip_ref.writestr('mimetype', self._encoded_text('mimetype'), compress_type=zipfile.ZIP_STORED)
 
-            # Add binary files
-            for filename, content in self.binary_files.items():
-                zip_ref.writestr(filename, content)
+                for filename in self.entries:
+                    if filename == 'mimetype':
+                        continue
+                    if filename in changed:
+                        zip_ref.writestr(filename, changed[filename])
+                    elif filename in self.files or filename in self.binary_files:
+                        _copy_raw_entry(src, zip_ref, self.entry_infos[filename])
+            try:
+                shutil.copymode(self.epub_path, tmp_path)
+                stat = os.stat(self.epub_path)
+                os.chown(tmp_path, stat.st_uid, stat.st_gid)
+            except OSError:
+                pass
+            os.replace(tmp_path, output_path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                ...
+            raise
 
     def export_issue_summary(self, epub_path):
         if self.current_position:
@@ -1056,25 +1143,23 @@ class EPUBFixer:
         else:
             print_and_log(line_suffix + f"No issues found! - {epub_path}", log=self.manually_triggered)
 
-    def add_entry_to_db(self, input_path, output_path):
-        if self.fixed_problems:
-            fixed_problems = []
-            for count, problem in enumerate(self.fixed_problems):
-                fixed_problems.append(f"{str(count + 1).zfill(2)} - {problem}")
-            fixed_problems = "\n".join(fixed_problems)
-        else:
-            fixed_problems = "No fixes required"
+    @staticmethod
+    def format_fixed_problems(problems) -> str:
+        if not problems:
+            return "No fixes required"
+        return "\n".join(f"{str(count + 1).zfill(2)} - {problem}" for count, problem in enumerate(problems))
 
+    def add_entry_to_db(self, input_path, output_path):
         self.db.epub_fixer_add_entry(Path(input_path).stem,
                                     bool(self.manually_triggered),
                                     len(self.fixed_problems),
                                     str(self.cwa_settings['auto_backup_epub_fixes']),
                                     output_path,
-                                    fixed_problems)
+                                    self.format_fixed_problems(self.fixed_problems))
 
 
-    def process(self, input_path, output_path=None, default_language='en'):
-        """Process a single EPUB file"""
+    def process(self, input_path, output_path=None, default_language='en', add_to_db=True):
+        """Process a single EPUB file, add_to_db=False leaves recording the run to the caller"""
         if not output_path:
             output_path = input_path
 
@@ -1109,21 +1194,29 @@ class EPUBFixer:
         self.export_issue_summary(input_path)
 
         # Write EPUB
-        print_and_log("[cwa-kindle-epub-fixer] Writing EPUB...", log=self.manually_triggered)
         if Path(output_path).is_dir():
-            output_path = output_path + os.path.basename(input_path)
-        self.write_epub(output_path)
-        print_and_log("[cwa-kindle-epub-fixer] EPUB successfully written.", log=self.manually_triggered)
+            output_path = os.path.join(output_path, os.path.basename(input_path))
+        rewritten = self.needs_rewrite()
+        if rewritten:
+            print_and_log("[cwa-kindle-epub-fixer] Writing EPUB...", log=self.manually_triggered)
+            self.write_epub(output_path)
+            print_and_log("[cwa-kindle-epub-fixer] EPUB successfully written.", log=self.manually_triggered)
+        elif os.path.abspath(output_path) != os.path.abspath(input_path):
+            shutil.copy2(input_path, output_path)
+        else:
+            # Rewriting an unchanged file would only change its checksum (and KOReader's sync key)
+            print_and_log("[cwa-kindle-epub-fixer] Nothing changed, leaving the EPUB untouched.", log=self.manually_triggered)
 
         # Calculate and store new checksum after modification
-        if book_id and self.fixed_problems:
-            # Only recalculate if fixes were actually applied
+        if book_id and rewritten:
+            # Only recalculate if the file was actually rewritten
             self._recalculate_checksum_after_modification(book_id, book_format, output_path)
 
         # Add entry to cwa.db
-        print_and_log("[cwa-kindle-epub-fixer] Adding run to cwa.db...", log=self.manually_triggered)
-        self.add_entry_to_db(input_path, output_path)
-        print_and_log("[cwa-kindle-epub-fixer] Run successfully added to cwa.db.", log=self.manually_triggered)
+        if add_to_db:
+            print_and_log("[cwa-kindle-epub-fixer] Adding run to cwa.db...", log=self.manually_triggered)
+            self.add_entry_to_db(input_path, output_path)
+            print_and_log("[cwa-kindle-epub-fixer] Run successfully added to cwa.db.", log=self.manually_triggered)
         return self.fixed_problems
 
 
@@ -1151,6 +1244,88 @@ def get_all_epubs_in_library() -> list[str]:
     return epubs_in_library
 
 
+def _init_library_worker() -> None:
+    # Workers are forked from the main process, so its cwa.db connections must not be reused here
+    CWA_DB._local = threading.local()
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+
+def _fix_library_epub(epub: str, language: str) -> dict:
+    """Runs in a worker process, the main process records the returned result in cwa.db"""
+    result = {'path': epub, 'fixed_problems': [], 'error': None, 'file_size': None, 'file_mtime': None}
+    try:
+        result['fixed_problems'] = EPUBFixer(manually_triggered=True).process(epub, epub, language, add_to_db=False)
+        stat = os.stat(epub)
+        result['file_size'], result['file_mtime'] = stat.st_size, stat.st_mtime_ns
+    except Exception as e:
+        result['error'] = str(e)
+    return result
+
+
+def _terminate_library_run(signum, frame) -> None:
+    for child in multiprocessing.active_children():
+        child.terminate()
+    sys.exit(128 + signum)
+
+
+def get_epubs_to_fix(db: CWA_DB, epubs: list[str]) -> list[str]:
+    """Drops the EPUBs that haven't changed since this fixer version last checked them"""
+    checked = db.get_epub_fixer_files()
+    to_fix = []
+    for epub in epubs:
+        try:
+            stat = os.stat(epub)
+        except OSError:
+            continue
+        if checked.get(epub) != (stat.st_size, stat.st_mtime_ns, FIXER_VERSION):
+            to_fix.append(epub)
+    return to_fix
+
+
+def fix_library(epubs: list[str], language: str, workers: int) -> dict[str, str]:
+    """Fixes the given EPUBs on a pool of worker processes, returning the files that errored.
+
+    Results are committed to cwa.db in batches together with the size and mtime each file was left
+    with, so a cancelled or crashed run picks up where it stopped and later runs skip untouched books."""
+    db = CWA_DB()
+    original_backed_up = str(db.cwa_settings['auto_backup_epub_fixes'])
+    errored_files = {}
+    fixes, files = [], []
+
+    def flush():
+        if fixes or files:
+            db.epub_fixer_record_batch(fixes, files)
+            fixes.clear()
+            files.clear()
+
+    pool = ProcessPoolExecutor(max_workers=workers,
+                               mp_context=multiprocessing.get_context('fork'),
+                               initializer=_init_library_worker)
+    try:
+        futures = [pool.submit(_fix_library_epub, epub, language) for epub in epubs]
+        for done, future in enumerate(as_completed(futures), start=1):
+            result = future.result()
+            current_position = f"{done}/{len(epubs)}"
+            if result['error'] is not None:
+                print_and_log(f"[cwa-kindle-epub-fixer] {current_position} - The following error occurred when processing {result['path']}:\n{result['error']}")
+                errored_files[result['path']] = result['error']
+            else:
+                print_and_log(f"[cwa-kindle-epub-fixer] {current_position} - Finished processing {result['path']}")
+                fixes.append((Path(result['path']).stem, True, len(result['fixed_problems']), original_backed_up,
+                              result['path'], EPUBFixer.format_fixed_problems(result['fixed_problems'])))
+                files.append((result['path'], result['file_size'], result['file_mtime'], FIXER_VERSION))
+            if len(fixes) >= DB_BATCH_SIZE:
+                flush()
+            if os.path.exists(KILL_TRIGGER_PATH):
+                flush()
+                pool.shutdown(wait=False, cancel_futures=True)
+                exit_if_cancelled()
+    finally:
+        flush()
+        pool.shutdown(wait=False, cancel_futures=True)
+    return errored_files
+
+
 def main():
     parser = argparse.ArgumentParser(
         prog='kindle-epub-fixer',
@@ -1163,6 +1338,8 @@ def main():
     parser.add_argument('--language', '-l', required=False, default='en', help='Default language to use if not specified or invalid')
     parser.add_argument('--suffix', '-s',required=False,  default=False, action='store_true', help='Adds suffix "fixed" to output filename if given')
     parser.add_argument('--all', '-a', required=False, default=False, action='store_true', help='Will attempt to fix any issues in every EPUB in th user\'s library')
+    parser.add_argument('--workers', '-w', required=False, type=int, default=DEFAULT_LIBRARY_WORKERS, help=f'Number of EPUBs fixed at the same time with --all (default {DEFAULT_LIBRARY_WORKERS}, set with CWA_EPUB_FIXER_WORKERS)')
+    parser.add_argument('--force', '-f', required=False, default=False, action='store_true', help='With --all, also check EPUBs that haven\'t changed since they were last checked')
 
     args = parser.parse_args()
     # logger.info(f"CWA Kindle EPUB Fixer Service - Run Started: {datetime.now()}\n")
@@ -1177,8 +1354,16 @@ def main():
         # logger.info(f"\nCWA Kindle EPUB Fixer Service - Run Ended: {datetime.now()}\n")
         sys.exit(5)
 
+    # Exit with code 2 if another run of the fixer is already in progress
+    if not acquireLock():
+        print_and_log("[cwa-kindle-epub-fixer] CANCELLING... kindle-epub-fixer was initiated but is already running")
+        logger.info(f"\nCWA Kindle EPUB Fixer Service - Run Ended: {datetime.now()}")
+        sys.exit(2)
+    # Will automatically run when the script exits
+    atexit.register(removeLock)
+
     ### INPUT_FILE PROVIDED
-    elif args.input_file and not args.all:
+    if args.input_file and not args.all:
         logger.info(f"CWA Kindle EPUB Fixer Service - Run Started: {datetime.now()}\n")
         exit_if_cancelled()
         # Validate input file
@@ -1215,20 +1400,15 @@ def main():
         logger.info(f"CWA Kindle EPUB Fixer Service - Run Started: {datetime.now()}\n")
         print_and_log("[cwa-kindle-epub-fixer] Processing all epubs in library...")
         exit_if_cancelled()
-        epubs_to_process = get_all_epubs_in_library()
+        epubs_in_library = get_all_epubs_in_library()
+        epubs_to_process = epubs_in_library if args.force else get_epubs_to_fix(CWA_DB(), epubs_in_library)
+        if len(epubs_in_library) > len(epubs_to_process):
+            print_and_log(f"[cwa-kindle-epub-fixer] {len(epubs_in_library) - len(epubs_to_process)} EPUBs are unchanged since they were last checked and will be skipped.")
         if len(epubs_to_process) > 0:
-            print_and_log(f"[cwa-kindle-epub-fixer] {len(epubs_to_process)} EPUBs found to process.")
-            errored_files = {}
-            for count, epub in enumerate(epubs_to_process):
-                exit_if_cancelled()
-                current_position = f"{count + 1}/{len(epubs_to_process)}"
-                try:
-                    print_and_log(f"\n[cwa-kindle-epub-fixer] {current_position} - Processing {epub}...")
-                    exit_if_cancelled()
-                    EPUBFixer(manually_triggered=True, current_position=current_position).process(epub, epub, args.language)
-                except Exception as e:
-                    print_and_log(f"[cwa-kindle-epub-fixer] {current_position} - The following error occurred when processing {epub}:\n{e}")
-                    errored_files |= {epub:e}
+            workers = max(1, min(args.workers, len(epubs_to_process)))
+            print_and_log(f"[cwa-kindle-epub-fixer] {len(epubs_to_process)} EPUBs found to process with {workers} worker(s).")
+            signal.signal(signal.SIGTERM, _terminate_library_run)
+            errored_files = fix_library(epubs_to_process, args.language, workers)
             if errored_files:
                 print_and_log(f"\n[cwa-kindle-epub-fixer] {len(epubs_to_process) - len(errored_files)}/{len(epubs_to_process)} EPUBs in library successfully processed")
                 print_and_log(f"\n[cwa-kindle-epub-fixer] The following {len(errored_files)} encountered errors:\n")
@@ -0,0 +1,202 @@
+# Calibre-Web Automated – fork of Calibre-Web
+# Copyright (C) 2018-2026 Calibre-Web contributors
+# Copyright (C) 2024-2026 Calibre-Web Automated contributors
+# SPDX-License-Identifier: GPL-3.0-or-later
+# See CONTRIBUTORS for full list of authors.
+
+"""Ownership fix-up for the calibre library.
+
+Imports only need the book folders they touched handed back to abc:abc, so the ingest and
+convert scripts call fix_book_dirs() with those folders instead of running `chown -R` over the
+whole library. audit_library() is the full walk, run on a schedule by the cwa-ownership-audit
+service (or by hand with --audit); it only chowns entries whose owner is actually wrong.
+"""
+
+import argparse
+import grp
+import os
+import pwd
+import sqlite3
+import sys
+import time
+
+USER_NAME = "abc"
+GROUP_NAME = "abc"
+
+
+def network_share_mode() -> bool:
+    return os.getenv("NETWORK_SHARE_MODE", "false").strip().lower() in ("1", "true", "yes", "on")
+
+
+def library_owner() -> tuple[int, int] | None:
+    """uid/gid of abc:abc, or None when the account doesn't exist (e.g. outside the container)."""
+    try:
+        return pwd.getpwnam(USER_NAME).pw_uid, grp.getgrnam(GROUP_NAME).gr_gid
+    except KeyError:
+        return None
+
+
+class OwnershipStats:
+    def __init__(self):
+        self.checked = 0
+        self.changed = 0
+        self.errors = 0
+
+    def __str__(self) -> str:
+        return f"{self.checked} checked, {self.changed} changed, {self.errors} error(s)"
+
+
+def _fix_entry(path: str, st: os.stat_result, uid: int, gid: int, stats: OwnershipStats) -> None:
+    stats.checked += 1
+    if st.st_uid == uid and st.st_gid == gid:
+        return
+    try:
+        os.chown(path, uid, gid, follow_symlinks=False)
+        stats.changed += 1
+    except OSError:
+        stats.errors += 1
+
+
+def _walk_and_fix(root: str, uid: int, gid: int, stats: OwnershipStats) -> None:
+    """Fix `root` and everything below it, without following symlinks."""
+    try:
+        _fix_entry(root, os.lstat(root), uid, gid, stats)
+    except OSError:
+        stats.errors += 1
+        return
+    stack = [root]
+    while stack:
+        current = stack.pop()
+        try:
+            with os.scandir(current) as it:
+                for entry in it:
+                    try:
+                        _fix_entry(entry.path, entry.stat(follow_symlinks=False), uid, gid, stats)
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                    except OSError:
+                        stats.errors += 1
+        except OSError:
+            stats.errors += 1
+
+
+def book_dirs_for_ids(library_dir: str, metadata_db: str, book_ids) -> list[str]:
+    """Absolute folders of the given books, read after any renames metadata fetching may have done."""
+    book_ids = [int(book_id) for book_id in book_ids]
+    if not book_ids:
+        return []
+    placeholders = ",".join("?" * len(book_ids))
+    with sqlite3.connect(metadata_db, timeout=30) as con:
+        rows = con.execute(f"SELECT path FROM books WHERE id IN ({placeholders})", book_ids).fetchall()
+    return [os.path.join(library_dir, row[0]) for row in rows if row[0]]
+
+
+def book_dirs_changed_since(library_dir: str, since: float) -> list[str]:
+    """Book folders created or modified since `since`, for imports whose book ids are unknown.
+
+    Adding a book folder bumps its author folder's mtime, so only recently changed author
+    folders are opened.
+    """
+    book_dirs = []
+    try:
+        with os.scandir(library_dir) as authors:
+            for author in authors:
+                try:
+                    if not author.is_dir(follow_symlinks=False) or author.stat(follow_symlinks=False).st_mtime < since:
+                        continue
+                    with os.scandir(author.path) as books:
+                        for book in books:
+                            if book.is_dir(follow_symlinks=False) and book.stat(follow_symlinks=False).st_mtime >= since:
+                                book_dirs.append(book.path)
+                except OSError:
+                    continue
+    except OSError:
+        pass
+    return book_dirs
+
+
+def fix_book_dirs(library_dir: str, book_dirs) -> OwnershipStats | None:
+    """Give the touched book folders, their author folders and the library's metadata.db back to abc:abc.
+
+    Returns None when nothing was done (network share mode, or no abc account).
+    """
+    if network_share_mode():
+        return None
+    owner = library_owner()
+    if owner is None:
+        return None
+    uid, gid = owner
+    stats = OwnershipStats()
+    library_dir = os.path.normpath(library_dir)
+
+    for name in ("metadata.db", "metadata.db-wal", "metadata.db-shm", "metadata_db_prefs_backup.json"):
+        path = os.path.join(library_dir, name)
+        try:
+            _fix_entry(path, os.lstat(path), uid, gid, stats)
+        except FileNotFoundError:
+            pass
+
+    author_dirs = set()
+    for book_dir in set(book_dirs):
+        book_dir = os.path.normpath(book_dir)
+        if not book_dir.startswith(library_dir + os.sep) or not os.path.isdir(book_dir):
+            continue
+        _walk_and_fix(book_dir, uid, gid, stats)
+        author_dir = os.path.dirname(book_dir)
+        if author_dir != library_dir:
+            author_dirs.add(author_dir)
+    for author_dir in author_dirs:
+        try:
+            _fix_entry(author_dir, os.lstat(author_dir), uid, gid, stats)
+        except OSError:
+            stats.errors += 1
+    return stats
+
+
+def audit_library(library_dir: str) -> OwnershipStats | None:
+    """Walk the whole library and chown only the entries not already owned by abc:abc."""
+    if network_share_mode():
+        return None
+    owner = library_owner()
+    if owner is None:
+        return None
+    stats = OwnershipStats()
+    _walk_and_fix(os.path.normpath(library_dir), *owner, stats)
+    return stats
+
+
+def _library_dir_from_dirs_json(path: str = "/app/calibre-web-automated/dirs.json") -> str:
+    import json
+    with open(path, 'r') as f:
+        return json.load(f)['calibre_library_dir']
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='library-permissions',
+        description='Sets ownership of the calibre library to abc:abc, touching only entries that are wrong'
+    )
+    parser.add_argument('--audit', action='store_true', help='Walk the whole library (default when no book folders are given)')
+    parser.add_argument('--library', dest='library_dir', default=None, help='Library folder (defaults to the one in dirs.json)')
+    parser.add_argument('book_dirs', nargs='*', help='Only fix these book folders')
+    args = parser.parse_args()
+
+    library_dir = args.library_dir or _library_dir_from_dirs_json()
+    if network_share_mode():
+        print(f"[library-permissions] NETWORK_SHARE_MODE=true detected; skipping ownership audit of {library_dir}", flush=True)
+        sys.exit(0)
+    if library_owner() is None:
+        print(f"[library-permissions] User {USER_NAME} not found; nothing to do", flush=True)
+        sys.exit(0)
+
+    t_start = time.monotonic()
+    if args.book_dirs and not args.audit:
+        stats = fix_book_dirs(library_dir, args.book_dirs)
+    else:
+        stats = audit_library(library_dir)
+    print(f"[library-permissions] Ownership of {library_dir} checked in {time.monotonic() - t_start:.1f}s: {stats}", flush=True)
+    sys.exit(1 if stats is not None and stats.errors else 0)
+
+
+if __name__ == "__main__":
+    main()
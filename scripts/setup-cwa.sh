@@ -13,6 +13,7 @@ change_script_permissions () {
     chown -R abc:abc /etc/s6-overlay
     chmod +x /etc/s6-overlay/s6-rc.d/cwa-auto-library/run
     chmod +x /etc/s6-overlay/s6-rc.d/cwa-auto-zipper/run
+    chmod +x /etc/s6-overlay/s6-rc.d/cwa-ownership-audit/run
     chmod +x /etc/s6-overlay/s6-rc.d/cwa-ingest-service/run
     chmod +x /etc/s6-overlay/s6-rc.d/cwa-init/run
     chmod +x /etc/s6-overlay/s6-rc.d/cwa-process-recovery/run
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+# Calibre-Web Automated – fork of Calibre-Web
+# Copyright (C) 2018-2026 Calibre-Web contributors
+# Copyright (C) 2024-2026 Calibre-Web Automated contributors
+# SPDX-License-Identifier: GPL-3.0-or-later
+# See CONTRIBUTORS for full list of authors.
+
+import os
+import threading
+import zipfile
+from types import SimpleNamespace
+from unittest import mock
+
+import pytest
+from flask import Response
+
+from cps import comic_pages, web
+
+
+@pytest.fixture
+def cbz(tmp_path):
+    path = tmp_path / "comic.cbz"
+    with zipfile.ZipFile(path, "w") as zf:
+        for name in ("page10.jpg", "page2.png", "page1.jpg", "__MACOSX/page1.jpg", "ComicInfo.xml"):
+            zf.writestr(name, name.encode())
+    comic_pages.clear()
+    yield str(path)
+    comic_pages.clear()
+
+
+@pytest.mark.unit
+class TestComicPages:
+    def test_pages_are_naturally_sorted_images(self, cbz):
+        assert comic_pages.page_names(cbz) == ["page1.jpg", "page2.png", "page10.jpg"]
+
+    def test_read_page_uses_cache(self, cbz, monkeypatch):
+        assert comic_pages.read_page(cbz, 1, prefetch=False) == (b"page2.png", "page2.png")
+        _, archive = comic_pages._get_archive(cbz)
+        monkeypatch.setattr(archive, "read", lambda index: pytest.fail("page read twice"))
+
+        assert comic_pages.read_page(cbz, 1, prefetch=False)[0] == b"page2.png"
+        with pytest.raises(IndexError):
+            comic_pages.read_page(cbz, 3, prefetch=False)
+
+    def test_etag_follows_file(self, cbz):
+        etag = comic_pages.page_etag(cbz, 0)
+        assert etag != comic_pages.page_etag(cbz, 1)
+
+        stat = os.stat(cbz)
+        os.utime(cbz, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        assert comic_pages.page_etag(cbz, 0) != etag
+
+    def test_eviction_waits_for_a_page_read(self, cbz):
+        key, archive = comic_pages._get_archive(cbz)
+        cleared = threading.Event()
+
+        def clear():
+            comic_pages.clear()
+            cleared.set()
+
+        with archive.lock:
+            # A reader is using the handle while the archive gets evicted
+            threading.Thread(target=clear, daemon=True).start()
+            assert not cleared.wait(0.3)
+            assert archive.read(0) == b"page1.jpg"
+        assert cleared.wait(5)
+        assert archive.closed
+
+    def test_evicted_archive_is_reopened_by_late_readers(self, cbz):
+        key, archive = comic_pages._get_archive(cbz)
+        comic_pages.clear()
+
+        assert comic_pages._load_page(key, archive, 2) == b"page10.jpg"
+
+
+@pytest.mark.unit
+class TestComicPageHeaders:
+    def _csp(self, endpoint):
+        settings = {"config_trustedhosts": "", "config_use_google_drive": False, "config_use_goodreads": False}
+        with mock.patch.object(web, "request", SimpleNamespace(endpoint=endpoint, path="/ajax/comic/1/cbz/0")), \
+                mock.patch.multiple(web.config, create=True, **settings):
+            return web.add_security_headers(Response()).headers["Content-Security-Policy"]
+
+    def test_pages_are_sandboxed(self):
+        assert comic_pages.page_mimetype("page.svg") == "image/svg+xml"
+        assert self._csp("web.get_comic_page").endswith(" sandbox;")
+        assert "sandbox" not in self._csp("web.get_comic_pages")
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+# Calibre-Web Automated – fork of Calibre-Web
+# Copyright (C) 2018-2026 Calibre-Web contributors
+# Copyright (C) 2024-2026 Calibre-Web Automated contributors
+# SPDX-License-Identifier: GPL-3.0-or-later
+# See CONTRIBUTORS for full list of authors.
+
+import io
+import json
+import os
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+import cover_enforcer
+
+
+class _FakeDB:
+    def __init__(self):
+        self.entries = []
+        self.status = {}
+
+    def enforce_add_entry_from_log(self, log_info, trigger_type="auto -log"):
+        self.entries.append(log_info)
+
+    def update_enforcer_status(self, **fields):
+        self.status.update(fields)
+
+
+class _FakeEnforcer:
+    _parse_log_filename = cover_enforcer.Enforcer._parse_log_filename
+    delete_log = cover_enforcer.Enforcer.delete_log
+
+    def __init__(self):
+        self.db = _FakeDB()
+        self.enforcer_on = True
+        self.enforced = []
+        self.failures = []
+        self.lock = threading.Lock()
+
+    def refresh_settings(self):
+        pass
+
+    def enforce_from_log(self, log_path, metadata_dir):
+        with open(log_path) as f:
+            log_info = json.load(f)
+        with self.lock:
+            self.enforced.append((os.path.basename(log_path), metadata_dir))
+        return log_info, [SimpleNamespace(file_path=log_path.replace(".json", ".epub"))], None
+
+    def record_failed_enforcement(self, log_info, error):
+        self.failures.append((log_info, error))
+
+
+@pytest.fixture
+def dirs(tmp_path, monkeypatch):
+    logs = tmp_path / "logs"
+    logs.mkdir()
+    monkeypatch.setattr(cover_enforcer, "change_logs_dir", str(logs))
+    monkeypatch.setattr(cover_enforcer, "metadata_temp_dir", str(tmp_path / "metadata"))
+    monkeypatch.setattr(cover_enforcer, "lock_path", str(tmp_path / "cover_enforcer.lock"))
+    return logs
+
+
+def _write_log(logs, timestamp, book_id):
+    path = logs / f"{timestamp}-{book_id}.json"
+    path.write_text(json.dumps({"title": f"Book {book_id}", "authors": "Author"}))
+    return path
+
+
+@pytest.mark.unit
+class TestEnforcerService:
+    def test_logs_are_coalesced_per_book(self, dirs):
+        _write_log(dirs, "20260101120000", 7)
+        _write_log(dirs, "20260101120005", 7)
+        _write_log(dirs, "20260101120001", 8)
+        for book_id in range(20, 25):
+            _write_log(dirs, "20260101120002", book_id)
+        enforcer = _FakeEnforcer()
+        service = cover_enforcer.EnforcerService(enforcer, workers=2, debounce=0)
+
+        service.run(stream=io.StringIO("20260101120005-7.json\n"))
+
+        assert sorted(name for name, _ in enforcer.enforced) == sorted(
+            ["20260101120005-7.json", "20260101120001-8.json"] + [f"20260101120002-{i}.json" for i in range(20, 25)])
+        assert {os.path.basename(metadata_dir) for _, metadata_dir in enforcer.enforced} <= {"worker-1", "worker-2"}
+        assert os.listdir(dirs) == []
+        assert not os.path.exists(cover_enforcer.lock_path)
+        assert enforcer.db.status["processed"] == 7
+        assert (enforcer.db.status["running"], enforcer.db.status["queue_depth"]) == (0, 0)
+
+    def test_waits_for_debounce_and_lock(self, dirs):
+        _write_log(dirs, "20260101120000", 7)
+        enforcer = _FakeEnforcer()
+        service = cover_enforcer.EnforcerService(enforcer, workers=1, debounce=60)
+        service.scan()
+        service.dispatch(None)
+        assert service.pending and not service.in_flight
+
+        service.debounce = 0
+        open(cover_enforcer.lock_path, "x").close()
+        service.dispatch(None)
+        assert service.pending and not service.in_flight
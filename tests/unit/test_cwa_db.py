@@ -90,6 +90,58 @@ class TestCWADBSettings:
         settings2 = temp_cwa_db.get_cwa_settings()
         assert settings1['auto_convert_target_format'] == settings2['auto_convert_target_format'] == 'mobi'
 
+    def test_settings_cache_sees_writes_from_other_connections(self, temp_cwa_db):
+        """A cached settings row is refreshed when another process writes cwa.db"""
+        temp_cwa_db.update_cwa_settings({'auto_convert_target_format': 'epub'})
+        assert CWA_DB().cwa_settings['auto_convert_target_format'] == 'epub'
+
+        import sqlite3
+        other = sqlite3.connect(temp_cwa_db.db_path + temp_cwa_db.db_file)
+        other.execute("UPDATE cwa_settings SET auto_convert_target_format='azw3'")
+        other.commit()
+        other.close()
+
+        assert CWA_DB().cwa_settings['auto_convert_target_format'] == 'azw3'
+
+    def test_returned_settings_are_copies(self, temp_cwa_db):
+        """Mutating one caller's settings must not leak into the cache"""
+        settings = temp_cwa_db.get_cwa_settings()
+        settings['auto_convert_target_format'] = 'not-a-format'
+        assert CWA_DB().cwa_settings['auto_convert_target_format'] != 'not-a-format'
+
+    def test_connection_is_reused_within_a_thread(self, temp_cwa_db):
+        """Instances in one thread share a connection; a closed one is replaced"""
+        assert CWA_DB().con is temp_cwa_db.con
+        temp_cwa_db.con.close()
+        db = CWA_DB()
+        assert db.con is not temp_cwa_db.con
+        assert db.get_cwa_settings()
+
+    def test_new_instance_leaves_open_transaction_alone(self, temp_cwa_db):
+        """Constructing a CWA_DB must not roll back another instance's uncommitted writes"""
+        temp_cwa_db.cur.execute("INSERT INTO cwa_import(timestamp, filename, original_backed_up) "
+                                "VALUES ('2026-01-01 00:00:00', 'uncommitted.epub', 'False')")
+        CWA_DB().get_cwa_settings()
+        assert temp_cwa_db.con.in_transaction
+        temp_cwa_db.con.commit()
+
+        count = temp_cwa_db.cur.execute("SELECT COUNT(*) FROM cwa_import WHERE filename = 'uncommitted.epub'").fetchone()[0]
+        assert count == 1
+
+    def test_failed_write_rolls_back_its_own_work(self, temp_cwa_db):
+        """A write that fails leaves no open transaction behind for the next user of the connection"""
+        temp_cwa_db.ingest_queue_add("/ingest/a.epub")
+        row_id = temp_cwa_db.ingest_queue_claim()['id']
+        temp_cwa_db.cur.execute("CREATE TEMP TRIGGER fail_retry BEFORE UPDATE OF next_attempt_at ON cwa_ingest_queue "
+                                "BEGIN SELECT RAISE(ABORT, 'retry refused'); END")
+        try:
+            with pytest.raises(Exception, match="retry refused"):
+                temp_cwa_db.ingest_queue_retry(row_id, 60, "boom")
+            assert not temp_cwa_db.con.in_transaction
+            assert not CWA_DB().con.in_transaction
+        finally:
+            temp_cwa_db.cur.execute("DROP TRIGGER fail_retry")
+
 
 @pytest.mark.unit  
 class TestCWADBEnforcementLogging:
@@ -246,6 +298,7 @@ class TestCWADBUserFilters:
         # Insert activity for two users
         temp_cwa_db.log_activity(100, "User A", "LOGIN")
         temp_cwa_db.log_activity(101, "User B", "LOGIN")
+        temp_cwa_db.flush_activity()
 
         stats = temp_cwa_db.get_dashboard_stats(days=1, user_id=[100, 101])
 
@@ -255,6 +308,208 @@ class TestCWADBUserFilters:
         assert stats["totals"]["active_users"] == 0
 
 
+@pytest.mark.unit
+class TestCWADBActivityLog:
+    """Test buffered activity logging."""
+
+    def _count(self, db, event_type):
+        return db.cur.execute("SELECT COUNT(*) FROM cwa_user_activity WHERE event_type=?", (event_type,)).fetchone()[0]
+
+    def test_events_are_written_on_flush(self, temp_cwa_db, monkeypatch):
+        """Buffered events land in cwa.db, with their own timestamp, once flushed."""
+        import cwa_db
+        monkeypatch.setattr(cwa_db, "ACTIVITY_ASYNC", True)
+        before = self._count(temp_cwa_db, "TEST_BUFFERED")
+
+        temp_cwa_db.log_activity(100, "User A", "TEST_BUFFERED", extra_data={"endpoint": "/opds"})
+        temp_cwa_db.flush_activity()
+
+        assert self._count(temp_cwa_db, "TEST_BUFFERED") == before + 1
+        timestamp = temp_cwa_db.cur.execute(
+            "SELECT timestamp FROM cwa_user_activity WHERE event_type='TEST_BUFFERED' ORDER BY id DESC").fetchone()[0]
+        assert len(timestamp) == 19
+
+    def test_sampled_out_events_are_skipped(self, temp_cwa_db, monkeypatch):
+        """An event type sampled at 0 is never logged; kept sampled events record their rate."""
+        import cwa_db
+        monkeypatch.setattr(cwa_db, "ACTIVITY_SAMPLE_RATES", {"TEST_SAMPLED_OUT": 0.0, "TEST_SAMPLED_IN": 0.999999})
+        monkeypatch.setattr(cwa_db.random, "random", lambda: 0.5)
+        dropped_before = self._count(temp_cwa_db, "TEST_SAMPLED_OUT")
+
+        for _ in range(5):
+            temp_cwa_db.log_activity(100, "User A", "TEST_SAMPLED_OUT")
+        temp_cwa_db.log_activity(100, "User A", "TEST_SAMPLED_IN")
+        temp_cwa_db.flush_activity()
+
+        assert self._count(temp_cwa_db, "TEST_SAMPLED_OUT") == dropped_before
+        extra = temp_cwa_db.cur.execute(
+            "SELECT extra_data FROM cwa_user_activity WHERE event_type='TEST_SAMPLED_IN' ORDER BY id DESC").fetchone()[0]
+        assert '"sample_rate": 0.999999' in extra
+
+    def test_sampled_events_are_weighted_in_stats(self, temp_cwa_db, monkeypatch):
+        """A kept event sampled at 0.25 counts as four events in the dashboard stats."""
+        import cwa_db
+        monkeypatch.setattr(cwa_db, "ACTIVITY_SAMPLE_RATES", {"SEARCH": 0.25})
+        monkeypatch.setattr(cwa_db.random, "random", lambda: 0.1)
+        user_id = 987654
+
+        def totals():
+            stats = temp_cwa_db.get_dashboard_stats(days=1, user_id=user_id)
+            return stats["totals"]["total_events"], stats["totals"]["total_searches"]
+
+        events_before, searches_before = totals()
+        temp_cwa_db.log_activity(user_id, "Sampled User", "SEARCH", extra_data={"query": "dune"})
+        temp_cwa_db.log_activity(user_id, "Sampled User", "LOGIN")
+        temp_cwa_db.flush_activity()
+
+        events, searches = totals()
+        assert (events - events_before, searches - searches_before) == (5, 4)
+
+
+@pytest.mark.unit
+class TestCWADBDuplicateSummary:
+    """Test the cached duplicate summary used by the page banner"""
+
+    def test_summary_follows_cache_updates(self, temp_cwa_db):
+        book = type("Book", (), {"id": 1})()
+        groups = [{'title': 'Dune', 'author': 'Frank Herbert', 'count': 2, 'group_hash': 'h1', 'books': [book, book]}]
+        temp_cwa_db.update_duplicate_cache(groups, 1, 10)
+
+        summary = CWA_DB().get_duplicate_summary()
+        assert summary['groups'] == ({'title': 'Dune', 'author': 'Frank Herbert', 'count': 2, 'group_hash': 'h1'},)
+        assert summary['hashes'] == {'h1'}
+        assert summary['scan_pending'] is False
+        assert CWA_DB().get_duplicate_summary() is summary
+
+        temp_cwa_db.invalidate_duplicate_cache()
+        assert CWA_DB().get_duplicate_summary()['scan_pending'] is True
+
+    def test_summary_sees_writes_from_other_connections(self, temp_cwa_db):
+        temp_cwa_db.update_duplicate_cache([], 0, 10)
+        assert CWA_DB().get_duplicate_summary()['groups'] == ()
+
+        import sqlite3
+        other = sqlite3.connect(temp_cwa_db.db_path + temp_cwa_db.db_file)
+        other.execute("UPDATE cwa_duplicate_cache SET duplicate_groups_json = ? WHERE id = 1",
+                      ('[{"title": "Emma", "author": "Jane Austen", "count": 3, "group_hash": "h2", "book_ids": [1, 2, 3]}]',))
+        other.commit()
+        other.close()
+
+        assert CWA_DB().get_duplicate_summary()['hashes'] == {'h2'}
+
+
+@pytest.mark.unit
+class TestCWADBDuplicateKeys:
+    """Test the persistent duplicate key index"""
+
+    def test_candidates_share_a_key(self, temp_cwa_db):
+        rows = [(1, '["dune", "frank herbert"]', '2026-01-01'),
+                (2, '["dune", "frank herbert"]', '2026-01-02'),
+                (3, '["emma", "jane austen"]', '2026-01-01')]
+        assert temp_cwa_db.update_duplicate_keys('[1, 1]', rows, reset=True)
+
+        criteria, keys = temp_cwa_db.get_duplicate_keys()
+        assert criteria == '[1, 1]'
+        assert keys[2] == ('["dune", "frank herbert"]', '2026-01-02')
+        assert temp_cwa_db.get_duplicate_key_candidates() == {1, 2}
+        assert temp_cwa_db.get_duplicate_key_candidates({'["emma", "jane austen"]'}) == set()
+
+    def test_rekeying_and_deletes_move_books_between_groups(self, temp_cwa_db):
+        temp_cwa_db.update_duplicate_keys('[1, 1]', [(1, '["dune"]', 'a'), (2, '["dune"]', 'a'), (3, '["emma"]', 'a')],
+                                          reset=True)
+
+        temp_cwa_db.update_duplicate_keys('[1, 1]', [(3, '["dune"]', 'b')], deleted_book_ids=[1])
+
+        assert temp_cwa_db.get_duplicate_key_candidates() == {2, 3}
+        assert set(temp_cwa_db.get_duplicate_keys()[1]) == {2, 3}
+
+
+@pytest.mark.unit
+class TestCWADBEpubSpineIndex:
+    """Test the stored EPUB spine/chapter-length index"""
+
+    def test_round_trip_and_replace(self, temp_cwa_db):
+        # The fixture's db can outlive a run, so use a book id nothing has indexed yet
+        temp_cwa_db.cur.execute("SELECT COALESCE(MAX(book_id), 0) + 1 FROM cwa_epub_spine_index")
+        book_id = temp_cwa_db.cur.fetchone()[0]
+        assert temp_cwa_db.get_epub_spine_index(book_id, 'epub') is None
+        assert temp_cwa_db.set_epub_spine_index(book_id, 'epub', 100, 2048, ['a.xhtml', 'b.xhtml'], [10, 20])
+        assert temp_cwa_db.set_epub_spine_index(book_id, 'EPUB', 200, 4096, ['a.xhtml'], [30])
+
+        assert temp_cwa_db.get_epub_spine_index(book_id, 'EPUB') == {
+            'file_mtime': 200, 'file_size': 4096, 'spine': ['a.xhtml'], 'chapter_lengths': [30]}
+        assert temp_cwa_db.get_epub_spine_index(book_id, 'KEPUB') is None
+
+
+@pytest.mark.unit
+class TestCWADBConvertLibraryState:
+    """Test the resumable convert-library run state"""
+
+    @pytest.fixture(autouse=True)
+    def restore_state(self, temp_cwa_db):
+        # The state is a single row that outlives the test, so put back whatever was there
+        before = temp_cwa_db.get_convert_library_state()
+        yield
+        before.pop('updated_at')
+        temp_cwa_db.update_convert_library_state(**before)
+        temp_cwa_db.reset_convert_library_books()
+
+    def test_run_state_and_book_outcomes(self, temp_cwa_db):
+        assert temp_cwa_db.reset_convert_library_books()
+        assert temp_cwa_db.update_convert_library_state(status='running', target_format='epub', workers=3, total=4,
+                                                        converted=0, failed=0)
+        assert temp_cwa_db.update_convert_library_state(book_id='12', book_status='failed', failed=1)
+        assert temp_cwa_db.update_convert_library_state(book_id=13, book_status='converted', converted=1)
+
+        state = temp_cwa_db.get_convert_library_state()
+        assert (state['status'], state['workers'], state['converted'], state['failed']) == ('running', 3, 1, 1)
+        assert state['updated_at'] is not None
+        assert temp_cwa_db.get_convert_library_books('failed') == {12}
+
+        assert temp_cwa_db.reset_convert_library_books()
+        assert temp_cwa_db.get_convert_library_books('failed') == set()
+        with pytest.raises(ValueError):
+            temp_cwa_db.update_convert_library_state(not_a_column=1)
+
+
+@pytest.mark.unit
+class TestCWADBEpubFixerFiles:
+    """Test the batched library-wide EPUB fixer results"""
+
+    def test_batch_records_fixes_and_file_signatures(self, temp_cwa_db):
+        before = temp_cwa_db.get_stat_totals()['epub_fixes']
+        assert temp_cwa_db.epub_fixer_record_batch(
+            [("a", True, 0, "True", "/lib/a.epub", "No fixes required"),
+             ("b", True, 1, "True", "/lib/b.epub", "01 - Fixed")],
+            [("/lib/a.epub", 10, 100, 1), ("/lib/b.epub", 20, 200, 1)])
+        assert temp_cwa_db.epub_fixer_record_batch([], [("/lib/b.epub", 25, 300, 1)])
+
+        assert temp_cwa_db.get_stat_totals()['epub_fixes'] == before + 2
+        assert temp_cwa_db.get_epub_fixer_files() == {"/lib/a.epub": (10, 100, 1), "/lib/b.epub": (25, 300, 1)}
+
+
+@pytest.mark.unit
+class TestCWADBEnforcerStatus:
+    """Test the long-lived enforcer's published counters"""
+
+    @pytest.fixture(autouse=True)
+    def restore_status(self, temp_cwa_db):
+        # The status is a single row that outlives the test, so put back whatever was there
+        before = temp_cwa_db.get_enforcer_status()
+        yield
+        before.pop('updated_at')
+        temp_cwa_db.update_enforcer_status(**before)
+
+    def test_status_round_trip(self, temp_cwa_db):
+        assert temp_cwa_db.update_enforcer_status(running=1, queue_depth=12, in_flight=2, processed=5, busy_seconds=7.5)
+
+        status = temp_cwa_db.get_enforcer_status()
+        assert (status['running'], status['queue_depth'], status['in_flight'], status['processed']) == (1, 12, 2, 5)
+        assert status['busy_seconds'] == 7.5 and status['updated_at'] is not None
+        with pytest.raises(ValueError):
+            temp_cwa_db.update_enforcer_status(unknown=1)
+
+
 @pytest.mark.unit
 class TestCWADBStatistics:
     """Test statistics aggregation functions."""
@@ -329,6 +584,79 @@ class TestCWADBStatistics:
         assert import_final == import_initial + 1
 
 
+@pytest.mark.unit
+class TestCWADBIngestQueue:
+    """Test the durable ingest queue used by the ingest worker."""
+
+    def _drain(self, db):
+        claimed = []
+        while True:
+            job = db.ingest_queue_claim()
+            if job is None:
+                return claimed
+            claimed.append(job)
+
+    def test_claims_by_priority_then_age(self, temp_cwa_db, tmp_path):
+        """Verify uploads jump ahead of files that were queued earlier."""
+        self._drain(temp_cwa_db)
+        bulk = str(tmp_path / "bulk.epub")
+        upload = str(tmp_path / "upload.epub")
+        temp_cwa_db.ingest_queue_add(bulk)
+        temp_cwa_db.ingest_queue_add(upload, priority=10, source='upload')
+
+        claimed = self._drain(temp_cwa_db)
+        assert [job['filepath'] for job in claimed] == [upload, bulk]
+        assert claimed[0]['source'] == 'upload'
+        assert claimed[0]['attempts'] == 1
+
+    def test_requeue_keeps_higher_priority(self, temp_cwa_db, tmp_path):
+        """Verify the watcher event for an upload doesn't lower its priority."""
+        path = str(tmp_path / "book.epub")
+        temp_cwa_db.ingest_queue_add(path, priority=10, source='upload')
+        temp_cwa_db.ingest_queue_add(path)
+
+        row = temp_cwa_db.cur.execute(
+            "SELECT priority, source, state FROM cwa_ingest_queue WHERE filepath = ?", (path,)
+        ).fetchone()
+        assert row == (10, 'upload', 'pending')
+
+    def test_retry_backoff_delays_next_claim(self, temp_cwa_db, tmp_path):
+        """Verify a retried entry isn't handed out again before its backoff expires."""
+        self._drain(temp_cwa_db)
+        path = str(tmp_path / "retry.epub")
+        temp_cwa_db.ingest_queue_add(path)
+        job = temp_cwa_db.ingest_queue_claim()
+        temp_cwa_db.ingest_queue_retry(job['id'], 3600, "app.db locked")
+
+        assert temp_cwa_db.ingest_queue_claim() is None
+        stats = temp_cwa_db.ingest_queue_stats()
+        assert stats['retrying'] >= 1
+        assert stats['pending'] >= 1
+
+    def test_finish_records_throughput(self, temp_cwa_db, tmp_path):
+        """Verify finished entries count towards throughput and leave the queue."""
+        self._drain(temp_cwa_db)
+        path = str(tmp_path / "done.epub")
+        temp_cwa_db.ingest_queue_add(path)
+        depth_before = temp_cwa_db.ingest_queue_depth()
+        job = temp_cwa_db.ingest_queue_claim()
+        temp_cwa_db.ingest_queue_finish(job['id'], 2.5)
+
+        assert temp_cwa_db.ingest_queue_depth() == depth_before - 1
+        assert temp_cwa_db.ingest_queue_stats()['throughput']['last_5_min']['done'] >= 1
+
+    def test_interrupted_entries_are_requeued(self, temp_cwa_db, tmp_path):
+        """Verify entries left in 'processing' by a crash are picked up again."""
+        self._drain(temp_cwa_db)
+        path = str(tmp_path / "crash.epub")
+        temp_cwa_db.ingest_queue_add(path)
+        temp_cwa_db.ingest_queue_claim()
+
+        assert temp_cwa_db.ingest_queue_requeue_interrupted() >= 1
+        reclaimed = {job['filepath']: job for job in self._drain(temp_cwa_db)}
+        assert reclaimed[path]['attempts'] == 2
+
+
 @pytest.mark.unit
 class TestCWADBErrorHandling:
     """Test database error handling and edge cases."""
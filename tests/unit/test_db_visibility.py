@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+# Calibre-Web Automated – fork of Calibre-Web
+# Copyright (C) 2018-2026 Calibre-Web contributors
+# Copyright (C) 2024-2026 Calibre-Web Automated contributors
+# SPDX-License-Identifier: GPL-3.0-or-later
+# See CONTRIBUTORS for full list of authors.
+
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import create_engine, event, true
+from sqlalchemy.orm import sessionmaker
+
+from cps import db
+
+RESTRICTIONS = ("en", ("",), ("Horror",), ("",), ("",))
+
+
+class _Session:
+    """Answers the visibility pass with fixed (book id, allowed) rows and PRAGMA data_version."""
+
+    def __init__(self):
+        self.passes = 0
+        self.data_version = 1
+
+    def query(self, *entities):
+        self.passes += 1
+        return iter([(1, 1), (2, 0), (3, 1)])
+
+    def execute(self, statement):
+        return SimpleNamespace(scalar=lambda: self.data_version)
+
+
+@pytest.fixture
+def calibre_db(monkeypatch):
+    monkeypatch.setattr(db.CalibreDB, "_visibility_cache", dict())
+    monkeypatch.setattr(db.CalibreDB, "_commit_count", 0)
+    monkeypatch.setattr(db.CalibreDB, "library_generation", 0)
+    monkeypatch.setattr(db.CalibreDB, "config", SimpleNamespace(config_restricted_column=0))
+    monkeypatch.setattr(db.CalibreDB, "_restriction_filter", lambda self, *restrictions: true())
+    calibre = db.CalibreDB()
+    calibre.session = _Session()
+    return calibre
+
+
+@pytest.mark.unit
+class TestVisibilityFilterCache:
+    def test_id_list_is_reused_while_nothing_changed(self, calibre_db):
+        calibre_db._visibility_filter(*RESTRICTIONS)
+        calibre_db._visibility_filter(*RESTRICTIONS)
+        assert calibre_db.session.passes == 1
+
+        # Other restrictions have their own entry
+        calibre_db._visibility_filter("de", *RESTRICTIONS[1:])
+        assert calibre_db.session.passes == 2
+
+    def test_commit_in_this_process_invalidates(self, calibre_db):
+        factory = sessionmaker(bind=create_engine("sqlite://"))
+        event.listen(factory, "after_commit", db.CalibreDB._count_commit)
+        calibre_db._visibility_filter(*RESTRICTIONS)
+
+        session = factory()
+        session.commit()
+        session.close()
+
+        assert db.CalibreDB._commit_count == 1
+        calibre_db._visibility_filter(*RESTRICTIONS)
+        assert calibre_db.session.passes == 2
+
+    def test_write_by_another_process_invalidates(self, calibre_db):
+        calibre_db._visibility_filter(*RESTRICTIONS)
+        calibre_db.session.data_version = 2
+        calibre_db._visibility_filter(*RESTRICTIONS)
+        assert calibre_db.session.passes == 2
+
+    def test_library_generation_bump_invalidates(self, calibre_db):
+        calibre_db._visibility_filter(*RESTRICTIONS)
+        db.CalibreDB.library_generation += 1
+        calibre_db._visibility_filter(*RESTRICTIONS)
+        assert calibre_db.session.passes == 2
+
+
+@pytest.mark.unit
+class TestNotifyLibraryChanged:
+    @pytest.fixture
+    def reconnects(self, monkeypatch):
+        calls = []
+        monkeypatch.setattr(db.CalibreDB, "_init", True)
+        monkeypatch.setattr(db.CalibreDB, "engine", object(), raising=False)
+        monkeypatch.setattr(db.CalibreDB, "library_generation", 0)
+        monkeypatch.setattr(db.CalibreDB, "_cc_signature", ((1, "text"),))
+        monkeypatch.setattr(db.CalibreDB, "reconnect_db", lambda self, config, app_db_path: calls.append(config))
+        return calls
+
+    def test_unchanged_columns_only_bump_the_generation(self, reconnects, monkeypatch):
+        monkeypatch.setattr(db.CalibreDB, "read_cc_signature", staticmethod(lambda path: ((1, "text"),)))
+
+        assert not db.CalibreDB().notify_library_changed(SimpleNamespace(config_calibre_dir="/books"), "app.db")
+        assert reconnects == []
+        assert db.CalibreDB.library_generation == 1
+
+    def test_custom_column_change_rebuilds(self, reconnects, monkeypatch):
+        monkeypatch.setattr(db.CalibreDB, "read_cc_signature",
+                            staticmethod(lambda path: ((1, "text"), (2, "int"))))
+        config = SimpleNamespace(config_calibre_dir="/books")
+
+        assert db.CalibreDB().notify_library_changed(config, "app.db")
+        assert reconnects == [config]
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+# Calibre-Web Automated – fork of Calibre-Web
+# Copyright (C) 2018-2026 Calibre-Web contributors
+# Copyright (C) 2024-2026 Calibre-Web Automated contributors
+# SPDX-License-Identifier: GPL-3.0-or-later
+# See CONTRIBUTORS for full list of authors.
+
+"""Unit tests for the persistent duplicate key index and the Python duplicate scan"""
+
+import json
+import sys
+
+import pytest
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.orm import sessionmaker
+
+from cps import db, duplicates
+
+TITLE_AND_AUTHOR = (True, True, False, False, False, False)
+
+# test_duplicates_timezone leaves stubs of these in sys.modules for the test files after it
+_REAL_MODULES = {name: sys.modules[name] for name in
+                 ("cps", "sqlalchemy", "sqlalchemy.orm", "sqlalchemy.sql", "sqlalchemy.sql.expression")}
+
+
+class _KeyStore:
+    """The cwa_duplicate_keys part of CWA_DB, kept in memory and recording every write"""
+
+    def __init__(self):
+        self.criteria = ''
+        self.keys = {}
+        self.writes = []
+
+    def get_duplicate_keys(self):
+        return self.criteria, dict(self.keys)
+
+    def update_duplicate_keys(self, criteria, rows, deleted_book_ids=(), reset=False):
+        self.writes.append({'rows': list(rows), 'deleted': set(deleted_book_ids), 'reset': reset})
+        if reset:
+            self.keys = {}
+        for book_id in deleted_book_ids:
+            self.keys.pop(book_id, None)
+        for book_id, dup_key, last_modified in rows:
+            self.keys[book_id] = (dup_key, last_modified)
+        self.criteria = criteria
+        return True
+
+
+@pytest.fixture
+def library(monkeypatch):
+    for name, module in _REAL_MODULES.items():
+        monkeypatch.setitem(sys.modules, name, module)
+    engine = create_engine('sqlite://')
+
+    @event.listens_for(engine, 'connect')
+    def attach_calibre(dbapi_con, record):
+        dbapi_con.execute("ATTACH DATABASE ':memory:' AS calibre")
+
+    with engine.begin() as con:
+        # calibre's link table has its own id, which orders the authors of a book
+        con.execute(text("CREATE TABLE books_authors_link (id INTEGER PRIMARY KEY, book INTEGER, author INTEGER)"))
+    db.Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    calibre = db.CalibreDB()
+    calibre.session = session
+    monkeypatch.setattr(duplicates, "calibre_db", calibre)
+    yield session
+    session.close()
+
+
+def _add_book(session, book_id, title, author, last_modified='2026-01-01 00:00:00'):
+    author_id = session.execute(text("SELECT id FROM authors WHERE name = :name"), {'name': author}).scalar()
+    if author_id is None:
+        sort = ", ".join(reversed(author.split(" ", 1)))
+        author_id = session.execute(text("INSERT INTO authors (name, sort, link) VALUES (:name, :sort, '')"),
+                                    {'name': author, 'sort': sort}).lastrowid
+    sort = session.execute(text("SELECT sort FROM authors WHERE id = :id"), {'id': author_id}).scalar()
+    session.execute(text("INSERT INTO books (id, title, sort, author_sort, timestamp, series_index, last_modified, "
+                         "path, has_cover) VALUES (:id, :title, :title, :sort, :stamp, '1.0', :stamp, '', 0)"),
+                    {'id': book_id, 'title': title, 'sort': sort, 'stamp': last_modified})
+    session.execute(text("INSERT INTO books_authors_link (book, author) VALUES (:book, :author)"),
+                    {'book': book_id, 'author': author_id})
+    session.commit()
+
+
+@pytest.fixture
+def keyed_books(library, monkeypatch):
+    _add_book(library, 1, "Dune", "Frank Herbert")
+    _add_book(library, 2, "Dune", "Frank Herbert")
+    _add_book(library, 3, "Emma", "Jane Austen")
+    store = _KeyStore()
+    scanned = []
+    real_scan = duplicates.scan_duplicate_keys
+
+    def scan_duplicate_keys(*criteria, book_ids=None, **kwargs):
+        scanned.append(set(book_ids))
+        return real_scan(*criteria, book_ids=book_ids, **kwargs)
+
+    monkeypatch.setattr(duplicates, "scan_duplicate_keys", scan_duplicate_keys)
+    assert duplicates.refresh_duplicate_keys(*TITLE_AND_AUTHOR, cwa_db=store)['reset']
+    scanned.clear()
+    store.writes.clear()
+    return library, store, scanned
+
+
+@pytest.mark.unit
+class TestRefreshDuplicateKeys:
+    def test_unchanged_library_is_not_rekeyed(self, keyed_books):
+        library, store, scanned = keyed_books
+
+        result = duplicates.refresh_duplicate_keys(*TITLE_AND_AUTHOR, cwa_db=store)
+
+        assert result['changed'] == set() and result['deleted'] == set()
+        assert scanned == [set()]
+        assert store.writes == []
+
+    def test_only_books_with_a_new_last_modified_are_rekeyed(self, keyed_books):
+        library, store, scanned = keyed_books
+        old_key = store.keys[2][0]
+        library.execute(text("UPDATE books SET title = 'Dune Messiah', last_modified = '2026-02-01 00:00:00' "
+                             "WHERE id = 2"))
+        # Book 3 changed too, but its last_modified wasn't bumped
+        library.execute(text("UPDATE books SET title = 'Persuasion' WHERE id = 3"))
+        library.commit()
+
+        result = duplicates.refresh_duplicate_keys(*TITLE_AND_AUTHOR, cwa_db=store)
+
+        assert scanned == [{2}]
+        assert result['changed'] == {2}
+        assert [row[0] for row in store.writes[0]['rows']] == [2]
+        assert not store.writes[0]['reset']
+        new_key = store.keys[2][0]
+        assert json.loads(new_key)[0] == "dune messiah"
+        assert result['affected_keys'] == {old_key, new_key}
+        assert json.loads(store.keys[3][0])[0] == "emma"
+
+    def test_new_and_deleted_books(self, keyed_books):
+        library, store, scanned = keyed_books
+        _add_book(library, 4, "Emma", "Jane Austen")
+        library.execute(text("DELETE FROM books WHERE id = 1"))
+        library.commit()
+
+        result = duplicates.refresh_duplicate_keys(*TITLE_AND_AUTHOR, cwa_db=store)
+
+        assert scanned == [{4}]
+        assert result['deleted'] == {1}
+        assert store.writes[0]['deleted'] == {1}
+        assert set(store.keys) == {2, 3, 4}
+        assert store.keys[4][0] == store.keys[3][0]
+
+    def test_changed_criteria_rekey_every_book(self, keyed_books):
+        library, store, scanned = keyed_books
+
+        result = duplicates.refresh_duplicate_keys(True, False, False, False, False, False, cwa_db=store)
+
+        assert result['reset']
+        assert scanned == [{1, 2, 3}]
+        assert store.writes[0]['reset']
+        assert store.criteria == json.dumps([1, 0, 0, 0, 0, 0])
+        assert {json.loads(key)[0] for key, __ in store.keys.values()} == {"dune", "emma"}
+        assert all(len(json.loads(key)) == 1 for key, __ in store.keys.values())
+
+
+@pytest.mark.unit
+class TestFindDuplicateBooksPython:
+    def test_only_books_in_duplicate_groups_are_hydrated(self, library):
+        _add_book(library, 1, "Dune", "Frank Herbert")
+        _add_book(library, 2, "Dune", "Frank Herbert", last_modified='2026-03-01 00:00:00')
+        _add_book(library, 3, "Dune", "Brian Herbert")
+        _add_book(library, 4, "Emma", "Jane Austen")
+        _add_book(library, 5, "Emma", "Jane Austen")
+        _add_book(library, 6, "Persuasion", "Jane Austen")
+        library.expunge_all()
+        hydrated = []
+        event.listen(library, 'loaded_as_persistent',
+                     lambda session, instance: isinstance(instance, db.Books) and hydrated.append(instance.id))
+
+        groups = duplicates.find_duplicate_books_python(*TITLE_AND_AUTHOR)
+
+        assert sorted(hydrated) == [1, 2, 4, 5]
+        assert [(group['title'], sorted(book.id for book in group['books'])) for group in groups] == \
+            [("Dune", [1, 2]), ("Emma", [4, 5])]
+        assert groups[0]['author'] == "Frank Herbert"
+
+    def test_candidate_ids_limit_keying_and_hydration(self, library, monkeypatch):
+        for book_id in (1, 2, 3):
+            _add_book(library, book_id, "Dune", "Frank Herbert")
+        _add_book(library, 4, "Emma", "Jane Austen")
+        _add_book(library, 5, "Emma", "Jane Austen")
+        library.expunge_all()
+        hydrated = []
+        event.listen(library, 'loaded_as_persistent',
+                     lambda session, instance: isinstance(instance, db.Books) and hydrated.append(instance.id))
+
+        groups = duplicates.find_duplicate_books_python(*TITLE_AND_AUTHOR, candidate_ids={1, 2, 4})
+
+        # Book 4 has no partner among the candidates, so it isn't loaded
+        assert sorted(hydrated) == [1, 2]
+        assert [sorted(book.id for book in group['books']) for group in groups] == [[1, 2]]
+        assert duplicates.find_duplicate_books_python(*TITLE_AND_AUTHOR, candidate_ids=set()) == []
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+# Calibre-Web Automated – fork of Calibre-Web
+# Copyright (C) 2018-2026 Calibre-Web contributors
+# Copyright (C) 2024-2026 Calibre-Web Automated contributors
+# SPDX-License-Identifier: GPL-3.0-or-later
+# See CONTRIBUTORS for full list of authors.
+
+import os
+import time
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+
+from cps import export_cache, fs
+
+
+def _book(**overrides):
+    book = SimpleNamespace(
+        id=7, title="Dune", sort="Dune", author_sort="Herbert, Frank",
+        authors=[SimpleNamespace(name="Frank Herbert")], tags=[], series=[], series_index=1.0,
+        publishers=[], languages=[SimpleNamespace(lang_code="eng")], identifiers=[], comments=[],
+        ratings=[], pubdate=datetime(1965, 8, 1), has_cover=1, uuid="abc",
+        last_modified=datetime(2026, 1, 2, 3, 4, 5),
+    )
+    for name, value in overrides.items():
+        setattr(book, name, value)
+    return book
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(fs.FileSystem, "_cache_dir", str(tmp_path))
+    return tmp_path
+
+
+@pytest.mark.unit
+class TestExportKey:
+    def test_stable_for_same_inputs(self):
+        assert export_cache.export_key(_book(), "epub", [10, 20]) == export_cache.export_key(_book(), "epub", [10, 20])
+
+    def test_changes_with_metadata_file_and_variant(self):
+        base = export_cache.export_key(_book(), "epub", [10, 20])
+        assert export_cache.export_key(_book(title="Dune Messiah"), "epub", [10, 20]) != base
+        assert export_cache.export_key(_book(), "epub", [11, 20]) != base
+        assert export_cache.export_key(_book(), "epub", [10, 20], "de") != base
+        assert export_cache.export_key(_book(last_modified=datetime(2026, 1, 3)), "epub", [10, 20]) != base
+        assert export_cache.export_key(_book(), "epub", [10, 20]).startswith("7-epub-20260102030405-")
+
+
+@pytest.mark.unit
+class TestExportCacheStore:
+    def test_store_then_lookup(self, cache_dir, tmp_path):
+        exported = tmp_path / "export.epub"
+        exported.write_bytes(b"book")
+
+        entry = export_cache.store("k1", str(exported), "Dune - Frank Herbert", "epub")
+
+        assert entry == export_cache.lookup("k1", "Dune - Frank Herbert", "epub")
+        assert (cache_dir / "exports" / "k1" / "Dune - Frank Herbert.epub").read_bytes() == b"book"
+        assert not exported.exists()
+        assert export_cache.lookup("k2", "Dune - Frank Herbert", "epub") is None
+
+    def test_evicts_least_recently_used(self, cache_dir, tmp_path):
+        for key in ("old", "new"):
+            exported = tmp_path / (key + ".epub")
+            exported.write_bytes(b"x" * 100)
+            export_cache.store(key, str(exported), "book", "epub")
+        past = time.time() - 60
+        os.utime(cache_dir / "exports" / "old", (past, past))
+
+        export_cache.evict(max_bytes=150)
+
+        assert export_cache.lookup("old", "book", "epub") is None
+        assert export_cache.lookup("new", "book", "epub") is not None
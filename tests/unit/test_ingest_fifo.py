@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+# Calibre-Web Automated – fork of Calibre-Web
+# Copyright (C) 2018-2026 Calibre-Web contributors
+# Copyright (C) 2024-2026 Calibre-Web Automated contributors
+# SPDX-License-Identifier: GPL-3.0-or-later
+# See CONTRIBUTORS for full list of authors.
+
+import os
+
+import pytest
+
+from cps import cwa_functions
+
+
+@pytest.fixture
+def fifo(tmp_path, monkeypatch):
+    path = str(tmp_path / "cwa_ingest.fifo")
+    os.mkfifo(path)
+    monkeypatch.setattr(cwa_functions, "INGEST_FIFO", path)
+    return path
+
+
+@pytest.mark.unit
+class TestIngestWorkerListening:
+    def test_stale_fifo_is_not_listening(self, fifo, monkeypatch):
+        monkeypatch.setattr(cwa_functions, "CWA_DB", lambda: pytest.fail("queued an upload nothing drains"))
+        assert not cwa_functions.is_ingest_worker_listening()
+        cwa_functions.queue_upload_for_ingest("/ingest/book.epub")
+        assert not cwa_functions.submit_to_ingest_worker("/ingest/book.epub")
+
+    def test_fifo_with_reader_is_listening(self, fifo):
+        reader = os.open(fifo, os.O_RDONLY | os.O_NONBLOCK)
+        try:
+            assert cwa_functions.is_ingest_worker_listening()
+            assert cwa_functions.submit_to_ingest_worker("/ingest/book.epub")
+            assert os.read(reader, 100) == b"/ingest/book.epub\n"
+        finally:
+            os.close(reader)
+
+    def test_missing_fifo_is_not_listening(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(cwa_functions, "INGEST_FIFO", str(tmp_path / "missing.fifo"))
+        assert not cwa_functions.is_ingest_worker_listening()
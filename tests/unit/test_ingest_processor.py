@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+# Calibre-Web Automated – fork of Calibre-Web
+# Copyright (C) 2018-2026 Calibre-Web contributors
+# Copyright (C) 2024-2026 Calibre-Web Automated contributors
+# SPDX-License-Identifier: GPL-3.0-or-later
+# See CONTRIBUTORS for full list of authors.
+
+import contextlib
+import fcntl
+import os
+import sqlite3
+import threading
+import time
+from unittest import mock
+
+import pytest
+
+import ingest_processor
+
+
+@pytest.fixture
+def lock_paths(tmp_path):
+    return str(tmp_path / "ingest_processor.lock"), str(tmp_path / "restore_calibre_db.lock")
+
+
+def _try_exclusive(lock_path):
+    with open(lock_path, "a") as lock_file:
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return False
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+        return True
+
+
+@pytest.mark.unit
+class TestIngestJobLock:
+    def test_jobs_share_the_lock_and_block_exclusive_holders(self, lock_paths):
+        with ingest_processor.ingest_job_lock(*lock_paths):
+            with ingest_processor.ingest_job_lock(*lock_paths):
+                assert not _try_exclusive(lock_paths[0])
+        assert _try_exclusive(lock_paths[0])
+
+    def test_jobs_wait_for_restore(self, lock_paths):
+        lock_path, restore_path = lock_paths
+        open(restore_path, "w").close()
+        started = threading.Event()
+
+        def job():
+            with ingest_processor.ingest_job_lock(lock_path, restore_path):
+                started.set()
+
+        worker = threading.Thread(target=job, daemon=True)
+        worker.start()
+        assert not started.wait(1.5)
+
+        os.remove(restore_path)
+        assert started.wait(5)
+        worker.join(5)
+
+
+@pytest.mark.unit
+class TestCalibredbAddParsing:
+    def test_parse_book_ids_collects_every_reported_id(self):
+        output = ("Added book ids: 12, 13\n"
+                  "Merged book id: 7\n"
+                  "The following books were not added as they already exist in the database\n"
+                  "Updated book ids: 13, 14")
+        assert ingest_processor.parse_book_ids(output) == [12, 13, 7, 14]
+        assert ingest_processor.parse_book_ids("nothing added") == []
+
+    def test_files_are_matched_by_format_and_size(self):
+        files = [("EPUB", 100), ("EPUB", 200), ("PDF", 100)]
+        rows = [(31, "PDF", 100), (30, "EPUB", 200), (29, "EPUB", 100)]
+        assert ingest_processor.map_added_ids_to_files(files, rows) == [29, 30, 31]
+
+    def test_identical_files_fall_back_to_argument_order(self):
+        files = [("EPUB", 100), ("EPUB", 100), ("PDF", 50)]
+        rows = [(41, "EPUB", 100), (40, "EPUB", 100), (42, "PDF", 50)]
+        assert ingest_processor.map_added_ids_to_files(files, rows) == [40, 41, 42]
+
+    def test_ambiguous_leftovers_stay_unmapped(self):
+        # Only one id for two identical files, e.g. calibredb merged one into an existing book
+        files = [("EPUB", 100), ("EPUB", 100)]
+        assert ingest_processor.map_added_ids_to_files(files, [(50, "EPUB", 100)]) == [None, None]
+
+
+@pytest.fixture
+def processor(tmp_path, monkeypatch):
+    nbp = object.__new__(ingest_processor.NewBookProcessor)
+    original = tmp_path / "book.pdf"
+    original.write_bytes(b"%PDF")
+    metadata_db = tmp_path / "metadata.db"
+    with sqlite3.connect(metadata_db) as con:
+        con.execute("CREATE TABLE books (id INTEGER PRIMARY KEY, timestamp TEXT)")
+        con.execute("INSERT INTO books VALUES (7, '2026-01-01 00:00:00')")
+    nbp.__dict__.update(filepath=str(original), filename=original.name, target_format="epub",
+                        is_kindle_epub_fixer=False, staging_dir=str(tmp_path), metadata_db=str(metadata_db),
+                        library_dir=str(tmp_path), calibre_env={},
+                        cwa_settings={'auto_ingest_automerge': 'new_record', 'auto_backup_imports': False},
+                        db=mock.MagicMock(), last_added_book_id=None, last_added_book_ids=[],
+                        book_id_unknown=False, touched_book_ids=set())
+    for name in ("backup", "add_format_to_book", "fetch_metadata_if_enabled", "trigger_auto_send_if_enabled",
+                 "refresh_cwa_session", "invalidate_duplicate_cache", "schedule_debounced_duplicate_scan",
+                 "generate_book_checksums", "build_spine_index"):
+        monkeypatch.setattr(nbp, name, mock.MagicMock())
+    monkeypatch.setattr(ingest_processor, "gdrive_sync_if_enabled", lambda: None)
+    monkeypatch.setattr(ingest_processor.library_add_batcher, "add", lambda *args: [])
+    converted = tmp_path / "converted" / "book.epub"
+    converted.parent.mkdir()
+    converted.write_bytes(b"epub")
+    return nbp, str(converted)
+
+
+@pytest.mark.unit
+class TestRetainedFormat:
+    def test_unmapped_batched_add_keeps_the_original_off_other_books(self, processor, monkeypatch):
+        nbp, converted = processor
+        monkeypatch.setattr(ingest_processor.library_add_batcher, "window_seconds", 1.0)
+        monkeypatch.setattr(ingest_processor.library_add_batcher, "max_batch", 2)
+
+        nbp.add_book_to_library(converted)
+        nbp.add_retained_format(nbp.filepath)
+
+        assert nbp.book_id_unknown
+        nbp.fetch_metadata_if_enabled.assert_not_called()
+        nbp.add_format_to_book.assert_not_called()
+        nbp.backup.assert_called_once_with(nbp.filepath, backup_type="failed")
+
+    def test_without_batching_the_newest_book_is_used(self, processor, monkeypatch):
+        nbp, converted = processor
+        monkeypatch.setattr(ingest_processor.library_add_batcher, "window_seconds", 0.0)
+        monkeypatch.setattr(nbp, "_fallback_last_added_book_id", lambda: None)
+
+        nbp.add_book_to_library(converted)
+        nbp.add_retained_format(nbp.filepath)
+
+        assert not nbp.book_id_unknown
+        nbp.add_format_to_book.assert_called_once_with(7, nbp.filepath)
+
+
+@pytest.fixture
+def ingest_worker(temp_cwa_db, monkeypatch):
+    worker = object.__new__(ingest_processor.IngestWorker)
+    worker.__dict__.update(_local=threading.local(), _lock=threading.Lock(), _active=0, files_processed=0,
+                           total_seconds=0.0, max_seconds=0.0, settings=temp_cwa_db.cwa_settings)
+    worker._local.db = temp_cwa_db
+    monkeypatch.setattr(worker, "write_status", lambda *args: None)
+    monkeypatch.setattr(ingest_processor, "ingest_job_lock", contextlib.nullcontext)
+    return worker
+
+
+def _queue_state(db, row_id):
+    return db.cur.execute("SELECT state, next_attempt_at FROM cwa_ingest_queue WHERE id = ?", (row_id,)).fetchone()
+
+
+@pytest.mark.unit
+class TestIngestWorkerRetries:
+    def test_file_that_was_not_ready_is_retried_later(self, ingest_worker, temp_cwa_db, tmp_path, monkeypatch):
+        book = tmp_path / "still-copying.epub"
+        book.write_bytes(b"epub")
+        temp_cwa_db.ingest_queue_add(str(book))
+        job = temp_cwa_db.ingest_queue_claim()
+        monkeypatch.setattr(ingest_processor, "main", lambda filepath, db=None: False)
+
+        success, error, elapsed = ingest_worker.process(job)
+        ingest_worker._finish(temp_cwa_db, job, success, error, elapsed)
+
+        state, next_attempt_at = _queue_state(temp_cwa_db, job['id'])
+        assert not success
+        assert state == 'pending'
+        assert next_attempt_at > time.time() + ingest_processor.ingest_retry_delay(1) - 5
+        # Not claimable again until the backoff has passed
+        claimed = iter(temp_cwa_db.ingest_queue_claim, None)
+        assert job['id'] not in [entry['id'] for entry in claimed]
+
+    def test_finished_file_is_done(self, ingest_worker, temp_cwa_db, tmp_path, monkeypatch):
+        book = tmp_path / "imported.epub"
+        book.write_bytes(b"epub")
+        temp_cwa_db.ingest_queue_add(str(book))
+        job = temp_cwa_db.ingest_queue_claim()
+        monkeypatch.setattr(ingest_processor, "main", lambda filepath, db=None: os.remove(filepath))
+
+        ingest_worker._finish(temp_cwa_db, job, *ingest_worker.process(job))
+
+        assert _queue_state(temp_cwa_db, job['id'])[0] == 'done'
+
+
+class _StageTracker:
+    """Stands in for the external tools and records how many of each ran at the same time"""
+    STAGES = {"ebook-convert": "convert", "kepubify": "convert", "fixer": "epub_fixer", "calibredb": "library_write"}
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = {}
+        self.peak = {}
+        self.overlapped_add = False
+
+    def running(self, tool):
+        stage = self.STAGES[tool]
+        with self.lock:
+            for name in (tool, stage):
+                self.active[name] = self.active.get(name, 0) + 1
+                self.peak[name] = max(self.peak.get(name, 0), self.active[name])
+            if self.active.get("library_write") and sum(self.active.get(other, 0) for other in
+                                                        ("convert", "epub_fixer")):
+                self.overlapped_add = True
+        time.sleep(0.2)
+        with self.lock:
+            for name in (tool, stage):
+                self.active[name] -= 1
+
+    def run(self, args, **kwargs):
+        self.running(args[0])
+        return mock.Mock(stdout="Added book ids: 1", stderr="", returncode=0)
+
+
+@pytest.fixture
+def stage_tracker(monkeypatch):
+    tracker = _StageTracker()
+    monkeypatch.setattr(ingest_processor, "_stage_semaphores", {
+        "convert": threading.BoundedSemaphore(2),
+        "epub_fixer": threading.BoundedSemaphore(2),
+        "checksum": threading.BoundedSemaphore(2),
+        "library_write": threading.BoundedSemaphore(1),
+    })
+    monkeypatch.setattr(ingest_processor.subprocess, "run", tracker.run)
+    fixer = mock.Mock()
+    fixer.return_value.process.side_effect = lambda **kwargs: tracker.running("fixer")
+    monkeypatch.setattr(ingest_processor, "EPUBFixer", fixer)
+    monkeypatch.setattr(ingest_processor.library_add_batcher, "window_seconds", 0.0)
+    return tracker
+
+
+def _book_processor(tmp_path, name, input_format):
+    nbp = object.__new__(ingest_processor.NewBookProcessor)
+    nbp.__dict__.update(filepath=str(tmp_path / f"{name}.{input_format}"), filename=f"{name}.{input_format}",
+                        input_format=input_format, target_format="epub", tmp_conversion_dir=str(tmp_path) + "/",
+                        calibre_env={}, cwa_settings={'auto_backup_conversions': False}, db=mock.MagicMock())
+    return nbp
+
+
+@pytest.mark.unit
+class TestIngestStages:
+    def test_library_writes_are_serialized_while_other_stages_run_in_parallel(self, stage_tracker, tmp_path):
+        jobs = []
+        for i in range(4):
+            jobs.append(_book_processor(tmp_path, f"convert{i}", "mobi").convert_book)
+            jobs.append(_book_processor(tmp_path, f"kepub{i}", "epub").convert_to_kepub)
+            jobs.append(lambda i=i: _book_processor(tmp_path, f"fix{i}", "epub").run_kindle_epub_fixer(
+                str(tmp_path / f"fix{i}.epub")))
+            jobs.append(lambda i=i: ingest_processor.library_add_batcher.add(
+                str(tmp_path / f"add{i}.epub"), "new_record", str(tmp_path), {}))
+        threads = [threading.Thread(target=job, daemon=True) for job in jobs]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+
+        assert stage_tracker.peak["calibredb"] == 1
+        # ebook-convert and kepubify share the convert stage and fill it, but never exceed it
+        assert stage_tracker.peak["convert"] == 2
+        assert stage_tracker.peak["epub_fixer"] == 2
+        assert stage_tracker.overlapped_add
+
+    def test_stage_limits_follow_the_worker_count(self):
+        limits = ingest_processor.INGEST_STAGE_LIMITS
+        assert limits["library_write"] == 1
+        assert limits["convert"] == limits["epub_fixer"] == limits["checksum"] == ingest_processor.INGEST_WORKERS
+        for name, limit in limits.items():
+            semaphore = ingest_processor._stage_semaphores[name]
+            assert all(semaphore.acquire(blocking=False) for _ in range(limit))
+            assert not semaphore.acquire(blocking=False)
+            for _ in range(limit):
+                semaphore.release()
+
+    def test_worker_pool_runs_at_most_workers_jobs_at_once(self, tmp_path, monkeypatch):
+        jobs = []
+        for i in range(6):
+            book = tmp_path / f"book{i}.epub"
+            book.write_bytes(b"epub")
+            jobs.append({'id': i, 'filepath': str(book), 'attempts': 1})
+        queue_lock = threading.Lock()
+        # The pool threads outlive the test, so they get a queue of their own rather than cwa.db
+        queue = mock.Mock()
+        queue.ingest_queue_claim.side_effect = lambda: jobs.pop(0) if jobs else None
+        queue.ingest_queue_depth.side_effect = lambda: len(jobs)
+        pool = object.__new__(ingest_processor.IngestWorker)
+        pool.__dict__.update(workers=2, _lock=threading.Lock(), _wakeup=threading.Event(), _active=0)
+        active, peak, finished = [0], [0], []
+        all_finished = threading.Event()
+
+        def process(job):
+            with queue_lock:
+                active[0] += 1
+                peak[0] = max(peak[0], active[0])
+            time.sleep(0.2)
+            with queue_lock:
+                active[0] -= 1
+            return True, "", 0.2
+
+        def finish(db, job, success, error, elapsed):
+            finished.append(job['id'])
+            if len(finished) == 6:
+                all_finished.set()
+
+        monkeypatch.setattr(pool, "_thread_db", lambda: queue)
+        monkeypatch.setattr(pool, "process", process)
+        monkeypatch.setattr(pool, "_finish", finish)
+        monkeypatch.setattr(pool, "write_status", lambda *args: None)
+        monkeypatch.setattr(ingest_processor.library_add_batcher, "window_seconds",
+                            ingest_processor.library_add_batcher.window_seconds)
+        monkeypatch.setattr(ingest_processor.library_add_batcher, "max_batch",
+                            ingest_processor.library_add_batcher.max_batch)
+
+        pool.start_workers()
+
+        assert all_finished.wait(10)
+        assert sorted(finished) == list(range(6))
+        assert peak[0] == 2
+        assert ingest_processor.library_add_batcher.max_batch == min(ingest_processor.INGEST_BATCH_SIZE, 2)
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+# Calibre-Web Automated – fork of Calibre-Web
+# Copyright (C) 2018-2026 Calibre-Web contributors
+# Copyright (C) 2024-2026 Calibre-Web Automated contributors
+# SPDX-License-Identifier: GPL-3.0-or-later
+# See CONTRIBUTORS for full list of authors.
+
+import os
+import zipfile
+
+import pytest
+
+import kindle_epub_fixer
+
+CONTAINER = """<?xml version="1.0" encoding="utf-8"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+  <rootfiles><rootfile full-path="content.opf" media-type="application/oebps-package+xml"/></rootfiles>
+</container>"""
+
+OPF = """<?xml version="1.0" encoding="utf-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="2.0">
+  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/"><dc:language>en</dc:language></metadata>
+  <manifest><item id="c1" href="one.xhtml" media-type="application/xhtml+xml"/></manifest>
+  <spine><itemref idref="c1"/></spine>
+</package>"""
+
+CHAPTER = """<?xml version="1.0" encoding="utf-8"?>
+<html xmlns="http://www.w3.org/1999/xhtml"><body><p>Hello</p></body></html>"""
+
+
+class _FakeCWADB:
+    cwa_settings = {'kindle_epub_fixer_aggressive': 0, 'auto_backup_epub_fixes': 0}
+    checked_files = {}
+    batches = []
+
+    def epub_fixer_add_entry(self, *args):
+        pass
+
+    def get_epub_fixer_files(self):
+        return dict(self.checked_files)
+
+    def epub_fixer_record_batch(self, fixes, files):
+        self.batches.append((list(fixes), list(files)))
+        for path, size, mtime, version in files:
+            self.checked_files[path] = (size, mtime, version)
+        return True
+
+
+def _make_epub(path, chapter=CHAPTER):
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("mimetype", "application/epub+zip", compress_type=zipfile.ZIP_STORED)
+        zf.writestr("META-INF/container.xml", CONTAINER)
+        zf.writestr("content.opf", OPF)
+        zf.writestr("one.xhtml", chapter)
+        zf.writestr("images/cover.jpg", b"\xff\xd8\xff" + os.urandom(4096))
+
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    monkeypatch.setattr(kindle_epub_fixer, "CWA_DB", _FakeCWADB)
+    monkeypatch.setattr(_FakeCWADB, "checked_files", {})
+    monkeypatch.setattr(_FakeCWADB, "batches", [])
+    return _FakeCWADB
+
+
+@pytest.fixture
+def fixer(fake_db):
+    return kindle_epub_fixer.EPUBFixer()
+
+
+@pytest.mark.unit
+class TestEPUBFixerWrites:
+    def test_clean_epub_is_not_rewritten(self, fixer, tmp_path):
+        epub = tmp_path / "clean.epub"
+        _make_epub(epub)
+        before = (epub.read_bytes(), os.stat(epub).st_mtime_ns)
+        fixer.write_epub = lambda *args: pytest.fail("clean EPUB rewritten")
+
+        fixer.process(str(epub))
+        assert (epub.read_bytes(), os.stat(epub).st_mtime_ns) == before
+
+    def test_rewrite_copies_unchanged_entries_raw(self, fixer, tmp_path):
+        epub = tmp_path / "broken.epub"
+        _make_epub(epub, chapter=CHAPTER.replace("<p>Hello</p>", "<p>Hello</p><img alt='x'/>"))
+        with zipfile.ZipFile(epub) as zf:
+            cover_before = zf.getinfo("images/cover.jpg")
+            cover_bytes = zf.read("images/cover.jpg")
+
+        fixer.process(str(epub))
+        assert fixer.fixed_problems
+
+        with zipfile.ZipFile(epub) as zf:
+            assert zf.testzip() is None
+            assert zf.namelist()[0] == "mimetype"
+            assert zf.getinfo("mimetype").compress_type == zipfile.ZIP_STORED
+            assert "<img" not in zf.read("one.xhtml").decode("utf-8")
+            cover = zf.getinfo("images/cover.jpg")
+            assert (cover.compress_size, cover.CRC) == (cover_before.compress_size, cover_before.CRC)
+            assert zf.read("images/cover.jpg") == cover_bytes
+        assert [name for name in os.listdir(tmp_path) if name.startswith(".cwa-epub-fixer-")] == []
+
+
+@pytest.mark.unit
+class TestEPUBFixerLibraryRun:
+    def test_results_batched_and_unchanged_files_skipped(self, fake_db, tmp_path, monkeypatch):
+        monkeypatch.setattr(kindle_epub_fixer, "DB_BATCH_SIZE", 2)
+        epubs = []
+        for count in range(3):
+            epub = tmp_path / f"book{count}.epub"
+            _make_epub(epub)
+            epubs.append(str(epub))
+
+        to_fix = kindle_epub_fixer.get_epubs_to_fix(fake_db(), epubs)
+        assert to_fix == epubs
+        assert kindle_epub_fixer.fix_library(to_fix, "en", workers=2) == {}
+
+        assert [len(fixes) for fixes, _ in fake_db.batches] == [2, 1]
+        assert kindle_epub_fixer.get_epubs_to_fix(fake_db(), epubs) == []
+
+        os.utime(epubs[1], ns=(0, 0))
+        assert kindle_epub_fixer.get_epubs_to_fix(fake_db(), epubs) == [epubs[1]]
+        monkeypatch.setattr(kindle_epub_fixer, "FIXER_VERSION", kindle_epub_fixer.FIXER_VERSION + 1)
+        assert kindle_epub_fixer.get_epubs_to_fix(fake_db(), epubs) == epubs
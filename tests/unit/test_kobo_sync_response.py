@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+# Calibre-Web Automated – fork of Calibre-Web
+# Copyright (C) 2018-2026 Calibre-Web contributors
+# Copyright (C) 2024-2026 Calibre-Web Automated contributors
+# SPDX-License-Identifier: GPL-3.0-or-later
+# See CONTRIBUTORS for full list of authors.
+
+"""Unit tests for building the Kobo /v1/library/sync response"""
+
+import json
+from time import perf_counter
+from types import SimpleNamespace
+from unittest import mock
+
+import pytest
+from werkzeug.test import EnvironBuilder
+
+from cps import app, kobo
+from cps.services.SyncToken import SyncToken
+
+
+@pytest.fixture
+def sync_context():
+    activity = mock.MagicMock()
+    with app.request_context(EnvironBuilder(path="/kobo/token/v1/library/sync").get_environ()), \
+            mock.patch.object(kobo, "current_user", SimpleNamespace(id=3, name="reader")), \
+            mock.patch.object(kobo.config, "config_kobo_proxy", False, create=True), \
+            mock.patch("scripts.cwa_db.CWA_DB", return_value=activity):
+        yield activity
+
+
+@pytest.mark.unit
+class TestGenerateSyncResponse:
+    def test_sync_timing_is_logged(self, sync_context):
+        results = [{"NewEntitlement": {}}]
+        response = kobo.generate_sync_response(SyncToken(), results, sync_timing=(perf_counter(), "refreshed", 2.5))
+
+        assert response.status_code == 200
+        assert json.loads(response.get_data(as_text=True)) == results
+        assert SyncToken.SYNC_TOKEN_HEADER in response.headers
+        extra = json.loads(sync_context.log_activity.call_args.kwargs["extra_data"])
+        assert (extra["books_synced"], extra["db_refresh"], extra["db_refresh_ms"]) == (1, "refreshed", 2.5)
+
+    def test_continued_sync_without_timing(self, sync_context):
+        response = kobo.generate_sync_response(SyncToken(), [], set_cont=True)
+
+        assert response.headers["x-kobo-sync"] == "continue"
+        extra = json.loads(sync_context.log_activity.call_args.kwargs["extra_data"])
+        assert extra["db_refresh"] == "skipped"
@@ -0,0 +1,102 @@
+# Calibre-Web Automated – fork of Calibre-Web
+# Copyright (C) 2018-2026 Calibre-Web contributors
+# Copyright (C) 2024-2026 Calibre-Web Automated contributors
+# SPDX-License-Identifier: GPL-3.0-or-later
+# See CONTRIBUTORS for full list of authors.
+
+"""
+Unit Tests for Library Ownership Fix-up
+
+These tests verify that imports only chown the book folders they touched and that
+the full audit only changes entries whose owner is wrong.
+"""
+
+import os
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+scripts_dir = Path(__file__).parent.parent.parent / "scripts"
+sys.path.insert(0, str(scripts_dir))
+
+import library_permissions
+
+OWNER = (4242, 4242)
+OTHER = (4343, 4343)
+
+pytestmark = pytest.mark.skipif(os.geteuid() != 0, reason="chown to arbitrary ids needs root")
+
+
+@pytest.fixture
+def library(tmp_path, monkeypatch):
+    monkeypatch.setattr(library_permissions, "library_owner", lambda: OWNER)
+    monkeypatch.delenv("NETWORK_SHARE_MODE", raising=False)
+    for book in ("Author A/Book One (1)", "Author A/Book Two (2)", "Author B/Book Three (3)"):
+        book_dir = tmp_path / book
+        book_dir.mkdir(parents=True)
+        (book_dir / "cover.jpg").write_bytes(b"x")
+    (tmp_path / "metadata.db").write_bytes(b"")
+    for root, dirs, files in os.walk(tmp_path):
+        for name in dirs + files:
+            os.chown(os.path.join(root, name), *OTHER)
+    return tmp_path
+
+
+def _owner(path: Path) -> tuple[int, int]:
+    st = os.lstat(path)
+    return st.st_uid, st.st_gid
+
+
+@pytest.mark.unit
+class TestFixBookDirs:
+    def test_only_touched_book_is_changed(self, library):
+        stats = library_permissions.fix_book_dirs(str(library), [str(library / "Author A/Book One (1)")])
+
+        assert _owner(library / "Author A/Book One (1)/cover.jpg") == OWNER
+        assert _owner(library / "Author A") == OWNER
+        assert _owner(library / "metadata.db") == OWNER
+        assert _owner(library / "Author A/Book Two (2)/cover.jpg") == OTHER
+        assert _owner(library / "Author B") == OTHER
+        assert stats.changed == 4
+
+    def test_paths_outside_library_are_ignored(self, library, tmp_path_factory):
+        outside = tmp_path_factory.mktemp("outside")
+        os.chown(outside, *OTHER)
+
+        library_permissions.fix_book_dirs(str(library), [str(outside)])
+
+        assert _owner(outside) == OTHER
+
+    def test_network_share_mode_skips(self, library, monkeypatch):
+        monkeypatch.setenv("NETWORK_SHARE_MODE", "true")
+
+        assert library_permissions.fix_book_dirs(str(library), [str(library / "Author B/Book Three (3)")]) is None
+        assert _owner(library / "Author B/Book Three (3)") == OTHER
+
+
+@pytest.mark.unit
+class TestAuditLibrary:
+    def test_changes_only_wrong_entries(self, library):
+        os.chown(library / "Author B", *OWNER)
+
+        stats = library_permissions.audit_library(str(library))
+
+        assert stats.checked == 10
+        assert stats.changed == 9
+        assert stats.errors == 0
+        for root, dirs, files in os.walk(library):
+            for name in dirs + files:
+                assert _owner(Path(root) / name) == OWNER
+
+    def test_changed_since_finds_new_book_folders(self, library):
+        since = time.time() - 1
+        new_book = library / "Author B" / "New Book (4)"
+        new_book.mkdir()
+        old = since - 3600
+        for path in (library / "Author A", library / "Author A/Book One (1)", library / "Author A/Book Two (2)",
+                     library / "Author B/Book Three (3)"):
+            os.utime(path, (old, old))
+
+        assert library_permissions.book_dirs_changed_since(str(library), since) == [str(new_book)]
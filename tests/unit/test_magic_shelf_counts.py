@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+# Calibre-Web Automated – fork of Calibre-Web
+# Copyright (C) 2018-2026 Calibre-Web contributors
+# Copyright (C) 2024-2026 Calibre-Web Automated contributors
+# SPDX-License-Identifier: GPL-3.0-or-later
+# See CONTRIBUTORS for full list of authors.
+
+"""Unit tests for the per-user magic shelf sidebar counts"""
+
+import sys
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+import cps
+from cps import magic_shelf, ub
+
+READ_RULES = {'condition': 'AND', 'rules': [{'id': 'read_status', 'operator': 'equal', 'value': 1}]}
+TAG_RULES = {'condition': 'AND', 'rules': [{'id': 'tags', 'operator': 'equal', 'value': 'sf'}]}
+
+# test_duplicates_timezone leaves stubs of these in sys.modules for the test files after it
+_REAL_MODULES = {name: sys.modules[name] for name in
+                 ("cps", "sqlalchemy", "sqlalchemy.orm", "sqlalchemy.sql", "sqlalchemy.sql.expression")}
+
+
+class _FakeCalibreDB:
+    def __init__(self):
+        self.stamp = (1, 0, 0)
+
+    def ensure_session(self):
+        pass
+
+    def visibility_key(self):
+        return None
+
+    def library_change_stamp(self):
+        return self.stamp
+
+
+@pytest.fixture
+def app_db(monkeypatch):
+    for name, module in _REAL_MODULES.items():
+        monkeypatch.setitem(sys.modules, name, module)
+    engine = create_engine('sqlite://')
+    ub.Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    monkeypatch.setattr(ub, "session", session)
+    monkeypatch.setattr(magic_shelf, "current_user", SimpleNamespace(id=1))
+    monkeypatch.setattr(cps.config, "config_read_column", 0, raising=False)
+    monkeypatch.setattr(cps.config, "config_restricted_column", 0, raising=False)
+    monkeypatch.setattr(magic_shelf, "_count_cache", magic_shelf.OrderedDict())
+    yield session
+    session.close()
+
+
+@pytest.fixture
+def shelves():
+    return [SimpleNamespace(id=1, user_id=2, rules=dict(READ_RULES)),
+            SimpleNamespace(id=2, user_id=1, rules=dict(TAG_RULES))]
+
+
+@pytest.mark.unit
+class TestCountsKey:
+    def test_key_follows_everything_counts_depend_on(self, app_db, shelves):
+        cdb = _FakeCalibreDB()
+        key = magic_shelf._counts_key(shelves, cdb)
+        assert magic_shelf._counts_key(shelves, cdb) == key
+
+        # Read books of the owner of a read-status shelf
+        app_db.add(ub.ReadBook(user_id=2, book_id=5, read_status=ub.ReadBook.STATUS_FINISHED))
+        app_db.commit()
+        changed = magic_shelf._counts_key(shelves, cdb)
+        assert changed != key
+
+        # Read books of users whose shelves don't use the read status don't matter
+        app_db.add(ub.ReadBook(user_id=1, book_id=5, read_status=ub.ReadBook.STATUS_FINISHED))
+        app_db.commit()
+        assert magic_shelf._counts_key(shelves, cdb) == changed
+
+        # The viewer archiving a book, even one archived before
+        archived = ub.ArchivedBook(user_id=1, book_id=7, is_archived=True,
+                                   last_modified=datetime.now(timezone.utc) - timedelta(days=1))
+        app_db.add(archived)
+        app_db.commit()
+        key = magic_shelf._counts_key(shelves, cdb)
+        assert key != changed
+        archived.is_archived = False
+        archived.last_modified = datetime.now(timezone.utc)
+        app_db.commit()
+        changed = magic_shelf._counts_key(shelves, cdb)
+        assert changed != key
+
+        # Rule edits and library changes
+        shelves[1].rules = {'condition': 'AND', 'rules': [{'id': 'tags', 'operator': 'equal', 'value': 'fantasy'}]}
+        key = magic_shelf._counts_key(shelves, cdb)
+        assert key != changed
+        cdb.stamp = (2, 0, 0)
+        assert magic_shelf._counts_key(shelves, cdb) != key
+
+
+@pytest.mark.unit
+class TestBookCountsCache:
+    def test_counts_reused_until_key_changes(self, app_db, shelves, monkeypatch):
+        cdb = _FakeCalibreDB()
+        evaluated = []
+
+        def matching(shelf, _cdb, any_order=False):
+            evaluated.append(shelf.id)
+            return (10, 11, 12) if shelf.id == 1 else (11,)
+
+        monkeypatch.setattr(cps, "calibre_db", cdb)
+        monkeypatch.setattr(magic_shelf, "_matching_book_ids", matching)
+        app_db.add(ub.ArchivedBook(user_id=1, book_id=11, is_archived=True))
+        app_db.commit()
+
+        assert magic_shelf.get_book_counts_for_magic_shelves(shelves) == {1: 2, 2: 0}
+        assert magic_shelf.get_book_counts_for_magic_shelves(shelves) == {1: 2, 2: 0}
+        assert evaluated == [1, 2]
+
+        cdb.stamp = (2, 0, 0)
+        assert magic_shelf.get_book_counts_for_magic_shelves(shelves) == {1: 2, 2: 0}
+        assert evaluated == [1, 2, 1, 2]
+
+        # Another user has their own entry
+        monkeypatch.setattr(magic_shelf, "current_user", SimpleNamespace(id=3))
+        assert magic_shelf.get_book_counts_for_magic_shelves(shelves) == {1: 3, 2: 1}
+        assert evaluated == [1, 2, 1, 2, 1, 2]
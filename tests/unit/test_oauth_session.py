@@ -182,6 +182,8 @@ with patch.dict(sys.modules, module_patches):
     if project_root not in sys.path:
         sys.path.insert(0, project_root)
 
+    # Import afresh against the mocks even if an earlier test loaded the real module
+    sys.modules.pop('cps.oauth_bb', None)
     import cps.oauth_bb as oauth_bb
 
 # Keep oauth_bb in sys.modules so patch() can find it later
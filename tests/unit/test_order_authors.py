@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+# Calibre-Web Automated – fork of Calibre-Web
+# Copyright (C) 2018-2026 Calibre-Web contributors
+# Copyright (C) 2024-2026 Calibre-Web Automated contributors
+# SPDX-License-Identifier: GPL-3.0-or-later
+# See CONTRIBUTORS for full list of authors.
+
+from types import SimpleNamespace
+
+import pytest
+
+from cps import db
+
+PRATCHETT = SimpleNamespace(id=1, name="Terry Pratchett", sort="Pratchett, Terry")
+GAIMAN = SimpleNamespace(id=2, name="Neil Gaiman", sort="Gaiman, Neil")
+BAXTER = SimpleNamespace(id=3, name="Stephen Baxter", sort="Baxter, Stephen")
+
+
+class _Query:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def filter(self, *criteria):
+        return self
+
+    def order_by(self, *criteria):
+        return self
+
+    def __iter__(self):
+        return iter(self.rows)
+
+
+class _Session:
+    def __init__(self):
+        self.queries = 0
+
+    def query(self, *entities):
+        self.queries += 1
+        return _Query([PRATCHETT, GAIMAN, BAXTER])
+
+
+@pytest.fixture
+def calibre_db():
+    calibre = db.CalibreDB()
+    calibre.session = _Session()
+    return calibre
+
+
+@pytest.mark.unit
+class TestOrderAuthors:
+    def test_orders_by_author_sort(self, calibre_db):
+        book = SimpleNamespace(author_sort="Gaiman, Neil & Pratchett, Terry", authors=[PRATCHETT, GAIMAN])
+
+        assert calibre_db.order_authors([book]) == [GAIMAN, PRATCHETT]
+
+    def test_unknown_sort_keeps_remaining_authors(self, calibre_db):
+        book = SimpleNamespace(author_sort="Somebody Else", authors=[PRATCHETT])
+
+        assert calibre_db.order_authors([book]) == [PRATCHETT]
+
+    def test_whole_page_uses_one_query(self, calibre_db):
+        books = [SimpleNamespace(author_sort="Pratchett, Terry & Gaiman, Neil", authors=[GAIMAN, PRATCHETT]),
+                 SimpleNamespace(author_sort="Pratchett, Terry & Baxter, Stephen", authors=[BAXTER, PRATCHETT])]
+
+        calibre_db.order_authors(books, list_return=True)
+
+        assert calibre_db.session.queries == 1
+        assert books[0].ordered_authors == [PRATCHETT, GAIMAN]
+        assert books[1].ordered_authors == [PRATCHETT, BAXTER]
+
+
+@pytest.mark.unit
+class TestFirstAuthor:
+    ROWS = [(2, "Neil Gaiman", "Gaiman, Neil"), (1, "Terry Pratchett", "Pratchett, Terry")]
+
+    def test_matches_order_authors(self):
+        known = {"Pratchett, Terry", "Gaiman, Neil"}
+
+        assert db.CalibreDB.first_author("Pratchett, Terry & Gaiman, Neil", self.ROWS, known) == "Terry Pratchett"
+        assert db.CalibreDB.first_author(" & Gaiman, Neil", self.ROWS, known) == "Neil Gaiman"
+
+    def test_unknown_sort_falls_back_to_link_order(self):
+        assert db.CalibreDB.first_author("Somebody Else & Pratchett, Terry", self.ROWS, {"Pratchett, Terry"}) \
+            == "Neil Gaiman"
+        assert db.CalibreDB.first_author("Pratchett, Terry", [], set()) is None
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+# Calibre-Web Automated – fork of Calibre-Web
+# Copyright (C) 2018-2026 Calibre-Web contributors
+# Copyright (C) 2024-2026 Calibre-Web Automated contributors
+# SPDX-License-Identifier: GPL-3.0-or-later
+# See CONTRIBUTORS for full list of authors.
+
+import sqlite3
+import threading
+import time
+
+import pytest
+
+from cps import search_index
+
+
+@pytest.fixture
+def library(tmp_path):
+    metadata_db = tmp_path / "metadata.db"
+    con = sqlite3.connect(metadata_db)
+    con.executescript("""
+        CREATE TABLE library_id (id INTEGER PRIMARY KEY, uuid TEXT);
+        INSERT INTO library_id (uuid) VALUES ('lib-uuid');
+        CREATE TABLE books (id INTEGER PRIMARY KEY, title TEXT, sort TEXT, last_modified TIMESTAMP);
+        CREATE TABLE authors (id INTEGER PRIMARY KEY, name TEXT);
+        CREATE TABLE books_authors_link (id INTEGER PRIMARY KEY, book INTEGER, author INTEGER);
+        CREATE TABLE series (id INTEGER PRIMARY KEY, name TEXT);
+        CREATE TABLE books_series_link (id INTEGER PRIMARY KEY, book INTEGER, series INTEGER);
+        CREATE TABLE tags (id INTEGER PRIMARY KEY, name TEXT);
+        CREATE TABLE books_tags_link (id INTEGER PRIMARY KEY, book INTEGER, tag INTEGER);
+        CREATE TABLE publishers (id INTEGER PRIMARY KEY, name TEXT);
+        CREATE TABLE books_publishers_link (id INTEGER PRIMARY KEY, book INTEGER, publisher INTEGER);
+        CREATE TABLE comments (id INTEGER PRIMARY KEY, book INTEGER, text TEXT);
+        CREATE TABLE custom_columns (id INTEGER PRIMARY KEY, label TEXT, name TEXT, datatype TEXT, normalized BOOL);
+        INSERT INTO custom_columns VALUES (1, 'shelf', 'Shelf', 'text', 1);
+        CREATE TABLE custom_column_1 (id INTEGER PRIMARY KEY, value TEXT);
+        CREATE TABLE books_custom_column_1_link (id INTEGER PRIMARY KEY, book INTEGER, value INTEGER);
+
+        INSERT INTO books VALUES (1, 'Dune', 'Dune', '2026-01-01 00:00:00');
+        INSERT INTO books VALUES (2, 'Émile', 'Emile', '2026-01-01 00:00:00');
+        INSERT INTO books VALUES (3, 'Anthology', 'Anthology', '2026-01-01 00:00:00');
+        INSERT INTO authors VALUES (1, 'Frank Herbert'), (2, 'Jean-Jacques Rousseau'), (3, 'Frank Smith'),
+                                   (4, 'Jane Herbert');
+        INSERT INTO books_authors_link (book, author) VALUES (1, 1), (2, 2), (3, 3), (3, 4);
+        INSERT INTO tags VALUES (1, 'Science Fiction');
+        INSERT INTO books_tags_link (book, tag) VALUES (1, 1);
+        INSERT INTO comments (book, text) VALUES (2, 'On education');
+        INSERT INTO custom_column_1 VALUES (1, 'Living room');
+        INSERT INTO books_custom_column_1_link (book, value) VALUES (2, 1);
+    """)
+    con.commit()
+    con.close()
+    assert search_index.configure(str(metadata_db), str(tmp_path / "search_index.db"))
+    assert search_index.update()
+    return metadata_db
+
+
+def _hits(match, table="books_fts"):
+    con = search_index._index.con
+    return sorted(row[0] for row in con.execute("SELECT rowid FROM {0} WHERE {0} MATCH ?".format(table), (match,)))
+
+
+def _author_hits(term):
+    return sorted({rowid >> search_index.CC_SHIFT
+                   for rowid in _hits(search_index.match_expressions(term)[1], "authors_fts")})
+
+
+def _change(library, *statements):
+    con = sqlite3.connect(library)
+    for statement in statements:
+        con.execute(statement)
+    con.commit()
+    con.close()
+
+
+@pytest.mark.unit
+class TestMatchExpressions:
+    def test_short_terms_are_left_to_ilike(self):
+        assert search_index.match_expressions(" du ") is None
+
+    def test_splits_author_words(self):
+        fields, authors, short_words = search_index.match_expressions('Le Guin "x"')
+        assert fields == '{title series tags publishers comments} : "le guin ""x"""'
+        assert authors == '"guin" AND """x"""'
+        assert short_words == ["le"]
+
+
+@pytest.mark.unit
+class TestSearchIndex:
+    def test_substring_and_unidecoded_matches(self, library):
+        assert _hits(search_index.match_expressions("fiction")[0]) == [1]
+        assert _hits(search_index.match_expressions("emil")[0]) == [2]
+        assert _hits(search_index.match_expressions("education")[0]) == [2]
+        assert _author_hits("herbert frank") == [1]
+        assert _hits(search_index.custom_match("living"), "custom_fts") == [(2 << search_index.CC_SHIFT) | 1]
+
+    def test_author_words_must_match_one_author(self, library):
+        assert _author_hits("frank") == [1, 3]
+        assert _author_hits("herbert") == [1, 3]
+        # Book 3 has a Frank and a Herbert, but no Frank Herbert
+        assert _author_hits("frank herbert") == [1]
+
+    def test_update_follows_last_modified_and_deletions(self, library):
+        _change(library,
+                "UPDATE books SET title = 'Dune Messiah', last_modified = '2026-02-01 00:00:00' WHERE id = 1",
+                "DELETE FROM books WHERE id = 2")
+
+        assert search_index.update()
+
+        assert _hits(search_index.match_expressions("messiah")[0]) == [1]
+        assert _hits(search_index.match_expressions("emil")[0]) == []
+        assert _hits(search_index.custom_match("living"), "custom_fts") == []
+
+    def test_update_follows_renames(self, library):
+        # Renames don't touch books.last_modified
+        _change(library,
+                "UPDATE tags SET name = 'Space Opera' WHERE id = 1",
+                "UPDATE authors SET name = 'Brian Herbert' WHERE id = 1",
+                "UPDATE custom_column_1 SET value = 'Attic' WHERE id = 1")
+
+        assert search_index.update()
+
+        assert _hits(search_index.match_expressions("fiction")[0]) == []
+        assert _hits(search_index.match_expressions("opera")[0]) == [1]
+        assert _author_hits("frank herbert") == []
+        assert _author_hits("brian herbert") == [1]
+        assert _hits(search_index.custom_match("attic"), "custom_fts") == [(2 << search_index.CC_SHIFT) | 1]
+
+    def test_sync_updates_in_the_background(self, library, monkeypatch):
+        search_index._index.ready = True
+        search_index._index.data_version = search_index._index.con.execute(
+            "PRAGMA calibre.data_version").fetchone()[0]
+        assert search_index.sync()
+
+        update = search_index.update
+        threads = []
+        release = threading.Event()
+
+        def background_update(generation=None):
+            threads.append(threading.current_thread())
+            release.wait(5)
+            return update(generation)
+
+        monkeypatch.setattr(search_index, "update", background_update)
+        _change(library, "UPDATE books SET title = 'Dune Messiah', last_modified = '2026-02-01 00:00:00' WHERE id = 1")
+
+        # Searches keep using the last built index while the update runs
+        assert search_index.sync()
+        assert search_index._index.building
+        assert search_index.sync()
+        assert _hits(search_index.match_expressions("dune")[0]) == [1]
+        assert _hits(search_index.match_expressions("messiah")[0]) == []
+        release.set()
+        deadline = time.monotonic() + 5
+        while search_index._index.building and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        assert search_index.sync()
+        assert threads and threading.current_thread() not in threads
+        assert _hits(search_index.match_expressions("messiah")[0]) == [1]
+
+    def test_searches_use_ilike_until_the_first_build_is_done(self, library, monkeypatch):
+        search_index._index.ready = False
+        release = threading.Event()
+        monkeypatch.setattr(search_index, "update", lambda generation=None: release.wait(5))
+
+        assert not search_index.sync()
+        assert not search_index.sync()
+        release.set()
+        deadline = time.monotonic() + 5
+        while search_index._index.building and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        assert search_index._index.ready
+        assert search_index.sync()
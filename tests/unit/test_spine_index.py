@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+# Calibre-Web Automated – fork of Calibre-Web
+# Copyright (C) 2018-2026 Calibre-Web contributors
+# Copyright (C) 2024-2026 Calibre-Web Automated contributors
+# SPDX-License-Identifier: GPL-3.0-or-later
+# See CONTRIBUTORS for full list of authors.
+
+import zipfile
+
+import pytest
+
+from cps.progress_syncing import spine_index
+
+CONTAINER = """<?xml version="1.0"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+  <rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/></rootfiles>
+</container>"""
+
+OPF = """<?xml version="1.0"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="2.0">
+  <manifest>
+    <item id="c1" href="Text/one.xhtml" media-type="application/xhtml+xml"/>
+    <item id="c2" href="Text/two.xhtml" media-type="application/xhtml+xml"/>
+  </manifest>
+  <spine><itemref idref="c2"/><itemref idref="c1"/></spine>
+</package>"""
+
+
+class _FakeCWADB:
+    def __init__(self):
+        self.rows = {}
+
+    def get_epub_spine_index(self, book_id, book_format):
+        return self.rows.get((book_id, book_format.upper()))
+
+    def set_epub_spine_index(self, book_id, book_format, file_mtime, file_size, spine, chapter_lengths):
+        self.rows[(book_id, book_format.upper())] = {'file_mtime': file_mtime, 'file_size': file_size,
+                                                     'spine': spine, 'chapter_lengths': chapter_lengths}
+        return True
+
+
+@pytest.fixture
+def epub(tmp_path):
+    path = tmp_path / "book.epub"
+    with zipfile.ZipFile(path, "w") as zf:
+        zf.writestr("META-INF/container.xml", CONTAINER)
+        zf.writestr("OEBPS/content.opf", OPF)
+        zf.writestr("OEBPS/Text/one.xhtml", "<html><body><p>abcd</p></body></html>")
+        zf.writestr("OEBPS/Text/two.xhtml", "<html><body><p>ab</p></body></html>")
+    spine_index._memory_cache.clear()
+    return str(path)
+
+
+@pytest.mark.unit
+class TestSpineIndex:
+    def test_build_follows_spine_order(self, epub):
+        assert spine_index.build_spine_index(epub) == (["OEBPS/Text/two.xhtml", "OEBPS/Text/one.xhtml"], [2, 4])
+
+    def test_stored_index_is_reused_until_file_changes(self, epub, monkeypatch):
+        cwa_db = _FakeCWADB()
+        expected = spine_index.load_spine_index(7, "epub", epub, cwa_db=cwa_db)
+        assert cwa_db.get_epub_spine_index(7, "EPUB")["chapter_lengths"] == [2, 4]
+
+        spine_index._memory_cache.clear()
+        monkeypatch.setattr(spine_index, "build_spine_index", lambda path: pytest.fail("book parsed again"))
+        assert spine_index.load_spine_index(7, "epub", epub, cwa_db=cwa_db) == expected
+
+        with zipfile.ZipFile(epub, "a") as zf:
+            zf.writestr("OEBPS/extra.css", "p {}")
+        monkeypatch.setattr(spine_index, "build_spine_index", lambda path: (["x"], [1]))
+        assert spine_index.load_spine_index(7, "epub", epub, cwa_db=cwa_db) == (["x"], [1])
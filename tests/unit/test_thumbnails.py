@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+# Calibre-Web Automated – fork of Calibre-Web
+# Copyright (C) 2018-2026 Calibre-Web contributors
+# Copyright (C) 2024-2026 Calibre-Web Automated contributors
+# SPDX-License-Identifier: GPL-3.0-or-later
+# See CONTRIBUTORS for full list of authors.
+
+"""Unit tests for the batched cover thumbnail generator"""
+
+import os
+import threading
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+
+from cps import constants, fs, ub
+from cps.services import worker
+from cps.tasks import thumbnail
+
+RESOLUTIONS = (constants.COVER_THUMBNAIL_SMALL, constants.COVER_THUMBNAIL_MEDIUM, constants.COVER_THUMBNAIL_LARGE)
+
+
+class _FakeImage:
+    """Stands in for wand.image.Image; counts decodes and writes the format name as file content"""
+    decoded = []
+
+    def __init__(self, filename=None, blob=None, _source=None):
+        if _source is None:
+            _source = filename if filename is not None else blob
+            _FakeImage.decoded.append(_source)
+        self.source = _source
+        self.width, self.height = 600, 900
+        self.format = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def clone(self):
+        return _FakeImage(_source=self.source)
+
+    def resize(self, width, height, filter=None):
+        self.width, self.height = width, height
+
+    def save(self, file):
+        file.write(self.format.encode())
+
+
+@pytest.fixture
+def fake_image(monkeypatch):
+    _FakeImage.decoded = []
+    monkeypatch.setattr(thumbnail, "Image", _FakeImage, raising=False)
+    monkeypatch.setattr(thumbnail, "use_IM", True)
+    return _FakeImage
+
+
+@pytest.fixture
+def app_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(ub, "app_DB_path", str(tmp_path / "app.db"))
+    monkeypatch.setattr(fs, "CONFIG_DIR", str(tmp_path / "config"))
+    session = ub.get_new_session_instance()
+    ub.Thumbnail.__table__.create(bind=session.get_bind(), checkfirst=True)
+    yield session
+    session.remove()
+
+
+def _books(count):
+    return [SimpleNamespace(id=book_id, path="Author/Book ({})".format(book_id),
+                            last_modified=datetime(2026, 1, 1)) for book_id in range(1, count + 1)]
+
+
+def _task(monkeypatch, books):
+    monkeypatch.setattr(thumbnail.TaskGenerateCoverThumbnails, "get_books_with_covers",
+                        staticmethod(lambda book_id=-1: books))
+    task = thumbnail.TaskGenerateCoverThumbnails()
+    monkeypatch.setattr(task, "get_book_cover_source", lambda book: "/covers/{}.jpg".format(book.id))
+    return task
+
+
+def _rows(session, book_id=None):
+    query = session.query(ub.Thumbnail).filter(ub.Thumbnail.type == constants.THUMBNAIL_TYPE_COVER)
+    if book_id is not None:
+        query = query.filter(ub.Thumbnail.entity_id == book_id)
+    return query.all()
+
+
+@pytest.mark.unit
+class TestRenderCoverThumbnails:
+    def test_decodes_once_for_all_resolutions_and_formats(self, fake_image, tmp_path):
+        targets = [(resolution, fmt, str(tmp_path / "{}.{}".format(resolution, fmt)))
+                   for resolution in RESOLUTIONS for fmt in thumbnail.THUMBNAIL_FORMATS]
+
+        errors = thumbnail.render_cover_thumbnails("/covers/1.jpg", targets)
+
+        assert errors == {}
+        assert fake_image.decoded == ["/covers/1.jpg"]
+        for __, fmt, path in targets:
+            with open(path, 'rb') as f:
+                assert f.read() == fmt.encode()
+
+    def test_files_are_replaced_through_a_temp_file(self, fake_image, tmp_path, monkeypatch):
+        path = str(tmp_path / "book_1_r1.webp")
+        with open(path, 'wb') as f:
+            f.write(b"old")
+        replaced = []
+        real_replace = os.replace
+
+        def replace(src, dst):
+            # The served file keeps its old content until the new one is complete
+            with open(dst, 'rb') as f:
+                assert f.read() == b"old"
+            replaced.append((src, dst))
+            real_replace(src, dst)
+
+        monkeypatch.setattr(thumbnail.os, "replace", replace)
+
+        assert thumbnail.render_cover_thumbnails("/covers/1.jpg", [(1, 'webp', path)]) == {}
+        assert replaced == [(path + '.tmp', path)]
+        assert not os.path.exists(path + '.tmp')
+
+    def test_failed_write_keeps_the_old_file(self, fake_image, tmp_path, monkeypatch):
+        path = str(tmp_path / "book_1_r1.webp")
+        with open(path, 'wb') as f:
+            f.write(b"old")
+
+        def save(self, file):
+            file.write(b"partial")
+            raise IOError("disk full")
+
+        monkeypatch.setattr(_FakeImage, "save", save)
+
+        errors = thumbnail.render_cover_thumbnails("/covers/1.jpg", [(1, 'webp', path)])
+
+        assert errors == {(1, 'webp'): "disk full"}
+        with open(path, 'rb') as f:
+            assert f.read() == b"old"
+        assert not os.path.exists(path + '.tmp')
+
+
+@pytest.mark.unit
+class TestGenerateCoverThumbnails:
+    def test_rows_are_committed_in_batches(self, fake_image, app_db, monkeypatch):
+        monkeypatch.setattr(thumbnail, "THUMBNAIL_WORKERS", 1)
+        task = _task(monkeypatch, _books(120))
+        committed = []
+        real_commit = task.commit_thumbnails
+
+        def commit_thumbnails():
+            real_commit()
+            committed.append(len({row.entity_id for row in _rows(app_db)}))
+            app_db.remove()
+
+        monkeypatch.setattr(task, "commit_thumbnails", commit_thumbnails)
+
+        task.run(None)
+
+        # One pool thread finishes at most two books per round, so a batch is 50 or 51 books
+        assert len(committed) == 3
+        assert 50 <= committed[0] <= 51
+        assert 100 <= committed[1] <= 102
+        assert committed[2] == 120
+        assert len(fake_image.decoded) == 120
+        assert len(_rows(app_db)) == 120 * len(RESOLUTIONS) * len(thumbnail.THUMBNAIL_FORMATS)
+        assert task.stat == worker.STAT_FINISH_SUCCESS
+
+    def test_cancel_stops_submissions_and_keeps_finished_books(self, fake_image, app_db, monkeypatch):
+        monkeypatch.setattr(thumbnail, "THUMBNAIL_WORKERS", 1)
+        task = _task(monkeypatch, _books(10))
+        first_done = threading.Event()
+        real_init = _FakeImage.__init__
+
+        def init(self, filename=None, blob=None, _source=None):
+            real_init(self, filename, blob, _source)
+            if filename == "/covers/1.jpg":
+                # Cancelled from /tasks while the first cover renders
+                task.stat = worker.STAT_CANCELLED
+                first_done.set()
+
+        monkeypatch.setattr(_FakeImage, "__init__", init)
+
+        task.run(None)
+
+        assert first_done.is_set()
+        # Only the books submitted before the cancel were rendered, at most two with one thread
+        assert set(fake_image.decoded) <= {"/covers/1.jpg", "/covers/2.jpg"}
+        assert len(_rows(app_db, 1)) == len(RESOLUTIONS) * len(thumbnail.THUMBNAIL_FORMATS)
+        assert {row.entity_id for row in _rows(app_db)} <= {1, 2}
+        assert task.stat == worker.STAT_CANCELLED
+
+    def test_existing_row_with_missing_file_is_refreshed(self, fake_image, app_db, monkeypatch):
+        generated_at = datetime(2026, 1, 2)
+        existing = ub.Thumbnail(type=constants.THUMBNAIL_TYPE_COVER, entity_id=1, format='webp',
+                                resolution=constants.COVER_THUMBNAIL_SMALL, generated_at=generated_at,
+                                filename=ub.thumbnail_filename(constants.THUMBNAIL_TYPE_COVER, 1,
+                                                               constants.COVER_THUMBNAIL_SMALL, 'webp'))
+        app_db.add(existing)
+        app_db.commit()
+        existing_id = existing.id
+        app_db.remove()
+        task = _task(monkeypatch, _books(1))
+
+        task.run(None)
+
+        rows = _rows(app_db, 1)
+        assert len(rows) == len(RESOLUTIONS) * len(thumbnail.THUMBNAIL_FORMATS)
+        small_webp = [row for row in rows
+                      if row.resolution == constants.COVER_THUMBNAIL_SMALL and row.format == 'webp']
+        assert [row.id for row in small_webp] == [existing_id]
+        assert small_webp[0].generated_at > generated_at
+        assert fs.FileSystem().get_cache_file_exists(small_webp[0].filename, constants.CACHE_TYPE_THUMBNAILS)
+
+    def test_up_to_date_thumbnails_are_not_rendered_again(self, fake_image, app_db, monkeypatch):
+        task = _task(monkeypatch, _books(1))
+        task.run(None)
+        app_db.remove()
+        fake_image.decoded.clear()
+
+        again = _task(monkeypatch, _books(1))
+        again.run(None)
+
+        assert fake_image.decoded == []
+        assert len(_rows(app_db, 1)) == len(RESOLUTIONS) * len(thumbnail.THUMBNAIL_FORMATS)
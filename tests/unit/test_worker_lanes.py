@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+# Calibre-Web Automated – fork of Calibre-Web
+# Copyright (C) 2018-2026 Calibre-Web contributors
+# Copyright (C) 2024-2026 Calibre-Web Automated contributors
+# SPDX-License-Identifier: GPL-3.0-or-later
+# See CONTRIBUTORS for full list of authors.
+
+import threading
+import time
+
+import pytest
+
+from cps import helper
+from cps.services import worker
+from cps.tasks.database import TaskReconnectDatabase
+from cps.tasks.thumbnail import TaskClearCoverThumbnailCache, TaskGenerateSeriesThumbnails
+
+
+class _Task(worker.CalibreTask):
+    def __init__(self, lane, gate=None, exclusive=False):
+        super().__init__("test")
+        self.lane = lane
+        self.gate = gate
+        self.exclusive = exclusive
+        self.started = threading.Event()
+        self.done = threading.Event()
+
+    def run(self, worker_thread):
+        self.started.set()
+        if self.gate is not None:
+            self.gate.wait(5)
+        self._handleSuccess()
+        self.done.set()
+
+    @property
+    def name(self):
+        return "Test"
+
+    @property
+    def is_cancellable(self):
+        return True
+
+
+@pytest.fixture
+def worker_thread(monkeypatch):
+    instance = worker.WorkerThread(lane_limits={worker.LANE_IO: 1, worker.LANE_CPU: 1, worker.LANE_THUMBNAIL: 1,
+                                                worker.LANE_MAIL: 1, worker.LANE_MAINTENANCE: 1})
+    monkeypatch.setattr(worker.WorkerThread, "_instance", instance)
+    return instance
+
+
+@pytest.mark.unit
+class TestWorkerLanes:
+    def test_busy_lane_does_not_block_others(self, worker_thread):
+        gate = threading.Event()
+        long_task = _Task(worker.LANE_CPU, gate)
+        queued_task = _Task(worker.LANE_CPU)
+        mail_task = _Task(worker.LANE_MAIL)
+        try:
+            worker.WorkerThread.add("admin", long_task)
+            worker.WorkerThread.add("admin", queued_task)
+            worker.WorkerThread.add("admin", mail_task)
+
+            assert mail_task.done.wait(5)
+            assert not queued_task.done.is_set()
+            stats = {lane['lane']: lane for lane in worker_thread.lane_stats()}
+            assert stats[worker.LANE_CPU]['running'] == 1
+            assert stats[worker.LANE_CPU]['queued'] == 1
+            assert [item.task for item in worker_thread.tasks] == [long_task, queued_task, mail_task]
+        finally:
+            gate.set()
+        assert queued_task.done.wait(5)
+
+    def test_cancelled_waiting_task_is_skipped(self, worker_thread):
+        gate = threading.Event()
+        blocker = _Task(worker.LANE_MAINTENANCE, gate)
+        cancelled = _Task(worker.LANE_MAINTENANCE)
+        try:
+            worker.WorkerThread.add(None, blocker)
+            worker.WorkerThread.add(None, cancelled)
+            worker_thread.end_task(cancelled.id)
+        finally:
+            gate.set()
+
+        assert blocker.done.wait(5)
+        worker_thread.lanes[worker.LANE_MAINTENANCE].queue.join()
+        assert cancelled.stat == worker.STAT_CANCELLED
+        assert not cancelled.done.is_set()
+
+    def test_conversions_do_not_wait_for_thumbnails(self, worker_thread):
+        assert worker_thread.lane_for(helper.TaskConvert).name == worker.LANE_CPU
+        assert worker_thread.lane_for(helper.TaskGenerateCoverThumbnails).name == worker.LANE_THUMBNAIL
+        assert worker_thread.lane_for(TaskGenerateSeriesThumbnails).name == worker.LANE_THUMBNAIL
+
+    def test_thumbnail_cache_is_cleared_in_order_with_generation(self):
+        # Clearing runs on the generation lane, which runs one task at a time
+        assert TaskClearCoverThumbnailCache.lane == worker.LANE_THUMBNAIL
+        assert worker.LANE_LIMITS[worker.LANE_THUMBNAIL] == 1
+
+    def test_exclusive_task_runs_alone(self, worker_thread):
+        assert TaskReconnectDatabase.exclusive
+
+        gate = threading.Event()
+        running = _Task(worker.LANE_IO, gate)
+        exclusive = _Task(worker.LANE_MAINTENANCE, exclusive=True)
+        later = _Task(worker.LANE_MAIL)
+        try:
+            worker.WorkerThread.add(None, running)
+            assert running.started.wait(5)
+            worker.WorkerThread.add(None, exclusive)
+            worker.WorkerThread.add(None, later)
+
+            # The exclusive task waits for the running one and holds back tasks queued after it
+            assert not exclusive.started.wait(0.5)
+            assert not later.started.is_set()
+        finally:
+            gate.set()
+        assert exclusive.done.wait(5)
+        assert later.done.wait(5)
+
+    def test_exclusive_task_holds_back_other_lanes_only_for_a_while(self):
+        gate = worker.TaskGate(priority_seconds=0.3)
+        started = threading.Event()
+
+        def other_lane():
+            with gate.hold():
+                started.set()
+
+        with gate.hold():
+            # A long task is running when an exclusive task gets queued
+            gate.announce("exclusive")
+            thread = threading.Thread(target=other_lane, daemon=True)
+            begin = time.monotonic()
+            thread.start()
+            assert started.wait(5)
+            assert time.monotonic() - begin >= 0.25
+        thread.join(5)
+
+    def test_withdrawing_an_exclusive_task_keeps_the_others_announced(self):
+        gate = worker.TaskGate(priority_seconds=60)
+        gate.announce("first")
+        time.sleep(0.01)
+        gate.announce("second")
+        first_announced = gate.announced["first"]
+
+        # Cancelling the newer task must not drop the older task's priority window
+        gate.withdraw("second")
+        assert gate.announced == {"first": first_announced}
+
+        gate.announce("third")
+        with gate.hold(exclusive=True, token="third"):
+            assert list(gate.announced) == ["first"]
+        assert gate._priority_left() > 0
+
+        gate.withdraw("first")
+        assert gate._priority_left() == 0
+
+    def test_cancelled_exclusive_task_stops_holding_back(self, worker_thread):
+        gate = threading.Event()
+        blocker = _Task(worker.LANE_MAINTENANCE, gate)
+        exclusive = _Task(worker.LANE_MAINTENANCE, exclusive=True)
+        later = _Task(worker.LANE_MAIL)
+        try:
+            worker.WorkerThread.add(None, blocker)
+            assert blocker.started.wait(5)
+            worker.WorkerThread.add(None, exclusive)
+            worker_thread.end_task(exclusive.id)
+        finally:
+            gate.set()
+        worker.WorkerThread.add(None, later)
+        assert later.done.wait(5)
+        assert exclusive.stat == worker.STAT_CANCELLED